@@ -0,0 +1,350 @@
+import asyncio
+import codecs
+import hashlib
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import brotli
+import zstandard
+from mitmproxy.net import encoding
+from mitmproxy.net.http.headers import infer_content_encoding, parse_content_type
+
+# 主体存储编码方式
+CODEC_RAW = "raw"
+CODEC_ZLIB = "zlib"
+# 按前缀解码时每块输出的上限
+DECODE_CHUNK = 64 * 1024
+# brotli 无法限制单次输出，只能小块输入
+BROTLI_STEP = 1024
+
+
+def to_bytes(body):
+    """Normalize a captured body (str, bytes or None) to bytes."""
+    if body is None:
+        return b""
+    if isinstance(body, str):
+        return body.encode("utf-8")
+    return bytes(body)
+
+
+def hash_body(data):
+    """Content address of a body: 128-bit BLAKE2b hex digest."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def pack_body(data, min_size=1024, level=6):
+    """Compress a body when it is large enough and compression actually helps."""
+    if len(data) >= min_size:
+        packed = zlib.compress(data, level)
+        if len(packed) < len(data):
+            return CODEC_ZLIB, packed
+    return CODEC_RAW, data
+
+
+def unpack_body(codec, payload):
+    payload = bytes(payload or b"")
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(payload)
+    return payload
+
+
+class BodyBatch:
+    """Deduplicated bodies of one write batch with per-hash reference counts."""
+
+    def __init__(self, min_size=1024, level=6):
+        self.min_size = min_size
+        self.level = level
+        # hash -> [size, codec, payload, refs]
+        self.blobs = {}
+
+    def add(self, body):
+        """Register a body and return ``(hash, size)``; empty bodies map to ``(None, 0)``."""
+        data = to_bytes(body)
+        if not data:
+            return None, 0
+        digest = hash_body(data)
+        blob = self.blobs.get(digest)
+        if blob is None:
+            codec, payload = pack_body(data, self.min_size, self.level)
+            self.blobs[digest] = [len(data), codec, payload, 1]
+        else:
+            blob[3] += 1
+        return digest, len(data)
+
+    def rows(self):
+        """Rows of (hash, size, codec, payload, refs) for the bodies upsert."""
+        return [
+            (digest, size, codec, payload, refs)
+            for digest, (size, codec, payload, refs) in self.blobs.items()
+        ]
+
+
+# 按文本处理的非 text/* 类型
+TEXT_SUBTYPE_HINTS = (
+    "json",
+    "xml",
+    "javascript",
+    "ecmascript",
+    "x-www-form-urlencoded",
+    "graphql",
+    "yaml",
+    "csv",
+)
+
+# 旧版本存储的是已解码的 UTF-8 文本
+LEGACY_CONTENT_TYPE = "text/plain; charset=utf-8"
+
+
+def body_key(row, side):
+    """How one side of a stored row is decoded: ``(hash, content_encoding, content_type)``."""
+    content_encoding = row.get(f"{side}_content_encoding")
+    if content_encoding is None:
+        # 旧版本行保存的是已解码的 UTF-8 文本
+        return row.get(f"{side}_body_hash"), "", LEGACY_CONTENT_TYPE
+    return (
+        row.get(f"{side}_body_hash"),
+        content_encoding,
+        row.get(f"{side}_content_type") or "",
+    )
+
+
+def is_text_type(content_type):
+    parsed = parse_content_type(content_type or "")
+    if not parsed:
+        return False
+    major, subtype, _ = parsed
+    return major == "text" or any(hint in subtype for hint in TEXT_SUBTYPE_HINTS)
+
+
+def undo_content_encoding(raw, content_encoding=""):
+    """Undo Content-Encoding; returns ``(data, error)`` and leaves ``raw`` as is on failure."""
+    if content_encoding and content_encoding.lower() not in ("identity", "none"):
+        try:
+            return encoding.decode(raw, content_encoding.lower()), None
+        except Exception as e:
+            return raw, f"Failed to decode {content_encoding}: {e}"
+    return raw, None
+
+
+def _decode_text(data, charset, errors="strict", final=True):
+    return codecs.getincrementaldecoder(charset)(errors).decode(data, final)
+
+
+def body_text(data, content_type="", final=True):
+    """Charset-decode a body if it is text; None for binary bodies.
+
+    ``final=False`` marks ``data`` as a prefix of a longer body: a character
+    cut off at the end is dropped instead of being treated as an error.
+    """
+    if is_text_type(content_type):
+        charset = infer_content_encoding(content_type, data)
+        try:
+            return _decode_text(data, charset, final=final)
+        except (LookupError, UnicodeDecodeError):
+            return _decode_text(data, "utf-8", "replace", final)
+    if not content_type:
+        # 未声明类型时，能按 UTF-8 解码的视为文本
+        try:
+            return _decode_text(data, "utf-8", final=final)
+        except UnicodeDecodeError:
+            return None
+    return None
+
+
+def decode_body(raw, content_encoding="", content_type=""):
+    """Undo Content-Encoding and charset-decode a raw wire body.
+
+    Returns ``{"body", "binary", "size", "raw_size"}`` (plus ``"error"`` when the
+    content-encoding could not be undone). Binary bodies come back with an
+    empty ``body`` instead of mojibake.
+    """
+    raw = bytes(raw or b"")
+    result = {"raw_size": len(raw)}
+    data, error = undo_content_encoding(raw, content_encoding)
+    if error:
+        result["error"] = error
+    result["size"] = len(data)
+
+    text = body_text(data, content_type)
+    result["binary"] = text is None and bool(data)
+    result["body"] = text or ""
+    return result
+
+
+def decode_stored(codec, payload, content_encoding, content_type):
+    """Decompress a stored blob and decode it for display."""
+    return decode_body(unpack_body(codec, payload), content_encoding, content_type)
+
+
+def iter_unpacked(codec, payload, chunk_size=DECODE_CHUNK):
+    """Yield a stored body in pieces of at most ``chunk_size`` bytes."""
+    payload = bytes(payload or b"")
+    if codec != CODEC_ZLIB:
+        for start in range(0, len(payload), chunk_size):
+            yield payload[start : start + chunk_size]
+        return
+    decompressor = zlib.decompressobj()
+    data = decompressor.decompress(payload, chunk_size)
+    while data:
+        yield data
+        data = decompressor.decompress(decompressor.unconsumed_tail, chunk_size)
+
+
+class _ChunkReader:
+    """File-like ``read`` over an iterator of byte chunks (for zstandard)."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = bytearray()
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+def _deflate_wbits(first):
+    # deflate 应带 zlib 头，但不少服务器发送的是裸 deflate 流 (与 mitmproxy 相同的兼容处理)
+    if len(first) >= 2 and first[0] & 0x0F == 8 and int.from_bytes(first[:2], "big") % 31 == 0:
+        return zlib.MAX_WBITS
+    return -zlib.MAX_WBITS
+
+
+def iter_decoded(chunks, content_encoding="", chunk_size=DECODE_CHUNK):
+    """Undo Content-Encoding on a chunked body, yielding at most ``chunk_size`` bytes at a time.
+
+    Output is produced only as it is consumed, so a caller that stops early
+    never inflates the rest of the body. Raises on a broken or unknown encoding.
+    """
+    content_encoding = (content_encoding or "").lower()
+    if content_encoding in ("", "identity", "none"):
+        yield from chunks
+    elif content_encoding in ("gzip", "deflate", "deflateraw"):
+        decompressor = None
+        for chunk in chunks:
+            if decompressor is None:
+                if content_encoding == "gzip":
+                    wbits = 16 + zlib.MAX_WBITS
+                elif content_encoding == "deflate":
+                    wbits = _deflate_wbits(chunk)
+                else:
+                    wbits = -zlib.MAX_WBITS
+                decompressor = zlib.decompressobj(wbits)
+            data = decompressor.decompress(chunk, chunk_size)
+            while data:
+                yield data
+                data = decompressor.decompress(decompressor.unconsumed_tail, chunk_size)
+    elif content_encoding == "zstd":
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            _ChunkReader(chunks), read_across_frames=True
+        )
+        data = reader.read(chunk_size)
+        while data:
+            yield data
+            data = reader.read(chunk_size)
+    elif content_encoding == "br":
+        decompressor = brotli.Decompressor()
+        for chunk in chunks:
+            for start in range(0, len(chunk), BROTLI_STEP):
+                data = decompressor.process(chunk[start : start + BROTLI_STEP])
+                if data:
+                    yield data
+    else:
+        raise ValueError(f"Unsupported content encoding: {content_encoding}")
+
+
+def _take(chunks, max_bytes):
+    out = bytearray()
+    for chunk in chunks:
+        out += chunk
+        if len(out) >= max_bytes:
+            return bytes(out[:max_bytes]), True
+    return bytes(out), False
+
+
+def read_prefix(codec, payload, content_encoding, max_bytes):
+    """First ``max_bytes`` of a body with the store codec and Content-Encoding undone.
+
+    Both layers are decompressed in bounded chunks and decoding stops at
+    ``max_bytes``. Returns ``(data, truncated)``; like ``decode_body``, a body
+    whose encoding cannot be undone comes back raw.
+    """
+    chunk_size = max(1, min(DECODE_CHUNK, max_bytes))
+    try:
+        return _take(
+            iter_decoded(iter_unpacked(codec, payload, chunk_size), content_encoding, chunk_size),
+            max_bytes,
+        )
+    except (zlib.error, brotli.error, zstandard.ZstdError, ValueError):
+        return _take(iter_unpacked(codec, payload, chunk_size), max_bytes)
+
+
+class BodyDecoder:
+    """Decodes bodies on demand in a thread pool and keeps results in an LRU cache.
+
+    Keys are ``(hash, content_encoding, content_type)``; the cache is bounded
+    both by entry count and by the total size of the decoded text.
+    """
+
+    def __init__(self, max_workers=2, max_entries=256, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="body-decode"
+        )
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self._cache
+
+    def get(self, key):
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        self._cache.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, value):
+        cost = len(value.get("body") or "")
+        if cost > self.max_bytes:
+            return
+        old = self._cache.pop(key, None)
+        if old is not None:
+            self._cached_bytes -= len(old.get("body") or "")
+        self._cache[key] = value
+        self._cached_bytes += cost
+        while self._cache and (
+            len(self._cache) > self.max_entries or self._cached_bytes > self.max_bytes
+        ):
+            _, evicted = self._cache.popitem(last=False)
+            self._cached_bytes -= len(evicted.get("body") or "")
+
+    async def run(self, func, *args):
+        """Run a decode job on the decoder's thread pool."""
+        self.misses += 1
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def clear(self):
+        self._cache.clear()
+        self._cached_bytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._cache),
+            "bytes": self._cached_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,458 @@
+import asyncio
+import json
+import logging
+import re
+import time
+from collections import deque
+from itertools import count
+
+from logging_config import config
+from metrics import histogram
+
+logger = logging.getLogger("proxy_insight")
+
+# 实时推送默认只包含列表展示所需的摘要字段
+SUMMARY_FIELDS = (
+    "id",
+    "method",
+    "url",
+    "host",
+    "status",
+    "status_code",
+    "reason",
+    "time",
+    "latency_ms",
+    "timestamp",
+    "captured_at",
+)
+
+# /metrics: 事件从入队到随帧发出的等待时间 (每帧按最早的事件记录一次)
+WS_DELIVERY_LAG_SECONDS = histogram(
+    "proxy_insight_ws_delivery_lag_seconds",
+    "Time the oldest event of a WebSocket frame waited in its client's queue",
+)
+
+DETAIL_SUMMARY = "summary"
+DETAIL_FULL = "full"
+
+# url_regex 由客户端提供并在事件循环上逐条匹配：限制模式长度与被匹配的 URL 长度，
+# 并拒绝可能灾难性回溯的写法
+MAX_URL_REGEX_CHARS = 200
+MAX_MATCHED_URL_CHARS = 2048
+# {m}, {m,n}, {,n}, {m,}: 其余写法的 { 是字面字符
+_BRACE_QUANTIFIER = re.compile(r"\{(\d*)(?:(,)(\d*))?\}")
+# 全局标志 (?i) 或带标志的非捕获分组 (?i:...)
+_FLAGS_GROUP = re.compile(r"\?[aiLmsux-]*([:)])")
+# 单个字符的分支 (a|b|\d) 等价于字符类，不会回溯
+_SINGLE_CHAR = re.compile(r"[^\\()\[\]{}|.^$*+?]|\\[^0-9A-Za-z]|\\[dswDSW]|\[(?!\^)(?:\\.|[^\]\\])+\]")
+
+
+def _group_prefix_end(pattern, i):
+    """Index after the ``?...`` prefix of a group opened just before ``i``.
+
+    Returns None for inline flags ``(?i)``, which open no group.
+    """
+    if not pattern.startswith("?", i):
+        return i
+    if pattern.startswith("?P<", i):
+        return pattern.index(">", i) + 1
+    if pattern.startswith(("?<=", "?<!"), i):
+        return i + 3
+    if pattern.startswith(("?:", "?=", "?!", "?>"), i):
+        return i + 2
+    flags = _FLAGS_GROUP.match(pattern, i)
+    return flags.end() if flags.group(1) == ":" else None
+
+
+def _backtracking_risk(pattern):
+    """Why a (valid) pattern could backtrack catastrophically, or None.
+
+    A small scan over the pattern text rather than the private ``re``
+    parser: rejects quantifiers nested in a repeated group (``(a+)+``),
+    alternation in a repeated group (``(a|ab)*``) and backreferences.
+    """
+    # 每层分组: [包含可重复多次的量词, 包含分支, 起始位置, 本层 | 的位置]
+    groups = [[False, False, 0, []]]
+    # 上一个可以被量词修饰的单元 (字符、字符类或分组) 的同样两个标记
+    last = None
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        i += 1
+        if c == "\\":
+            if pattern[i] in "123456789":
+                return "backreferences are not allowed"
+            i += 1
+            last = (False, False)
+        elif c == "[":
+            # 字符类开头的 ^ 与 ] 是字面字符
+            i += 1 if pattern.startswith("^", i) else 0
+            i += 1 if pattern.startswith("]", i) else 0
+            while pattern[i] != "]":
+                i += 2 if pattern[i] == "\\" else 1
+            i += 1
+            last = (False, False)
+        elif c == "(":
+            if pattern.startswith(("?P=", "?("), i):
+                return "backreferences are not allowed"
+            if pattern.startswith("?#", i):
+                i = pattern.index(")", i) + 1
+                continue
+            end = _group_prefix_end(pattern, i)
+            if end is None:
+                i = pattern.index(")", i) + 1
+                continue
+            i = end
+            groups.append([False, False, i, []])
+            last = None
+        elif c == ")":
+            quantified, branched, start, bars = groups.pop()
+            if bars:
+                alternatives = zip([start] + [b + 1 for b in bars], bars + [i - 1])
+                branched |= not all(_SINGLE_CHAR.fullmatch(pattern, s, e) for s, e in alternatives)
+            groups[-1][0] |= quantified
+            groups[-1][1] |= branched
+            last = (quantified, branched)
+        elif c == "|":
+            groups[-1][3].append(i - 1)
+            last = None
+        elif c in "*+?" or (c == "{" and _BRACE_QUANTIFIER.match(pattern, i - 1)):
+            if c == "{":
+                quantifier = _BRACE_QUANTIFIER.match(pattern, i - 1)
+                i = quantifier.end()
+                low, comma, high = quantifier.groups()
+                bound = high if comma else low
+                repeats = not bound or int(bound) > 1
+            else:
+                repeats = c != "?"
+            # 惰性 (*?) 与占有 (*+) 量词
+            if pattern.startswith(("?", "+"), i):
+                i += 1
+            if repeats and last is not None:
+                if last[0]:
+                    return "nested quantifiers are not allowed"
+                if last[1]:
+                    return "alternation inside a repeated group is not allowed"
+            groups[-1][0] |= repeats
+            last = None
+        else:
+            last = (False, False)
+    return None
+
+
+def compile_url_regex(pattern):
+    """Compile a client-supplied url_regex; raises ValueError for unsafe patterns."""
+    if len(pattern) > MAX_URL_REGEX_CHARS:
+        raise ValueError(f"url_regex is longer than {MAX_URL_REGEX_CHARS} characters")
+    try:
+        compiled = re.compile(pattern, re.IGNORECASE)
+    except re.error as e:
+        raise ValueError(f"Invalid url_regex: {e}")
+    if compiled.flags & re.VERBOSE:
+        raise ValueError("Invalid url_regex: verbose patterns are not allowed")
+    reason = _backtracking_risk(pattern)
+    if reason:
+        raise ValueError(f"Invalid url_regex: {reason} (use url_contains for substrings)")
+    return compiled
+
+
+class Subscription:
+    """Server-side filter of one client, compiled once from its subscribe message.
+
+    Supported keys (all optional, combined with AND; list values are OR'ed):
+    ``host`` (exact or parent domain), ``method``, ``status`` ("404" or "4xx"),
+    ``url_contains`` (case-insensitive substring), ``url_regex`` (see
+    compile_url_regex) and ``min_latency_ms``. URL filters look at the first
+    MAX_MATCHED_URL_CHARS characters.
+    """
+
+    KEYS = ("host", "method", "status", "url_contains", "url_regex", "min_latency_ms")
+
+    def __init__(self, filters=None):
+        filters = filters or {}
+        unknown = set(filters) - set(self.KEYS)
+        if unknown:
+            raise ValueError(f"Unknown subscription filters: {sorted(unknown)}")
+        self.filters = {k: v for k, v in filters.items() if v not in (None, "", [])}
+
+        self.hosts = tuple(h.lower().lstrip(".") for h in self._as_list("host"))
+        self.methods = frozenset(m.upper() for m in self._as_list("method"))
+        self.status_ranges = tuple(
+            self._status_range(v) for v in self._as_list("status")
+        )
+        self.url_substrings = tuple(s.lower() for s in self._as_list("url_contains"))
+        pattern = self.filters.get("url_regex")
+        self.url_regex = compile_url_regex(str(pattern)) if pattern else None
+        min_latency = self.filters.get("min_latency_ms")
+        self.min_latency_ms = int(min_latency) if min_latency is not None else None
+
+    def _as_list(self, key):
+        value = self.filters.get(key)
+        if value is None:
+            return []
+        if isinstance(value, (list, tuple)):
+            return [str(v) for v in value]
+        return [str(value)]
+
+    @staticmethod
+    def _status_range(status):
+        status = status.strip().lower()
+        if len(status) == 3 and status.endswith("xx") and status[0].isdigit():
+            low = int(status[0]) * 100
+            return low, low + 100
+        if not status.isdigit():
+            raise ValueError(f"Invalid status filter: {status}")
+        code = int(status)
+        return code, code + 1
+
+    def matches(self, event):
+        if self.methods and (event.get("method") or "").upper() not in self.methods:
+            return False
+        if self.hosts:
+            host = (event.get("host") or "").lower()
+            if not any(host == h or host.endswith("." + h) for h in self.hosts):
+                return False
+        if self.status_ranges:
+            code = event.get("status_code")
+            if code is None or not any(lo <= code < hi for lo, hi in self.status_ranges):
+                return False
+        if self.min_latency_ms is not None:
+            if (event.get("latency_ms") or 0) < self.min_latency_ms:
+                return False
+        if self.url_substrings or self.url_regex is not None:
+            url = (event.get("url") or "")[:MAX_MATCHED_URL_CHARS]
+            if self.url_substrings:
+                lowered = url.lower()
+                if not any(s in lowered for s in self.url_substrings):
+                    return False
+            if self.url_regex is not None and not self.url_regex.search(url):
+                return False
+        return True
+
+
+class ClientSession:
+    """One /ws/traffic connection: a bounded outbound queue drained by its own sender task."""
+
+    _ids = count(1)
+
+    def __init__(self, websocket, queue_size, detail=DETAIL_SUMMARY):
+        self.id = next(self._ids)
+        self.websocket = websocket
+        self.queue_size = queue_size
+        self.detail = detail if detail in (DETAIL_SUMMARY, DETAIL_FULL) else DETAIL_SUMMARY
+        # 已序列化的事件 (满时丢弃最旧的) 与控制消息 (从不丢弃)
+        self.events = deque()
+        # 与 events 一一对应的入队时间 (monotonic)，用于计算客户端滞后
+        self.enqueued_at = deque()
+        self.control = deque()
+        self.skipped = 0
+        self.total_skipped = 0
+        self.frames = 0
+        self.downgraded = False
+        self.subscription = None
+        self.filtered = 0
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def enqueue(self, encoded, now):
+        if len(self.events) >= self.queue_size:
+            self.events.popleft()
+            self.enqueued_at.popleft()
+            self.skipped += 1
+            self.total_skipped += 1
+            # 跟不上的客户端降级为只接收摘要
+            if self.detail == DETAIL_FULL:
+                self.detail = DETAIL_SUMMARY
+                self.downgraded = True
+        self.events.append(encoded)
+        self.enqueued_at.append(now)
+        self.wakeup.set()
+
+    def enqueue_control(self, encoded):
+        self.control.append(encoded)
+        self.wakeup.set()
+
+    def take_frame(self, max_batch):
+        """Pop up to ``max_batch`` events as one batched frame (None if empty)."""
+        if not self.events and not self.skipped:
+            return None
+        n = min(len(self.events), max_batch)
+        if n:
+            WS_DELIVERY_LAG_SECONDS.observe(time.monotonic() - self.enqueued_at[0])
+        items = [self.events.popleft() for _ in range(n)]
+        for _ in range(n):
+            self.enqueued_at.popleft()
+        frame = (
+            f'{{"type": "batch", "skipped": {self.skipped}, '
+            f'"events": [{", ".join(items)}]}}'
+        )
+        self.skipped = 0
+        return frame
+
+    def lag(self, now):
+        """Seconds the oldest queued event has been waiting (0 when caught up)."""
+        return now - self.enqueued_at[0] if self.enqueued_at else 0.0
+
+
+class Broadcaster:
+    """Fans captured flows out to WebSocket clients without blocking the capture path.
+
+    ``publish`` only serializes the event (once per detail level) and appends
+    it to every client's bounded queue. Each client has a sender task that
+    wakes up, waits one batch interval so that more events can coalesce, and
+    writes them as a single frame. A client that falls behind loses its oldest
+    events (reported as ``skipped`` in the next frame) and is downgraded to
+    summaries; one that cannot take a frame within ``send_timeout_s`` is
+    disconnected.
+    """
+
+    def __init__(self):
+        self.clients = set()
+        # 生产模式下由采集进程设置: 事件同时转发给各 API 工作进程
+        self.relay = None
+        self.published = 0
+        self.dropped_clients = 0
+        self.refresh_config()
+
+    def refresh_config(self):
+        ws_config = config.get("websocket", {})
+        self.queue_size = int(ws_config.get("queue_size", 1000))
+        self.batch_interval = ws_config.get("batch_interval_ms", 100) / 1000
+        self.max_batch = int(ws_config.get("max_batch", 200))
+        self.send_timeout = float(ws_config.get("send_timeout_s", 5))
+
+    async def connect(self, websocket, detail=DETAIL_SUMMARY):
+        await websocket.accept()
+        session = ClientSession(websocket, self.queue_size, detail)
+        session.task = asyncio.create_task(self._sender(session))
+        self.clients.add(session)
+        logger.info(f"WebSocket client connected ({len(self.clients)} total)")
+        return session
+
+    async def disconnect(self, session):
+        if session not in self.clients:
+            return
+        self.clients.discard(session)
+        task = session.task
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        logger.info(f"WebSocket client disconnected ({len(self.clients)} total)")
+
+    def handle_message(self, session, text):
+        """Apply a client message; ``{"type": "subscribe", "filters": {...}}`` replaces the filter.
+
+        ``detail`` may be sent along to switch between summaries and full events.
+        """
+        try:
+            message = json.loads(text)
+            if not isinstance(message, dict):
+                raise ValueError("Message must be a JSON object")
+            msg_type = message.get("type")
+            if msg_type == "subscribe":
+                subscription = Subscription(message.get("filters"))
+                session.subscription = subscription if subscription.filters else None
+                if message.get("detail") in (DETAIL_SUMMARY, DETAIL_FULL):
+                    session.detail = message["detail"]
+                    session.downgraded = False
+                reply = {
+                    "type": "subscribed",
+                    "filters": subscription.filters,
+                    "detail": session.detail,
+                }
+            elif msg_type == "unsubscribe":
+                session.subscription = None
+                reply = {"type": "subscribed", "filters": {}, "detail": session.detail}
+            else:
+                raise ValueError(f"Unknown message type: {msg_type}")
+        except (ValueError, TypeError) as e:
+            reply = {"type": "error", "message": str(e)}
+        session.enqueue_control(json.dumps(reply))
+
+    @staticmethod
+    def summary(event):
+        return {k: event[k] for k in SUMMARY_FIELDS if k in event}
+
+    def publish(self, event):
+        """Queue a captured flow for every client (never awaits)."""
+        self.relay_message({"type": "traffic", "event": event})
+        if not self.clients:
+            return
+        self.published += 1
+        now = time.monotonic()
+        encoded = {}
+        for session in self.clients:
+            # 过滤在序列化之前完成，不匹配的客户端不产生任何编码开销
+            if session.subscription is not None and not session.subscription.matches(event):
+                session.filtered += 1
+                continue
+            detail = session.detail
+            if detail not in encoded:
+                payload = event if detail == DETAIL_FULL else self.summary(event)
+                encoded[detail] = json.dumps(payload)
+            session.enqueue(encoded[detail], now)
+
+    def send_control(self, message):
+        """Queue a control message (notification, clear) for every client."""
+        self.relay_message({"type": "control", "message": message})
+        encoded = json.dumps(message)
+        for session in self.clients:
+            session.enqueue_control(encoded)
+
+    def relay_message(self, message):
+        """Forward a message to the other processes' broadcasters, if relaying."""
+        if self.relay is not None:
+            self.relay.publish(message)
+
+    async def _sender(self, session):
+        websocket = session.websocket
+        try:
+            while True:
+                await session.wakeup.wait()
+                # 等待一个批次间隔，让更多事件合并进同一帧
+                await asyncio.sleep(self.batch_interval)
+                session.wakeup.clear()
+                while session.control:
+                    await asyncio.wait_for(
+                        websocket.send_text(session.control.popleft()),
+                        self.send_timeout,
+                    )
+                frame = session.take_frame(self.max_batch)
+                if frame is not None:
+                    await asyncio.wait_for(websocket.send_text(frame), self.send_timeout)
+                    session.frames += 1
+                if session.events:
+                    session.wakeup.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # 发送超时或连接已断开：丢弃该客户端，不影响其他客户端
+            self.dropped_clients += 1
+            logger.warning(f"Dropping WebSocket client: {type(e).__name__} {e}")
+            self.clients.discard(session)
+            try:
+                await websocket.close()
+            except Exception:
+                pass
+
+    async def close(self):
+        for session in list(self.clients):
+            await self.disconnect(session)
+
+    def stats(self):
+        return {
+            "clients": len(self.clients),
+            "published": self.published,
+            "dropped_clients": self.dropped_clients,
+            "queued": sum(len(s.events) for s in self.clients),
+            "skipped": sum(s.total_skipped for s in self.clients),
+            "downgraded": sum(1 for s in self.clients if s.downgraded),
+            "subscribed": sum(1 for s in self.clients if s.subscription is not None),
+            "filtered": sum(s.filtered for s in self.clients),
+        }
+
+
+broadcaster = Broadcaster()
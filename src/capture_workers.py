@@ -0,0 +1,509 @@
+import asyncio
+import inspect
+import itertools
+import logging
+import multiprocessing
+import os
+import pickle
+import queue
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+from mitmproxy.certs import CertStore
+from mitmproxy.options import CONF_BASENAME, Options
+from mitmproxy.proxy import mode_servers
+from mitmproxy.proxy.mode_specs import ProxyMode
+from mitmproxy.tools.dump import DumpMaster
+
+from ingest import TrafficAddon
+
+# 工作进程以 spawn 方式启动，本模块不引入 logging_config / db
+logger = logging.getLogger("proxy_insight")
+
+# 连续两次重启之间的最短运行时间 (秒)，运行超过该时长后退避重新计算
+STABLE_RUN_S = 10
+
+
+def reuse_port_supported():
+    """True where SO_REUSEPORT also load-balances connections across listeners.
+
+    Linux spreads incoming connections over every socket bound with
+    SO_REUSEPORT; on macOS/BSD the option exists but one socket gets all of
+    them, so the port-range dispatcher is used there instead.
+    """
+    return hasattr(socket, "SO_REUSEPORT") and sys.platform.startswith("linux")
+
+
+# ---------------------------------------------------------------------------
+# 工作进程
+# ---------------------------------------------------------------------------
+
+
+async def _listen_reuse_port(self, host, port):
+    """``RegularInstance.listen`` binding with SO_REUSEPORT, so all workers share one port."""
+    return [await asyncio.start_server(self.handle_stream, host, port, reuse_port=True)]
+
+
+def check_listen_patch():
+    """Raise RuntimeError unless ``_listen_reuse_port`` can replace mitmproxy's listen.
+
+    The replacement relies on private mitmproxy internals: an async
+    ``RegularInstance.listen(self, host, port)`` returning the servers, a
+    ``handle_stream`` callback, and regular mode being TCP only. A mitmproxy
+    release that changes any of them must stop the capture workers at
+    startup rather than leave them half-listening.
+    """
+    instance = mode_servers.RegularInstance
+    listen = getattr(instance, "listen", None)
+    problems = []
+    if not inspect.iscoroutinefunction(listen):
+        problems.append("listen is not a coroutine function")
+    elif list(inspect.signature(listen).parameters) != ["self", "host", "port"]:
+        problems.append(f"listen{inspect.signature(listen)} takes other arguments")
+    if not callable(getattr(instance, "handle_stream", None)):
+        problems.append("handle_stream is missing")
+    if ProxyMode.parse("regular").transport_protocol != "tcp":
+        problems.append("regular mode is no longer TCP only")
+    if problems:
+        raise RuntimeError(
+            "Unsupported mitmproxy version for SO_REUSEPORT capture workers: "
+            + "; ".join(problems)
+            + ". Set [capture] workers = 0 or use a mitmproxy release this version supports."
+        )
+
+
+class RecordShipper:
+    """Sends FlowRecords of a worker process to the main process in batches.
+
+    ``put`` runs on the mitmproxy loop; a sender thread pickles batches of up
+    to ``batch_size`` records (or whatever arrived within ``interval``) and
+    writes them to the IPC connection, together with the worker's counters.
+    With the ``block`` policy a full queue blocks the proxy loop, so
+    backpressure from the main process reaches the clients as in
+    single-process mode; other policies drop the record instead.
+    """
+
+    def __init__(self, conn, maxsize=5000, batch_size=200, interval=0.05, block=True):
+        self.conn = conn
+        self.queue = queue.Queue(maxsize=max(int(maxsize), 1))
+        self.batch_size = max(int(batch_size), 1)
+        self.interval = interval
+        self.block = block
+        self.on_error = None
+        self.counters = {"captured": 0, "dropped": 0, "batches": 0}
+        # TrafficAddon 的计数器，随每个批次发送给主进程 (/metrics)
+        self.addon_counters = None
+        self._thread = threading.Thread(target=self._run, name="record-shipper", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def put(self, record):
+        if not self.block:
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.counters["dropped"] += 1
+                return False
+        else:
+            self.queue.put(record)
+        self.counters["captured"] += 1
+        return True
+
+    def close(self, timeout=5.0):
+        """Send what is still queued, then stop the sender thread."""
+        self.queue.put(None)
+        self._thread.join(timeout)
+
+    def _run(self):
+        done = False
+        while not done:
+            batch = []
+            # 空闲时每秒发送一次空批次作为心跳
+            deadline = time.monotonic() + 1.0
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    record = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if record is None:
+                    done = True
+                    break
+                if not batch:
+                    deadline = time.monotonic() + self.interval
+                batch.append(record)
+            try:
+                self._send(batch)
+            except (OSError, EOFError) as e:
+                logger.error(f"Capture worker lost its IPC connection: {e}")
+                if self.on_error:
+                    self.on_error()
+                return
+
+    def _send(self, batch):
+        self.counters["batches"] += 1
+        stats = dict(self.counters, depth=self.queue.qsize())
+        if self.addon_counters is not None:
+            stats["addon"] = dict(self.addon_counters)
+        message = {"flows": batch, "stats": stats}
+        self.conn.send_bytes(pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+async def _serve(host, port, shipper, ssl_insecure=False):
+    loop = asyncio.get_running_loop()
+    master = DumpMaster(
+        Options(listen_host=host, listen_port=port, ssl_insecure=ssl_insecure),
+        with_termlog=True,
+        with_dumper=False,
+        loop=loop,
+    )
+    addon = TrafficAddon(shipper)
+    shipper.addon_counters = addon.counters
+    master.addons.add(addon)
+    # SIGTERM 时正常关闭，确保队列中的记录发送完毕
+    loop.add_signal_handler(signal.SIGTERM, master.shutdown)
+    shipper.on_error = lambda: loop.call_soon_threadsafe(master.shutdown)
+    shipper.start()
+    try:
+        await master.run()
+    finally:
+        shipper.close()
+
+
+def run_worker(index, host, port, address, authkey, settings):
+    """Entry point of a capture worker process."""
+    conn = Client(address, family="AF_UNIX", authkey=authkey)
+    conn.send_bytes(pickle.dumps({"hello": index, "pid": os.getpid()}))
+    if settings.get("reuse_port"):
+        check_listen_patch()
+        mode_servers.RegularInstance.listen = _listen_reuse_port
+    shipper = RecordShipper(
+        conn,
+        maxsize=settings.get("queue_size", 5000),
+        batch_size=settings.get("batch_size", 200),
+        interval=settings.get("interval_ms", 50) / 1000,
+        block=settings.get("overflow", "block") == "block",
+    )
+    try:
+        asyncio.run(_serve(host, port, shipper, bool(settings.get("ssl_insecure", False))))
+    finally:
+        conn.close()
+
+
+# ---------------------------------------------------------------------------
+# 主进程: 监督工作进程并接收流量记录
+# ---------------------------------------------------------------------------
+
+
+class CaptureWorker:
+    """Supervision state and counters of one worker process."""
+
+    def __init__(self, index, port):
+        self.index = index
+        self.port = port
+        self.process = None
+        self.pid = None
+        self.started_at = None
+        self.restarts = 0
+        self.failures = 0
+        self.next_start = 0.0
+        self.connected = False
+        self.received = 0
+        self.last_seen = None
+        self.stats = {}
+
+    def alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def to_dict(self):
+        return {
+            "index": self.index,
+            "pid": self.pid,
+            "port": self.port,
+            "alive": self.alive(),
+            "connected": self.connected,
+            "exitcode": self.process.exitcode if self.process else None,
+            "uptime_s": round(time.time() - self.started_at, 1) if self.alive() else 0,
+            "restarts": self.restarts,
+            "received": self.received,
+            "last_seen": self.last_seen,
+            **self.stats,
+        }
+
+
+class PortDispatcher:
+    """Round-robin TCP relay from the public port to workers on private ports.
+
+    Fallback for platforms where SO_REUSEPORT does not load-balance. Runs on
+    its own thread and event loop; bytes are relayed unchanged, so HTTP and
+    CONNECT tunnels both work.
+    """
+
+    def __init__(self, host, port, targets):
+        self.host = host
+        self.port = port
+        self.targets = targets
+        self._cycle = itertools.cycle(targets)
+        self._loop = None
+        self._server = None
+        self._thread = None
+        # 事件循环只弱引用任务，转发中的连接任务需在此持有
+        self._relays = set()
+        self.connections = 0
+
+    def start(self):
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            try:
+                self._server = self._loop.run_until_complete(
+                    asyncio.start_server(self._handle, self.host, self.port)
+                )
+            except OSError as e:
+                logger.error(f"Capture dispatcher failed to listen on {self.port}: {e}")
+                started.set()
+                return
+            started.set()
+            self._loop.run_forever()
+            self._server.close()
+            # 关闭仍在转发的连接
+            tasks = asyncio.all_tasks(self._loop)
+            for task in tasks:
+                task.cancel()
+            self._loop.run_until_complete(
+                asyncio.gather(*tasks, return_exceptions=True)
+            )
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name="capture-dispatcher", daemon=True)
+        self._thread.start()
+        started.wait(timeout=5.0)
+
+    def stop(self):
+        if self._loop and self._loop.is_running():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        if self._thread:
+            self._thread.join(timeout=2.0)
+
+    async def _handle(self, reader, writer):
+        upstream = None
+        for _ in self.targets:
+            try:
+                upstream = await asyncio.open_connection("127.0.0.1", next(self._cycle))
+                break
+            except OSError:
+                continue
+        if upstream is None:
+            writer.close()
+            return
+        self.connections += 1
+        up_reader, up_writer = upstream
+        task = asyncio.current_task()
+        self._relays.add(task)
+        try:
+            await asyncio.gather(
+                self._pipe(reader, up_writer), self._pipe(up_reader, writer)
+            )
+        finally:
+            self._relays.discard(task)
+            up_writer.close()
+            writer.close()
+
+    @staticmethod
+    async def _pipe(reader, writer):
+        try:
+            while data := await reader.read(65536):
+                writer.write(data)
+                await writer.drain()
+            if writer.can_write_eof():
+                writer.write_eof()
+        except (OSError, RuntimeError):
+            writer.close()
+
+
+class WorkerPool:
+    """Runs N mitmproxy worker processes and feeds their records into ``channel``.
+
+    Workers connect back over an authenticated Unix socket; one reader thread
+    per worker unpickles record batches and calls ``channel.put``, exactly as
+    the in-process proxy thread does. A supervisor thread restarts workers
+    that exit, with exponential backoff for ones that keep crashing.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.workers = []
+        self.mode = None
+        self._listener = None
+        self._dispatcher = None
+        self._tmpdir = None
+        self._stopping = threading.Event()
+        self._supervisor = None
+        self._lock = threading.Lock()
+
+    def running(self):
+        return any(worker.alive() for worker in self.workers)
+
+    def start(self, host, port, count, settings):
+        if reuse_port_supported():
+            # 在启动任何工作进程之前确认 mitmproxy 内部接口未变
+            check_listen_patch()
+        # 提前生成 CA，避免多个进程首次启动时各自生成不同的证书
+        opts = Options()
+        CertStore.from_store(os.path.expanduser(opts.confdir), CONF_BASENAME, opts.key_size)
+
+        self._stopping.clear()
+        self._tmpdir = tempfile.mkdtemp(prefix="proxy-insight-")
+        self._address = os.path.join(self._tmpdir, "capture.sock")
+        self._authkey = os.urandom(32)
+        self._listener = Listener(self._address, family="AF_UNIX", authkey=self._authkey)
+        threading.Thread(target=self._accept_loop, name="capture-ipc", daemon=True).start()
+
+        self.settings = dict(settings)
+        if reuse_port_supported():
+            self.mode = "reuse_port"
+            self.settings["reuse_port"] = True
+            self.workers = [CaptureWorker(i, port) for i in range(count)]
+            self._host = host
+        else:
+            # 工作进程监听本机私有端口，由分发线程转发公共端口上的连接
+            self.mode = "dispatcher"
+            self.workers = [CaptureWorker(i, port + 1 + i) for i in range(count)]
+            self._host = "127.0.0.1"
+            self._dispatcher = PortDispatcher(host, port, [w.port for w in self.workers])
+            self._dispatcher.start()
+
+        self._ctx = multiprocessing.get_context("spawn")
+        for worker in self.workers:
+            self._spawn(worker)
+        self._supervisor = threading.Thread(
+            target=self._supervise, name="capture-supervisor", daemon=True
+        )
+        self._supervisor.start()
+        logger.info(f"Started {count} capture workers on {host}:{port} ({self.mode})")
+
+    def _spawn(self, worker):
+        worker.process = self._ctx.Process(
+            target=run_worker,
+            args=(
+                worker.index,
+                self._host,
+                worker.port,
+                self._address,
+                self._authkey,
+                self.settings,
+            ),
+            name=f"capture-worker-{worker.index}",
+            daemon=True,
+        )
+        worker.process.start()
+        worker.pid = worker.process.pid
+        worker.started_at = time.time()
+
+    def _supervise(self):
+        backoff_max = float(self.settings.get("restart_backoff_max_s", 30))
+        while not self._stopping.wait(1.0):
+            for worker in self.workers:
+                if worker.alive():
+                    continue
+                now = time.time()
+                if worker.next_start == 0.0:
+                    # 刚发现退出: 按连续失败次数计算退避时间
+                    if now - worker.started_at >= STABLE_RUN_S:
+                        worker.failures = 0
+                    delay = min(2**worker.failures, backoff_max)
+                    worker.failures += 1
+                    worker.next_start = now + delay
+                    logger.warning(
+                        f"Capture worker {worker.index} (pid {worker.pid}) exited with "
+                        f"{worker.process.exitcode}, restarting in {delay:.0f}s"
+                    )
+                elif now >= worker.next_start and not self._stopping.is_set():
+                    worker.next_start = 0.0
+                    worker.restarts += 1
+                    self._spawn(worker)
+
+    def _accept_loop(self):
+        while not self._stopping.is_set():
+            try:
+                conn = self._listener.accept()
+                hello = pickle.loads(conn.recv_bytes())
+            except (OSError, EOFError):
+                if self._stopping.is_set():
+                    return
+                continue
+            except Exception as e:
+                # 认证失败等，忽略该连接
+                logger.warning(f"Rejected capture IPC connection: {e}")
+                continue
+            worker = self.workers[hello["hello"]]
+            threading.Thread(
+                target=self._read_loop,
+                args=(worker, conn),
+                name=f"capture-ipc-{worker.index}",
+                daemon=True,
+            ).start()
+
+    def _read_loop(self, worker, conn):
+        worker.connected = True
+        try:
+            while True:
+                message = pickle.loads(conn.recv_bytes())
+                for record in message["flows"]:
+                    self.channel.put(record)
+                worker.received += len(message["flows"])
+                worker.stats = message["stats"]
+                worker.last_seen = time.time()
+        except (OSError, EOFError):
+            pass
+        finally:
+            worker.connected = False
+            conn.close()
+
+    def stop(self, timeout=5.0):
+        """Stop the workers gracefully (SIGTERM flushes their queues), then clean up."""
+        self._stopping.set()
+        for worker in self.workers:
+            if worker.alive():
+                worker.process.terminate()
+        deadline = time.time() + timeout
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            worker.process.join(max(deadline - time.time(), 0))
+            if worker.process.is_alive():
+                worker.process.kill()
+                worker.process.join(1.0)
+        if self._dispatcher:
+            self._dispatcher.stop()
+            self._dispatcher = None
+        if self._listener:
+            self._listener.close()
+            self._listener = None
+        if self._supervisor:
+            self._supervisor.join(timeout=2.0)
+            self._supervisor = None
+        if self._tmpdir:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
+        self.workers = []
+        self.mode = None
+        logger.info("Capture workers stopped")
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "workers": [worker.to_dict() for worker in self.workers],
+            "dispatched": self._dispatcher.connections if self._dispatcher else None,
+        }
@@ -0,0 +1,321 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+import httpx
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+
+logger = logging.getLogger("proxy_insight")
+
+# 进程角色: all = 开发模式单进程; capture = 抓包与写库; api = 只读 API 工作进程
+ROLE_ALL = "all"
+ROLE_CAPTURE = "capture"
+ROLE_API = "api"
+
+ROLE_ENV = "PROXY_INSIGHT_ROLE"
+RUNTIME_ENV = "PROXY_INSIGHT_RUNTIME_DIR"
+
+
+def current_role():
+    """Role of this process, set by ``run_production`` through the environment."""
+    return os.environ.get(ROLE_ENV, ROLE_ALL)
+
+
+# API 工作进程本地处理的只读接口，其余请求转发给采集进程
+# (按主机/状态分类的延迟分布只保存在采集进程中)
+LOCAL_PATHS = re.compile(
+    r"^/(?:$|static/|api/(?:requests|stats(?!/latency)|status|export/|cert/download))"
+)
+HOP_HEADERS = frozenset(
+    ("host", "connection", "keep-alive", "transfer-encoding", "upgrade", "te", "trailer")
+)
+
+
+def runtime_path(name):
+    """Path of a socket in the runtime directory shared by the production processes."""
+    return os.path.join(os.environ[RUNTIME_ENV], name)
+
+
+def capture_socket():
+    return runtime_path("capture.sock")
+
+
+def events_socket():
+    return runtime_path("events.sock")
+
+
+class EventHub:
+    """Publisher side of the local pub/sub channel (runs in the capture process).
+
+    API workers connect to a Unix socket and receive newline-delimited JSON
+    messages: ``traffic`` (live events), ``control`` (notifications, clear),
+    ``stats`` (the writer state: running aggregates and id bounds, every
+    ``interval`` seconds) and ``config``.
+    A subscriber whose socket buffer exceeds ``max_buffer`` bytes misses
+    messages instead of slowing the capture process down.
+    """
+
+    def __init__(self, max_buffer=8 * 1024 * 1024):
+        self.max_buffer = max_buffer
+        self.subscribers = set()
+        self.published = 0
+        self.dropped = 0
+        self._server = None
+        self._stats_task = None
+
+    async def start(self, path, stats_source=None, interval=1.0):
+        if os.path.exists(path):
+            os.remove(path)
+        self._server = await asyncio.start_unix_server(self._accept, path)
+        if stats_source is not None:
+            self._stats_task = asyncio.create_task(self._stats_loop(stats_source, interval))
+        logger.info(f"Event hub listening on {path}")
+
+    async def _accept(self, reader, writer):
+        self.subscribers.add(writer)
+        try:
+            # 订阅端不发送数据，读到 EOF 即表示断开
+            await reader.read()
+        except OSError:
+            pass
+        finally:
+            self.subscribers.discard(writer)
+            writer.close()
+
+    def publish(self, message):
+        """Send a message to every subscriber (never awaits)."""
+        if not self.subscribers:
+            return
+        line = (json.dumps(message) + "\n").encode()
+        self.published += 1
+        for writer in list(self.subscribers):
+            if writer.transport.get_write_buffer_size() > self.max_buffer:
+                self.dropped += 1
+                continue
+            writer.write(line)
+
+    async def _stats_loop(self, stats_source, interval):
+        while True:
+            await asyncio.sleep(interval)
+            self.publish({"type": "stats", "stats": stats_source()})
+
+    async def close(self):
+        if self._stats_task is not None:
+            self._stats_task.cancel()
+            self._stats_task = None
+        for writer in list(self.subscribers):
+            writer.close()
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    def stats(self):
+        return {
+            "subscribers": len(self.subscribers),
+            "published": self.published,
+            "dropped": self.dropped,
+        }
+
+
+class EventSubscriber:
+    """Subscriber side of the pub/sub channel (runs in each API worker); reconnects on loss."""
+
+    def __init__(self):
+        self.connected = False
+        self.received = 0
+        self.reconnects = 0
+        self._task = None
+
+    def start(self, path, handler):
+        self._task = asyncio.create_task(self._run(path, handler))
+
+    async def _run(self, path, handler):
+        delay = 0.5
+        while True:
+            writer = None
+            try:
+                reader, writer = await asyncio.open_unix_connection(
+                    path, limit=64 * 1024 * 1024
+                )
+                self.connected = True
+                delay = 0.5
+                while line := await reader.readline():
+                    self.received += 1
+                    try:
+                        await handler(json.loads(line))
+                    except Exception as e:
+                        logger.error(f"Failed to handle cluster message: {e}")
+            except (OSError, ValueError) as e:
+                logger.debug(f"Event channel unavailable: {e}")
+            finally:
+                if self.connected:
+                    self.reconnects += 1
+                    logger.warning("Lost the capture process event channel, reconnecting")
+                self.connected = False
+                if writer is not None:
+                    writer.close()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 5.0)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self):
+        return {
+            "connected": self.connected,
+            "received": self.received,
+            "reconnects": self.reconnects,
+        }
+
+
+class CaptureForwarder:
+    """Reverse proxy from an API worker to the capture process's Unix socket.
+
+    Request and response bodies are streamed, so imports and large responses
+    are not buffered in the worker.
+    """
+
+    def __init__(self):
+        self._client = None
+
+    @staticmethod
+    def should_forward(method, path):
+        return not (method in ("GET", "HEAD") and LOCAL_PATHS.match(path))
+
+    def client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                transport=httpx.AsyncHTTPTransport(uds=capture_socket()),
+                base_url="http://capture",
+                timeout=httpx.Timeout(None, connect=5.0),
+            )
+        return self._client
+
+    async def forward(self, request):
+        headers = [
+            (k, v) for k, v in request.headers.raw if k.decode().lower() not in HOP_HEADERS
+        ]
+        target = request.url.path + (f"?{request.url.query}" if request.url.query else "")
+        has_body = any(h in request.headers for h in ("content-length", "transfer-encoding"))
+        upstream = self.client().build_request(
+            request.method,
+            target,
+            headers=headers,
+            content=request.stream() if has_body else None,
+        )
+        try:
+            response = await self.client().send(upstream, stream=True)
+        except httpx.HTTPError as e:
+            logger.error(f"Capture process unavailable: {e}")
+            return JSONResponse(
+                {"detail": "Capture process unavailable"}, status_code=503
+            )
+        return StreamingResponse(
+            response.aiter_raw(),
+            status_code=response.status_code,
+            headers={
+                k: v for k, v in response.headers.items() if k.lower() not in HOP_HEADERS
+            },
+            background=BackgroundTask(response.aclose),
+        )
+
+    async def get_json(self, path):
+        response = await self.client().get(path)
+        response.raise_for_status()
+        return response.json()
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+def _run_capture(runtime_dir):
+    """Entry point of the capture process: the full app on a private Unix socket."""
+    import uvicorn
+
+    os.environ[ROLE_ENV] = ROLE_CAPTURE
+    os.environ[RUNTIME_ENV] = runtime_dir
+    uvicorn.run("main:app", uds=os.path.join(runtime_dir, "capture.sock"))
+
+
+class CaptureSupervisor:
+    """Runs the capture process and restarts it if it exits unexpectedly."""
+
+    def __init__(self, runtime_dir):
+        self.runtime_dir = runtime_dir
+        self.process = None
+        self.restarts = 0
+        self._stopping = threading.Event()
+        self._thread = None
+        self._ctx = multiprocessing.get_context("spawn")
+
+    def _spawn(self):
+        self.process = self._ctx.Process(
+            target=_run_capture, args=(self.runtime_dir,), name="capture"
+        )
+        self.process.start()
+
+    def start(self, timeout=30.0):
+        self._spawn()
+        # 等待采集进程开始监听，再启动 API 工作进程
+        deadline = time.time() + timeout
+        sock = os.path.join(self.runtime_dir, "capture.sock")
+        while not os.path.exists(sock) and time.time() < deadline:
+            if not self.process.is_alive():
+                raise RuntimeError("Capture process exited during startup")
+            time.sleep(0.1)
+        self._thread = threading.Thread(target=self._supervise, daemon=True)
+        self._thread.start()
+
+    def _supervise(self):
+        while not self._stopping.wait(1.0):
+            if not self.process.is_alive():
+                self.restarts += 1
+                logger.warning(
+                    f"Capture process exited with {self.process.exitcode}, restarting"
+                )
+                time.sleep(min(self.restarts, 10))
+                if not self._stopping.is_set():
+                    self._spawn()
+
+    def stop(self, timeout=15.0):
+        """Stop the capture process gracefully so queued rows are flushed."""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout)
+            if self.process.is_alive():
+                self.process.kill()
+
+
+def run_production(host, port, api_workers):
+    """Start the capture process, then ``api_workers`` uvicorn workers on host:port."""
+    import uvicorn
+
+    runtime_dir = tempfile.mkdtemp(prefix="proxy-insight-run-")
+    os.environ[RUNTIME_ENV] = runtime_dir
+    supervisor = CaptureSupervisor(runtime_dir)
+    try:
+        supervisor.start()
+        os.environ[ROLE_ENV] = ROLE_API
+        uvicorn.run("main:app", host=host, port=port, workers=api_workers)
+    finally:
+        supervisor.stop()
+        shutil.rmtree(runtime_dir, ignore_errors=True)
@@ -2,7 +2,9 @@ from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
 import tomllib
 import os
+import json
 import logging
+import re
 from typing import Dict, Any, Optional
 
 # Assuming these are imported correctly in main.py
@@ -30,30 +32,78 @@ def _read_config(path: str) -> bytes:
         return f.read()
 
 
-def _write_config(path: str, cfg: Dict[str, Any]):
-    """Sync helper to write TOML config."""
-    lines = []
-    if "app_host" in cfg:
-        lines.append(f'app_host = "{cfg["app_host"]}"')
-    if "app_port" in cfg:
-        lines.append(f'app_port = {cfg["app_port"]}')
-    if "proxy_host" in cfg:
-        lines.append(f'proxy_host = "{cfg["proxy_host"]}"')
-    if "proxy_port" in cfg:
-        lines.append(f'proxy_port = {cfg["proxy_port"]}')
-    if "db_type" in cfg:
-        lines.append(f'db_type = "{cfg["db_type"]}"')
-
-    if "mysql" in cfg:
-        lines.append("\n[mysql]")
-        for k, v in cfg["mysql"].items():
-            if isinstance(v, str):
-                lines.append(f'{k} = "{v}"')
-            else:
-                lines.append(f"{k} = {v}")
+_TOML_SECTION = re.compile(r"^\s*\[([^\[\]]+)\]\s*(?:#.*)?$")
+# key = value  # comment (字符串中的 # 不算注释)
+_TOML_KEY = re.compile(
+    r"^(\s*)([A-Za-z0-9_-]+)(\s*=\s*)(\"(?:[^\"\\]|\\.)*\"|'[^']*'|[^#]*?)(\s*#.*)?$"
+)
+
+
+def _format_toml_value(v: Any) -> str:
+    if isinstance(v, bool):
+        return "true" if v else "false"
+    if isinstance(v, str):
+        # JSON 字符串的转义写法同样是合法的 TOML 基本字符串
+        return json.dumps(v, ensure_ascii=False)
+    return f"{v}"
+
 
+def _update_toml(text: str, changes: Dict[str, Any]) -> str:
+    """Set ``changes`` (top-level keys and ``{section: {key: value}}``) in TOML text.
+
+    Only the lines of the changed keys are rewritten, so comments, ordering
+    and every other key are kept. Missing keys are added after the last key
+    of their section, missing sections at the end.
+    """
+    pending = {None: {k: v for k, v in changes.items() if not isinstance(v, dict)}}
+    for section, values in changes.items():
+        if isinstance(values, dict):
+            pending[section] = dict(values)
+
+    lines = []
+    # 每段最后一个键 (或段头) 之后的行号，缺少的键插在这里
+    ends = {None: 0}
+    section = None
+    for line in text.splitlines():
+        header = _TOML_SECTION.match(line)
+        key = None if header else _TOML_KEY.match(line)
+        if header:
+            section = header.group(1).strip()
+        elif key and key.group(2) in pending.get(section, {}):
+            indent, name, equals, _, comment = key.groups()
+            value = _format_toml_value(pending[section].pop(name))
+            line = f"{indent}{name}{equals}{value}{comment or ''}"
+        lines.append(line)
+        if header or key:
+            ends[section] = len(lines)
+
+    for section in sorted(ends, key=ends.get, reverse=True):
+        values = pending.pop(section, {})
+        lines[ends[section] : ends[section]] = [
+            f"{k} = {_format_toml_value(v)}" for k, v in values.items()
+        ]
+    for section, values in pending.items():
+        if values:
+            lines.append(f"\n[{section}]")
+            lines.extend(f"{k} = {_format_toml_value(v)}" for k, v in values.items())
+    return "\n".join(lines) + "\n"
+
+
+def _write_config(path: str, changes: Dict[str, Any]):
+    """Sync helper: write the changed keys into config.toml, keeping the rest of the file."""
+    text = ""
+    if os.path.exists(path):
+        text = _read_config(path).decode("utf-8")
+    current = tomllib.loads(text)
+    # 与文件中相同的值不改写
+    for key, value in list(changes.items()):
+        if isinstance(value, dict):
+            section = current.get(key, {})
+            changes[key] = {k: v for k, v in value.items() if section.get(k) != v}
+        elif current.get(key) == value:
+            del changes[key]
     with open(path, "w", encoding="utf-8") as f:
-        f.write("\n".join(lines))
+        f.write(_update_toml(text, changes))
 
 
 @router.get("")
@@ -78,32 +128,25 @@ async def update_config(update: ConfigUpdate):
     """Update configuration and save to config.toml."""
     config_path = os.path.join(SRC_DIR, "config.toml")
 
-    # Load current to merge
-    current_cfg = {}
-    if os.path.exists(config_path):
-        try:
-            content = await asyncio.to_thread(_read_config, config_path)
-            current_cfg = tomllib.loads(
-                content.decode("utf-8") if isinstance(content, bytes) else content
-            )
-        except Exception as e:
-            logger.warning(f"Failed to load current config for merge: {e}")
-
-    # Merge updates
-    _merge_updates(current_cfg, update)
+    # 只改写本次提交的键，config.toml 中的注释与其余配置保持不变
+    changes = {}
+    _merge_updates(changes, update)
 
     try:
         # Save to file asynchronously
-        await asyncio.to_thread(_write_config, config_path, current_cfg)
+        await asyncio.to_thread(_write_config, config_path, changes)
 
         # Apply to in-memory config object
         _apply_in_memory_config(update)
 
         # Trigger DB Refresh
+        from broadcast import broadcaster
         from db import db_manager
 
-        db_manager.refresh_config()
-        await db_manager.init_db()
+        # 切换前先把待写入的流量落到旧的数据库
+        await db_manager.reload()
+        # 生产模式下通知各 API 工作进程重新读取配置
+        broadcaster.relay_message({"type": "config"})
 
         # Notify
         await _notify_update(db_manager.db_type)
@@ -3,8 +3,41 @@ import aiomysql
 import json
 import os
 import logging
-from datetime import datetime
+import asyncio
+import time
+import urllib.parse
+import html
+import re
+import base64
+import fcntl
+import functools
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone
 from logging_config import config
+from metrics import LAG_BUCKETS, histogram
+from profiling import stage
+from stats import StatsEngine
+from partitions import (
+    GRANULARITIES,
+    LEGACY_PARTITION,
+    Partition,
+    PartitionRegistry,
+    partition_for,
+)
+from body_store import (
+    LEGACY_CONTENT_TYPE,
+    BodyDecoder,
+    BodyBatch,
+    CODEC_RAW,
+    body_key,
+    body_text,
+    decode_body,
+    decode_stored,
+    is_text_type,
+    read_prefix,
+    to_bytes,
+    unpack_body,
+)
 
 import warnings
 from contextlib import asynccontextmanager
@@ -17,11 +50,594 @@ logger = logging.getLogger("proxy_insight")
 
 # Determine project root (one level up from src/)
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-DB_PATH = os.path.join(PROJECT_ROOT, "proxy_traffic.db")
+# DB_PATH 环境变量可指定数据库文件 (基准测试等使用独立的数据库)
+DB_PATH = os.getenv("DB_PATH") or os.path.join(PROJECT_ROOT, "proxy_traffic.db")
+# 按时间分区时每个分区一个 SQLite 文件
+SHARD_DIR = os.path.join(os.path.dirname(DB_PATH), "proxy_traffic_shards")
+
+# 全文索引为无内容表 (content='')，只保存倒排索引，不保存 url 和主体的文本副本。
+# 按 rowid 删除需要 contentless_delete (SQLite 3.43+)
+FTS_CONTENTLESS_DELETE = aiosqlite.sqlite_version_info >= (3, 43, 0)
+FTS_COLUMNS = "url, request_body, response_body, content=''"
+
+# 不支持 contentless_delete 时，FTS5 只能用 'delete' 命令并原样提供当初索引的
+# 文本来删除一行 (不一致会损坏索引)。索引文本去重压缩后存入 bodies，这里
+# 记录每行引用的哈希
+FTS_TEXT_TABLE = """
+    CREATE TABLE IF NOT EXISTS {schema}.requests_fts_text (
+        id INTEGER PRIMARY KEY,
+        request_hash TEXT,
+        response_hash TEXT
+    )
+"""
+
+# /metrics: 写入批次与查询耗时、抓包到落库的滞后 (按后端区分)
+DB_SAVE_SECONDS = histogram(
+    "proxy_insight_db_save_seconds",
+    "Duration of one write batch, all partition transactions included",
+    ("backend",),
+)
+DB_QUERY_SECONDS = histogram(
+    "proxy_insight_db_query_seconds", "Duration of read queries", ("backend", "query")
+)
+PERSIST_LAG_SECONDS = histogram(
+    "proxy_insight_persist_lag_seconds",
+    "Time from the end of a captured response to its row being committed",
+    ("backend",),
+    LAG_BUCKETS,
+)
+# 各阶段耗时 (/api/admin/stages): save_request 的三步与写入批次的打包/提交
+_TO_ROW_STAGE = stage("db.to_row")
+_INTAKE_WAIT_STAGE = stage("db.intake_wait")
+_ENQUEUE_STAGE = stage("db.enqueue")
+_PACK_STAGE = stage("db.pack")
+_WRITE_STAGE = stage("db.write")
+
+# MySQL 原生 RANGE 分区：转换前的旧数据与尚未到来的时间段
+MYSQL_LEGACY_PARTITION = "p_legacy"
+MYSQL_MAX_PARTITION = "pmax"
+
+# 初始表结构之后新增的列 (旧库通过 _migrate_schema 一次性补齐并回填)
+ADDED_COLUMNS = {
+    "scheme": ("TEXT", "VARCHAR(16)"),
+    "host": ("TEXT", "VARCHAR(255)"),
+    "path": ("TEXT", "TEXT"),
+    "status_code": ("INTEGER", "INT"),
+    "reason": ("TEXT", "VARCHAR(255)"),
+    "latency_ms": ("INTEGER", "INT"),
+    "captured_at": ("INTEGER", "BIGINT"),
+    "request_body_hash": ("TEXT", "CHAR(32)"),
+    "request_body_size": ("INTEGER", "BIGINT"),
+    "response_body_hash": ("TEXT", "CHAR(32)"),
+    "response_body_size": ("INTEGER", "BIGINT"),
+    "request_content_type": ("TEXT", "VARCHAR(255)"),
+    "request_content_encoding": ("TEXT", "VARCHAR(64)"),
+    "response_content_type": ("TEXT", "VARCHAR(255)"),
+    "response_content_encoding": ("TEXT", "VARCHAR(64)"),
+}
+
+# INSERT 的列顺序 (_write_batch 按此顺序把行字典转换为参数元组)
+INSERT_COLUMNS = (
+    "id",
+    "method",
+    "url",
+    "scheme",
+    "host",
+    "path",
+    "status_code",
+    "reason",
+    "latency_ms",
+    "captured_at",
+    "request_headers",
+    "request_cookies",
+    "response_headers",
+    "response_cookies",
+    "request_body_hash",
+    "request_body_size",
+    "response_body_hash",
+    "response_body_size",
+    "request_content_type",
+    "request_content_encoding",
+    "response_content_type",
+    "response_content_encoding",
+)
+
+# SQLite requests 表结构 (主库与各分区文件共用)
+SQLITE_REQUESTS_TABLE = """
+    CREATE TABLE IF NOT EXISTS {schema}.requests (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        method TEXT,
+        url TEXT,
+        scheme TEXT,
+        host TEXT,
+        path TEXT,
+        status_code INTEGER,
+        reason TEXT,
+        latency_ms INTEGER,
+        captured_at INTEGER,
+        request_headers TEXT,
+        request_cookies TEXT,
+        response_headers TEXT,
+        response_cookies TEXT,
+        request_body_hash TEXT,
+        request_body_size INTEGER,
+        response_body_hash TEXT,
+        response_body_size INTEGER,
+        request_content_type TEXT,
+        request_content_encoding TEXT,
+        response_content_type TEXT,
+        response_content_encoding TEXT
+    )
+"""
+
+INDEXES = {
+    "idx_requests_host": "host, id",
+    "idx_requests_status": "status_code, id",
+    "idx_requests_captured_at": "captured_at",
+}
+
+
+def parse_status(value):
+    """Split a legacy status value (200, "200" or "200 OK") into (code, reason)."""
+    if value is None:
+        return None, ""
+    if isinstance(value, int):
+        return value, ""
+    code, _, reason = str(value).strip().partition(" ")
+    try:
+        return int(code), reason
+    except ValueError:
+        return None, str(value)
+
+
+def parse_latency(value):
+    """Parse a legacy latency string like "123ms" into integer milliseconds."""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    digits = "".join(ch for ch in str(value) if ch.isdigit())
+    return int(digits) if digits else None
+
+
+def split_url(url):
+    """Return (scheme, host, path) for a URL; path keeps the query string."""
+    parts = urllib.parse.urlsplit(url or "")
+    path = parts.path or "/"
+    if parts.query:
+        path += f"?{parts.query}"
+    return parts.scheme, parts.hostname or "", path
+
+
+# 高亮片段的占位标记，转义 HTML 后再替换为 <mark>
+_MARK_OPEN = "\x02"
+_MARK_CLOSE = "\x03"
+
+
+def render_snippet(text):
+    """HTML-escape a snippet and turn the sentinel markers into <mark> tags."""
+    if not text:
+        return ""
+    return (
+        html.escape(text)
+        .replace(_MARK_OPEN, "<mark>")
+        .replace(_MARK_CLOSE, "</mark>")
+    )
+
+
+def search_terms(query):
+    """Split a free-text query into index tokens."""
+    return re.findall(r"\w+", query or "")
+
+
+def build_snippet(texts, terms, width=64):
+    """Build a highlighted snippet around the first term hit.
+
+    The full-text index keeps no text to run snippet() on, so snippets are
+    cut from the decoded url and bodies of the rows on the page.
+    """
+    pattern = re.compile("|".join(re.escape(t) for t in terms), re.IGNORECASE)
+    for text in texts:
+        if not text:
+            continue
+        match = pattern.search(text)
+        if not match:
+            continue
+        start = max(0, match.start() - width)
+        end = min(len(text), match.end() + width)
+        window = pattern.sub(
+            lambda m: f"{_MARK_OPEN}{m.group(0)}{_MARK_CLOSE}", text[start:end]
+        )
+        prefix = "…" if start > 0 else ""
+        suffix = "…" if end < len(text) else ""
+        return render_snippet(f"{prefix}{window}{suffix}")
+    return ""
+
+
+def encode_cursor(state):
+    """Encode pagination state into an opaque, URL-safe cursor string."""
+    raw = json.dumps(state, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Decode a cursor produced by encode_cursor; raises ValueError if malformed."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        state = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+    if not isinstance(state, dict):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return state
+
+
+def header_value(headers, name):
+    """Case-insensitive header lookup on a captured headers dict."""
+    name = name.lower()
+    for key, value in (headers or {}).items():
+        if key.lower() == name:
+            return value
+    return ""
+
+
+def index_text(body, limit, content_encoding="", content_type="", codec=CODEC_RAW):
+    """Text copy of a body for the full-text index, capped at ``limit`` chars.
+
+    Raw wire bytes (or a stored blob in ``codec``) are decoded here, in the
+    writer's worker thread; only the first ``limit`` chars worth of bytes are
+    decompressed. Binary bodies are not indexed.
+    """
+    if not body:
+        return ""
+    if isinstance(body, str):
+        return body[:limit]
+    if content_type and not is_text_type(content_type):
+        return ""
+    # UTF-8 每个字符最多 4 字节
+    data, truncated = read_prefix(codec, body, content_encoding, limit * 4)
+    if not content_encoding and not content_type:
+        return data.decode("utf-8", errors="replace")[:limit]
+    return (body_text(data, content_type, final=not truncated) or "")[:limit]
+
+
+def encode_index_text(text):
+    """Bytes of an index text as stored in bodies; round-trips any str exactly."""
+    return (text or "").encode("utf-8", "surrogatepass")
+
+
+class BodyMatcher:
+    """SQLite function ``body_match`` behind the literal search on stored bodies.
+
+    ``body_match(hash, codec, data, content_encoding, content_type, needle, limit)``
+    decodes the start of a blob from the bodies table and tests whether its
+    text (as ``index_text`` extracts it, capped at ``limit`` chars) contains ``needle``,
+    ignoring case. Results are cached per body and needle, so a body shared by
+    many rows is decoded once. One instance per connection (and thread).
+    """
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+
+    def __call__(self, digest, codec, data, content_encoding, content_type, needle, limit):
+        if data is None or not needle:
+            return 0
+        if content_encoding is None:
+            # 旧版本行保存的是已解码的 UTF-8 文本
+            content_encoding, content_type = "", LEGACY_CONTENT_TYPE
+        key = (digest, content_encoding, content_type, needle, limit)
+        found = self._cache.get(key)
+        if found is None:
+            text = index_text(data, limit, content_encoding, content_type or "", codec=codec)
+            found = int(needle.lower() in text.lower())
+            self._cache[key] = found
+            if len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(key)
+        return found
+
+
+def timed_query(name):
+    """Record the duration of a DatabaseManager read method in DB_QUERY_SECONDS."""
+
+    def decorate(func):
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(self, *args, **kwargs)
+            finally:
+                DB_QUERY_SECONDS.labels(backend=self.db_type, query=name).observe(
+                    time.perf_counter() - start
+                )
+
+        return wrapper
+
+    return decorate
+
+
+def format_timestamp(captured_at):
+    """Format an epoch-ms capture time the way the UI displays it."""
+    if not captured_at:
+        return ""
+    return datetime.fromtimestamp(captured_at / 1000).strftime("%Y-%m-%d %H:%M:%S")
+
+
+class SQLitePool:
+    """SQLite connections in WAL mode: one writer, a set of read-only readers.
+
+    In WAL mode readers never block the writer and the writer never blocks
+    readers, so capture ingestion and dashboard queries no longer contend
+    for the same journal lock.
+
+    Partition shard files are ATTACHed to a connection on first use and kept
+    attached in a small per-connection LRU (SQLite allows 10 by default).
+    """
+
+    MAX_ATTACHED = 8
+
+    def __init__(self, path, size=4, options=None):
+        self.path = path
+        self.size = max(1, int(size))
+        self.options = options or {}
+        self.writer = None
+        self._checkpointer = None
+        self._write_lock = asyncio.Lock()
+        self._conns = []
+        self._idle = None
+        self._in_use = 0
+        self._released = None
+        self.last_checkpoint = None
+        # 每个连接已 ATTACH 的分区: conn -> OrderedDict(name -> path)
+        self._attached = {}
+        # 已删除的分区，读连接下次借出时再 DETACH
+        self._stale = {}
+        self._checkpoint_lock = asyncio.Lock()
+
+    def _pragmas(self):
+        opts = self.options
+        return [
+            f"PRAGMA busy_timeout = {int(opts.get('busy_timeout_ms', 5000))}",
+            f"PRAGMA cache_size = -{int(opts.get('cache_size_kb', 65536))}",
+            f"PRAGMA mmap_size = {int(opts.get('mmap_size', 268435456))}",
+            "PRAGMA temp_store = MEMORY",
+        ]
+
+    async def _connect(self, read_only=False):
+        if read_only:
+            uri = f"file:{urllib.parse.quote(self.path)}?mode=ro"
+            conn = await aiosqlite.connect(uri, uri=True)
+        else:
+            conn = await aiosqlite.connect(self.path)
+        conn.row_factory = aiosqlite.Row
+        for pragma in self._pragmas():
+            await conn.execute(pragma)
+        await conn.create_function("body_match", 7, BodyMatcher(), deterministic=True)
+        return conn
+
+    async def open(self, read_only=False):
+        """Open the connections; ``read_only`` pools (API workers) have no writer."""
+        self._idle = asyncio.Queue()
+        self._released = asyncio.Event()
+
+        if read_only:
+            await self._open_readers()
+            return
+
+        # 写连接先打开 (同时负责创建数据库文件并切换到 WAL)
+        self.writer = await self._connect()
+        # 新库启用增量 auto_vacuum，保留策略删除数据后可逐步归还磁盘空间
+        # (已有的库在 clear_all 执行 VACUUM 时转换)
+        await self.writer.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        await self.writer.execute("PRAGMA journal_mode = WAL")
+        synchronous = self.options.get("synchronous", "NORMAL")
+        await self.writer.execute(f"PRAGMA synchronous = {synchronous}")
+        # 关闭提交时的自动 checkpoint，由后台任务定期执行，不占用写入批次的时间
+        await self.writer.execute("PRAGMA wal_autocheckpoint = 0")
+        journal_limit = int(self.options.get("journal_size_limit", 67108864))
+        await self.writer.execute(f"PRAGMA journal_size_limit = {journal_limit}")
+
+        self._checkpointer = await self._connect()
+        await self._open_readers()
+
+    async def _open_readers(self):
+        for _ in range(self.size):
+            conn = await self._connect(read_only=True)
+            self._conns.append(conn)
+            self._idle.put_nowait(conn)
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Borrow a read-only connection."""
+        conn = await self._idle.get()
+        self._in_use += 1
+        try:
+            for name in self._stale.pop(conn, ()):
+                await self._detach(conn, name)
+            yield conn
+        finally:
+            try:
+                # 归还前结束未完成的读事务，避免长期持有旧快照阻止 checkpoint
+                if conn.in_transaction:
+                    await conn.rollback()
+            finally:
+                self._in_use -= 1
+                self._idle.put_nowait(conn)
+                self._released.set()
+
+    @asynccontextmanager
+    async def acquire_writer(self):
+        """Borrow the single writer connection (serialized by a lock)."""
+        if self.writer is None:
+            raise RuntimeError("SQLite pool was opened read-only")
+        async with self._write_lock:
+            try:
+                yield self.writer
+            finally:
+                if self.writer.in_transaction:
+                    await self.writer.rollback()
+
+    async def attach(self, conn, name, path):
+        """ATTACH a shard file as schema ``name``; returns True if it was not attached yet.
+
+        Readers attach read-only; the least recently used shard is detached
+        when the connection is at MAX_ATTACHED. Must be called outside a
+        transaction.
+        """
+        attached = self._attached.setdefault(conn, OrderedDict())
+        if name in attached:
+            attached.move_to_end(name)
+            return False
+        while len(attached) >= self.MAX_ATTACHED:
+            oldest = next(iter(attached))
+            await self._detach(conn, oldest)
+        if conn in self._conns:
+            target = f"file:{urllib.parse.quote(path)}?mode=ro"
+        else:
+            target = path
+        await conn.execute(f"ATTACH DATABASE ? AS {name}", (target,))
+        attached[name] = path
+        if conn is self.writer:
+            await conn.execute(f"PRAGMA {name}.journal_mode = WAL")
+            synchronous = self.options.get("synchronous", "NORMAL")
+            await conn.execute(f"PRAGMA {name}.synchronous = {synchronous}")
+        return True
+
+    async def _detach(self, conn, name):
+        attached = self._attached.get(conn)
+        if attached is None or name not in attached:
+            return
+        del attached[name]
+        await conn.execute(f"DETACH DATABASE {name}")
+
+    async def forget(self, name):
+        """Detach a dropped shard everywhere (call with the writer lock held, if any).
+
+        Readers may be in the middle of a query, so they detach the next
+        time they are borrowed.
+        """
+        await self._detach(self.writer, name)
+        async with self._checkpoint_lock:
+            await self._detach(self._checkpointer, name)
+        for conn in self._conns:
+            if name in self._attached.get(conn, ()):
+                self._stale.setdefault(conn, set()).add(name)
+
+    async def checkpoint(self, mode="PASSIVE"):
+        """Run a WAL checkpoint on a side connection.
+
+        PASSIVE checkpoints copy as many frames as possible without waiting
+        for readers or the writer, so capture batches keep committing.
+        Shards the writer currently has attached are checkpointed as well.
+        """
+        start = time.perf_counter()
+        async with self._checkpoint_lock:
+            async with self._checkpointer.execute(
+                f"PRAGMA wal_checkpoint({mode})"
+            ) as cursor:
+                busy, log_frames, checkpointed = await cursor.fetchone()
+            for name, path in list(self._attached.get(self.writer, {}).items()):
+                await self.attach(self._checkpointer, name, path)
+                async with self._checkpointer.execute(
+                    f"PRAGMA {name}.wal_checkpoint({mode})"
+                ) as cursor:
+                    await cursor.fetchone()
+        self.last_checkpoint = {
+            "mode": mode,
+            "busy": busy,
+            "wal_frames": log_frames,
+            "checkpointed_frames": checkpointed,
+            "duration_ms": round((time.perf_counter() - start) * 1000, 2),
+            "at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        return self.last_checkpoint
+
+    def wal_size(self):
+        try:
+            return os.path.getsize(f"{self.path}-wal")
+        except OSError:
+            return 0
+
+    async def close(self):
+        """Wait for borrowed connections to come back, then close them all."""
+        while self._in_use:
+            self._released.clear()
+            await self._released.wait()
+        async with self._write_lock:
+            conns = self._conns + [self._checkpointer, self.writer]
+            for conn in conns:
+                if conn is None:
+                    continue
+                try:
+                    await conn.close()
+                except Exception as e:
+                    logger.warning(f"Failed to close SQLite connection: {e}")
+        self._conns = []
+        self._attached = {}
+        self._stale = {}
+        self._checkpointer = None
+        self.writer = None
 
 
 class DatabaseManager:
     def __init__(self):
+        # 长连接池：由 init_db 创建，refresh_config 时退役并在下次 init_db 时关闭
+        self._pool = None
+        self._pool_type = None
+        self._retired_pools = []
+        self._pool_lock = asyncio.Lock()
+        # Write-behind 队列与后台写入任务 (在 FastAPI 事件循环中启动)
+        self._queue = None
+        self._writer_task = None
+        self._checkpoint_task = None
+        self._retention_task = None
+        self._follower_task = None
+        # 写入进程持有的文件锁 (见 acquire_writer_lock)
+        self._writer_lock = None
+        # API 工作进程只读打开存储 (见 open_follower)
+        self.read_only = False
+        # 写入进程发布的最小未落库 id，详情接口据此判断是否转发 (见 follow_writer)
+        self.uncommitted_from = None
+        # 增量统计：写入成功后累加，启动/清空时各重建一次
+        self.stats = StatsEngine()
+        self._stats_lock = asyncio.Lock()
+        # 主键由写入任务分配，便于在同一事务内同步全文索引
+        self._next_id = None
+        # 已分配 id 但尚未落库的行，详情接口先查这里
+        self._pending = {}
+        # 重新加载配置期间暂停接收新流量
+        self._intake_open = asyncio.Event()
+        self._intake_open.set()
+        self.fts_enabled = False
+        # 全文索引按 rowid 删除，或通过 requests_fts_text 保存的文本删除
+        self.fts_text_refs = False
+        self.fts_table_args = FTS_COLUMNS
+        # 保留策略删除过行、索引段待合并的 schema
+        self._fts_pruned = set()
+        # 按捕获时间划分的分区 (SQLite 分区文件 / MySQL 原生分区)
+        self.partitions = PartitionRegistry()
+        # 主体按需解码 (查看详情时)，结果缓存在 LRU 中
+        self.decoder = BodyDecoder()
+        self.writer_stats = {
+            "batches": 0,
+            "rows": 0,
+            "failed_rows": 0,
+            "last_batch_size": 0,
+            "max_batch_size": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "total_flush_ms": 0.0,
+        }
+        self.retention_stats = {
+            "runs": 0,
+            "deleted_rows": 0,
+            "freed_body_bytes": 0,
+            "last_run": None,
+            "last_deleted_rows": 0,
+            "last_duration_ms": 0.0,
+        }
         self.refresh_config()
 
     def refresh_config(self):
@@ -32,33 +648,171 @@ class DatabaseManager:
         self.db_type = config.get("db_type", "sqlite").lower()
         self.db_path = DB_PATH
         self.mysql_config = config.get("mysql", {})
+        self.sqlite_config = config.get("sqlite", {})
+        self.checkpoint_interval = float(
+            self.sqlite_config.get("checkpoint_interval_s", 30)
+        )
+
+        # 旧连接池不能在同步方法里关闭，先退役，由 init_db 排空后关闭
+        if self._pool is not None:
+            self._retired_pools.append((self._pool_type, self._pool))
+            self._pool = None
+            self._pool_type = None
+
+        body_config = config.get("bodies", {})
+        self.compress_min_bytes = int(body_config.get("compress_min_bytes", 1024))
+        self.compress_level = int(body_config.get("compress_level", 6))
+
+        search_config = config.get("search", {})
+        self.fts_body_chars = int(search_config.get("indexed_body_chars", 32768))
+
+        writer_config = config.get("writer", {})
+        self.batch_size = int(writer_config.get("batch_size", 500))
+        self.batch_interval = writer_config.get("batch_interval_ms", 50) / 1000
+        self.queue_size = int(writer_config.get("queue_size", 10000))
+
+        retention_config = config.get("retention", {})
+        self.retention_max_age_s = float(retention_config.get("max_age_hours", 0)) * 3600
+        self.retention_max_rows = int(retention_config.get("max_rows", 0))
+        self.retention_max_body_bytes = int(
+            float(retention_config.get("max_body_mb", 0)) * 1024 * 1024
+        )
+        self.retention_interval = float(retention_config.get("interval_s", 60))
+        self.retention_chunk = int(retention_config.get("chunk_size", 500))
+        self.retention_vacuum_pages = int(retention_config.get("vacuum_pages", 256))
+
+        partition_config = config.get("partitioning", {})
+        self.partitioning = bool(partition_config.get("enabled", False))
+        self.partition_granularity = partition_config.get("granularity", "day")
+        if self.partition_granularity not in GRANULARITIES:
+            logger.warning(
+                f"Unknown partition granularity {self.partition_granularity!r}, using day"
+            )
+            self.partition_granularity = "day"
+        self.partition_premake = int(partition_config.get("premake", 2))
+
+        export_config = config.get("export", {})
+        self.export_batch_rows = int(export_config.get("batch_rows", 200))
+
+        # 新的精度与主机上限在下次重建统计时生效
+        stats_config = config.get("stats", {})
+        self.stats.max_hosts = int(stats_config.get("latency_max_hosts", 1000))
+        self.stats.relative_accuracy = float(stats_config.get("latency_accuracy", 0.01))
+        self.shard_dir = SHARD_DIR
         logger.info(f"DatabaseManager configuration refreshed: type={self.db_type}")
 
     def get_placeholder(self):
         return "%s" if self.db_type == "mysql" else "?"
 
+    async def _open_pool(self):
+        async with self._pool_lock:
+            if self._pool is not None:
+                return
+            if self.db_type == "mysql":
+                self._pool = await aiomysql.create_pool(
+                    host=self.mysql_config.get("host", "127.0.0.1"),
+                    port=self.mysql_config.get("port", 3306),
+                    user=self.mysql_config.get("user", "root"),
+                    password=self.mysql_config.get("password", "root"),
+                    db=self.mysql_config.get("database", "proxy_insight"),
+                    minsize=int(self.mysql_config.get("pool_min_size", 1)),
+                    maxsize=int(self.mysql_config.get("pool_max_size", 10)),
+                    pool_recycle=int(self.mysql_config.get("pool_recycle", 3600)),
+                    autocommit=True,
+                )
+            else:
+                pool = SQLitePool(
+                    self.db_path,
+                    self.sqlite_config.get("pool_size", 4),
+                    self.sqlite_config,
+                )
+                await pool.open(read_only=self.read_only)
+                self._pool = pool
+            self._pool_type = self.db_type
+            logger.info(f"Connection pool opened for {self.db_type}")
+
+    @staticmethod
+    async def _close_pool(pool_type, pool):
+        if pool_type == "mysql":
+            # close() 拒绝新的借出，wait_closed() 等待借出的连接归还后关闭
+            pool.close()
+            await pool.wait_closed()
+        else:
+            await pool.close()
+        logger.info(f"Connection pool closed for {pool_type}")
+
+    async def close_pool(self):
+        """Drain and close the active pool and any pools retired by refresh_config."""
+        if self._pool is not None:
+            self._retired_pools.append((self._pool_type, self._pool))
+            self._pool = None
+            self._pool_type = None
+        await self._close_retired_pools()
+
+    async def _close_retired_pools(self):
+        while self._retired_pools:
+            pool_type, pool = self._retired_pools.pop()
+            try:
+                await self._close_pool(pool_type, pool)
+            except Exception as e:
+                logger.error(f"Failed to close {pool_type} pool: {e}")
+
     @asynccontextmanager
     async def get_conn(self):
-        """Returns a context manager for the database connection."""
+        """Returns a context manager for a pooled database connection."""
+        if self._pool is None:
+            await self._open_pool()
+        async with self._pool.acquire() as conn:
+            yield conn
+
+    @asynccontextmanager
+    async def get_write_conn(self):
+        """Returns a context manager for a connection that may write.
+
+        SQLite writes all go through the single dedicated writer connection;
+        MySQL simply borrows a pooled connection.
+        """
+        if self._pool is None:
+            await self._open_pool()
         if self.db_type == "mysql":
-            conn = await aiomysql.connect(
-                host=self.mysql_config.get("host", "127.0.0.1"),
-                port=self.mysql_config.get("port", 3306),
-                user=self.mysql_config.get("user", "root"),
-                password=self.mysql_config.get("password", "root"),
-                db=self.mysql_config.get("database", "proxy_insight"),
-                autocommit=True,
-            )
-            try:
+            async with self._pool.acquire() as conn:
                 yield conn
-            finally:
-                conn.close()
         else:
-            async with aiosqlite.connect(self.db_path) as db:
-                yield db
+            async with self._pool.acquire_writer() as conn:
+                yield conn
+
+    @staticmethod
+    async def _execute(conn, sql, params=()):
+        if isinstance(conn, aiosqlite.Connection):
+            async with conn.execute(sql, params) as cursor:
+                return cursor.rowcount
+        async with conn.cursor() as cur:
+            await cur.execute(sql, params)
+            return cur.rowcount
+
+    @staticmethod
+    async def _executemany(conn, sql, rows):
+        if isinstance(conn, aiosqlite.Connection):
+            await conn.executemany(sql, rows)
+        else:
+            async with conn.cursor() as cur:
+                await cur.executemany(sql, rows)
+
+    @staticmethod
+    async def _fetchall(conn, sql, params=()):
+        """Run a query and return rows as dicts on either backend."""
+        if isinstance(conn, aiosqlite.Connection):
+            async with conn.execute(sql, params) as cursor:
+                return [dict(row) for row in await cursor.fetchall()]
+        async with conn.cursor(aiomysql.DictCursor) as cur:
+            await cur.execute(sql, params)
+            return list(await cur.fetchall())
 
     async def init_db(self):
         """Initialize the database and create the requests table."""
+        # 配置变更后先排空并关闭旧连接池
+        await self._close_retired_pools()
+
         if self.db_type == "mysql":
             # Initial connection to create database if it doesn't exist
             temp_conn = await aiomysql.connect(
@@ -74,200 +828,2296 @@ class DatabaseManager:
                 )
             temp_conn.close()
 
+        await self._open_pool()
+        async with self.get_write_conn() as conn:
+            await self._create_tables(conn)
+            await self._migrate_schema(conn)
+            await self._ensure_search_index(conn)
+            await self._migrate_inline_bodies(conn)
+            if self.db_type == "mysql" and self.partitioning:
+                await self._ensure_mysql_partitions(conn)
+            await self._load_partitions(conn)
+            await self._make_shards_contentless(conn)
+            await self._load_next_id(conn)
+
+        await self.rebuild_stats()
+        logger.info(f"Database initialized using {self.db_type}")
+
+    async def open_follower(self):
+        """Open the database read-only for an API worker.
+
+        The capture process owns the schema, migrations and id allocation, so
+        only readers are opened and the search index and partitions are
+        looked up. The running aggregates are not rebuilt: they arrive with
+        the writer state (see follow_writer).
+        """
+        self.read_only = True
+        await self._close_retired_pools()
+        await self._open_pool()
         async with self.get_conn() as conn:
-            if self.db_type == "mysql":
-                async with conn.cursor() as cur:
-                    await cur.execute(
-                        """
-                        CREATE TABLE IF NOT EXISTS requests (
-                            id INT AUTO_INCREMENT PRIMARY KEY,
-                            method TEXT,
-                            url TEXT,
-                            status INT,
-                            time TEXT,
-                            request_headers LONGTEXT,
-                            request_body LONGTEXT,
-                            request_cookies LONGTEXT,
-                            response_headers LONGTEXT,
-                            response_body LONGTEXT,
-                            response_cookies LONGTEXT,
-                            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-                        )
-                    """
+            await self._detect_search_index(conn)
+            await self._load_partitions(conn)
+        logger.info(f"Database opened read-only using {self.db_type}")
+
+    async def _detect_search_index(self, conn):
+        """Read-only counterpart of _ensure_search_index: use the index the writer created."""
+        if isinstance(conn, aiosqlite.Connection):
+            rows = await self._fetchall(
+                conn,
+                "SELECT sql FROM sqlite_master WHERE name = 'requests_fts'",
+            )
+            if rows:
+                by_rowid = "contentless_delete" in rows[0]["sql"]
+                self.fts_text_refs = not by_rowid
+                self.fts_table_args = FTS_COLUMNS + (", contentless_delete=1" if by_rowid else "")
+        else:
+            rows = await self._fetchall(conn, "SHOW TABLES LIKE 'requests_search'")
+        self.fts_enabled = bool(rows)
+
+    async def _create_tables(self, conn):
+        """Create the requests, bodies and meta tables if they do not exist."""
+        if self.db_type == "mysql":
+            await self._execute(
+                conn,
+                """
+                CREATE TABLE IF NOT EXISTS requests (
+                    id INT AUTO_INCREMENT PRIMARY KEY,
+                    method TEXT,
+                    url TEXT,
+                    scheme VARCHAR(16),
+                    host VARCHAR(255),
+                    path TEXT,
+                    status_code INT,
+                    reason VARCHAR(255),
+                    latency_ms INT,
+                    captured_at BIGINT,
+                    request_headers LONGTEXT,
+                    request_cookies LONGTEXT,
+                    response_headers LONGTEXT,
+                    response_cookies LONGTEXT,
+                    request_body_hash CHAR(32),
+                    request_body_size BIGINT,
+                    response_body_hash CHAR(32),
+                    response_body_size BIGINT,
+                    request_content_type VARCHAR(255),
+                    request_content_encoding VARCHAR(64),
+                    response_content_type VARCHAR(255),
+                    response_content_encoding VARCHAR(64)
+                )
+            """,
+            )
+            await self._execute(
+                conn,
+                """
+                CREATE TABLE IF NOT EXISTS bodies (
+                    hash CHAR(32) PRIMARY KEY,
+                    size BIGINT,
+                    codec VARCHAR(8),
+                    data LONGBLOB,
+                    refcount INT
+                )
+            """,
+            )
+            await self._execute(
+                conn,
+                """
+                CREATE TABLE IF NOT EXISTS meta (
+                    name VARCHAR(64) PRIMARY KEY,
+                    value TEXT
+                )
+            """,
+            )
+        else:
+            await conn.execute(SQLITE_REQUESTS_TABLE.format(schema="main"))
+            # 主体按内容寻址去重存储，refcount 为引用该主体的请求数
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS bodies (
+                    hash TEXT PRIMARY KEY,
+                    size INTEGER,
+                    codec TEXT,
+                    data BLOB,
+                    refcount INTEGER
+                ) WITHOUT ROWID
+            """
+            )
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS meta (
+                    name TEXT PRIMARY KEY,
+                    value TEXT
+                )
+            """
+            )
+            # 分区登记表：每个分区文件覆盖的时间段与 id 范围
+            await conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS partitions (
+                    name TEXT PRIMARY KEY,
+                    start_ms INTEGER,
+                    end_ms INTEGER,
+                    min_id INTEGER,
+                    max_id INTEGER,
+                    row_count INTEGER
+                )
+            """
+            )
+            await conn.commit()
+
+    async def _stat_groups(self, conn, source="requests", where="", params=()):
+        """Grouped (status_class, host, latency_ms, total) rows of one table.
+
+        Latency is stored in whole milliseconds, so the groups stay few
+        enough to rebuild the latency sketches without reading every row.
+        """
+        cls_expr = "status_code DIV 100" if self.db_type == "mysql" else "status_code / 100"
+        rows = await self._fetchall(
+            conn,
+            f"""
+            SELECT {cls_expr} AS cls, host, latency_ms, COUNT(*) AS total
+            FROM {source} {where} GROUP BY cls, host, latency_ms
+        """,
+            params,
+        )
+        return [(r["cls"], r["host"], r["latency_ms"], r["total"]) for r in rows]
+
+    async def _window_stat_groups(self, since=None, until=None):
+        """Grouped stats over every partition overlapping ``[since, until)``."""
+        where, params = self._window_filter(since, until, column="captured_at")
+        where = f"WHERE {' AND '.join(where)}" if where else ""
+        groups = []
+        async with self.get_conn() as conn:
+            for part in self._sources(since, until):
+                schema = await self._attach_source(conn, part)
+                groups += await self._stat_groups(
+                    conn, self._table(schema, "requests"), where, tuple(params)
+                )
+        return groups
+
+    async def rebuild_stats(self):
+        """Recompute the running aggregates from the table (one grouped scan per partition)."""
+        async with self._stats_lock:
+            self.stats.load(await self._window_stat_groups())
+        logger.info(f"Stats rebuilt: {self.stats.total} rows")
+
+    async def _table_columns(self, conn, table):
+        if isinstance(conn, aiosqlite.Connection):
+            rows = await self._fetchall(conn, f"PRAGMA table_info({table})")
+            return {row["name"] for row in rows}
+        rows = await self._fetchall(conn, f"SHOW COLUMNS FROM {table}")
+        return {row["Field"] for row in rows}
+
+    async def _migrate_schema(self, conn):
+        """One-time upgrade of pre-typed-column tables, then ensure indexes."""
+        is_sqlite = isinstance(conn, aiosqlite.Connection)
+        columns = await self._table_columns(conn, "requests")
+        missing = [c for c in ADDED_COLUMNS if c not in columns]
+        if missing:
+            logger.info(f"Migrating requests table, adding columns: {missing}")
+            for name in missing:
+                sqlite_type, mysql_type = ADDED_COLUMNS[name]
+                col_type = sqlite_type if is_sqlite else mysql_type
+                await self._execute(
+                    conn, f"ALTER TABLE requests ADD COLUMN {name} {col_type}"
+                )
+            if is_sqlite:
+                await conn.commit()
+
+        if "status" in columns and "time" in columns:
+            await self._backfill_typed_columns(conn, "timestamp" in columns)
+
+        if is_sqlite:
+            for name, cols in INDEXES.items():
+                await conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS {name} ON requests ({cols})"
+                )
+            await conn.commit()
+        else:
+            rows = await self._fetchall(conn, "SHOW INDEX FROM requests")
+            existing = {row["Key_name"] for row in rows}
+            for name, cols in INDEXES.items():
+                if name not in existing:
+                    await self._execute(
+                        conn, f"ALTER TABLE requests ADD INDEX {name} ({cols})"
                     )
+
+    async def _ensure_search_index(self, conn):
+        """Create the full-text index (FTS5 / FULLTEXT) and backfill it once.
+
+        The index covers url and the first indexed_body_chars of each body,
+        keyed by requests.id, and is written in the same transaction as the
+        requests rows. On SQLite it is a contentless FTS5 table, so the text
+        is tokenized but not stored again next to the compressed bodies;
+        MySQL's FULLTEXT index needs the text in a (page-compressed) table.
+        """
+        n = self.fts_body_chars
+        columns = await self._table_columns(conn, "requests")
+        inline = "request_body" in columns
+        if isinstance(conn, aiosqlite.Connection):
+            rows = await self._fetchall(
+                conn,
+                "SELECT sql FROM sqlite_master WHERE name = 'requests_fts'",
+            )
+            created = not rows
+            # 已是无内容表时沿用它的删除方式，否则按当前 SQLite 版本选择
+            sql = rows[0]["sql"] if rows else ""
+            if "content=''" in sql:
+                by_rowid = "contentless_delete" in sql
             else:
+                by_rowid = FTS_CONTENTLESS_DELETE
+            self.fts_text_refs = not by_rowid
+            self.fts_table_args = FTS_COLUMNS + (", contentless_delete=1" if by_rowid else "")
+            try:
                 await conn.execute(
-                    """
-                    CREATE TABLE IF NOT EXISTS requests (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        method TEXT,
-                        url TEXT,
-                        status INTEGER,
-                        time TEXT,
-                        request_headers TEXT,
-                        request_body TEXT,
-                        request_cookies TEXT,
-                        response_headers TEXT,
-                        response_body TEXT,
-                        response_cookies TEXT,
-                        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-                    )
-                """
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS requests_fts "
+                    f"USING fts5({self.fts_table_args})"
                 )
+            except Exception as e:
+                logger.warning(f"FTS5 unavailable, search falls back to LIKE: {e}")
+                self.fts_enabled = False
+                return
+            if self.fts_text_refs:
+                await conn.execute(FTS_TEXT_TABLE.format(schema="main"))
+            await self._make_contentless(conn)
+            bodies = (
+                f"substr(request_body, 1, {n}), substr(response_body, 1, {n})"
+                if inline
+                else "'', ''"
+            )
+            backfill = (
+                "INSERT INTO requests_fts (rowid, url, request_body, response_body) "
+                f"SELECT id, url, {bodies} FROM requests WHERE id > ? AND id <= ?"
+            )
+        else:
+            rows = await self._fetchall(conn, "SHOW TABLES LIKE 'requests_search'")
+            created = not rows
+            table = """
+                CREATE TABLE IF NOT EXISTS requests_search (
+                    id INT PRIMARY KEY,
+                    url TEXT,
+                    request_body MEDIUMTEXT,
+                    response_body MEDIUMTEXT,
+                    FULLTEXT KEY ft_requests_search (url, request_body, response_body)
+                ) ENGINE=InnoDB
+            """
+            try:
+                # FULLTEXT 需要保存文本，至少按页压缩
+                await self._execute(conn, f"{table} ROW_FORMAT=COMPRESSED")
+            except aiomysql.Error as e:
+                logger.warning(f"requests_search is not compressed: {e}")
+                await self._execute(conn, table)
+            bodies = (
+                f"LEFT(request_body, {n}), LEFT(response_body, {n})" if inline else "'', ''"
+            )
+            backfill = (
+                "INSERT INTO requests_search (id, url, request_body, response_body) "
+                f"SELECT id, url, {bodies} FROM requests WHERE id > %s AND id <= %s"
+            )
+
+        if created:
+            rows = await self._fetchall(conn, "SELECT MAX(id) AS max_id FROM requests")
+            max_id = rows[0]["max_id"] or 0
+            for low in range(0, max_id, 5000):
+                await self._execute(conn, backfill, (low, low + 5000))
                 await conn.commit()
-        logger.info(f"Database initialized using {self.db_type}")
+            if max_id:
+                logger.info(f"Full-text index built for existing rows (max id {max_id})")
+        await conn.commit()
+        self.fts_enabled = True
 
-    async def save_request(self, data):
-        """Save a captured request/response pair to the database."""
+    async def _make_contentless(self, conn, schema=None):
+        """Convert a requests_fts that stores its own text copy (older versions) in place.
+
+        The text is read back from the old table, so no body is decoded. The
+        copy and the swap happen in one transaction; an interrupted
+        conversion starts over.
+        """
+        rows = await self._fetchall(
+            conn,
+            f"SELECT sql FROM {self._table(schema, 'sqlite_master')} "
+            "WHERE name = 'requests_fts'",
+        )
+        if not rows or "content=''" in rows[0]["sql"]:
+            return
+        fts = self._table(schema, "requests_fts")
+        staging = self._table(schema, "requests_fts_new")
+        await conn.execute(f"DROP TABLE IF EXISTS {staging}")
+        await conn.execute(f"CREATE VIRTUAL TABLE {staging} USING fts5({self.fts_table_args})")
+        if self.fts_text_refs:
+            await conn.execute(FTS_TEXT_TABLE.format(schema=schema or "main"))
+        last = 0
         try:
-            p = self.get_placeholder()
-            sql = f"""
-                INSERT INTO requests (
-                    method, url, status, time,
-                    request_headers, request_body, request_cookies,
-                    response_headers, response_body, response_cookies
-                ) VALUES ({p}, {p}, {p}, {p}, {p}, {p}, {p}, {p}, {p}, {p})
-            """
-            values = (
-                data["method"],
-                data["url"],
-                data["status"],
-                data["time"],
-                json.dumps(data["request"]["headers"]),
-                data["request"]["body"],
-                json.dumps(data["request"]["cookies"]),
-                json.dumps(data["response"]["headers"]),
-                data["response"]["body"],
-                json.dumps(data["response"]["cookies"]),
+            while True:
+                chunk = await self._fetchall(
+                    conn,
+                    f"SELECT rowid, url, request_body, response_body FROM {fts} "
+                    "WHERE rowid > ? ORDER BY rowid LIMIT 1000",
+                    (last,),
+                )
+                if not chunk:
+                    break
+                last = chunk[-1]["rowid"]
+                await conn.executemany(
+                    f"INSERT INTO {staging} (rowid, url, request_body, response_body) "
+                    "VALUES (?, ?, ?, ?)",
+                    [
+                        (r["rowid"], r["url"], r["request_body"], r["response_body"])
+                        for r in chunk
+                    ],
+                )
+                if self.fts_text_refs:
+                    await self._save_index_texts(conn, schema, chunk)
+            await conn.execute(f"DROP TABLE {fts}")
+            await conn.execute(f"ALTER TABLE {staging} RENAME TO requests_fts")
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+        logger.info(f"Full-text index of {schema or 'main'} no longer keeps a text copy")
+
+    async def _save_index_texts(self, conn, schema, rows):
+        """Store the index texts of converted rows in bodies and reference them."""
+
+        def pack():
+            batch = self._new_body_batch()
+            refs = [
+                (
+                    r["rowid"],
+                    batch.add(encode_index_text(r["request_body"]))[0],
+                    batch.add(encode_index_text(r["response_body"]))[0],
+                )
+                for r in rows
+            ]
+            return batch, refs
+
+        batch, refs = await asyncio.to_thread(pack)
+        await self._executemany(conn, self._bodies_upsert_sql(), batch.rows())
+        await conn.executemany(
+            f"INSERT OR REPLACE INTO {self._table(schema, 'requests_fts_text')} "
+            "(id, request_hash, response_hash) VALUES (?, ?, ?)",
+            refs,
+        )
+
+    async def _unindex_rows(self, conn, schema, rows):
+        """Remove rows from a requests_fts that has no contentless_delete.
+
+        The 'delete' command is given exactly the texts the rows were indexed
+        with, read back from bodies. Returns the body references held by
+        those texts, for the caller to release.
+        """
+        texts = self._table(schema, "requests_fts_text")
+        ids = tuple(r["id"] for r in rows)
+        in_list = ", ".join("?" * len(ids))
+        refs = await self._fetchall(
+            conn,
+            f"SELECT id, request_hash, response_hash FROM {texts} WHERE id IN ({in_list})",
+            ids,
+        )
+        hashes = Counter(
+            h for r in refs for h in (r["request_hash"], r["response_hash"]) if h
+        )
+        blobs = await self._fetch_blobs(conn, list(hashes))
+        urls = {r["id"]: r["url"] for r in rows}
+
+        def values():
+            decoded = {None: ""}
+            for digest, blob in blobs.items():
+                decoded[digest] = unpack_body(blob["codec"], blob["data"]).decode(
+                    "utf-8", "surrogatepass"
+                )
+            return [
+                (r["id"], urls[r["id"]], decoded[r["request_hash"]], decoded[r["response_hash"]])
+                for r in refs
+                # 文本缺失时无法精确删除，宁可留下索引条目 (查询时被 JOIN 过滤)
+                if r["request_hash"] in decoded and r["response_hash"] in decoded
+            ]
+
+        await conn.executemany(
+            f"INSERT INTO {self._table(schema, 'requests_fts')} "
+            "(requests_fts, rowid, url, request_body, response_body) "
+            "VALUES ('delete', ?, ?, ?, ?)",
+            await asyncio.to_thread(values),
+        )
+        await conn.execute(f"DELETE FROM {texts} WHERE id IN ({in_list})", ids)
+        return hashes
+
+    async def _make_shards_contentless(self, conn):
+        """Run _make_contentless on every registered shard, once per database."""
+        if self.db_type == "mysql" or not self.fts_enabled:
+            return
+        if await self._get_meta(conn, "fts_contentless"):
+            return
+        for name in list(self.partitions.partitions):
+            if name != LEGACY_PARTITION:
+                await self._pool.attach(conn, name, self._shard_path(name))
+                await self._make_contentless(conn, name)
+        await self._set_meta(conn, "fts_contentless", 1)
+
+    async def _get_meta(self, conn, name):
+        p = "?" if isinstance(conn, aiosqlite.Connection) else "%s"
+        rows = await self._fetchall(
+            conn, f"SELECT value FROM meta WHERE name = {p}", (name,)
+        )
+        return rows[0]["value"] if rows else None
+
+    async def _set_meta(self, conn, name, value):
+        if isinstance(conn, aiosqlite.Connection):
+            sql = "INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)"
+        else:
+            sql = "REPLACE INTO meta (name, value) VALUES (%s, %s)"
+        await self._execute(conn, sql, (name, str(value)))
+        await conn.commit()
+
+    def _bodies_upsert_sql(self):
+        if self.db_type == "mysql":
+            return (
+                "INSERT INTO bodies (hash, size, codec, data, refcount) "
+                "VALUES (%s, %s, %s, %s, %s) "
+                "ON DUPLICATE KEY UPDATE refcount = refcount + VALUES(refcount)"
+            )
+        return (
+            "INSERT INTO bodies (hash, size, codec, data, refcount) "
+            "VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(hash) DO UPDATE SET refcount = refcount + excluded.refcount"
+        )
+
+    def _new_body_batch(self):
+        return BodyBatch(self.compress_min_bytes, self.compress_level)
+
+    async def _migrate_inline_bodies(self, conn, chunk=500):
+        """Move bodies stored inline in legacy rows into the body store (once)."""
+        columns = await self._table_columns(conn, "requests")
+        if "request_body" not in columns:
+            return
+        if await self._get_meta(conn, "inline_bodies_migrated"):
+            return
+
+        p = "?" if isinstance(conn, aiosqlite.Connection) else "%s"
+        last_id = 0
+        migrated = 0
+        while True:
+            rows = await self._fetchall(
+                conn,
+                f"SELECT id, request_body, response_body FROM requests "
+                f"WHERE id > {p} ORDER BY id LIMIT {chunk}",
+                (last_id,),
+            )
+            if not rows:
+                break
+            last_id = rows[-1]["id"]
+
+            def pack(rows=rows):
+                batch = self._new_body_batch()
+                refs = [
+                    (*batch.add(r["request_body"]), *batch.add(r["response_body"]), r["id"])
+                    for r in rows
+                    if r["request_body"] or r["response_body"]
+                ]
+                return batch, refs
+
+            batch, refs = await asyncio.to_thread(pack)
+            if not refs:
+                continue
+            if not isinstance(conn, aiosqlite.Connection):
+                await conn.begin()
+            await self._executemany(conn, self._bodies_upsert_sql(), batch.rows())
+            await self._executemany(
+                conn,
+                f"UPDATE requests SET request_body_hash = {p}, request_body_size = {p}, "
+                f"response_body_hash = {p}, response_body_size = {p}, "
+                f"request_body = NULL, response_body = NULL WHERE id = {p}",
+                refs,
             )
+            await conn.commit()
+            migrated += len(refs)
+
+        await self._set_meta(conn, "inline_bodies_migrated", 1)
+        if migrated:
+            logger.info(f"Moved inline bodies of {migrated} rows into the body store")
+
+    async def _load_next_id(self, conn):
+        rows = await self._fetchall(conn, "SELECT MAX(id) AS max_id FROM requests")
+        max_id = rows[0]["max_id"] or 0
+        if isinstance(conn, aiosqlite.Connection):
+            # AUTOINCREMENT 的序列在清空后仍保留，沿用它保证 id 单调递增
+            seq = await self._fetchall(
+                conn, "SELECT seq FROM sqlite_sequence WHERE name = 'requests'"
+            )
+            if seq:
+                max_id = max(max_id, seq[0]["seq"] or 0)
+            # 分区文件中的 id 不能复用
+            max_id = max(
+                [max_id] + [part.max_id or 0 for part in self.partitions.partitions.values()]
+            )
+        # 已删除的分区与清空前用过的 id 同样不能复用
+        max_id = max(max_id, int(await self._get_meta(conn, "max_id") or 0))
+        self._next_id = max(self._next_id or 0, max_id + 1)
+
+    async def _backfill_typed_columns(self, conn, has_timestamp, chunk=1000):
+        """Fill typed columns of legacy rows from the old status/time/timestamp values."""
+        is_sqlite = isinstance(conn, aiosqlite.Connection)
+        p = "?" if is_sqlite else "%s"
+        ts_col = "timestamp" if has_timestamp else "NULL AS timestamp"
+        migrated = 0
+        while True:
+            rows = await self._fetchall(
+                conn,
+                f"SELECT id, url, status, time, {ts_col} FROM requests "
+                f"WHERE captured_at IS NULL ORDER BY id LIMIT {chunk}",
+            )
+            if not rows:
+                break
+
+            updates = []
+            for row in rows:
+                status_code, reason = parse_status(row["status"])
+                scheme, host, path = split_url(row["url"])
+                ts = row["timestamp"]
+                if isinstance(ts, str):
+                    # SQLite CURRENT_TIMESTAMP 为 UTC
+                    ts = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S").replace(
+                        tzinfo=timezone.utc
+                    )
+                captured_at = int(ts.timestamp() * 1000) if ts else 0
+                updates.append(
+                    (
+                        scheme,
+                        host,
+                        path,
+                        status_code,
+                        reason,
+                        parse_latency(row["time"]),
+                        captured_at,
+                        row["id"],
+                    )
+                )
+
+            await self._executemany(
+                conn,
+                f"UPDATE requests SET scheme = {p}, host = {p}, path = {p}, "
+                f"status_code = {p}, reason = {p}, latency_ms = {p}, captured_at = {p} "
+                f"WHERE id = {p}",
+                updates,
+            )
+            if is_sqlite:
+                await conn.commit()
+            migrated += len(rows)
+
+        if migrated:
+            logger.info(f"Backfilled typed columns for {migrated} legacy rows")
+
+    def _shard_path(self, name):
+        return os.path.join(self.shard_dir, f"{name}.db")
+
+    def _remove_shard_files(self, name):
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(self._shard_path(name) + suffix)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Failed to remove partition file of {name}: {e}")
+
+    @staticmethod
+    def _table(schema, table):
+        return f"{schema}.{table}" if schema else table
+
+    async def _load_partitions(self, conn):
+        """Rebuild the partition registry from the database.
+
+        On SQLite the rows written before partitioning was enabled stay in the
+        main file and are registered as the legacy partition.
+        """
+        self.partitions.clear()
+        if self.db_type == "mysql":
+            start = None
+            for r in await self._mysql_partition_rows(conn):
+                if r["name"] is None:
+                    # 表未分区
+                    break
+                end = None if r["bound"] in (None, "MAXVALUE") else int(r["bound"])
+                self.partitions.add(
+                    Partition(r["name"], start, end, rows=r["table_rows"])
+                )
+                start = end
+            return
 
+        rows = await self._fetchall(
+            conn,
+            "SELECT MIN(id) AS min_id, MAX(id) AS max_id, COUNT(*) AS n FROM requests",
+        )
+        legacy = rows[0]
+        self.partitions.add(
+            Partition(
+                LEGACY_PARTITION, None, None, legacy["min_id"], legacy["max_id"], legacy["n"]
+            )
+        )
+        for r in await self._fetchall(conn, "SELECT * FROM partitions"):
+            if not os.path.exists(self._shard_path(r["name"])):
+                if self.read_only:
+                    # 由写入进程注销
+                    continue
+                logger.warning(f"Partition file of {r['name']} is missing, unregistering it")
+                await conn.execute("DELETE FROM partitions WHERE name = ?", (r["name"],))
+                continue
+            self.partitions.add(
+                Partition(
+                    r["name"],
+                    r["start_ms"],
+                    r["end_ms"],
+                    r["min_id"],
+                    r["max_id"],
+                    r["row_count"],
+                )
+            )
+        await conn.commit()
+        if self.partitions.sharded():
+            logger.info(f"Loaded {len(self.partitions.partitions) - 1} partitions")
+
+    async def _mysql_partition_rows(self, conn):
+        return await self._fetchall(
+            conn,
+            "SELECT PARTITION_NAME AS name, PARTITION_DESCRIPTION AS bound, "
+            "TABLE_ROWS AS table_rows FROM information_schema.PARTITIONS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'requests' "
+            "ORDER BY PARTITION_ORDINAL_POSITION",
+        )
+
+    def _upcoming_partitions(self):
+        """(name, start_ms, end_ms) of the current period and the next ``premake`` ones."""
+        period_ms = GRANULARITIES[self.partition_granularity] * 1000
+        now = int(time.time() * 1000)
+        return [
+            partition_for(now + i * period_ms, self.partition_granularity)
+            for i in range(self.partition_premake + 1)
+        ]
+
+    async def _ensure_mysql_partitions(self, conn):
+        """Convert requests to RANGE partitions on captured_at and add upcoming periods.
+
+        Existing rows end up in one legacy partition. New periods are split
+        off the (empty) MAXVALUE partition ahead of time, so inserts never
+        wait for DDL.
+        """
+        upcoming = self._upcoming_partitions()
+        rows = await self._mysql_partition_rows(conn)
+        if not rows or rows[0]["name"] is None:
+            logger.info("Converting requests table to RANGE partitions on captured_at")
+            await self._execute(
+                conn, "UPDATE requests SET captured_at = 0 WHERE captured_at IS NULL"
+            )
+            # 分区键必须出现在主键中
+            await self._execute(
+                conn,
+                "ALTER TABLE requests MODIFY id INT NOT NULL AUTO_INCREMENT, "
+                "MODIFY captured_at BIGINT NOT NULL DEFAULT 0, "
+                "DROP PRIMARY KEY, ADD PRIMARY KEY (id, captured_at)",
+            )
+            defs = [
+                f"PARTITION {MYSQL_LEGACY_PARTITION} VALUES LESS THAN ({upcoming[0][1]})"
+            ]
+            defs += [
+                f"PARTITION {name} VALUES LESS THAN ({end})" for name, _, end in upcoming
+            ]
+            defs.append(f"PARTITION {MYSQL_MAX_PARTITION} VALUES LESS THAN MAXVALUE")
+            await self._execute(
+                conn,
+                f"ALTER TABLE requests PARTITION BY RANGE (captured_at) ({', '.join(defs)})",
+            )
+            return
+
+        names = {r["name"] for r in rows}
+        if MYSQL_MAX_PARTITION not in names:
+            logger.warning(
+                f"requests is partitioned without a {MYSQL_MAX_PARTITION} partition, "
+                "not creating upcoming partitions"
+            )
+            return
+        last = max(
+            (int(r["bound"]) for r in rows if r["bound"] not in (None, "MAXVALUE")),
+            default=0,
+        )
+        new = [(name, end) for name, _, end in upcoming if end > last and name not in names]
+        if not new:
+            return
+        defs = [f"PARTITION {name} VALUES LESS THAN ({end})" for name, end in new]
+        defs.append(f"PARTITION {MYSQL_MAX_PARTITION} VALUES LESS THAN MAXVALUE")
+        await self._execute(
+            conn,
+            f"ALTER TABLE requests REORGANIZE PARTITION {MYSQL_MAX_PARTITION} "
+            f"INTO ({', '.join(defs)})",
+        )
+        logger.info(f"Created partitions {[name for name, _ in new]}")
+
+    async def maintain_partitions(self):
+        """Create upcoming MySQL partitions (SQLite shards are created on first write)."""
+        if self.db_type != "mysql" or not self.partitioning:
+            return
+        async with self.get_write_conn() as conn:
+            await self._ensure_mysql_partitions(conn)
+            await self._load_partitions(conn)
+
+    async def refresh_partitions(self):
+        """Re-read the partition registry maintained by another process.
+
+        Used by read-only API workers: only the small ``partitions`` table is
+        read (the legacy partition's bounds come with the writer state), and
+        shards dropped by the writer process are detached.
+        """
+        if self.db_type == "mysql":
             async with self.get_conn() as conn:
-                if self.db_type == "mysql":
-                    async with conn.cursor() as cur:
-                        await cur.execute(sql, values)
-                else:
-                    await conn.execute(sql, values)
-                    await conn.commit()
+                await self._load_partitions(conn)
+            return
+        async with self.get_conn() as conn:
+            rows = await self._fetchall(conn, "SELECT * FROM partitions")
+        seen = {LEGACY_PARTITION}
+        for r in rows:
+            seen.add(r["name"])
+            part = self.partitions.get(r["name"])
+            if part is None:
+                self.partitions.add(
+                    Partition(
+                        r["name"],
+                        r["start_ms"],
+                        r["end_ms"],
+                        r["min_id"],
+                        r["max_id"],
+                        r["row_count"],
+                    )
+                )
+            else:
+                part.min_id, part.max_id = r["min_id"], r["max_id"]
+                part.rows = r["row_count"] or 0
+        for name in list(self.partitions.partitions):
+            if name not in seen:
+                self.partitions.remove(name)
+                await self._pool.forget(name)
+
+    def writer_state(self):
+        """State the capture process publishes to API workers every second.
+
+        Besides the running aggregates it carries the bounds of the legacy
+        partition (kept in memory by the writer, never in the ``partitions``
+        table) and the lowest id that may not be committed yet.
+        """
+        legacy = self.partitions.get(LEGACY_PARTITION)
+        return {
+            "stats": self.stats.state(),
+            "legacy": legacy.to_dict() if legacy is not None else None,
+            "uncommitted_from": min(self._pending, default=self._next_id or 1),
+        }
+
+    def follow_writer(self, state):
+        """Apply a writer_state() received from the capture process."""
+        self.stats.restore(state["stats"])
+        self.uncommitted_from = state["uncommitted_from"]
+        legacy = self.partitions.get(LEGACY_PARTITION)
+        if legacy is not None and state["legacy"] is not None:
+            legacy.min_id = state["legacy"]["min_id"]
+            legacy.max_id = state["legacy"]["max_id"]
+            legacy.rows = state["legacy"]["rows"]
+
+    def may_be_uncommitted(self, request_id):
+        """True if a flow missing from the tables may still be queued in the writer process."""
+        return self.uncommitted_from is None or request_id >= self.uncommitted_from
+
+    def start_follower(self, interval=1.0):
+        """Keep the partition registry in sync with a writer running in another process."""
+        if self._follower_task is None or self._follower_task.done():
+            self._follower_task = asyncio.create_task(self._follower_loop(interval))
+
+    async def stop_follower(self):
+        if self._follower_task is not None:
+            self._follower_task.cancel()
+            try:
+                await self._follower_task
+            except asyncio.CancelledError:
+                pass
+            self._follower_task = None
+
+    async def _follower_loop(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh_partitions()
+            except Exception as e:
+                logger.warning(f"Partition refresh failed: {e}")
+
+    async def _create_shard_tables(self, conn, name):
+        await conn.execute(SQLITE_REQUESTS_TABLE.format(schema=name))
+        for index, cols in INDEXES.items():
+            await conn.execute(
+                f"CREATE INDEX IF NOT EXISTS {name}.{index} ON requests ({cols})"
+            )
+        if self.fts_enabled:
+            await conn.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {name}.requests_fts "
+                f"USING fts5({self.fts_table_args})"
+            )
+            if self.fts_text_refs:
+                await conn.execute(FTS_TEXT_TABLE.format(schema=name))
+        await conn.commit()
+
+    async def _open_partition(self, conn, name, start_ms, end_ms):
+        """Attach the shard file a write group belongs to, creating and registering it if new."""
+        os.makedirs(self.shard_dir, exist_ok=True)
+        if await self._pool.attach(conn, name, self._shard_path(name)):
+            await self._create_shard_tables(conn, name)
+        part = self.partitions.get(name)
+        if part is None:
+            part = Partition(name, start_ms, end_ms)
+            await conn.execute(
+                "INSERT OR REPLACE INTO partitions (name, start_ms, end_ms, row_count) "
+                "VALUES (?, ?, ?, 0)",
+                (name, start_ms, end_ms),
+            )
+            await conn.commit()
+            self.partitions.add(part)
+            logger.info(f"Created partition {name}")
+        return part
+
+    def _sources(self, since=None, until=None):
+        """Partitions a query over ``[since, until)`` has to visit.
+
+        Only SQLite shards are visited one by one; MySQL prunes its native
+        partitions from the captured_at predicate, so there (and without
+        shards) the single unqualified requests table is returned as None.
+        """
+        if self.db_type == "mysql" or not self.partitions.sharded():
+            return [None]
+        return self.partitions.overlapping(since, until)
+
+    async def _committed_max_id(self, sources):
+        """Highest committed id across ``sources``, read from the tables.
+
+        Used instead of the in-process id allocator, which API workers never
+        advance and which runs ahead of the rows actually written.
+        """
+        high = 0
+        async with self.get_conn() as conn:
+            for part in sources:
+                schema = await self._attach_source(conn, part)
+                rows = await self._fetchall(
+                    conn, f"SELECT MAX(id) AS max_id FROM {self._table(schema, 'requests')}"
+                )
+                high = max(high, rows[0]["max_id"] or 0)
+        return high
+
+    async def _attach_source(self, conn, part):
+        """Make a partition visible on a pooled reader; returns its schema name."""
+        if part is None:
+            return None
+        if part.name == LEGACY_PARTITION:
+            return "main"
+        await self._pool.attach(conn, part.name, self._shard_path(part.name))
+        return part.name
+
+    def _insert_sql(self, schema=None):
+        p = self.get_placeholder()
+        return (
+            f"INSERT INTO {self._table(schema, 'requests')} ({', '.join(INSERT_COLUMNS)}) "
+            f"VALUES ({', '.join([p] * len(INSERT_COLUMNS))})"
+        )
+
+    def _search_insert_sql(self, schema=None):
+        if self.db_type == "mysql":
+            return (
+                "INSERT INTO requests_search (id, url, request_body, response_body) "
+                "VALUES (%s, %s, %s, %s)"
+            )
+        return (
+            f"INSERT INTO {self._table(schema, 'requests_fts')} "
+            "(rowid, url, request_body, response_body) VALUES (?, ?, ?, ?)"
+        )
+
+    @staticmethod
+    def _to_row(data):
+        """Convert a captured flow dict into a row dict for the write batch."""
+        status_code = data.get("status_code")
+        reason = data.get("reason")
+        if status_code is None:
+            status_code, reason = parse_status(data.get("status"))
+        latency_ms = data.get("latency_ms")
+        if latency_ms is None:
+            latency_ms = parse_latency(data.get("time"))
+
+        host = data.get("host")
+        if host is None:
+            scheme, host, path = split_url(data["url"])
+        else:
+            scheme, path = data.get("scheme", ""), data.get("path", "")
+        request, response = data["request"], data["response"]
+
+        return {
+            "method": data["method"],
+            "url": data["url"],
+            "scheme": scheme,
+            "host": host,
+            "path": path,
+            "status_code": status_code,
+            "reason": reason or "",
+            "latency_ms": latency_ms,
+            "captured_at": data.get("captured_at") or int(time.time() * 1000),
+            "request_headers": json.dumps(data["request"]["headers"]),
+            "request_cookies": json.dumps(data["request"]["cookies"]),
+            "response_headers": json.dumps(data["response"]["headers"]),
+            "response_cookies": json.dumps(data["response"]["cookies"]),
+            "request_body": data["request"]["body"],
+            "response_body": data["response"]["body"],
+            "request_content_type": request.get("content_type")
+            or header_value(request["headers"], "content-type"),
+            "request_content_encoding": request.get("content_encoding")
+            or header_value(request["headers"], "content-encoding"),
+            "response_content_type": response.get("content_type")
+            or header_value(response["headers"], "content-type"),
+            "response_content_encoding": response.get("content_encoding")
+            or header_value(response["headers"], "content-encoding"),
+        }
+
+    async def save_request(self, data):
+        """Queue a captured request/response pair for batched persistence.
+
+        Returns the id allocated to the flow (None if it could not be saved).
+        """
+        start = time.perf_counter()
+        try:
+            row = self._to_row(data)
         except Exception as e:
             logger.error(
                 f"DB SAVE ERROR: {e} | Data keys: {list(data.keys())} | URL: {data.get('url')}"
             )
-            import traceback
+            return None
+        converted = time.perf_counter()
+        _TO_ROW_STAGE.observe(converted - start)
 
-            logger.error(traceback.format_exc())
+        await self._intake_open.wait()
+        opened = time.perf_counter()
+        _INTAKE_WAIT_STAGE.observe(opened - converted)
+        if not self.writer_running():
+            # 写入任务未启动 (例如独立脚本)，直接同步落库
+            await self._write_batch([row])
+            return row.get("id")
 
-    async def get_requests(self, limit=50, offset=0, query=None):
-        """Fetch historical requests from the database."""
-        async with self.get_conn() as conn:
-            p = self.get_placeholder()
-            sql = "SELECT * FROM requests"
-            params = []
+        # 入队时即分配 id，实时推送可以直接引用 /api/requests/{id}
+        if self._next_id is not None:
+            row["id"] = self._next_id
+            self._next_id += 1
+            self._pending[row["id"]] = row
 
-            if query:
-                sql += f" WHERE url LIKE {p} OR method LIKE {p} OR request_body LIKE {p} OR response_body LIKE {p}"
-                q = f"%{query}%"
-                params.extend([q, q, q, q])
+        # 有界队列：写入跟不上时在此处产生背压
+        await self._queue.put(row)
+        _ENQUEUE_STAGE.observe(time.perf_counter() - opened)
+        return row.get("id")
 
-            sql += f" ORDER BY id DESC LIMIT {p} OFFSET {p}"
-            params.extend([limit, offset])
+    async def bulk_insert(self, flows):
+        """Write a large batch of flow dicts directly, bypassing the write queue.
 
-            if self.db_type == "mysql":
-                async with conn.cursor(aiomysql.DictCursor) as cur:
-                    await cur.execute(sql, tuple(params))
-                    rows = await cur.fetchall()
-            else:
-                conn.row_factory = aiosqlite.Row
-                async with conn.execute(sql, tuple(params)) as cursor:
-                    rows = await cursor.fetchall()
+        Used by bulk imports: the whole batch goes through ``_write_batch``
+        (one transaction per partition touched). Returns the number of rows
+        written; rows that could not be converted or written are logged and
+        left out of the count.
+        """
+        rows = []
+        for data in flows:
+            try:
+                rows.append(self._to_row(data))
+            except Exception as e:
+                logger.error(f"DB IMPORT ERROR: {e} | URL: {data.get('url')}")
+        await self._intake_open.wait()
+        if not rows:
+            return 0
+        return await self._write_batch(rows)
 
-            result = []
-            for row in rows:
-                d = dict(row)
-                ts = d["timestamp"]
-                # Convert datetime to string if it's a MySQL datetime object
-                if isinstance(ts, datetime):
-                    ts = ts.strftime("%Y-%m-%d %H:%M:%S")
-
-                item = {
-                    "id": d["id"],
-                    "method": d["method"],
-                    "url": d["url"],
-                    "status": d["status"],
-                    "time": d["time"],
-                    "timestamp": ts,
-                    "request": {
-                        "headers": json.loads(d["request_headers"]),
-                        "body": d["request_body"],
-                        "cookies": json.loads(d["request_cookies"]),
-                    },
-                    "response": {
-                        "headers": json.loads(d["response_headers"]),
-                        "body": d["response_body"],
-                        "cookies": json.loads(d["response_cookies"]),
-                    },
-                }
-                result.append(item)
-            return result
+    def _observe_persist_lag(self, rows):
+        # 以响应结束时间 (captured_at + latency_ms) 为起点，包含通道排队与批量等待
+        now_ms = time.time() * 1000
+        lag = PERSIST_LAG_SECONDS.labels(backend=self.db_type)
+        for row in rows:
+            lag.observe(max(now_ms - row["captured_at"] - (row["latency_ms"] or 0), 0) / 1000)
+
+    def pending_saves(self):
+        """Rows accepted by save_request but not yet committed."""
+        queued = self._queue.qsize() if self._queue is not None else 0
+        return max(len(self._pending), queued)
+
+    def writer_running(self):
+        return self._writer_task is not None and not self._writer_task.done()
+
+    def _writer_lock_path(self):
+        if self.db_type == "mysql":
+            cfg = self.mysql_config
+            name = (
+                f"mysql-{cfg.get('host', '127.0.0.1')}-{cfg.get('port', 3306)}-"
+                f"{cfg.get('database', 'proxy_insight')}.writer.lock"
+            )
+            return os.path.join(os.path.dirname(DB_PATH), name)
+        return f"{DB_PATH}.writer.lock"
+
+    def acquire_writer_lock(self):
+        """Become the only process writing to this database.
+
+        Ids are allocated from an in-memory counter, so a second writer (for
+        example ``importer.py`` next to the running app) would reuse ids and
+        its rows would never reach the app's running stats. Raises
+        RuntimeError if another process holds the lock.
+        """
+        if self._writer_lock is not None:
+            return
+        path = self._writer_lock_path()
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            owner = os.pread(fd, 32, 0).decode(errors="replace").strip() or "?"
+            os.close(fd)
+            raise RuntimeError(
+                f"Database is being written by another process (pid {owner}, lock {path})"
+            )
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, str(os.getpid()).encode(), 0)
+        self._writer_lock = fd
+
+    def release_writer_lock(self):
+        if self._writer_lock is not None:
+            # 锁文件保留，删除会让等待中的进程锁住已解除链接的文件
+            fcntl.flock(self._writer_lock, fcntl.LOCK_UN)
+            os.close(self._writer_lock)
+            self._writer_lock = None
+
+    async def start_writer(self):
+        """Start the background write-behind task on the running loop."""
+        if self.writer_running():
+            return
+        self.acquire_writer_lock()
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._writer_task = asyncio.create_task(self._writer_loop())
+        self._checkpoint_task = asyncio.create_task(self._checkpoint_loop())
+        self._retention_task = asyncio.create_task(self._retention_loop())
+        logger.info(
+            f"DB writer started: batch_size={self.batch_size}, "
+            f"interval={int(self.batch_interval * 1000)}ms, queue_size={self.queue_size}"
+        )
+
+    async def flush(self):
+        """Wait until every queued row has been written."""
+        if self.writer_running():
+            await self._queue.join()
+
+    async def reload(self):
+        """Apply a configuration change: drain the queue, then re-open storage.
+
+        New captures wait in save_request while the backend is switched, so
+        ids are never allocated against the old database.
+        """
+        self._intake_open.clear()
+        try:
+            await self.flush()
+            self.refresh_config()
+            if self._writer_lock is not None:
+                # 切换数据库后锁住新的目标
+                self.release_writer_lock()
+                try:
+                    self.acquire_writer_lock()
+                except RuntimeError as e:
+                    logger.warning(str(e))
+            await self.init_db()
+        finally:
+            self._intake_open.set()
+
+    async def stop_writer(self):
+        """Flush pending rows and stop the background writer."""
+        if not self.writer_running():
+            return
+        await self.flush()
+        self._writer_task.cancel()
+        try:
+            await self._writer_task
+        except asyncio.CancelledError:
+            pass
+        self._writer_task = None
+        for task in (self._checkpoint_task, self._retention_task):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._checkpoint_task = None
+        self._retention_task = None
+        self.release_writer_lock()
+        logger.info("DB writer stopped")
+
+    async def _writer_loop(self):
+        while True:
+            batch = [await self._queue.get()]
+            # 未攒满一批时等待一个时间窗口，让更多流量进入同一事务
+            if self._queue.qsize() < self.batch_size - 1:
+                await asyncio.sleep(self.batch_interval)
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+
+            try:
+                if await self._write_batch(batch):
+                    self._observe_persist_lag(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _checkpoint_loop(self):
+        """Periodically checkpoint the SQLite WAL without blocking the writer."""
+        while True:
+            await asyncio.sleep(self.checkpoint_interval)
+            pool = self._pool
+            if not isinstance(pool, SQLitePool):
+                continue
+            try:
+                result = await pool.checkpoint()
+                logger.debug(f"WAL checkpoint: {result}")
+            except Exception as e:
+                logger.warning(f"WAL checkpoint failed: {e}")
 
-    async def get_stats(self):
-        """Get summary statistics from the database."""
+    def retention_enabled(self):
+        return bool(
+            self.retention_max_age_s
+            or self.retention_max_rows
+            or self.retention_max_body_bytes
+        )
+
+    async def _retention_loop(self):
+        """Periodically enforce the [retention] limits in small chunks."""
+        while True:
+            await asyncio.sleep(self.retention_interval)
+            try:
+                await self.maintain_partitions()
+            except Exception as e:
+                logger.warning(f"Partition maintenance failed: {e}")
+            if not self.retention_enabled():
+                continue
+            try:
+                await self.enforce_retention()
+            except Exception as e:
+                logger.warning(f"Retention pass failed: {e}")
+
+    async def _retention_boundary(self):
+        """Highest id that the row-count limit requires deleting (None if none).
+
+        Only used without SQLite shards; the age limit is applied by capture
+        time instead (see ``_prune_chunk``), because imported flows make ids
+        and capture times diverge.
+        """
+        if (
+            not self.retention_max_rows
+            or self.stats.total <= self.retention_max_rows
+            or self.partitions.sharded()
+        ):
+            return None
         async with self.get_conn() as conn:
+            rows = await self._fetchall(
+                conn,
+                f"SELECT id FROM requests ORDER BY id DESC "
+                f"LIMIT 1 OFFSET {self.retention_max_rows}",
+            )
+        return rows[0]["id"] if rows else None
 
-            async def fetch_one(sql):
+    async def _body_bytes(self):
+        """Bytes held by the stored bodies and by the full-text index of their text.
+
+        Both count towards ``max_body_mb``. The index is measured as the
+        FTS5 segment blocks of every partition, or as the size InnoDB reports
+        for requests_search. Returns ``(body_bytes, index_bytes)``.
+        """
+        async with self.get_conn() as conn:
+            rows = await self._fetchall(
+                conn, "SELECT COALESCE(SUM(LENGTH(data)), 0) AS used FROM bodies"
+            )
+            body_bytes = int(rows[0]["used"] or 0)
+            index_bytes = 0
+            if self.fts_enabled and self.db_type == "mysql":
+                rows = await self._fetchall(
+                    conn,
+                    "SELECT DATA_LENGTH + INDEX_LENGTH AS used FROM information_schema.TABLES "
+                    "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'requests_search'",
+                )
+                index_bytes = int(rows[0]["used"] or 0) if rows else 0
+            elif self.fts_enabled:
+                for part in self._sources():
+                    schema = await self._attach_source(conn, part)
+                    rows = await self._fetchall(
+                        conn,
+                        "SELECT COALESCE(SUM(LENGTH(block)), 0) AS used "
+                        f"FROM {self._table(schema, 'requests_fts_data')}",
+                    )
+                    index_bytes += int(rows[0]["used"] or 0)
+        return body_bytes, index_bytes
+
+    async def _decrement_bodies(self, conn, refs):
+        """Drop ``{hash: n}`` body references and delete orphans inside the caller's transaction.
+
+        Returns the number of body bytes freed.
+        """
+        p = self.get_placeholder()
+        await self._executemany(
+            conn,
+            f"UPDATE bodies SET refcount = refcount - {p} WHERE hash = {p}",
+            [(n, h) for h, n in refs.items()],
+        )
+        in_list = ", ".join([p] * len(refs))
+        orphaned = f"FROM bodies WHERE refcount <= 0 AND hash IN ({in_list})"
+        result = await self._fetchall(
+            conn,
+            f"SELECT COALESCE(SUM(LENGTH(data)), 0) AS freed {orphaned}",
+            tuple(refs),
+        )
+        await self._execute(conn, f"DELETE {orphaned}", tuple(refs))
+        return int(result[0]["freed"] or 0)
+
+    async def _release_bodies(self, refs):
+        """Release the body references of a dropped partition in short transactions."""
+        freed = 0
+        items = list(refs.items())
+        for i in range(0, len(items), self.retention_chunk):
+            async with self.get_write_conn() as conn:
                 if self.db_type == "mysql":
-                    async with conn.cursor() as cur:
-                        await cur.execute(sql)
-                        res = await cur.fetchone()
-                        return res[0]
+                    await conn.begin()
+                try:
+                    freed += await self._decrement_bodies(
+                        conn, dict(items[i : i + self.retention_chunk])
+                    )
+                    await conn.commit()
+                except Exception:
+                    await conn.rollback()
+                    raise
+            await asyncio.sleep(0)
+        return freed
+
+    async def _prune_chunk(self, boundary=None, partition=None, limit=None, cutoff=None):
+        """Delete the oldest chunk of rows in one short transaction.
+
+        Rows are limited to ids up to ``boundary`` and/or capture times before
+        ``cutoff`` (epoch ms), taken in id order. ``partition`` selects a
+        SQLite shard (default: the requests table). Returns
+        ``(deleted_rows, freed_body_bytes)``. Body refcounts, the full-text
+        index, the partition registry and the running stats are updated in
+        step.
+        """
+        p = self.get_placeholder()
+        schema = None
+        if partition is not None and partition.name != LEGACY_PARTITION:
+            schema = partition.name
+        else:
+            partition = self.partitions.get(LEGACY_PARTITION)
+        requests = self._table(schema, "requests")
+        conditions, params = [], []
+        if boundary is not None:
+            conditions.append(f"id <= {p}")
+            params.append(boundary)
+        if cutoff is not None:
+            conditions.append(f"captured_at < {p}")
+            params.append(cutoff)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        params = tuple(params)
+        async with self._stats_lock:
+            async with self.get_write_conn() as conn:
+                if schema is not None:
+                    await self._pool.attach(conn, schema, self._shard_path(schema))
+                rows = await self._fetchall(
+                    conn,
+                    f"SELECT id, url, host, status_code, latency_ms, "
+                    f"request_body_hash, response_body_hash "
+                    f"FROM {requests} {where} ORDER BY id LIMIT {limit or self.retention_chunk}",
+                    params,
+                )
+                if not rows:
+                    return 0, 0
+                # 按捕获时间筛选时 id 不一定连续 (导入的旧流量)，按 id 列表删除
+                ids = tuple(r["id"] for r in rows)
+                in_list = ", ".join([p] * len(ids))
+                refs = Counter(
+                    h
+                    for r in rows
+                    for h in (r["request_body_hash"], r["response_body_hash"])
+                    if h
+                )
+                freed = 0
+                if self.db_type == "mysql":
+                    await conn.begin()
+                try:
+                    await self._execute(
+                        conn, f"DELETE FROM {requests} WHERE id IN ({in_list})", ids
+                    )
+                    if self.fts_enabled and self.db_type != "mysql":
+                        self._fts_pruned.add(schema or "main")
+                    if self.fts_enabled and self.fts_text_refs:
+                        refs.update(await self._unindex_rows(conn, schema, rows))
+                    elif self.fts_enabled:
+                        if self.db_type == "mysql":
+                            sql = f"DELETE FROM requests_search WHERE id IN ({in_list})"
+                        else:
+                            sql = (
+                                f"DELETE FROM {self._table(schema, 'requests_fts')} "
+                                f"WHERE rowid IN ({in_list})"
+                            )
+                        await self._execute(conn, sql, ids)
+                    if refs:
+                        freed = await self._decrement_bodies(conn, refs)
+                    remaining = await self._fetchall(
+                        conn, f"SELECT MIN(id) AS low FROM {requests}"
+                    )
+                    low = remaining[0]["low"]
+                    if schema is not None:
+                        await self._execute(
+                            conn,
+                            "UPDATE partitions SET min_id = ?, row_count = row_count - ? "
+                            "WHERE name = ?",
+                            (low, len(rows), schema),
+                        )
+                    await conn.commit()
+                except Exception:
+                    await conn.rollback()
+                    raise
+            for r in rows:
+                self.stats.remove(r["status_code"], r["latency_ms"], r["host"])
+            if partition is not None:
+                partition.rows = max(partition.rows - len(rows), 0)
+                if low is not None:
+                    partition.min_id = low
+        return len(rows), freed
+
+    async def _drop_partition(self, part):
+        """Expire a whole partition: unlink its SQLite shard or DROP the MySQL partition.
+
+        Row-level work is limited to one grouped scan for the stats and body
+        references. The references are released after the partition is gone,
+        so an interruption can only leak bodies, never free ones still in use.
+        """
+        mysql = self.db_type == "mysql"
+        async with self._stats_lock:
+            async with self.get_write_conn() as conn:
+                if mysql:
+                    source = f"requests PARTITION ({part.name})"
                 else:
-                    async with conn.execute(sql) as cursor:
-                        res = await cursor.fetchone()
-                        return res[0]
+                    await self._pool.attach(conn, part.name, self._shard_path(part.name))
+                    source = f"{part.name}.requests"
+                texts = ""
+                if not mysql and self.fts_text_refs:
+                    table = f"{part.name}.requests_fts_text"
+                    texts = (
+                        f" UNION ALL SELECT request_hash FROM {table}"
+                        f" UNION ALL SELECT response_hash FROM {table}"
+                    )
+                refs = await self._fetchall(
+                    conn,
+                    f"SELECT hash, COUNT(*) AS n FROM ("
+                    f"SELECT request_body_hash AS hash FROM {source} "
+                    f"UNION ALL SELECT response_body_hash AS hash FROM {source}{texts}"
+                    f") h WHERE hash IS NOT NULL GROUP BY hash",
+                )
+                groups = await self._stat_groups(conn, source)
+                if mysql:
+                    if self.fts_enabled:
+                        await self._execute(
+                            conn,
+                            f"DELETE s FROM requests_search s JOIN {source} r ON r.id = s.id",
+                        )
+                    await self._execute(
+                        conn, f"ALTER TABLE requests DROP PARTITION {part.name}"
+                    )
+                else:
+                    await conn.execute("DELETE FROM partitions WHERE name = ?", (part.name,))
+                    # 记录已分配过的最大 id，重启后不会复用被删除分区的 id
+                    await self._set_meta(conn, "max_id", (self._next_id or 1) - 1)
+                    await self._pool.forget(part.name)
+            self.partitions.remove(part.name)
+            self.stats.merge(groups, sign=-1)
 
-            total = await fetch_one("SELECT COUNT(*) FROM requests")
-            success = await fetch_one(
-                "SELECT COUNT(*) FROM requests WHERE status >= 200 AND status < 400"
+        if not mysql:
+            self._remove_shard_files(part.name)
+        freed = await self._release_bodies({r["hash"]: r["n"] for r in refs})
+        deleted = sum(int(total or 0) for _, _, _, total in groups)
+        logger.info(f"Dropped partition {part.name} ({deleted} rows)")
+        return deleted, freed
+
+    async def _prune_oldest(self, limit=None):
+        """Delete up to ``limit`` (default: one chunk) of the oldest rows.
+
+        With SQLite shards the oldest partition is pruned; a shard that would
+        be emptied is dropped as a whole.
+        """
+        limit = limit or self.retention_chunk
+        if not self.partitions.sharded():
+            return await self._prune_chunk(limit=min(limit, self.retention_chunk))
+        for part in self.partitions.oldest_first():
+            if not part.rows:
+                continue
+            if part.name != LEGACY_PARTITION and part.rows <= limit:
+                return await self._drop_partition(part)
+            n, freed = await self._prune_chunk(
+                partition=part, limit=min(limit, self.retention_chunk)
             )
-            error = await fetch_one("SELECT COUNT(*) FROM requests WHERE status >= 400")
+            if n:
+                return n, freed
+            # 登记的行数与实际不符 (例如外部修改)，以实际为准
+            part.rows = 0
+        return 0, 0
 
-            # Simple average latency
-            sql_time = "SELECT time FROM requests"
-            if self.db_type == "mysql":
-                async with conn.cursor() as cur:
-                    await cur.execute(sql_time)
-                    times = await cur.fetchall()
-            else:
-                async with conn.execute(sql_time) as cursor:
-                    times = await cursor.fetchall()
-
-            if times:
-                import re
-
-                latencies = []
-                for t in times:
-                    match = re.search(r"(\d+)", t[0])
-                    if match:
-                        latencies.append(int(match.group(1)))
-                avg_latency = sum(latencies) / len(latencies) if latencies else 0
+    async def _merge_search_index(self):
+        """Merge the FTS5 segments of the partitions retention deleted rows from.
+
+        Deleted rows only leave the index (and stop counting towards
+        max_body_mb) once the segments holding them are merged. The merge
+        runs in steps of a few hundred pages, each in its own transaction.
+        """
+        while self._fts_pruned:
+            schema = self._fts_pruned.pop()
+            if schema != "main" and schema not in self.partitions.partitions:
+                # 分区已整体删除
+                continue
+            while True:
+                async with self.get_write_conn() as conn:
+                    if schema != "main":
+                        await self._pool.attach(conn, schema, self._shard_path(schema))
+                    before = conn.total_changes
+                    await conn.execute(
+                        f"INSERT INTO {schema}.requests_fts (requests_fts, rank) "
+                        "VALUES ('merge', -256)"
+                    )
+                    await conn.commit()
+                    # total_changes 增加不到 2 表示已没有可合并的段
+                    done = conn.total_changes - before < 2
+                if done:
+                    break
+                await asyncio.sleep(0)
+
+    async def _reclaim_free_pages(self):
+        """Return SQLite free pages to the OS with incremental_vacuum, a few at a time."""
+        if self.db_type == "mysql" or not self.retention_vacuum_pages:
+            return
+        async with self.get_write_conn() as conn:
+            rows = await self._fetchall(conn, "PRAGMA auto_vacuum")
+        if not rows or rows[0]["auto_vacuum"] != 2:
+            # 旧库未启用增量 auto_vacuum (incremental_vacuum 不起作用)，空闲页只能留给后续写入复用
+            return
+        while True:
+            async with self.get_write_conn() as conn:
+                rows = await self._fetchall(conn, "PRAGMA freelist_count")
+                if not rows or not rows[0]["freelist_count"]:
+                    return
+                # 每次只归还有限的空闲页，避免长时间占用写连接
+                await self._fetchall(
+                    conn, f"PRAGMA incremental_vacuum({self.retention_vacuum_pages})"
+                )
+                await conn.commit()
+            await asyncio.sleep(0)
+
+    async def enforce_retention(self):
+        """Delete the oldest flows until the age, row-count and body-size limits hold.
+
+        Partitions whose whole period is past ``max_age_hours`` are dropped
+        at once. Other work is split into chunks of ``chunk_size`` rows, each
+        in its own short transaction, so capture batches interleave with the
+        pruning.
+        """
+        start = time.perf_counter()
+        deleted = freed = 0
+        if self.retention_max_age_s:
+            cutoff = int((time.time() - self.retention_max_age_s) * 1000)
+            for part in self.partitions.expired(cutoff):
+                n, f = await self._drop_partition(part)
+                deleted += n
+                freed += f
+            # 未分区的旧表 (或 MySQL 整表) 按捕获时间删除
+            while True:
+                n, f = await self._prune_chunk(cutoff=cutoff)
+                deleted += n
+                freed += f
+                if n < self.retention_chunk:
+                    break
+                await asyncio.sleep(0)
+
+        boundary = await self._retention_boundary()
+        while boundary is not None:
+            n, f = await self._prune_chunk(boundary)
+            deleted += n
+            freed += f
+            if n < self.retention_chunk:
+                break
+            await asyncio.sleep(0)
+
+        if self.retention_max_rows and self.partitions.sharded():
+            while self.stats.total > self.retention_max_rows:
+                n, f = await self._prune_oldest(self.stats.total - self.retention_max_rows)
+                if not n:
+                    break
+                deleted += n
+                freed += f
+                await asyncio.sleep(0)
+
+        if self.retention_max_body_bytes:
+            body_bytes, index_bytes = await self._body_bytes()
+            used = body_bytes + index_bytes
+            # 索引的空间在段合并后才释放，按每行的平均大小估算
+            index_per_row = index_bytes / self.stats.total if self.stats.total else 0
+            while used > self.retention_max_body_bytes:
+                n, f = await self._prune_oldest()
+                if not n:
+                    break
+                deleted += n
+                freed += f
+                used -= f + n * index_per_row
+                await asyncio.sleep(0)
+
+        if deleted:
+            await self._merge_search_index()
+            await self._reclaim_free_pages()
+
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        stats = self.retention_stats
+        stats["runs"] += 1
+        stats["deleted_rows"] += deleted
+        stats["freed_body_bytes"] += freed
+        stats["last_run"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        stats["last_deleted_rows"] = deleted
+        stats["last_duration_ms"] = round(elapsed_ms, 2)
+        if deleted:
+            logger.info(
+                f"Retention pruned {deleted} rows, freed {freed} body bytes "
+                f"in {elapsed_ms:.0f}ms"
+            )
+        return {"deleted_rows": deleted, "freed_body_bytes": freed}
+
+    def _pack_batch(self, rows):
+        """Hash, deduplicate and compress the bodies of a batch (runs in a worker thread).
+
+        Bodies are stored as raw wire bytes; only the full-text index copy is
+        decoded here, so the capture path never decodes anything.
+        """
+        batch = self._new_body_batch()
+        for row in rows:
+            for side in ("request", "response"):
+                body = row[f"{side}_body"]
+                row[f"{side}_body_hash"], row[f"{side}_body_size"] = batch.add(body)
+                if self.fts_enabled:
+                    text = row[f"{side}_index_text"] = index_text(
+                        body,
+                        self.fts_body_chars,
+                        row[f"{side}_content_encoding"],
+                        row[f"{side}_content_type"],
+                    )
+                    if self.fts_text_refs:
+                        row[f"{side}_index_hash"] = batch.add(encode_index_text(text))[0]
+        return batch
+
+    def _pack_groups(self, rows):
+        """Split a batch by target partition and pack each group's bodies (worker thread).
+
+        Returns ``[(partition_key, rows, bodies)]``; the key is None when
+        rows go to the unpartitioned requests table.
+        """
+        if not self.partitioning or self.db_type == "mysql":
+            return [(None, rows, self._pack_batch(rows))]
+        groups = {}
+        for row in rows:
+            key = partition_for(row["captured_at"], self.partition_granularity)
+            groups.setdefault(key, []).append(row)
+        return [(key, group, self._pack_batch(group)) for key, group in groups.items()]
+
+    async def _write_batch(self, rows):
+        """Insert a batch of rows; one transaction per partition the batch touches."""
+        start = time.perf_counter()
+        written = 0
+        try:
+            # 哈希与压缩是 CPU 密集操作，放到线程中执行，不阻塞事件循环
+            groups = await asyncio.to_thread(self._pack_groups, rows)
+            packed = time.perf_counter()
+            _PACK_STAGE.observe(packed - start)
+            for key, group, bodies in groups:
+                await self._write_group(key, group, bodies)
+                written += len(group)
+            _WRITE_STAGE.observe(time.perf_counter() - packed)
+        except Exception as e:
+            self.writer_stats["failed_rows"] += len(rows) - written
+            logger.error(f"DB BATCH WRITE ERROR: {e} | rows: {len(rows) - written}")
+            import traceback
+
+            logger.error(traceback.format_exc())
+        finally:
+            for row in rows:
+                self._pending.pop(row.get("id"), None)
+        if not written:
+            return 0
+
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        stats = self.writer_stats
+        stats["batches"] += 1
+        stats["rows"] += written
+        stats["last_batch_size"] = written
+        stats["max_batch_size"] = max(stats["max_batch_size"], written)
+        stats["last_flush_ms"] = round(elapsed_ms, 2)
+        stats["max_flush_ms"] = round(max(stats["max_flush_ms"], elapsed_ms), 2)
+        stats["total_flush_ms"] += elapsed_ms
+        DB_SAVE_SECONDS.labels(backend=self.db_type).observe(elapsed_ms / 1000)
+        return written
+
+    async def _write_group(self, key, rows, bodies):
+        """Insert rows of one partition with one executemany inside a single transaction."""
+        async with self._stats_lock:
+            async with self.get_write_conn() as conn:
+                if self._next_id is None:
+                    await self._load_next_id(conn)
+                for row in rows:
+                    if row.get("id") is None:
+                        row["id"] = self._next_id
+                        self._next_id += 1
+                ids = [row["id"] for row in rows]
+
+                # ATTACH 不能在事务中执行，先打开分区文件
+                part = schema = None
+                if key is not None:
+                    part = await self._open_partition(conn, *key)
+                    schema = part.name
+                else:
+                    part = self.partitions.get(LEGACY_PARTITION)
+
+                if self.db_type == "mysql":
+                    await conn.begin()
+                try:
+                    await self._executemany(
+                        conn,
+                        self._insert_sql(schema),
+                        [tuple(row[c] for c in INSERT_COLUMNS) for row in rows],
+                    )
+                    await self._executemany(
+                        conn, self._bodies_upsert_sql(), bodies.rows()
+                    )
+                    if self.fts_enabled:
+                        await self._executemany(
+                            conn,
+                            self._search_insert_sql(schema),
+                            [
+                                (
+                                    row["id"],
+                                    row["url"],
+                                    row.get("request_index_text", ""),
+                                    row.get("response_index_text", ""),
+                                )
+                                for row in rows
+                            ],
+                        )
+                    if self.fts_text_refs:
+                        await self._executemany(
+                            conn,
+                            f"INSERT INTO {self._table(schema, 'requests_fts_text')} "
+                            "(id, request_hash, response_hash) VALUES (?, ?, ?)",
+                            [
+                                (row["id"], row["request_index_hash"], row["response_index_hash"])
+                                for row in rows
+                            ],
+                        )
+                    if schema is not None:
+                        low = min(ids) if part.min_id is None else min(part.min_id, *ids)
+                        high = max(ids) if part.max_id is None else max(part.max_id, *ids)
+                        await self._execute(
+                            conn,
+                            "UPDATE partitions SET min_id = ?, max_id = ?, "
+                            "row_count = row_count + ? WHERE name = ?",
+                            (low, high, len(rows), schema),
+                        )
+                    await conn.commit()
+                except Exception:
+                    await conn.rollback()
+                    raise
+            # 仅统计已提交的行
+            if part is not None:
+                part.record(ids)
+            for row in rows:
+                self.stats.add(row["status_code"], row["latency_ms"], row["host"])
+
+    def get_writer_stats(self):
+        """Return write-behind counters for status output."""
+        stats = dict(self.writer_stats)
+        batches = stats["batches"]
+        stats["total_flush_ms"] = round(stats["total_flush_ms"], 2)
+        stats["avg_batch_size"] = round(stats["rows"] / batches, 1) if batches else 0
+        stats["avg_flush_ms"] = (
+            round(stats["total_flush_ms"] / batches, 2) if batches else 0
+        )
+        stats["queue_depth"] = self._queue.qsize() if self._queue else 0
+        stats["running"] = self.writer_running()
+        return stats
+
+    def get_storage_status(self):
+        """Return backend storage details (WAL size, last checkpoint) for status output."""
+        partitions = self.partitions.oldest_first()
+        status = {
+            "type": self.db_type,
+            "retention": dict(self.retention_stats),
+            "partitioning": {
+                "enabled": self.partitioning,
+                "granularity": self.partition_granularity,
+                "partitions": len(partitions),
+                "oldest": partitions[0].to_dict() if partitions else None,
+                "newest": partitions[-1].to_dict() if partitions else None,
+            },
+        }
+        pool = self._pool
+        if isinstance(pool, SQLitePool):
+            status.update(
+                {
+                    "journal_mode": "wal",
+                    "db_size": (
+                        os.path.getsize(self.db_path)
+                        if os.path.exists(self.db_path)
+                        else 0
+                    ),
+                    "wal_size": pool.wal_size(),
+                    "last_checkpoint": pool.last_checkpoint,
+                }
+            )
+        elif pool is not None:
+            status.update(
+                {"pool_size": pool.size, "pool_free": pool.freesize}
+            )
+        return status
+
+    @staticmethod
+    def _status_range(status):
+        """Translate a status filter ("404", "4xx") into an integer range."""
+        status = str(status).strip().lower()
+        if len(status) == 3 and status.endswith("xx") and status[0].isdigit():
+            low = int(status[0]) * 100
+            return low, low + 100
+        code = int(status)
+        return code, code + 1
+
+    # 列表页只需要的列 (不读取头部、Cookie 与主体)
+    SUMMARY_COLUMNS = (
+        "id", "method", "url", "host", "status_code", "reason", "latency_ms", "captured_at"
+    )
+    # 解码主体所需的列 (见 body_key)
+    BODY_KEY_COLUMNS = tuple(
+        f"{side}_{column}"
+        for side in ("request", "response")
+        for column in ("body_hash", "content_encoding", "content_type")
+    )
+
+    @staticmethod
+    def _format_summary(d):
+        return {
+            "id": d["id"],
+            "method": d["method"],
+            "url": d["url"],
+            "host": d["host"],
+            "status": f"{d['status_code'] or ''} {d['reason'] or ''}".strip(),
+            "status_code": d["status_code"],
+            "time": f"{d['latency_ms'] or 0}ms",
+            "latency_ms": d["latency_ms"],
+            "timestamp": format_timestamp(d["captured_at"]),
+            "captured_at": d["captured_at"],
+        }
+
+    def _format_detail(self, d, request_body, response_body):
+        item = self._format_summary(d)
+        item["request"] = {
+            "headers": json.loads(d["request_headers"]),
+            "cookies": json.loads(d["request_cookies"]),
+            **request_body,
+        }
+        item["response"] = {
+            "headers": json.loads(d["response_headers"]),
+            "cookies": json.loads(d["response_cookies"]),
+            **response_body,
+        }
+        return item
+
+    @staticmethod
+    def _body_key(d, side):
+        """Decode-cache key of one side: (hash, content-encoding, content-type)."""
+        return body_key(d, side)
+
+    async def _fetch_blobs(self, conn, hashes):
+        """Fetch stored (still compressed) bodies by hash; returns {hash: row}."""
+        hashes = [h for h in set(hashes) if h]
+        if not hashes:
+            return {}
+        p = self.get_placeholder()
+        rows = await self._fetchall(
+            conn,
+            f"SELECT hash, codec, data FROM bodies WHERE hash IN ({', '.join([p] * len(hashes))})",
+            tuple(hashes),
+        )
+        return {r["hash"]: r for r in rows}
+
+    async def _decode_side(self, d, side, blobs):
+        """Decode one body for display, going through the decode cache."""
+        key = self._body_key(d, side)
+        digest, content_encoding, content_type = key
+        if digest:
+            cached = self.decoder.get(key)
+            if cached is not None:
+                return cached
+            blob = blobs.get(digest)
+            if blob is not None:
+                result = await self.decoder.run(
+                    decode_stored, blob["codec"], blob["data"], content_encoding, content_type
+                )
+                self.decoder.put(key, result)
+                return result
+        # 尚未落库的行，或迁移未完成的旧行仍带有内联主体
+        raw = d.get(f"{side}_body")
+        if not raw:
+            return {"body": "", "binary": False, "size": 0, "raw_size": 0}
+        return await self.decoder.run(
+            decode_body, to_bytes(raw), content_encoding, content_type
+        )
+
+    @timed_query("detail")
+    async def get_request(self, request_id):
+        """Load one flow with headers, cookies and decoded bodies; None if it does not exist."""
+        d = self._pending.get(request_id)
+        blobs = {}
+        if d is None:
+            p = self.get_placeholder()
+            if self._sources() == [None]:
+                candidates = [None]
             else:
-                avg_latency = 0
+                candidates = self.partitions.holding_id(request_id)
+            async with self.get_conn() as conn:
+                rows = []
+                for part in candidates:
+                    schema = await self._attach_source(conn, part)
+                    rows = await self._fetchall(
+                        conn,
+                        f"SELECT * FROM {self._table(schema, 'requests')} WHERE id = {p}",
+                        (request_id,),
+                    )
+                    if rows:
+                        break
+                if not rows:
+                    return None
+                d = rows[0]
+                # 解码缓存命中的主体无需再读取
+                missing = [
+                    self._body_key(d, side)[0]
+                    for side in ("request", "response")
+                    if self._body_key(d, side) not in self.decoder
+                ]
+                blobs = await self._fetch_blobs(conn, missing)
+        request_body = await self._decode_side(d, "request", blobs)
+        response_body = await self._decode_side(d, "response", blobs)
+        return self._format_detail(d, request_body, response_body)
 
-            return {
-                "total": total,
-                "success": success,
-                "error": error,
-                "avg_latency": f"{int(avg_latency)}ms",
-            }
+    def _window_filter(self, since=None, until=None, column="r.captured_at"):
+        """WHERE conditions and params restricting capture time to ``[since, until)`` (epoch ms)."""
+        p = self.get_placeholder()
+        where, params = [], []
+        if since is not None:
+            where.append(f"{column} >= {p}")
+            params.append(int(since))
+        if until is not None:
+            where.append(f"{column} < {p}")
+            params.append(int(until))
+        return where, params
 
-    async def clear_all(self):
-        """Clear all historical requests."""
+    def _list_filters(self, host=None, status=None, since=None, until=None):
+        """WHERE conditions and params for the host, status and time-window filters."""
+        p = self.get_placeholder()
+        where, params = self._window_filter(since, until)
+        if host:
+            where.append(f"r.host = {p}")
+            params.append(host)
+        if status:
+            low, high = self._status_range(status)
+            where.append(f"r.status_code >= {p} AND r.status_code < {p}")
+            params.extend([low, high])
+        return where, params
+
+    def _literal_filter(self, query, where, params):
+        """Add a substring filter for ``query`` to ``where``; returns the JOIN it needs.
+
+        On SQLite the stored bodies are matched through the ``body_match``
+        function (see BodyMatcher); MySQL scans the text kept for its
+        FULLTEXT index.
+        """
+        if not query:
+            return ""
+        p = self.get_placeholder()
+        q = f"%{query}%"
+        if self.db_type != "mysql":
+            # bodies 只在主库中，分区查询也能直接引用
+            match = (
+                "EXISTS (SELECT 1 FROM bodies b WHERE b.hash = r.{side}_body_hash "
+                "AND body_match(b.hash, b.codec, b.data, r.{side}_content_encoding, "
+                "r.{side}_content_type, ?, ?))"
+            )
+            where.append(
+                f"(r.url LIKE ? OR r.method LIKE ? OR {match.format(side='request')} "
+                f"OR {match.format(side='response')})"
+            )
+            params.extend([q, q, query, self.fts_body_chars, query, self.fts_body_chars])
+            return ""
+        if not self.fts_enabled:
+            where.append(f"(r.url LIKE {p} OR r.method LIKE {p})")
+            params.extend([q, q])
+            return ""
+        where.append(
+            f"(r.url LIKE {p} OR r.method LIKE {p} OR s.request_body LIKE {p} OR s.response_body LIKE {p})"
+        )
+        params.extend([q, q, q, q])
+        return " JOIN requests_search s ON s.id = r.id"
+
+    @timed_query("requests")
+    async def get_requests(
+        self,
+        limit=50,
+        query=None,
+        host=None,
+        status=None,
+        mode="fts",
+        before_id=None,
+        after_id=None,
+        cursor=None,
+        since=None,
+        until=None,
+    ):
+        """Fetch a page of historical requests using keyset pagination.
+
+        Pages are anchored on ids rather than offsets, so rows captured while
+        a client is paging never shift or duplicate results. Returns
+        ``{"items", "next_cursor", "prev_cursor"}``: ``next_cursor`` walks
+        towards older rows, ``prev_cursor`` fetches rows newer than the page.
+
+        ``mode="fts"`` searches the full-text index with ranked results and
+        highlighted snippets; ``mode="literal"`` keeps the substring LIKE scan.
+        ``since``/``until`` (epoch ms) restrict the capture time, so only
+        the overlapping partitions are read.
+        """
+        state = decode_cursor(cursor) if cursor else {}
+        before_id = state.get("b", before_id)
+        after_id = state.get("a", after_id)
+        since = state.get("s", since)
+        until = state.get("u", until)
+        # 时间窗口随游标传递，翻页时保持不变
+        window = {k: v for k, v in (("s", since), ("u", until)) if v is not None}
+
+        p = self.get_placeholder()
+        where, params = self._list_filters(host, status, since, until)
+        sources = self._sources(since, until)
+
+        terms = search_terms(query)
+        if query and mode != "literal" and self.fts_enabled and terms:
+            # 排序结果无法按 id 翻页：固定首屏时的最大 id 作为快照，再按偏移翻页
+            offset = int(state.get("o", 0))
+            snapshot = state.get("m") or await self._committed_max_id(sources)
+            where.append(f"r.id <= {p}")
+            params.append(snapshot)
+            items = await self._search_fts(terms, where, params, limit, offset, sources)
+            next_cursor = None
+            if len(items) == limit:
+                next_cursor = encode_cursor({"o": offset + limit, "m": snapshot, **window})
+            return {"items": items, "next_cursor": next_cursor, "prev_cursor": None}
+
+        joins = self._literal_filter(query, where, params)
+        if after_id is not None:
+            where.append(f"r.id > {p}")
+            params.append(int(after_id))
+            order = "ASC"
+        else:
+            if before_id is not None:
+                where.append(f"r.id < {p}")
+                params.append(int(before_id))
+            order = "DESC"
+
+        sql = (
+            f"SELECT {', '.join(f'r.{c}' for c in self.SUMMARY_COLUMNS)} "
+            f"FROM {{requests}} r{joins}"
+        )
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += f" ORDER BY r.id {order} LIMIT {p}"
+        params.append(limit)
+
+        descending = order == "DESC"
+        # 分区按 id 范围排序，已凑满一页且剩余分区不可能有更靠前的行时提前结束
+        if descending:
+            sources.sort(key=lambda part: part.max_id if part else 0, reverse=True)
+        else:
+            sources.sort(key=lambda part: part.min_id if part else 0)
+        rows = []
         async with self.get_conn() as conn:
-            if self.db_type == "mysql":
-                async with conn.cursor() as cur:
-                    await cur.execute("DELETE FROM requests")
+            for part in sources:
+                if len(rows) >= limit and part is not None:
+                    edge = rows[-1]["id"]
+                    if (edge > part.max_id) if descending else (edge < part.min_id):
+                        break
+                schema = await self._attach_source(conn, part)
+                rows += await self._fetchall(
+                    conn,
+                    sql.format(
+                        requests=self._table(schema, "requests"),
+                        fts=self._table(schema, "requests_fts"),
+                    ),
+                    tuple(params),
+                )
+                rows.sort(key=lambda d: d["id"], reverse=descending)
+                del rows[limit:]
+        if order == "ASC":
+            rows.reverse()
+        items = [self._format_summary(d) for d in rows]
+
+        next_cursor = None
+        if items and (len(items) == limit or after_id is not None):
+            next_cursor = encode_cursor({"b": items[-1]["id"], **window})
+        newest = items[0]["id"] if items else after_id
+        prev_cursor = (
+            encode_cursor({"a": newest, **window}) if newest is not None else None
+        )
+        return {"items": items, "next_cursor": next_cursor, "prev_cursor": prev_cursor}
+
+    async def _search_fts(self, terms, where, params, limit, offset, sources=(None,)):
+        """Ranked full-text search with highlighted snippets.
+
+        Ranking only reads ids and bm25 scores; snippets are built afterwards
+        from the decoded bodies of the rows on the page (through the decode
+        cache shared with get_request). With SQLite shards each partition is
+        searched for its best ``offset + limit`` hits and the results are
+        merged by score. bm25 is computed per shard, so scores from different
+        partitions are only approximately comparable.
+        """
+        p = self.get_placeholder()
+        filters = "".join(f" AND {w}" for w in where)
+        columns = ", ".join(
+            f"r.{c}" for c in self.SUMMARY_COLUMNS + self.BODY_KEY_COLUMNS
+        )
+
+        if self.db_type == "mysql":
+            # 布尔模式：每个词必须出现，并支持前缀匹配
+            match = " ".join(f"+{t}*" for t in terms)
+            sql = f"""
+                SELECT {columns},
+                       MATCH(s.url, s.request_body, s.response_body) AGAINST ({p} IN BOOLEAN MODE) AS score
+                FROM requests_search s JOIN requests r ON r.id = s.id
+                WHERE MATCH(s.url, s.request_body, s.response_body) AGAINST ({p} IN BOOLEAN MODE){filters}
+                ORDER BY score DESC, r.id DESC LIMIT {p} OFFSET {p}
+            """
+            args = (match, match, *params, limit, offset)
+            async with self.get_conn() as conn:
+                rows = await self._fetchall(conn, sql, args)
+                snippets = await self._snippets(conn, rows, terms)
+        else:
+            match = " ".join('"' + t.replace('"', '""') + '"*' for t in terms)
+            single = len(sources) == 1
+            rank_sql = f"""
+                SELECT r.id AS id, bm25(requests_fts) AS score
+                FROM {{fts}} JOIN {{requests}} r ON r.id = requests_fts.rowid
+                WHERE requests_fts MATCH {p}{filters}
+                ORDER BY rank, r.id DESC LIMIT {p} OFFSET {p}
+            """
+            if single:
+                args = (match, *params, limit, offset)
             else:
-                await conn.execute("DELETE FROM requests")
-                await conn.commit()
+                args = (match, *params, offset + limit, 0)
+            hits = []
+            async with self.get_conn() as conn:
+                schemas = {}
+                for part in sources:
+                    schema = schemas[id(part)] = await self._attach_source(conn, part)
+                    found = await self._fetchall(
+                        conn,
+                        rank_sql.format(
+                            requests=self._table(schema, "requests"),
+                            fts=self._table(schema, "requests_fts"),
+                        ),
+                        args,
+                    )
+                    hits += [(d["score"], d["id"], part) for d in found]
+                if not single:
+                    # bm25 越小越相关
+                    hits.sort(key=lambda hit: (hit[0], -hit[1]))
+                    hits = hits[offset : offset + limit]
+
+                # 只读取本页的行
+                rows = {}
+                for part in sources:
+                    ids = [hit_id for _, hit_id, hit_part in hits if hit_part is part]
+                    if not ids:
+                        continue
+                    found = await self._fetchall(
+                        conn,
+                        f"SELECT {columns} FROM {self._table(schemas[id(part)], 'requests')} r "
+                        f"WHERE r.id IN ({', '.join([p] * len(ids))})",
+                        tuple(ids),
+                    )
+                    for d in found:
+                        rows[(id(part), d["id"])] = d
+                rows = [
+                    dict(rows[(id(part), hit_id)], score=score)
+                    for score, hit_id, part in hits
+                    if (id(part), hit_id) in rows
+                ]
+                snippets = await self._snippets(conn, rows, terms)
+
+        result = []
+        for d, snippet in zip(rows, snippets):
+            item = self._format_summary(d)
+            item["snippet"] = snippet
+            item["score"] = round(abs(float(d["score"] or 0)), 4)
+            result.append(item)
+        return result
+
+    async def _snippets(self, conn, rows, terms):
+        """Highlighted snippets of search hits, cut from the decoded url and bodies."""
+        missing = [
+            self._body_key(d, side)[0]
+            for d in rows
+            for side in ("request", "response")
+            if self._body_key(d, side) not in self.decoder
+        ]
+        blobs = await self._fetch_blobs(conn, missing)
+        n = self.fts_body_chars
+        snippets = []
+        for d in rows:
+            request_body = await self._decode_side(d, "request", blobs)
+            response_body = await self._decode_side(d, "response", blobs)
+            snippets.append(
+                build_snippet(
+                    (d["url"], request_body["body"][:n], response_body["body"][:n]), terms
+                )
+            )
+        return snippets
+
+    def export_rows(self, query=None, host=None, status=None, since=None, until=None):
+        """Stream full rows with their stored bodies for export, oldest first.
+
+        Filters are validated here (raising ValueError) before anything is
+        streamed. The returned async generator pages through the rows with an
+        id cursor and yields lists of at most ``[export] batch_rows`` rows, so
+        memory use does not depend on the size of the export. ``query`` is a
+        substring filter like ``mode="literal"`` in get_requests.
+        """
+        where, params = self._list_filters(host, status, since, until)
+        joins = self._literal_filter(query, where, params)
+        sources = self._sources(since, until)
+        sources.sort(key=lambda part: part.min_id if part else 0)
+        sql = (
+            "SELECT r.*, qb.codec AS request_codec, qb.data AS request_data, "
+            "sb.codec AS response_codec, sb.data AS response_data "
+            f"FROM {{requests}} r{joins} "
+            "LEFT JOIN bodies qb ON qb.hash = r.request_body_hash "
+            "LEFT JOIN bodies sb ON sb.hash = r.response_body_hash"
+        )
+        p = self.get_placeholder()
+        where.append(f"r.id > {p} AND r.id <= {p}")
+        sql += " WHERE " + " AND ".join(where)
+        sql += f" ORDER BY r.id LIMIT {p}"
+        return self._stream_rows(sql, tuple(params), sources)
+
+    async def _stream_rows(self, sql, params, sources):
+        """Yield pages of ``sql`` (which ends in ``id > ? AND id <= ? ... LIMIT ?``).
+
+        Every page is its own short read on a pooled connection that goes
+        back to the pool before the page is yielded, so a slow download
+        neither holds a reader nor pins an old WAL snapshot. Rows committed
+        after the export started are not included.
+        """
+        batch_rows = self.export_batch_rows
+        high = await self._committed_max_id(sources)
+        for part in sources:
+            after = 0
+            while True:
+                async with self.get_conn() as conn:
+                    schema = await self._attach_source(conn, part)
+                    query = sql.format(
+                        requests=self._table(schema, "requests"),
+                        fts=self._table(schema, "requests_fts"),
+                    )
+                    rows = await self._fetchall(conn, query, params + (after, high, batch_rows))
+                if rows:
+                    yield rows
+                if len(rows) < batch_rows:
+                    break
+                after = rows[-1]["id"]
+
+    @timed_query("stats")
+    async def get_stats(self, since=None, until=None):
+        """Get summary statistics.
+
+        Without a time window this is served from the running aggregates;
+        with ``since``/``until`` (epoch ms) only the overlapping partitions
+        are scanned.
+        """
+        if since is None and until is None:
+            if not self.stats.ready:
+                await self.rebuild_stats()
+            return self.stats.snapshot()
+        return (await self._window_stats(since, until)).snapshot()
+
+    async def _window_stats(self, since, until):
+        window = StatsEngine(self.stats.max_hosts, self.stats.relative_accuracy)
+        window.load(await self._window_stat_groups(since, until))
+        return window
+
+    @timed_query("latency")
+    async def get_latency_percentiles(
+        self, by="all", key=None, top=20, since=None, until=None
+    ):
+        """Latency percentiles globally, per host or per status class.
+
+        Without a time window they come from the running sketches; with
+        ``since``/``until`` the overlapping partitions are scanned as in
+        ``get_stats``.
+        """
+        if since is None and until is None:
+            if not self.stats.ready:
+                await self.rebuild_stats()
+            return self.stats.latency_percentiles(by, key, top)
+        window = await self._window_stats(since, until)
+        return window.latency_percentiles(by, key, top)
+
+    async def clear_all(self):
+        """Clear all historical requests.
+
+        Tables are truncated (MySQL) or dropped and recreated (SQLite) instead
+        of deleted row by row, so the write lock is held only briefly and the
+        disk space is returned.
+        """
+        # 先落库已排队的数据，避免清空后又被写回
+        await self.flush()
+        async with self._stats_lock:
+            async with self.get_write_conn() as conn:
+                # 删表 (或 TRUNCATE) 会重置自增序列，先记录已分配过的最大 id，重启后不会复用
+                await self._set_meta(conn, "max_id", (self._next_id or 1) - 1)
+                if self.db_type == "mysql":
+                    tables = ["requests", "bodies"]
+                    if self.fts_enabled:
+                        tables.append("requests_search")
+                    for table in tables:
+                        await self._execute(conn, f"TRUNCATE TABLE {table}")
+                else:
+                    shards = [
+                        name for name in self.partitions.partitions if name != LEGACY_PARTITION
+                    ]
+                    for name in shards:
+                        await self._pool.forget(name)
+                    for table in (
+                        "requests_fts", "requests_fts_text", "requests", "bodies", "partitions"
+                    ):
+                        await conn.execute(f"DROP TABLE IF EXISTS {table}")
+                    await conn.commit()
+                    for name in shards:
+                        self._remove_shard_files(name)
+                    await self._create_tables(conn)
+                    await self._migrate_schema(conn)
+                    await self._ensure_search_index(conn)
+                    # 空库上 VACUUM 很快，同时把旧库转换为增量 auto_vacuum
+                    await conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                    await conn.execute("VACUUM")
+                await self._load_partitions(conn)
+            self.stats.reset()
+            self.stats.ready = True
+        self.decoder.clear()
         logger.info("Database cleared")
 
 
@@ -0,0 +1,147 @@
+import asyncio
+import base64
+import json
+import logging
+import urllib.parse
+from contextlib import aclosing
+from datetime import datetime, timezone
+
+from mitmproxy.net.http import cookies
+
+from body_store import body_key, body_text, to_bytes, undo_content_encoding, unpack_body
+from db import header_value
+
+logger = logging.getLogger("proxy_insight")
+
+HAR_VERSION = "1.2"
+CREATOR = {"name": "ProxyInsight", "version": "0.1.0"}
+
+# 流式输出的 HAR 外层结构，entries 数组逐批写入
+HAR_PREFIX = (
+    f'{{"log": {{"version": "{HAR_VERSION}", '
+    f'"creator": {json.dumps(CREATOR)}, "entries": ['
+)
+HAR_SUFFIX = "]}}\n"
+
+
+def har_time(captured_at):
+    """ISO 8601 timestamp (UTC, milliseconds) of an epoch-ms capture time."""
+    dt = datetime.fromtimestamp((captured_at or 0) / 1000, tz=timezone.utc)
+    return dt.isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+def name_values(pairs):
+    return [{"name": str(name), "value": str(value)} for name, value in pairs]
+
+
+def _stored_body(row, side):
+    """Raw wire bytes of one side of an export row."""
+    data = row.get(f"{side}_data")
+    if data is not None:
+        return unpack_body(row.get(f"{side}_codec"), data)
+    # 尚未迁移的旧行仍带有内联主体
+    return to_bytes(row.get(f"{side}_body"))
+
+
+def _content(row, side):
+    """HAR content fields of one body: decoded text, or base64 for binary bodies."""
+    _, content_encoding, content_type = body_key(row, side)
+    data, _ = undo_content_encoding(_stored_body(row, side), content_encoding)
+    text = body_text(data, content_type)
+    content = {"size": len(data), "mimeType": content_type}
+    if text is None and data:
+        content.update(text=base64.b64encode(data).decode(), encoding="base64")
+    else:
+        content["text"] = text or ""
+    return content
+
+
+def entry_from_row(row):
+    """Build a HAR 1.2 entry from a stored row joined with its bodies."""
+    request_headers = json.loads(row.get("request_headers") or "{}")
+    response_headers = json.loads(row.get("response_headers") or "{}")
+    request_cookies = json.loads(row.get("request_cookies") or "{}")
+    set_cookie = header_value(response_headers, "set-cookie")
+    response_cookies = (
+        [(name, value) for name, value, _ in cookies.parse_set_cookie_headers([set_cookie])]
+        if set_cookie
+        else []
+    )
+    url = row.get("url") or ""
+    latency = row.get("latency_ms") or 0
+
+    request = {
+        "method": row.get("method") or "",
+        "url": url,
+        "httpVersion": "HTTP/1.1",
+        "cookies": name_values(request_cookies.items()),
+        "headers": name_values(request_headers.items()),
+        "queryString": name_values(
+            urllib.parse.parse_qsl(urllib.parse.urlsplit(url).query, keep_blank_values=True)
+        ),
+        "headersSize": -1,
+        "bodySize": row.get("request_body_size") or 0,
+    }
+    if row.get("request_body_size"):
+        post = _content(row, "request")
+        post.pop("size")
+        request["postData"] = post
+
+    response = {
+        "status": row.get("status_code") or 0,
+        "statusText": row.get("reason") or "",
+        "httpVersion": "HTTP/1.1",
+        "cookies": name_values(response_cookies),
+        "headers": name_values(response_headers.items()),
+        "content": _content(row, "response"),
+        "redirectURL": header_value(response_headers, "location"),
+        "headersSize": -1,
+        "bodySize": row.get("response_body_size") or 0,
+    }
+    return {
+        "startedDateTime": har_time(row.get("captured_at")),
+        "time": latency,
+        "request": request,
+        "response": response,
+        "cache": {},
+        "timings": {"send": 0, "wait": latency, "receive": 0},
+        "_id": row.get("id"),
+    }
+
+
+def encode_entries(rows, separator):
+    """Serialize a batch of rows as HAR entries joined by ``separator`` (worker thread)."""
+    return separator.join(
+        json.dumps(entry_from_row(row), ensure_ascii=False) for row in rows
+    )
+
+
+async def stream_har(batches):
+    """Yield a HAR document chunk by chunk from an async iterator of row batches.
+
+    Entries are encoded in a worker thread one batch at a time, so only one
+    batch is ever held in memory.
+    """
+    yield HAR_PREFIX
+    first = True
+    async with aclosing(batches):
+        try:
+            async for rows in batches:
+                chunk = await asyncio.to_thread(encode_entries, rows, ",")
+                yield chunk if first else "," + chunk
+                first = False
+        except Exception as e:
+            # 响应头已经发出，只能截断输出并记录错误
+            logger.error(f"HAR export failed: {e}")
+            return
+    yield HAR_SUFFIX
+
+
+async def stream_ndjson(batches):
+    """Yield one HAR entry per line (NDJSON) from an async iterator of row batches."""
+    async with aclosing(batches):
+        try:
+            async for rows in batches:
+                yield await asyncio.to_thread(encode_entries, rows, "\n") + "\n"
+        except Exception as e:
+            logger.error(f"NDJSON export failed: {e}")
@@ -0,0 +1,461 @@
+import argparse
+import asyncio
+import codecs
+import json
+import logging
+import multiprocessing
+import os
+import re
+import tempfile
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from mitmproxy import http
+from mitmproxy.io import compat, tnetstring
+
+from ingest import FlowRecord
+
+# 解析任务在 spawn 出的子进程中执行，本模块不在顶层引入 db / logging_config
+logger = logging.getLogger("proxy_insight")
+
+FORMAT_HAR = "har"
+FORMAT_NDJSON = "ndjson"
+FORMAT_FLOWS = "flows"
+FORMATS = (FORMAT_HAR, FORMAT_NDJSON, FORMAT_FLOWS)
+
+_EXTENSIONS = {
+    ".har": FORMAT_HAR,
+    ".ndjson": FORMAT_NDJSON,
+    ".jsonl": FORMAT_NDJSON,
+    ".flow": FORMAT_FLOWS,
+    ".flows": FORMAT_FLOWS,
+    ".mitm": FORMAT_FLOWS,
+    ".dump": FORMAT_FLOWS,
+}
+
+READ_SIZE = 1024 * 1024
+_ENTRIES_KEY = re.compile(r'"entries"\s*:\s*\[')
+_SEPARATORS = re.compile(r"[\s,]*")
+_HAR_HEAD = re.compile(rb'\s*\{\s*"log"')
+
+# 任务 id -> ImportJob，供 /api/import/{job_id} 查询进度
+import_jobs = {}
+# 同一时间只运行一个导入，避免多个进程池争抢 CPU
+_import_lock = asyncio.Lock()
+
+
+def detect_format(path, name=None):
+    """Guess the format from the file extension, falling back to sniffing the content."""
+    ext = os.path.splitext(name or path)[1].lower()
+    if ext in _EXTENSIONS:
+        return _EXTENSIONS[ext]
+    with open(path, "rb") as f:
+        head = f.read(4096).removeprefix(codecs.BOM_UTF8).lstrip()
+    if head[:1].isdigit():
+        # tnetstring 以长度前缀开头
+        return FORMAT_FLOWS
+    if head.startswith(b"{"):
+        return FORMAT_HAR if _HAR_HEAD.match(head) else FORMAT_NDJSON
+    raise ValueError("Unrecognized import format (expected HAR, NDJSON or mitmproxy flows)")
+
+
+def _read_har(f, job):
+    """Yield the raw text of each ``log.entries`` item without loading the whole file."""
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8-sig")()
+    buf, eof = "", False
+
+    def fill(size=READ_SIZE):
+        nonlocal buf, eof
+        data = f.read(size)
+        job.read_bytes += len(data)
+        eof = not data
+        buf += text.decode(data, final=eof)
+
+    while not (match := _ENTRIES_KEY.search(buf)):
+        if eof:
+            raise ValueError("No log.entries array in HAR file")
+        fill()
+    pos = match.end()
+
+    while True:
+        pos = _SEPARATORS.match(buf, pos).end()
+        if pos >= len(buf):
+            if eof:
+                raise ValueError("Truncated HAR file")
+            fill()
+            continue
+        if buf[pos] == "]":
+            return
+        try:
+            _, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError as e:
+            if eof:
+                raise ValueError(f"Malformed HAR entry: {e}")
+            # 条目跨越了缓冲区末尾: 按已缓冲的长度加倍读取，大条目也只需解析几次
+            fill(max(READ_SIZE, len(buf) - pos))
+            continue
+        yield buf[pos:end]
+        pos = end
+        if pos > READ_SIZE:
+            buf, pos = buf[pos:], 0
+
+
+def _read_ndjson(f, job):
+    """Yield one HAR entry (raw JSON line) per non-empty line."""
+    for line in f:
+        job.read_bytes += len(line)
+        line = line.strip()
+        if line:
+            yield line
+
+
+def _read_flows(f, job):
+    """Yield the raw tnetstring of each flow in a ``mitmdump -w`` file."""
+    while True:
+        length = b""
+        while (c := f.read(1)) != b":":
+            if not c:
+                if length.strip():
+                    raise ValueError("Truncated flow dump")
+                return
+            length += c
+            if len(length) > 12:
+                raise ValueError("Not a mitmproxy flow dump")
+        size = int(length)
+        payload = f.read(size + 1)
+        if len(payload) != size + 1:
+            raise ValueError("Truncated flow dump")
+        job.read_bytes += len(length) + 1 + len(payload)
+        yield length + b":" + payload
+
+
+_READERS = {
+    FORMAT_HAR: _read_har,
+    FORMAT_NDJSON: _read_ndjson,
+    FORMAT_FLOWS: _read_flows,
+}
+
+
+def _record_from_flow(raw):
+    state = compat.migrate_flow(tnetstring.loads(raw))
+    if state.get("type") != "http" or not state.get("response"):
+        # 只导入有响应的 HTTP 流量 (跳过 TCP/DNS 流与未完成的请求)
+        return None
+    return FlowRecord.from_flow(http.HTTPFlow.from_state(state))
+
+
+def convert_chunk(fmt, items):
+    """Convert raw entries into flow dicts (runs in a worker process).
+
+    Returns ``(flows, skipped, failed, last_error)``.
+    """
+    flows, skipped, failed, last_error = [], 0, 0, None
+    for item in items:
+        try:
+            if fmt == FORMAT_FLOWS:
+                record = _record_from_flow(item)
+            else:
+                record = FlowRecord.from_har(json.loads(item))
+            if record is None:
+                skipped += 1
+            else:
+                flows.append(record.to_dict())
+        except Exception as e:
+            failed += 1
+            last_error = f"{type(e).__name__}: {e}"
+    return flows, skipped, failed, last_error
+
+
+def _chunks(items, size):
+    while chunk := list(islice(items, size)):
+        yield chunk
+
+
+class ImportJob:
+    """Progress and throughput of one import, updated as parsed chunks are written."""
+
+    def __init__(self, path, fmt="auto", name=None, cleanup=False):
+        self.id = uuid.uuid4().hex[:12]
+        self.path = path
+        self.name = name or os.path.basename(path)
+        if not fmt or fmt == "auto":
+            fmt = detect_format(path, self.name)
+        if fmt not in FORMATS:
+            raise ValueError(f"Unsupported import format: {fmt}")
+        self.format = fmt
+        # 上传的临时文件在导入结束后删除
+        self.cleanup = cleanup
+        self.total_bytes = os.path.getsize(path)
+        self.read_bytes = 0
+        self.parsed = 0
+        self.imported = 0
+        self.skipped = 0
+        self.failed = 0
+        self.workers = 0
+        self.status = "pending"
+        self.error = None
+        self.last_error = None
+        self.started = None
+        self.finished = None
+        self.task = None
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def to_dict(self):
+        elapsed = self.elapsed()
+        progress = self.read_bytes / self.total_bytes * 100 if self.total_bytes else 100.0
+        return {
+            "id": self.id,
+            "name": self.name,
+            "format": self.format,
+            "status": self.status,
+            "error": self.error,
+            "last_error": self.last_error,
+            "workers": self.workers,
+            "total_bytes": self.total_bytes,
+            "read_bytes": self.read_bytes,
+            "progress": round(progress, 1),
+            "parsed": self.parsed,
+            "imported": self.imported,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "elapsed_s": round(elapsed, 2),
+            "flows_per_s": round(self.imported / elapsed, 1) if elapsed else 0,
+            "mb_per_s": round(self.read_bytes / 1048576 / elapsed, 2) if elapsed else 0,
+        }
+
+    def summary(self):
+        return format_summary(self.to_dict())
+
+
+def format_summary(d):
+    """One progress line for a job dict (``ImportJob.to_dict`` or /api/import/{id})."""
+    return (
+        f"{d['name']}: {d['status']} {d['progress']}% | {d['imported']} imported, "
+        f"{d['skipped']} skipped, {d['failed']} failed | "
+        f"{d['flows_per_s']} flows/s, {d['mb_per_s']} MB/s"
+    )
+
+
+def _settings():
+    from logging_config import config  # 延迟导入，子进程无需加载配置与日志
+
+    return config.get("import", {})
+
+
+async def _write(job, db, flows):
+    written = await db.bulk_insert(flows)
+    job.imported += written
+    if written < len(flows):
+        # 写库失败 (磁盘满、连接断开等) 不能按完成处理，否则丢失的流量无从得知
+        job.failed += len(flows) - written
+        raise RuntimeError(
+            f"{len(flows) - written} of {len(flows)} flows could not be written (see the log)"
+        )
+
+
+async def run_import(job, db, workers=None):
+    """Stream ``job.path`` through the parser pool into ``db.bulk_insert``.
+
+    The main process only frames entries; decoding them into flow dicts runs
+    in a process pool for large files (a worker thread for small ones). Parsed
+    chunks are consumed in file order and written ``[import] batch_rows`` rows
+    per transaction.
+    """
+    settings = _settings()
+    batch_rows = max(int(settings.get("batch_rows", 5000)), 1)
+    chunk_entries = max(int(settings.get("chunk_entries", 500)), 1)
+    if workers is None:
+        workers = int(settings.get("workers", 0))
+    if job.total_bytes >= float(settings.get("pool_min_mb", 16)) * 1048576:
+        job.workers = workers or os.cpu_count() or 1
+
+    job.status = "queued"
+    async with _import_lock:
+        job.status = "running"
+        job.started = time.time()
+        loop = asyncio.get_running_loop()
+        pool = (
+            ProcessPoolExecutor(job.workers, mp_context=multiprocessing.get_context("spawn"))
+            if job.workers
+            else None
+        )
+        in_flight = deque()
+        try:
+            with open(job.path, "rb") as f:
+                chunks = _chunks(_READERS[job.format](f, job), chunk_entries)
+                # 保持每个进程有两个待解析的块，写库时解析不停顿
+                depth = job.workers * 2 if pool else 2
+                buffer = []
+                while True:
+                    while len(in_flight) < depth:
+                        items = await asyncio.to_thread(next, chunks, None)
+                        if items is None:
+                            break
+                        if pool:
+                            future = loop.run_in_executor(pool, convert_chunk, job.format, items)
+                        else:
+                            future = asyncio.ensure_future(
+                                asyncio.to_thread(convert_chunk, job.format, items)
+                            )
+                        in_flight.append(future)
+                    if not in_flight:
+                        break
+                    flows, skipped, failed, last_error = await in_flight.popleft()
+                    job.parsed += len(flows)
+                    job.skipped += skipped
+                    job.failed += failed
+                    job.last_error = last_error or job.last_error
+                    buffer.extend(flows)
+                    if len(buffer) >= batch_rows:
+                        await _write(job, db, buffer)
+                        buffer = []
+                if buffer:
+                    await _write(job, db, buffer)
+            job.status = "done"
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+            raise
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+            logger.error(f"Import {job.id} ({job.name}) failed: {e}")
+        finally:
+            for future in in_flight:
+                future.cancel()
+            if pool:
+                pool.shutdown(wait=False, cancel_futures=True)
+            job.finished = time.time()
+            if job.cleanup:
+                try:
+                    os.remove(job.path)
+                except OSError:
+                    pass
+    logger.info(f"Import {job.id} {job.summary()}")
+    return job
+
+
+def start_import(job, db, on_done=None):
+    """Run an import in the background; ``on_done`` is awaited with the finished job."""
+
+    async def run():
+        await run_import(job, db)
+        if on_done:
+            await on_done(job)
+
+    import_jobs[job.id] = job
+    job.task = asyncio.create_task(run())
+    return job
+
+
+async def spool_upload(chunks, suffix=""):
+    """Write an uploaded body to a temporary file without blocking the event loop.
+
+    Chunks are collected up to READ_SIZE and written from a worker thread;
+    the file is removed if the upload fails. Returns the file's path.
+    """
+    fd, path = tempfile.mkstemp(prefix="import-", suffix=suffix)
+    f = os.fdopen(fd, "wb")
+    try:
+        buffer = bytearray()
+        async for chunk in chunks:
+            buffer += chunk
+            if len(buffer) >= READ_SIZE:
+                await asyncio.to_thread(f.write, buffer)
+                buffer.clear()
+        if buffer:
+            await asyncio.to_thread(f.write, buffer)
+        await asyncio.to_thread(f.close)
+    except BaseException:
+        f.close()
+        os.remove(path)
+        raise
+    return path
+
+
+async def _read_chunks(path):
+    with open(path, "rb") as f:
+        while chunk := await asyncio.to_thread(f.read, READ_SIZE):
+            yield chunk
+
+
+async def _import_via_app(args):
+    """Upload the files to the running app's POST /api/import and follow the jobs."""
+    import httpx
+
+    from logging_config import config
+
+    host = config.get("app_host", "127.0.0.1")
+    if host in ("0.0.0.0", "::", ""):
+        host = "127.0.0.1"
+    base_url = f"http://{host}:{config.get('app_port', 8000)}"
+    async with httpx.AsyncClient(base_url=base_url, timeout=None) as client:
+        for path in args.files:
+            try:
+                response = await client.post(
+                    "/api/import",
+                    params={"filename": os.path.basename(path), "format": args.format},
+                    content=_read_chunks(path),
+                )
+                response.raise_for_status()
+                job = response.json()
+                while job["status"] in ("pending", "queued", "running"):
+                    await asyncio.sleep(1)
+                    job = (await client.get(f"/api/import/{job['id']}")).json()
+                    print(format_summary(job), flush=True)
+            except httpx.HTTPError as e:
+                raise SystemExit(f"Import through {base_url} failed: {e}")
+            if job["status"] != "done":
+                raise SystemExit(f"{job['name']}: {job['status']}: {job['error']}")
+
+
+async def _cli(args):
+    from db import db_manager
+
+    try:
+        db_manager.acquire_writer_lock()
+    except RuntimeError as e:
+        # 应用正在写这个数据库: id 只能由它分配，交给它导入
+        print(f"{e}; importing through the running app", flush=True)
+        await _import_via_app(args)
+        return
+
+    await db_manager.init_db()
+    await db_manager.start_writer()
+    try:
+        for path in args.files:
+            job = ImportJob(path, args.format)
+            task = asyncio.create_task(run_import(job, db_manager, args.workers))
+            while not task.done():
+                await asyncio.wait([task], timeout=1)
+                print(job.summary(), flush=True)
+            await task
+    finally:
+        await db_manager.stop_writer()
+        await db_manager.close_pool()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Import HAR, NDJSON or mitmproxy flow files into ProxyInsight."
+    )
+    parser.add_argument("files", nargs="+", help="files to import")
+    parser.add_argument("--format", default="auto", choices=("auto",) + FORMATS)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="parser processes (default: [import] workers, 0 = one per CPU core)",
+    )
+    asyncio.run(_cli(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
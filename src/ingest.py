@@ -0,0 +1,396 @@
+import asyncio
+import base64
+import logging
+import threading
+import time
+import urllib.parse
+from collections import deque
+from datetime import datetime
+
+from mitmproxy import http
+from mitmproxy.http import Headers, infer_content_encoding
+from mitmproxy.net.http import cookies
+
+from profiling import stage
+
+# 导入进程池的子进程也会加载本模块，这里不引入 logging_config 的初始化
+logger = logging.getLogger("proxy_insight")
+
+# 队列满时的处理策略
+OVERFLOW_BLOCK = "block"
+OVERFLOW_DROP_OLDEST = "drop-oldest"
+OVERFLOW_DROP_BODIES = "drop-bodies"
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_BODIES)
+
+_TO_DICT_STAGE = stage("ingest.to_dict")
+
+
+class FlowRecord:
+    """Compact snapshot of a finished flow, taken on the mitmproxy thread.
+
+    Only references and scalars are copied here: header fields are mitmproxy's
+    immutable tuples and bodies are the raw wire bytes. Building the dicts the
+    rest of the app works with (headers, cookies, formatted times) is deferred
+    to ``to_dict`` on the app loop.
+    """
+
+    __slots__ = (
+        "method",
+        "url",
+        "scheme",
+        "host",
+        "path",
+        "status_code",
+        "reason",
+        "started",
+        "ended",
+        "request_fields",
+        "request_body",
+        "response_fields",
+        "response_body",
+        "bodies_decoded",
+    )
+
+    @classmethod
+    def from_flow(cls, flow):
+        record = cls()
+        request, response = flow.request, flow.response
+        record.method = request.method
+        record.url = request.pretty_url
+        record.scheme = request.scheme
+        record.host = request.pretty_host
+        record.path = request.path
+        record.status_code = response.status_code
+        record.reason = response.reason
+        record.started = request.timestamp_start
+        record.ended = response.timestamp_end or time.time()
+        record.request_fields = request.headers.fields
+        record.request_body = request.raw_content or b""
+        record.response_fields = response.headers.fields
+        record.response_body = response.raw_content or b""
+        record.bodies_decoded = False
+        return record
+
+    @classmethod
+    def from_har(cls, entry):
+        """Snapshot of a HAR 1.2 entry.
+
+        HAR bodies are already decompressed, so the stored content encoding is
+        ``identity`` whatever the Content-Encoding header says.
+        """
+        record = cls()
+        request, response = entry["request"], entry["response"]
+        parts = urllib.parse.urlsplit(request["url"])
+        record.method = request.get("method") or "GET"
+        record.url = request["url"]
+        record.scheme = parts.scheme
+        record.host = parts.hostname or ""
+        record.path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        record.status_code = int(response.get("status") or 0)
+        record.reason = response.get("statusText") or ""
+        record.started = datetime.fromisoformat(
+            entry["startedDateTime"].replace("Z", "+00:00")
+        ).timestamp()
+        record.ended = record.started + max(entry.get("time") or 0, 0) / 1000
+        record.request_fields = _har_fields(request.get("headers"))
+        record.request_body = _har_body(request.get("postData"))
+        record.response_fields = _har_fields(response.get("headers"))
+        record.response_body = _har_body(response.get("content"))
+        record.bodies_decoded = True
+        return record
+
+    def body_size(self):
+        return len(self.request_body) + len(self.response_body)
+
+    def drop_bodies(self):
+        self.request_body = b""
+        self.response_body = b""
+
+    def to_dict(self):
+        """Expand into the flow dict consumed by save_request and the broadcaster."""
+        # 取整而非截断: HAR 中的毫秒值经浮点秒数换算后可能略小 (40 -> 39.999...)
+        latency_ms = round((self.ended - self.started) * 1000)
+        request_headers = Headers(self.request_fields)
+        response_headers = Headers(self.response_fields)
+        request_cookies = cookies.parse_cookie_headers(
+            request_headers.get_all("cookie")
+        )
+        response_cookies = cookies.parse_set_cookie_headers(
+            response_headers.get_all("set-cookie")
+        )
+        if self.bodies_decoded:
+            request_encoding = response_encoding = "identity"
+        else:
+            request_encoding = request_headers.get("content-encoding", "")
+            response_encoding = response_headers.get("content-encoding", "")
+        return {
+            "method": self.method,
+            "url": self.url,
+            "scheme": self.scheme,
+            "host": self.host,
+            "path": self.path,
+            "status": f"{self.status_code} {self.reason}",
+            "status_code": self.status_code,
+            "reason": self.reason,
+            "time": f"{latency_ms}ms",
+            "latency_ms": latency_ms,
+            "timestamp": datetime.fromtimestamp(self.started).strftime(
+                "%Y-%m-%d %H:%M:%S"
+            ),
+            "captured_at": round(self.started * 1000),
+            # 主体保存原始字节 (未解压、未解码)，查看详情时再按需解码
+            "request": {
+                "headers": dict(request_headers),
+                "body": self.request_body,
+                "content_type": request_headers.get("content-type", ""),
+                "content_encoding": request_encoding,
+                "cookies": {k: str(v) for k, v in request_cookies},
+            },
+            "response": {
+                "headers": dict(response_headers),
+                "body": self.response_body,
+                "content_type": response_headers.get("content-type", ""),
+                "content_encoding": response_encoding,
+                "cookies": {
+                    name: str((value, attrs))
+                    for name, value, attrs in response_cookies
+                },
+            },
+        }
+
+
+def _har_fields(headers):
+    """HAR name/value list -> mitmproxy header fields."""
+    return tuple(
+        (str(h["name"]).encode(), str(h["value"]).encode()) for h in headers or ()
+    )
+
+
+def _har_body(content):
+    """Bytes of a HAR ``content``/``postData`` object."""
+    if not content:
+        return b""
+    text = content.get("text") or ""
+    if content.get("encoding") == "base64":
+        return base64.b64decode(text)
+    # 文本主体按 Content-Type 声明的字符集还原为字节
+    try:
+        return text.encode(infer_content_encoding(content.get("mimeType") or ""))
+    except (LookupError, UnicodeEncodeError):
+        return text.encode("utf-8", "surrogateescape")
+
+
+class IngestChannel:
+    """Bounded hand-off of FlowRecords from the proxy thread to the app loop.
+
+    ``put`` is called on the mitmproxy thread; a single consumer task on the
+    FastAPI loop drains the buffer. The buffer is bounded both by record count
+    and by buffered body bytes; what happens when it is full depends on the
+    overflow policy:
+
+    - ``block``: the proxy thread waits for room (backpressure on clients).
+    - ``drop-oldest``: the oldest buffered records are discarded.
+    - ``drop-bodies``: the new record is kept without its bodies; if the
+      count limit is still exceeded the oldest record is discarded.
+    """
+
+    def __init__(self, maxsize=5000, max_bytes=64 * 1024 * 1024, policy=OVERFLOW_BLOCK):
+        self.configure(maxsize, max_bytes, policy)
+        self._buffer = deque()
+        self._bytes = 0
+        self._cond = threading.Condition()
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+        self._closed = False
+        # 已取出、正在由消费任务处理的记录数
+        self._in_flight = 0
+        self.counters = {
+            "accepted": 0,
+            "processed": 0,
+            "dropped": 0,
+            "bodies_dropped": 0,
+            "blocked": 0,
+            "blocked_ms": 0.0,
+            "max_depth": 0,
+            "failed": 0,
+        }
+
+    def configure(self, maxsize, max_bytes, policy):
+        if policy not in OVERFLOW_POLICIES:
+            logger.warning(f"Unknown ingest overflow policy {policy!r}, using block")
+            policy = OVERFLOW_BLOCK
+        self.maxsize = max(int(maxsize), 1)
+        self.max_bytes = max(int(max_bytes), 0)
+        self.policy = policy
+
+    def _full(self, extra_bytes):
+        # 空缓冲区总能接收一条记录 (即使单条超过字节上限)
+        if not self._buffer:
+            return False
+        return len(self._buffer) >= self.maxsize or bool(
+            self.max_bytes and self._bytes + extra_bytes > self.max_bytes
+        )
+
+    def _pop_oldest(self):
+        record = self._buffer.popleft()
+        self._bytes -= record.body_size()
+        return record
+
+    def put(self, record):
+        """Hand a record to the app loop (called on the mitmproxy thread)."""
+        size = record.body_size()
+        with self._cond:
+            if self._closed:
+                return False
+            if self._full(size):
+                if self.policy == OVERFLOW_BLOCK:
+                    self.counters["blocked"] += 1
+                    start = time.perf_counter()
+                    # 带超时等待，关闭时不会永久卡住代理线程
+                    while self._full(size) and not self._closed:
+                        self._cond.wait(timeout=0.5)
+                    self.counters["blocked_ms"] += (time.perf_counter() - start) * 1000
+                    if self._closed:
+                        return False
+                elif self.policy == OVERFLOW_DROP_BODIES:
+                    if size:
+                        record.drop_bodies()
+                        size = 0
+                        self.counters["bodies_dropped"] += 1
+                    while len(self._buffer) >= self.maxsize:
+                        self._pop_oldest()
+                        self.counters["dropped"] += 1
+                else:
+                    while self._buffer and self._full(size):
+                        self._pop_oldest()
+                        self.counters["dropped"] += 1
+
+            was_empty = not self._buffer
+            self._buffer.append(record)
+            self._bytes += size
+            self.counters["accepted"] += 1
+            self.counters["max_depth"] = max(self.counters["max_depth"], len(self._buffer))
+
+        # 仅在缓冲区由空变为非空时唤醒消费者，避免每条流量都跨线程调度
+        if was_empty and self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._wakeup.set)
+            except RuntimeError:
+                pass
+        return True
+
+    def _take_all(self):
+        with self._cond:
+            records = list(self._buffer)
+            self._buffer.clear()
+            self._bytes = 0
+            self._cond.notify_all()
+        return records
+
+    def start(self, handler):
+        """Start the consumer task on the running loop; ``handler`` gets each flow dict."""
+        if self._task is not None and not self._task.done():
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._closed = False
+        self._task = asyncio.create_task(self._consume(handler))
+        logger.info(
+            f"Ingest channel started: maxsize={self.maxsize}, "
+            f"max_bytes={self.max_bytes}, policy={self.policy}"
+        )
+
+    async def _consume(self, handler):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while records := self._take_all():
+                await self._process(handler, records)
+            if self._closed:
+                return
+
+    async def _process(self, handler, records):
+        self._in_flight = len(records)
+        for record in records:
+            try:
+                start = time.perf_counter()
+                data = record.to_dict()
+                _TO_DICT_STAGE.observe(time.perf_counter() - start)
+                await handler(data)
+                self.counters["processed"] += 1
+            except Exception as e:
+                self.counters["failed"] += 1
+                logger.error(f"Failed to ingest flow {record.url}: {e}")
+            self._in_flight -= 1
+
+    async def stop(self):
+        """Stop accepting records and wait until the buffered ones are processed."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._task is not None:
+            self._wakeup.set()
+            await self._task
+            self._task = None
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats["blocked_ms"] = round(stats["blocked_ms"], 2)
+        stats["depth"] = len(self._buffer)
+        stats["in_flight"] = self._in_flight
+        stats["buffered_bytes"] = self._bytes
+        stats["maxsize"] = self.maxsize
+        stats["policy"] = self.policy
+        return stats
+
+
+class TrafficAddon:
+    """mitmproxy addon handing a FlowRecord of each finished flow to ``channel``.
+
+    ``channel`` is the in-process IngestChannel, or a worker process's
+    RecordShipper in multi-process capture; both expose ``put(record)``.
+    """
+
+    def __init__(self, channel):
+        # 只做最少的工作：抓取紧凑记录后交给消费端
+        self.channel = channel
+        # 由 /metrics 读取 (多进程抓包时随工作进程的统计一起发送)
+        # record_seconds / put_seconds 为 response 钩子两个阶段的累计耗时
+        self.counters = {
+            "captured": 0,
+            "errored": 0,
+            "request_bytes": 0,
+            "response_bytes": 0,
+            "record_seconds": 0.0,
+            "put_seconds": 0.0,
+        }
+
+    def request(self, flow: http.HTTPFlow):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"[Request] {flow.request.method} {flow.request.pretty_url}")
+
+    def response(self, flow: http.HTTPFlow):
+        start = time.perf_counter()
+        try:
+            record = FlowRecord.from_flow(flow)
+        except Exception as e:
+            logger.error(f"Failed to capture flow: {e}")
+            return
+        recorded = time.perf_counter()
+        counters = self.counters
+        counters["captured"] += 1
+        counters["request_bytes"] += len(record.request_body or b"")
+        counters["response_bytes"] += len(record.response_body or b"")
+        accepted = self.channel.put(record)
+        counters["record_seconds"] += recorded - start
+        counters["put_seconds"] += time.perf_counter() - recorded
+        if not accepted:
+            logger.debug(f"Ingest channel closed, dropped {record.url}")
+
+    def error(self, flow: http.HTTPFlow):
+        self.counters["errored"] += 1
+        # 记录错误信息
+        logger.error(
+            f"[Error] {flow.request.method} {flow.request.pretty_url}: {flow.error}"
+        )
@@ -1,7 +1,13 @@
 import logging
 import os
 import json
-from logging.handlers import RotatingFileHandler
+import atexit
+import copy
+import queue
+import random
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 import tomllib
 
 
@@ -11,26 +17,143 @@ PROJECT_ROOT = os.path.dirname(BASE_DIR)
 SRC_DIR = BASE_DIR
 
 
+# 配置默认值: config.toml 中缺少的键 (包括只写了部分键的配置段) 取这里的值
+DEFAULT_CONFIG = {
+    "app_host": "0.0.0.0",
+    "app_port": 8000,
+    "proxy_host": "0.0.0.0",
+    "proxy_port": 8080,
+    "db_type": "sqlite",
+    "mysql": {
+        "host": "127.0.0.1",
+        "port": 3306,
+        "user": "root",
+        "password": "root",
+        "database": "proxy_insight",
+        "pool_min_size": 1,
+        "pool_max_size": 10,
+    },
+    "sqlite": {
+        "pool_size": 4,
+        "synchronous": "NORMAL",
+        "mmap_size": 268435456,
+        "cache_size_kb": 65536,
+        "busy_timeout_ms": 5000,
+        "checkpoint_interval_s": 30,
+    },
+    "bodies": {
+        "compress_min_bytes": 1024,
+        "compress_level": 6,
+    },
+    "search": {
+        "indexed_body_chars": 32768,
+    },
+    "writer": {
+        "batch_size": 500,
+        "batch_interval_ms": 50,
+        "queue_size": 10000,
+    },
+    "ingest": {
+        "queue_size": 5000,
+        "max_buffered_mb": 64,
+        "overflow": "block",
+    },
+    "retention": {
+        # 0 表示不限制
+        "max_age_hours": 0,
+        "max_rows": 0,
+        # 已存储的主体及其全文索引
+        "max_body_mb": 0,
+        "interval_s": 60,
+        "chunk_size": 500,
+        "vacuum_pages": 256,
+    },
+    "partitioning": {
+        "enabled": False,
+        # hour | day
+        "granularity": "day",
+        # MySQL 预先创建的未来分区数
+        "premake": 2,
+    },
+    "stats": {
+        # 按主机保存延迟分布的主机数上限，超出的主机合并为 (other)
+        "latency_max_hosts": 1000,
+        # 延迟分位数的相对误差
+        "latency_accuracy": 0.01,
+    },
+    "export": {
+        # 导出时每次从游标读取的行数
+        "batch_rows": 200,
+    },
+    "server": {
+        # dev: 单进程 + 自动重载; production: 独立采集进程 + 多个 API 工作进程
+        "mode": "dev",
+        # API 工作进程数，0 表示按 CPU 核数
+        "api_workers": 0,
+    },
+    "capture": {
+        # mitmproxy 工作进程数，0 表示在应用进程内的线程中运行
+        "workers": 0,
+        # 工作进程向主进程发送记录的批大小与最长等待时间
+        "batch_size": 200,
+        "interval_ms": 50,
+        # 工作进程反复崩溃时的最长重启退避时间
+        "restart_backoff_max_s": 30,
+        # 不校验上游服务器证书 (自签名的内网或本地服务)
+        "ssl_insecure": False,
+    },
+    "profiling": {
+        # /api/admin/profile 单次采样的最长时间与默认采样间隔
+        "max_duration_s": 60,
+        "interval_ms": 5,
+        # 大于 0 时启动即开启慢回调检测 (毫秒阈值)
+        "slow_callback_ms": 0,
+    },
+    "import": {
+        # 每个事务写入的行数
+        "batch_rows": 5000,
+        # 每个解析任务包含的条目数
+        "chunk_entries": 500,
+        # 解析进程数，0 表示按 CPU 核数自动选择
+        "workers": 0,
+        # 小于该大小的文件在线程中解析，不启动进程池
+        "pool_min_mb": 16,
+    },
+    "logging": {
+        "level": "INFO",
+        "queue_size": 10000,
+        # 每条流量的访问日志: 采样比例与每秒上限 (0 表示不限)
+        "access_sample_rate": 1.0,
+        "access_rate_limit_per_s": 50,
+        # 额外输出 JSON Lines 格式的访问日志 (logs/access.jsonl)
+        "access_json": False,
+    },
+    "websocket": {
+        "queue_size": 1000,
+        "batch_interval_ms": 100,
+        "max_batch": 200,
+        "send_timeout_s": 5,
+    },
+}
+
+
+def merge_config(base, overrides):
+    """Merge ``overrides`` into ``base`` in place, section by section."""
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            merge_config(base[key], value)
+        else:
+            base[key] = value
+    return base
+
+
 def load_config():
     config_path = os.path.join(SRC_DIR, "config.toml")
-    config = {
-        "app_host": "0.0.0.0",
-        "app_port": 8000,
-        "proxy_host": "0.0.0.0",
-        "proxy_port": 8080,
-        "db_type": "sqlite",
-        "mysql": {
-            "host": "127.0.0.1",
-            "port": 3306,
-            "user": "root",
-            "password": "root",
-            "database": "proxy_insight",
-        },
-    }
+    config = copy.deepcopy(DEFAULT_CONFIG)
     if os.path.exists(config_path):
         try:
             with open(config_path, "rb") as f:
-                config.update(tomllib.load(f))
+                merge_config(config, tomllib.load(f))
         except Exception as e:
             print(f"Failed to load config.toml: {e}")
 
@@ -56,23 +179,52 @@ def load_config():
     return config
 
 
-def setup_logging():
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler over a bounded queue that drops (and counts) records when full.
+
+    Logging must never block the caller, so a burst larger than the queue
+    loses records instead of stalling the event loop.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _start_listener(handler, *targets):
+    listener = QueueListener(handler.queue, *targets, respect_handler_level=True)
+    listener.start()
+    # 退出时停止后台线程并写完队列中剩余的日志
+    atexit.register(listener.stop)
+    return listener
+
+
+def setup_logging(config):
     # 确保 logs 目录存在于项目根目录 (src 的上一级)
     log_dir = os.path.join(PROJECT_ROOT, "logs")
     if not os.path.exists(log_dir):
         os.makedirs(log_dir)
 
     log_file = os.path.join(log_dir, "app.log")
+    log_config = config.get("logging", {})
+    level = getattr(logging, str(log_config.get("level", "INFO")).upper(), logging.INFO)
+    queue_size = int(log_config.get("queue_size", 10000))
 
     # 配置根日志记录器
     logger = logging.getLogger("proxy_insight")
-    logger.setLevel(logging.INFO)
+    logger.setLevel(level)
 
     # 避免重复添加 handler
     if not logger.handlers:
         # 控制台处理器
         console_handler = logging.StreamHandler()
-        console_handler.setLevel(logging.INFO)
+        console_handler.setLevel(level)
         console_formatter = logging.Formatter(
             "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
         )
@@ -82,14 +234,16 @@ def setup_logging():
         file_handler = RotatingFileHandler(
             log_file, maxBytes=10 * 1024 * 1024, backupCount=5, encoding="utf-8"
         )
-        file_handler.setLevel(logging.INFO)
+        file_handler.setLevel(level)
         file_formatter = logging.Formatter(
             "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
         )
         file_handler.setFormatter(file_formatter)
 
-        logger.addHandler(console_handler)
-        logger.addHandler(file_handler)
+        # 调用方只把日志记录放入队列，终端与磁盘 I/O 由后台线程完成
+        queue_handler = DroppingQueueHandler(queue.Queue(maxsize=queue_size))
+        logger.addHandler(queue_handler)
+        _start_listener(queue_handler, console_handler, file_handler)
 
     # 禁止日志向上传递到根日志中
     logger.propagate = False
@@ -97,6 +251,107 @@ def setup_logging():
     return logger
 
 
+def setup_access_logger(config):
+    """JSON Lines access log (logs/access.jsonl), separate from the application log."""
+    if not config.get("logging", {}).get("access_json", False):
+        return None
+    access_logger = logging.getLogger("proxy_insight.access")
+    access_logger.setLevel(logging.INFO)
+    access_logger.propagate = False
+    if not access_logger.handlers:
+        file_handler = RotatingFileHandler(
+            os.path.join(PROJECT_ROOT, "logs", "access.jsonl"),
+            maxBytes=50 * 1024 * 1024,
+            backupCount=5,
+            encoding="utf-8",
+        )
+        file_handler.setFormatter(logging.Formatter("%(message)s"))
+        queue_handler = DroppingQueueHandler(
+            queue.Queue(maxsize=int(config["logging"].get("queue_size", 10000)))
+        )
+        access_logger.addHandler(queue_handler)
+        _start_listener(queue_handler, file_handler)
+    return access_logger
+
+
+class AccessLog:
+    """Per-flow access logging with sampling and a per-second rate limit.
+
+    Each captured flow is considered once; flows that are not sampled or
+    exceed the rate limit are only counted, so the logging cost stays flat
+    no matter how much traffic the proxy sees.
+    """
+
+    def __init__(self, sample_rate=1.0, rate_limit=50, json_logger=None):
+        self.sample_rate = float(sample_rate)
+        self.rate_limit = int(rate_limit)
+        self.json_logger = json_logger
+        self._lock = threading.Lock()
+        self._window = 0
+        self._window_count = 0
+        self.logged = 0
+        self.suppressed = 0
+
+    def allow(self):
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return False
+        if self.rate_limit <= 0:
+            return True
+        now = int(time.monotonic())
+        with self._lock:
+            if now != self._window:
+                self._window = now
+                self._window_count = 0
+            if self._window_count >= self.rate_limit:
+                return False
+            self._window_count += 1
+        return True
+
+    def log(self, data, request_id=None):
+        if not self.allow():
+            self.suppressed += 1
+            return
+        self.logged += 1
+        logger.info(
+            f"[Captured] {data['method']} {data['url']} - Status: {data['status']}"
+        )
+        if self.json_logger is not None:
+            self.json_logger.info(
+                json.dumps(
+                    {
+                        "id": request_id,
+                        "captured_at": data.get("captured_at"),
+                        "method": data["method"],
+                        "url": data["url"],
+                        "host": data.get("host"),
+                        "status_code": data.get("status_code"),
+                        "latency_ms": data.get("latency_ms"),
+                        "request_size": len(data["request"].get("body") or b""),
+                        "response_size": len(data["response"].get("body") or b""),
+                    }
+                )
+            )
+
+    def stats(self):
+        return {
+            "logged": self.logged,
+            "suppressed": self.suppressed,
+            "sample_rate": self.sample_rate,
+            "rate_limit_per_s": self.rate_limit,
+            "json": self.json_logger is not None,
+            "dropped": sum(
+                getattr(h, "dropped", 0)
+                for name in ("proxy_insight", "proxy_insight.access")
+                for h in logging.getLogger(name).handlers
+            ),
+        }
+
+
 # 全局实例
-logger = setup_logging()
 config = load_config()
+logger = setup_logging(config)
+access_log = AccessLog(
+    sample_rate=config.get("logging", {}).get("access_sample_rate", 1.0),
+    rate_limit=config.get("logging", {}).get("access_rate_limit_per_s", 50),
+    json_logger=setup_access_logger(config),
+)
@@ -1,18 +1,34 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from fastapi.responses import FileResponse, Response
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 import asyncio
-import json
 import os
 from contextlib import asynccontextmanager
+from datetime import datetime
 
 # Import from local modules
 from utils import set_mac_proxy
 from db import db_manager
-from logging_config import logger, config
+from logging_config import logger, config, access_log, load_config
 from proxy_mgr import proxy_manager
 from config_api import router as config_router
+from broadcast import broadcaster
+from har import stream_har, stream_ndjson
+from importer import ImportJob, import_jobs, spool_upload, start_import
+import cluster
+import metrics
+import profiling
+from cluster import CaptureForwarder, EventHub, EventSubscriber
+
+ROLE = cluster.current_role()
+
+# 生产模式下的进程间组件 (开发模式单进程时不使用)
+event_hub = EventHub()
+event_subscriber = EventSubscriber()
+forwarder = CaptureForwarder()
+# API 工作进程收到采集进程的第一份写入状态后才打开数据库
+writer_seen = asyncio.Event()
 
 
 async def send_notification(type: str, title: str, message: str):
@@ -24,15 +40,68 @@ async def send_notification(type: str, title: str, message: str):
         "message": message,
         "timestamp": os.popen("date '+%H:%M:%S'").read().strip(),
     }
-    await broadcast_traffic(data)
+    broadcaster.send_control(data)
+
+
+async def handle_cluster_message(message):
+    """Apply a message relayed from the capture process (API workers only)."""
+    kind = message.get("type")
+    if kind == "traffic":
+        broadcaster.publish(message["event"])
+    elif kind == "control":
+        broadcaster.send_control(message["message"])
+    elif kind == "stats":
+        db_manager.follow_writer(message["stats"])
+        writer_seen.set()
+    elif kind == "config":
+        # 采集进程已写入新配置并切换了数据库，这里只重新打开只读连接
+        config.update(await asyncio.to_thread(load_config))
+        db_manager.refresh_config()
+        await db_manager.open_follower()
+
+
+async def wait_for_writer(interval=10):
+    """Wait until the capture process publishes its state (schema ready, stats known)."""
+    while not writer_seen.is_set():
+        try:
+            await asyncio.wait_for(writer_seen.wait(), interval)
+        except asyncio.TimeoutError:
+            logger.warning("Still waiting for the capture process to publish its state")
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup logic
-    logger.info("Backend starting...")
+    logger.info(f"Backend starting ({ROLE})...")
+    profiling.register_loop("api")
+    slow_callback_ms = config.get("profiling", {}).get("slow_callback_ms", 0)
+    if slow_callback_ms > 0:
+        profiling.slow_callbacks.enable(slow_callback_ms)
+    if ROLE == cluster.ROLE_API:
+        # 只读工作进程: 不写库、不抓包，实时事件与统计来自采集进程
+        event_subscriber.start(cluster.events_socket(), handle_cluster_message)
+        # 采集进程建表与迁移完成后才开始发布状态
+        await wait_for_writer()
+        await db_manager.open_follower()
+        db_manager.start_follower()
+
+        yield
+
+        await event_subscriber.close()
+        await forwarder.close()
+        await broadcaster.close()
+        await db_manager.stop_follower()
+        await db_manager.close_pool()
+        logger.info("API worker stopped.")
+        return
+
     try:
         await db_manager.init_db()
+        await db_manager.start_writer()
+        proxy_manager.start_ingest(broadcast_traffic)
+        if ROLE == cluster.ROLE_CAPTURE:
+            await event_hub.start(cluster.events_socket(), db_manager.writer_state)
+            broadcaster.relay = event_hub
         await send_notification(
             "success", "系统就绪", f"数据库已初始化 ({db_manager.db_type})"
         )
@@ -46,6 +115,13 @@ async def lifespan(app: FastAPI):
     logger.info("Backend stopping...")
     proxy_manager.stop_proxy()
     set_mac_proxy(False)
+    # 停止抓包后先处理通道中剩余的流量，再把写入队列中尚未落库的数据写完
+    await proxy_manager.stop_ingest()
+    await broadcaster.close()
+    broadcaster.relay = None
+    await event_hub.close()
+    await db_manager.stop_writer()
+    await db_manager.close_pool()
     logger.info("Backend stopped.")
 
 
@@ -62,8 +138,15 @@ app.add_middleware(
 # Include routers
 app.include_router(config_router)
 
-# Active connections
-active_connections = []
+
+@app.middleware("http")
+async def forward_to_capture(request: Request, call_next):
+    # API 工作进程只处理只读接口，抓包控制、清空、导入与配置交给采集进程
+    if ROLE == cluster.ROLE_API and forwarder.should_forward(
+        request.method, request.url.path
+    ):
+        return await forwarder.forward(request)
+    return await call_next(request)
 
 # Paths
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -80,21 +163,247 @@ async def read_index():
 
 @app.get("/api/status")
 async def get_status():
+    if ROLE == cluster.ROLE_API:
+        try:
+            status = await forwarder.get_json("/api/status")
+        except Exception as e:
+            raise HTTPException(status_code=503, detail=f"Capture process unavailable: {e}")
+        status["api_worker"] = {
+            "pid": os.getpid(),
+            "websocket": broadcaster.stats(),
+            "events": event_subscriber.stats(),
+        }
+        return status
     return {
         "proxy_running": proxy_manager.is_running(),
         "proxy_host": config.get("proxy_host", "127.0.0.1"),
         "proxy_port": config.get("proxy_port", 8080),
+        "ingest": proxy_manager.channel.stats(),
+        "capture": proxy_manager.capture_stats(),
+        "websocket": broadcaster.stats(),
+        "access_log": access_log.stats(),
+        "db_writer": db_manager.get_writer_stats(),
+        "db_storage": db_manager.get_storage_status(),
+        "body_decoder": db_manager.decoder.stats(),
+        "event_hub": event_hub.stats(),
     }
 
 
+@app.get("/metrics")
+async def get_metrics():
+    # 生产模式下由 API 工作进程转发，抓包与写库指标来自采集进程
+    return Response(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.post("/api/admin/profile")
+async def profile_loop(
+    target: str = "api", duration: float = 10, interval_ms: float = None, lines: bool = False
+):
+    """Sample the API loop or the mitmproxy thread and return collapsed stacks."""
+    # 生产模式下由 API 工作进程转发，采样的是采集进程
+    profiling_config = config.get("profiling", {})
+    max_duration = profiling_config.get("max_duration_s", 60)
+    if not 0 < duration <= max_duration:
+        raise HTTPException(
+            status_code=400, detail=f"duration must be in (0, {max_duration}] seconds"
+        )
+    if interval_ms is None:
+        interval_ms = profiling_config.get("interval_ms", 5)
+    if interval_ms < 1:
+        raise HTTPException(status_code=400, detail="interval_ms must be at least 1")
+
+    if target not in ("api", "proxy"):
+        raise HTTPException(status_code=400, detail="target must be api or proxy")
+    if target == "proxy":
+        if proxy_manager.pool.workers:
+            raise HTTPException(
+                status_code=409,
+                detail="mitmproxy runs in capture worker processes ([capture] workers > 0)",
+            )
+        if not proxy_manager.is_running():
+            raise HTTPException(status_code=409, detail="Proxy is not running")
+    thread_id = profiling.loop_thread(target)
+
+    if profiling.profiler.busy():
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    stacks = await profiling.profiler.profile(thread_id, duration, interval_ms / 1000, lines)
+    return Response(
+        profiling.collapsed(stacks),
+        media_type="text/plain",
+        headers={"X-Profile-Samples": str(profiling.profiler.last["samples"])},
+    )
+
+
+@app.post("/api/admin/slow-callbacks")
+async def enable_slow_callbacks(threshold_ms: float = 100, duration: float = None):
+    if threshold_ms <= 0:
+        raise HTTPException(status_code=400, detail="threshold_ms must be positive")
+    profiling.slow_callbacks.enable(threshold_ms, duration)
+    return profiling.slow_callbacks.report()
+
+
+@app.get("/api/admin/slow-callbacks")
+async def get_slow_callbacks(top: int = 50):
+    return profiling.slow_callbacks.report(top)
+
+
+@app.delete("/api/admin/slow-callbacks")
+async def disable_slow_callbacks():
+    profiling.slow_callbacks.disable()
+    profiling.slow_callbacks.reset()
+    return {"success": True}
+
+
+@app.get("/api/admin/stages")
+async def get_stages():
+    addon = {}
+    for worker, counters in proxy_manager.capture_counters().items():
+        captured = counters.get("captured", 0)
+        addon[worker] = {
+            name: round(counters.get(f"{name}_seconds", 0) / captured * 1e6, 2) if captured else None
+            for name in ("record", "put")
+        }
+    return {"stages": profiling.stage_summary(), "addon_mean_us": addon}
+
+
 @app.get("/api/requests")
-async def get_requests(limit: int = 50, offset: int = 0, q: str = None):
-    return await db_manager.get_requests(limit, offset, q)
+async def get_requests(
+    limit: int = 50,
+    q: str = None,
+    host: str = None,
+    status: str = None,
+    mode: str = "fts",
+    before_id: int = None,
+    after_id: int = None,
+    cursor: str = None,
+    since: int = None,
+    until: int = None,
+):
+    try:
+        return await db_manager.get_requests(
+            limit,
+            q,
+            host=host,
+            status=status,
+            mode=mode,
+            before_id=before_id,
+            after_id=after_id,
+            cursor=cursor,
+            since=since,
+            until=until,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/api/requests/{request_id}")
+async def get_request_detail(request_id: int, request: Request):
+    item = await db_manager.get_request(request_id)
+    if item is None and ROLE == cluster.ROLE_API and db_manager.may_be_uncommitted(request_id):
+        # 尚未落库的行只在采集进程的写入队列中
+        return await forwarder.forward(request)
+    if item is None:
+        raise HTTPException(status_code=404, detail="Request not found")
+    return item
 
 
 @app.get("/api/stats")
-async def get_stats():
-    return await db_manager.get_stats()
+async def get_stats(since: int = None, until: int = None):
+    return await db_manager.get_stats(since, until)
+
+
+@app.get("/api/stats/latency")
+async def get_latency_percentiles(
+    by: str = "all",
+    key: str = None,
+    top: int = 20,
+    since: int = None,
+    until: int = None,
+):
+    """p50/p90/p99/p999 latency globally, per host or per status class (e.g. key=5xx)."""
+    try:
+        return await db_manager.get_latency_percentiles(by, key, top, since, until)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def _export_response(stream, fmt, q, host, status, since, until):
+    try:
+        batches = db_manager.export_rows(q, host, status, since, until)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    filename = f"proxy-insight-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{fmt}"
+    media_type = "application/x-ndjson" if fmt == "ndjson" else "application/json"
+    return StreamingResponse(
+        stream(batches),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@app.get("/api/export/har")
+async def export_har(
+    q: str = None,
+    host: str = None,
+    status: str = None,
+    since: int = None,
+    until: int = None,
+):
+    return _export_response(stream_har, "har", q, host, status, since, until)
+
+
+@app.get("/api/export/ndjson")
+async def export_ndjson(
+    q: str = None,
+    host: str = None,
+    status: str = None,
+    since: int = None,
+    until: int = None,
+):
+    return _export_response(stream_ndjson, "ndjson", q, host, status, since, until)
+
+
+async def _import_finished(job):
+    if job.status == "done":
+        await send_notification(
+            "success", "导入完成", f"{job.name}: {job.imported} 条流量"
+        )
+    else:
+        await send_notification("error", "导入失败", f"{job.name}: {job.error}")
+
+
+@app.post("/api/import")
+async def import_traffic(request: Request, filename: str = "upload", format: str = "auto"):
+    """Import a HAR / NDJSON / mitmproxy flow file sent as the raw request body.
+
+    The upload is spooled to a temporary file and imported in the background;
+    poll ``/api/import/{job_id}`` for progress.
+    """
+    path = await spool_upload(request.stream(), suffix=os.path.splitext(filename)[1])
+    try:
+        # 格式检测会读取文件开头，同样放到线程中
+        job = await asyncio.to_thread(ImportJob, path, format, name=filename, cleanup=True)
+    except ValueError as e:
+        os.remove(path)
+        raise HTTPException(status_code=400, detail=str(e))
+    except BaseException:
+        os.remove(path)
+        raise
+    start_import(job, db_manager, on_done=_import_finished)
+    return job.to_dict()
+
+
+@app.get("/api/import")
+async def list_imports():
+    return [job.to_dict() for job in import_jobs.values()]
+
+
+@app.get("/api/import/{job_id}")
+async def get_import(job_id: str):
+    job = import_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Import job not found")
+    return job.to_dict()
 
 
 @app.post("/api/proxy/toggle")
@@ -120,11 +429,7 @@ async def toggle_proxy(enable: bool):
 async def clear_requests():
     await db_manager.clear_all()
     # Notify clients
-    for client in active_connections:
-        try:
-            await client.send_json({"type": "clear"})
-        except Exception as e:
-            logger.error(f"Failed to send clear message: {e}")
+    broadcaster.send_control({"type": "clear"})
     return {"success": True}
 
 
@@ -143,26 +448,21 @@ async def download_cert():
 
 
 @app.websocket("/ws/traffic")
-async def traffic_websocket(websocket: WebSocket):
-    await websocket.accept()
-    active_connections.append(websocket)
+async def traffic_websocket(websocket: WebSocket, detail: str = "summary"):
+    session = await broadcaster.connect(websocket, detail)
     try:
         while True:
-            await websocket.receive_text()
+            # 客户端可随时发送订阅消息修改过滤条件，无需重连
+            broadcaster.handle_message(session, await websocket.receive_text())
     except WebSocketDisconnect:
-        if websocket in active_connections:
-            active_connections.remove(websocket)
+        pass
+    finally:
+        await broadcaster.disconnect(session)
 
 
 async def broadcast_traffic(data: dict):
-    if not active_connections:
-        return
-    message = json.dumps(data)
-    for connection in active_connections:
-        try:
-            await connection.send_text(message)
-        except Exception as e:
-            logger.error(f"Broadcast failed: {e}")
+    # 只入队，不等待任何客户端的发送
+    broadcaster.publish(data)
 
 
 if __name__ == "__main__":
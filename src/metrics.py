@@ -0,0 +1,315 @@
+import bisect
+import math
+import time
+
+# OpenMetrics 文本格式 (Prometheus 2.x 及以上可直接抓取)
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+# 数据库与推送延迟的默认桶 (秒)
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+# 落库滞后包含通道排队与批量等待，桶的范围更大
+LAG_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    return str(int(value))
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class _GaugeValue(_Value):
+    __slots__ = ()
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class _HistogramValue:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        # 只累加所在的桶，输出时再计算累积值
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric:
+    """A metric family with optional labels.
+
+    Updates are plain attribute increments without locks: every metric is
+    written from a single thread (the proxy thread for capture counters, the
+    app loop for everything else), and a scrape may at worst see a value
+    one update old.
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labels=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._children = {}
+        if not self.label_names:
+            self._default = self._children[()] = self._new_value()
+        if registry is not None:
+            registry.register(self)
+
+    def _new_value(self):
+        return _Value()
+
+    def labels(self, **values):
+        key = tuple(str(values[name]) for name in self.label_names)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children.setdefault(key, self._new_value())
+        return child
+
+    def _samples(self, labels, child):
+        yield "", labels, child.value
+
+    def render(self, lines):
+        lines.append(f"# TYPE {self.name} {self.type}")
+        lines.append(f"# HELP {self.name} {_escape(self.documentation)}")
+        for key, child in list(self._children.items()):
+            labels = list(zip(self.label_names, key))
+            for suffix, pairs, value in self._samples(labels, child):
+                lines.append(f"{self.name}{suffix}{_format_labels(pairs)} {_format_value(value)}")
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1):
+        self._default.value += amount
+
+    def _samples(self, labels, child):
+        yield "_total", labels, child.value
+
+
+class CounterFamily(Counter):
+    """Counter totals kept by another component, copied in by a scrape-time collector.
+
+    Like prometheus_client's CounterMetricFamily: a new family is built on
+    every scrape and ``add`` records the component's current total for one
+    label set (the component itself only ever increments it).
+    """
+
+    def add(self, value, **labels):
+        self.labels(**labels).value = value
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def _new_value(self):
+        return _GaugeValue()
+
+    def set(self, value):
+        self._default.value = value
+
+    def inc(self, amount=1):
+        self._default.value += amount
+
+    def dec(self, amount=1):
+        self._default.value -= amount
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), registry=None, buckets=LATENCY_BUCKETS):
+        self.bounds = tuple(sorted(float(b) for b in buckets))
+        super().__init__(name, documentation, labels, registry)
+
+    def _new_value(self):
+        return _HistogramValue(self.bounds)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def _samples(self, labels, child):
+        cumulative = 0
+        for bound, count in zip(self.bounds + (math.inf,), child.counts):
+            cumulative += count
+            yield "_bucket", labels + [("le", _format_value(float(bound)))], cumulative
+        yield "_count", labels, child.count
+        yield "_sum", labels, child.sum
+
+
+class Registry:
+    """Metrics rendered by /metrics: registered families plus scrape-time collectors.
+
+    A collector is a function returning metric families built from the
+    current state (queue depths, liveness), so nothing is updated on the hot
+    path for values that can simply be read when scraped.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            metric.render(lines)
+        for collector in self._collectors:
+            for metric in collector():
+                metric.render(lines)
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labels=()):
+    return Counter(name, documentation, labels, REGISTRY)
+
+
+def gauge(name, documentation, labels=()):
+    return Gauge(name, documentation, labels, REGISTRY)
+
+
+def histogram(name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+    return Histogram(name, documentation, labels, REGISTRY, buckets)
+
+
+def collect_runtime():
+    """State read at scrape time from the proxy, ingest channel, writer and broadcaster."""
+    from broadcast import broadcaster
+    from db import db_manager
+    from proxy_mgr import proxy_manager
+
+    proxy_up = Gauge("proxy_insight_proxy_up", "1 if the capture proxy is running")
+    proxy_up.set(int(proxy_manager.is_running()))
+    workers_up = Gauge(
+        "proxy_insight_capture_worker_up", "Liveness of each capture worker process", ("worker",)
+    )
+    for worker in proxy_manager.pool.workers:
+        workers_up.labels(worker=worker.index).set(int(worker.alive()))
+
+    captured = CounterFamily(
+        "proxy_insight_flows_captured", "Flows captured by TrafficAddon", ("worker",)
+    )
+    errored = CounterFamily(
+        "proxy_insight_flows_errored", "Flows that ended with a connection or protocol error", ("worker",)
+    )
+    body_bytes = CounterFamily(
+        "proxy_insight_body_bytes", "Raw body bytes captured", ("worker", "direction")
+    )
+    addon_seconds = CounterFamily(
+        "proxy_insight_addon_stage_seconds",
+        "Time spent in TrafficAddon.response: building the record, handing it off",
+        ("worker", "stage"),
+    )
+    for worker, counters in proxy_manager.capture_counters().items():
+        captured.add(counters.get("captured", 0), worker=worker)
+        errored.add(counters.get("errored", 0), worker=worker)
+        for direction in ("request", "response"):
+            body_bytes.add(counters.get(f"{direction}_bytes", 0), worker=worker, direction=direction)
+        for name in ("record", "put"):
+            addon_seconds.add(float(counters.get(f"{name}_seconds", 0)), worker=worker, stage=name)
+
+    channel = proxy_manager.channel.stats()
+    ingest_pending = Gauge(
+        "proxy_insight_ingest_pending", "Captured flows waiting in the ingest channel"
+    )
+    ingest_pending.set(channel["depth"] + channel["in_flight"])
+    ingest_dropped = CounterFamily(
+        "proxy_insight_ingest_dropped", "Flows dropped by the ingest overflow policy"
+    )
+    ingest_dropped.add(channel["dropped"])
+
+    backend = db_manager.db_type
+    pending = Gauge(
+        "proxy_insight_db_pending_saves", "Rows accepted by save_request but not yet committed", ("backend",)
+    )
+    pending.labels(backend=backend).set(db_manager.pending_saves())
+    rows = CounterFamily("proxy_insight_db_rows_written", "Rows committed by the DB writer", ("backend",))
+    rows.add(db_manager.writer_stats["rows"], backend=backend)
+    failed = CounterFamily("proxy_insight_db_rows_failed", "Rows that failed to be written", ("backend",))
+    failed.add(db_manager.writer_stats["failed_rows"], backend=backend)
+
+    clients = Gauge("proxy_insight_ws_clients", "Connected /ws/traffic clients")
+    clients.set(len(broadcaster.clients))
+    published = CounterFamily("proxy_insight_ws_events_published", "Events queued for WebSocket clients")
+    published.add(broadcaster.published)
+    send_failures = CounterFamily(
+        "proxy_insight_ws_send_failures", "WebSocket sends that failed or timed out (client dropped)"
+    )
+    send_failures.add(broadcaster.dropped_clients)
+    depth = Gauge("proxy_insight_ws_client_queue_depth", "Events queued for one client", ("client",))
+    lag = Gauge(
+        "proxy_insight_ws_client_lag_seconds", "Age of the oldest event queued for one client", ("client",)
+    )
+    skipped = CounterFamily(
+        "proxy_insight_ws_client_skipped", "Events one client lost by falling behind", ("client",)
+    )
+    now = time.monotonic()
+    for session in list(broadcaster.clients):
+        depth.labels(client=session.id).set(len(session.events))
+        lag.labels(client=session.id).set(round(session.lag(now), 6))
+        skipped.add(session.total_skipped, client=session.id)
+
+    return (
+        proxy_up,
+        workers_up,
+        captured,
+        errored,
+        body_bytes,
+        addon_seconds,
+        ingest_pending,
+        ingest_dropped,
+        pending,
+        rows,
+        failed,
+        clients,
+        published,
+        send_failures,
+        depth,
+        lag,
+        skipped,
+    )
+
+
+REGISTRY.add_collector(collect_runtime)
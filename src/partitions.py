@@ -0,0 +1,116 @@
+from datetime import datetime, timezone
+
+# 分区粒度 -> 时长 (秒)
+GRANULARITIES = {"hour": 3600, "day": 86400}
+
+# 旧的未分区数据 (SQLite 主库中的 requests 表 / MySQL 首个分区)
+LEGACY_PARTITION = "main"
+
+
+def partition_for(captured_at, granularity="day"):
+    """Name and ``[start_ms, end_ms)`` range of the partition holding a capture time.
+
+    Periods are aligned to UTC so shard boundaries do not move with the
+    server's timezone.
+    """
+    period_ms = GRANULARITIES[granularity] * 1000
+    start = captured_at - captured_at % period_ms
+    fmt = "%Y%m%d%H" if granularity == "hour" else "%Y%m%d"
+    name = "p" + datetime.fromtimestamp(start / 1000, tz=timezone.utc).strftime(fmt)
+    return name, start, start + period_ms
+
+
+class Partition:
+    """One time slice of the traffic table with the id range stored in it."""
+
+    __slots__ = ("name", "start_ms", "end_ms", "min_id", "max_id", "rows")
+
+    def __init__(self, name, start_ms, end_ms, min_id=None, max_id=None, rows=0):
+        self.name = name
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+        self.min_id = min_id
+        self.max_id = max_id
+        self.rows = rows or 0
+
+    def overlaps(self, since=None, until=None):
+        if since is not None and self.end_ms is not None and self.end_ms <= since:
+            return False
+        if until is not None and self.start_ms is not None and self.start_ms >= until:
+            return False
+        return True
+
+    def contains_id(self, request_id):
+        return (
+            self.min_id is not None
+            and self.min_id <= request_id <= self.max_id
+        )
+
+    def record(self, ids):
+        """Account for newly inserted ids."""
+        low, high = min(ids), max(ids)
+        self.min_id = low if self.min_id is None else min(self.min_id, low)
+        self.max_id = high if self.max_id is None else max(self.max_id, high)
+        self.rows += len(ids)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "start_ms": self.start_ms,
+            "end_ms": self.end_ms,
+            "min_id": self.min_id,
+            "max_id": self.max_id,
+            "rows": self.rows,
+        }
+
+
+class PartitionRegistry:
+    """In-memory index of partitions used to prune queries by time window and id."""
+
+    def __init__(self):
+        self.partitions = {}
+
+    def clear(self):
+        self.partitions = {}
+
+    def get(self, name):
+        return self.partitions.get(name)
+
+    def add(self, partition):
+        self.partitions[partition.name] = partition
+        return partition
+
+    def remove(self, name):
+        return self.partitions.pop(name, None)
+
+    def sharded(self):
+        """True once anything besides the legacy partition exists."""
+        return any(name != LEGACY_PARTITION for name in self.partitions)
+
+    def oldest_first(self):
+        """Partitions ordered by time; the legacy partition (unbounded start) comes first."""
+        return sorted(
+            self.partitions.values(),
+            key=lambda part: (part.start_ms is not None, part.start_ms or 0),
+        )
+
+    def overlapping(self, since=None, until=None):
+        """Non-empty partitions overlapping ``[since, until)``."""
+        return [
+            part
+            for part in self.oldest_first()
+            if part.rows and part.overlaps(since, until)
+        ]
+
+    def holding_id(self, request_id):
+        return [part for part in self.partitions.values() if part.contains_id(request_id)]
+
+    def expired(self, cutoff_ms):
+        """Time-bounded partitions that end at or before ``cutoff_ms``."""
+        return [
+            part
+            for part in self.oldest_first()
+            if part.end_ms is not None
+            and part.name != LEGACY_PARTITION
+            and part.end_ms <= cutoff_ms
+        ]
@@ -0,0 +1,273 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import weakref
+from collections import Counter, deque
+
+from metrics import histogram
+
+logger = logging.getLogger("proxy_insight")
+
+# 抓包与写库路径各阶段的耗时 (常开，每阶段两次 perf_counter)
+STAGE_SECONDS = histogram(
+    "proxy_insight_stage_seconds",
+    "Time spent in each stage of the capture -> ingest -> storage path",
+    ("stage",),
+    (
+        0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+        0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5,
+    ),
+)
+
+
+def stage(name):
+    """Histogram child of one stage; resolve once at import and ``observe`` on the hot path."""
+    return STAGE_SECONDS.labels(stage=name)
+
+
+def stage_summary():
+    """Count, mean and max bucket of every stage timer (for /api/admin/stages)."""
+    summary = {}
+    for (name,), child in sorted(STAGE_SECONDS._children.items()):
+        if not child.count:
+            continue
+        # 最大值所在桶的上界，直方图不保存精确最大值
+        top = max(i for i, n in enumerate(child.counts) if n)
+        bounds = STAGE_SECONDS.bounds
+        summary[name] = {
+            "count": child.count,
+            "total_ms": round(child.sum * 1000, 3),
+            "mean_us": round(child.sum / child.count * 1e6, 2),
+            "max_bucket_ms": round(bounds[top] * 1000, 3) if top < len(bounds) else None,
+        }
+    return summary
+
+
+# ---------------------------------------------------------------------------
+# 事件循环命名: 报告中区分 API 循环与代理循环
+# ---------------------------------------------------------------------------
+
+_loop_names = weakref.WeakKeyDictionary()
+_loop_threads = {}
+
+
+def register_loop(name, loop=None):
+    """Name the running (or given) loop and remember the thread that runs it."""
+    loop = loop or asyncio.get_running_loop()
+    _loop_names[loop] = name
+    _loop_threads[name] = threading.get_ident()
+
+
+def loop_thread(name):
+    """Thread id of a registered loop (None if unknown)."""
+    return _loop_threads.get(name)
+
+
+def loop_name(loop):
+    try:
+        return _loop_names.get(loop) or f"loop-{id(loop):x}"
+    except TypeError:
+        return "unknown"
+
+
+# ---------------------------------------------------------------------------
+# 采样分析器
+# ---------------------------------------------------------------------------
+
+
+def _frame_label(frame, lines):
+    code = frame.f_code
+    label = f"{os.path.basename(code.co_filename)}:{code.co_qualname}"
+    if lines:
+        label += f":{frame.f_lineno}"
+    # 折叠栈格式以 ; 分隔帧、以空格分隔计数
+    return label.replace(";", ",").replace(" ", "_")
+
+
+def _collapse(frame, lines):
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame, lines))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+def sample_thread(thread_id, duration, interval, lines=False):
+    """Sample the stack of one thread every ``interval`` seconds for ``duration`` seconds.
+
+    Runs on its own thread (it only needs the GIL between samples). Returns a
+    Counter of collapsed stacks, root frame first.
+    """
+    stacks = Counter()
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is None:
+            # 线程已退出
+            break
+        stacks[_collapse(frame, lines)] += 1
+        del frame
+        time.sleep(interval)
+    return stacks
+
+
+def collapsed(stacks):
+    """Brendan Gregg's collapsed format (flamegraph.pl, speedscope, inferno)."""
+    return "".join(f"{stack} {n}\n" for stack, n in stacks.most_common())
+
+
+class Profiler:
+    """Time-limited sampling of one thread; only one profile runs at a time."""
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        self.last = None
+
+    def busy(self):
+        return self._lock.locked()
+
+    async def profile(self, thread_id, duration, interval, lines=False):
+        async with self._lock:
+            started = time.time()
+            stacks = await asyncio.to_thread(sample_thread, thread_id, duration, interval, lines)
+            self.last = {
+                "started": started,
+                "duration_s": duration,
+                "samples": sum(stacks.values()),
+                "stacks": len(stacks),
+            }
+            return stacks
+
+
+# ---------------------------------------------------------------------------
+# 慢回调检测
+# ---------------------------------------------------------------------------
+
+
+def describe_callback(handle):
+    """Readable name of what a Handle ran: the task's coroutine, or the callback itself."""
+    callback = handle._callback
+    owner = getattr(callback, "__self__", None)
+    if isinstance(owner, asyncio.Future) and hasattr(owner, "get_coro"):
+        coro = owner.get_coro()
+        code = getattr(coro, "cr_code", None)
+        if code is not None:
+            return (
+                f"Task {code.co_qualname} "
+                f"({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            )
+        return f"Task {owner.get_name()}"
+    code = getattr(callback, "__code__", None)
+    name = getattr(callback, "__qualname__", None) or repr(callback)
+    if code is not None:
+        return f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    return name
+
+
+class SlowCallbackDetector:
+    """Reports callbacks that block an event loop for longer than a threshold.
+
+    While enabled, ``asyncio.Handle._run`` is wrapped so that every callback
+    of every loop in the process (the API loop and, in thread mode, the
+    mitmproxy loop) is timed; callbacks over the threshold are logged and
+    aggregated by loop and callback. Unlike asyncio debug mode nothing else
+    changes, so it can be switched on in production for a while.
+    """
+
+    def __init__(self):
+        self.threshold = None
+        self.enabled_at = None
+        self.expires_at = None
+        self.recent = deque(maxlen=200)
+        self.totals = {}
+        self._original = None
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def enabled(self):
+        return self._original is not None
+
+    def enable(self, threshold_ms, duration=None):
+        """Start (or re-arm) detection; ``duration`` seconds, or until ``disable``."""
+        self.threshold = threshold_ms / 1000
+        if self._original is None:
+            original = self._original = asyncio.events.Handle._run
+            detector = self
+
+            def _run(handle):
+                start = time.perf_counter()
+                original(handle)
+                elapsed = time.perf_counter() - start
+                if elapsed >= detector.threshold:
+                    detector.record(handle, elapsed)
+
+            asyncio.events.Handle._run = _run
+            self.enabled_at = time.time()
+            logger.info(f"Slow callback detection enabled (threshold {threshold_ms}ms)")
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self.expires_at = None
+        if duration:
+            self.expires_at = time.time() + duration
+            self._timer = threading.Timer(duration, self.disable)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def disable(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._original is not None:
+            asyncio.events.Handle._run = self._original
+            self._original = None
+            self.expires_at = None
+            logger.info("Slow callback detection disabled")
+
+    def record(self, handle, elapsed):
+        loop = loop_name(handle._loop)
+        callback = describe_callback(handle)
+        ms = elapsed * 1000
+        with self._lock:
+            self.recent.append(
+                {"time": time.time(), "loop": loop, "callback": callback, "ms": round(ms, 2)}
+            )
+            entry = self.totals.setdefault((loop, callback), [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += ms
+            entry[2] = max(entry[2], ms)
+        logger.warning(f"Slow callback on {loop} loop: {callback} took {ms:.1f}ms")
+
+    def reset(self):
+        with self._lock:
+            self.recent.clear()
+            self.totals.clear()
+
+    def report(self, top=50):
+        with self._lock:
+            totals = sorted(self.totals.items(), key=lambda item: item[1][1], reverse=True)
+            recent = list(self.recent)
+        return {
+            "enabled": self.enabled(),
+            "threshold_ms": self.threshold * 1000 if self.threshold is not None else None,
+            "enabled_at": self.enabled_at,
+            "expires_at": self.expires_at,
+            "callbacks": [
+                {
+                    "loop": loop,
+                    "callback": callback,
+                    "count": count,
+                    "total_ms": round(total, 2),
+                    "max_ms": round(worst, 2),
+                }
+                for (loop, callback), (count, total, worst) in totals[:top]
+            ],
+            "recent": recent[-top:],
+        }
+
+
+profiler = Profiler()
+slow_callbacks = SlowCallbackDetector()
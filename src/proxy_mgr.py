@@ -1,80 +1,81 @@
 import asyncio
-from mitmproxy import http
 from mitmproxy.options import Options
 from mitmproxy.tools.dump import DumpMaster
 import threading
 import os
 import time
 from datetime import datetime
-from logging_config import logger, config
-
-
-class TrafficAddon:
-    def __init__(self, broadcast_callback):
-        self.broadcast_callback = broadcast_callback
-        self.loop = asyncio.get_event_loop()
-
-    def request(self, flow: http.HTTPFlow):
-        logger.info(f"[Request] {flow.request.method} {flow.request.pretty_url}")
-
-    def response(self, flow: http.HTTPFlow):
-        # 提取关键信息
-        data = {
-            "method": flow.request.method,
-            "url": flow.request.pretty_url,
-            "status": f"{flow.response.status_code} {flow.response.reason}",
-            "time": f"{int((flow.response.timestamp_end - flow.request.timestamp_start) * 1000)}ms",
-            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "request": {
-                "headers": dict(flow.request.headers),
-                "body": flow.request.get_text() if flow.request.text else "",
-                "cookies": {k: str(v) for k, v in flow.request.cookies.items()},
-            },
-            "response": {
-                "headers": dict(flow.response.headers),
-                "body": flow.response.get_text() if flow.response.text else "",
-                "cookies": {k: str(v) for k, v in flow.response.cookies.items()},
-            },
+from logging_config import logger, config, access_log
+from ingest import IngestChannel, TrafficAddon
+from capture_workers import WorkerPool
+import profiling
+
+_SAVE_STAGE = profiling.stage("ingest.save")
+_ACCESS_LOG_STAGE = profiling.stage("ingest.access_log")
+_BROADCAST_STAGE = profiling.stage("ingest.broadcast")
+
+
+def live_event(data, request_id):
+    """WebSocket payload of a captured flow: headers and sizes, no bodies."""
+    event = dict(data, id=request_id)
+    for side in ("request", "response"):
+        part = data[side]
+        event[side] = {
+            "headers": part["headers"],
+            "cookies": part["cookies"],
+            "raw_size": len(part["body"] or b""),
         }
+    return event
 
-        # Log to console/file immediately
-        logger.info(
-            f"[Captured] {data['method']} {data['url']} - Status: {data['status']}"
-        )
-
-        # Save to database
-        try:
-            from db import db_manager
 
-            asyncio.run_coroutine_threadsafe(db_manager.save_request(data), self.loop)
-            logger.debug(f"Queued DB save for {data['url']}")
-        except Exception as e:
-            logger.error(f"Failed to save to database: {e}")
+class ProxyManager:
+    def __init__(self):
+        self.master = None
+        self.thread = None
+        self.broadcast_callback = None
+        ingest_config = config.get("ingest", {})
+        self.channel = IngestChannel(
+            maxsize=ingest_config.get("queue_size", 5000),
+            max_bytes=ingest_config.get("max_buffered_mb", 64) * 1024 * 1024,
+            policy=ingest_config.get("overflow", "block"),
+        )
+        # 重启代理时复用同一个 addon，抓包计数器不清零
+        self.addon = TrafficAddon(self.channel)
+        # 多进程抓包: [capture] workers > 0 时由工作进程运行 mitmproxy
+        self.pool = WorkerPool(self.channel)
+
+    def start_ingest(self, broadcast_callback=None):
+        """Start consuming captured flows on the running (FastAPI) loop."""
+        if broadcast_callback:
+            self.broadcast_callback = broadcast_callback
+        self.channel.start(self._handle_flow)
+
+    async def stop_ingest(self):
+        """Process the flows still buffered, then stop the consumer task."""
+        await self.channel.stop()
+
+    async def _handle_flow(self, data):
+        """Save the flow, then broadcast it (without bodies) under its database id."""
+        from db import db_manager
+
+        start = time.perf_counter()
+        request_id = await db_manager.save_request(data)
+        saved = time.perf_counter()
+        _SAVE_STAGE.observe(saved - start)
+        access_log.log(data, request_id)
+        logged = time.perf_counter()
+        _ACCESS_LOG_STAGE.observe(logged - saved)
 
         # 回调给 FastAPI 广播
         if self.broadcast_callback:
             try:
-                asyncio.run_coroutine_threadsafe(
-                    self.broadcast_callback(data), self.loop
-                )
-                logger.debug(f"Queued broadcast for {data['url']}")
+                await self.broadcast_callback(live_event(data, request_id))
             except Exception as e:
-                logger.error(f"Failed to queue broadcast: {e}")
-
-    def error(self, flow: http.HTTPFlow):
-        # 记录错误信息
-        logger.error(
-            f"[Error] {flow.request.method} {flow.request.pretty_url}: {flow.error}"
-        )
-
-
-class ProxyManager:
-    def __init__(self):
-        self.master = None
-        self.thread = None
+                logger.error(f"Failed to broadcast: {e}")
+            _BROADCAST_STAGE.observe(time.perf_counter() - logged)
 
     def start_proxy(self, broadcast_callback=None, host=None, port=None):
-        if self.thread and self.thread.is_alive():
+        if self.is_running():
             return
 
         host = host or config.get("proxy_host", "0.0.0.0")
@@ -83,21 +84,42 @@ class ProxyManager:
         # Use an event to notify when the master is ready
         startup_event = threading.Event()
 
+        # 消费任务需运行在 FastAPI 的事件循环上 (DB 写入任务所在的循环)
+        try:
+            self.start_ingest(broadcast_callback)
+        except RuntimeError:
+            logger.warning("No running event loop, captured flows will not be ingested")
+
+        capture_config = config.get("capture", {})
+        workers = int(capture_config.get("workers", 0))
+        if workers > 0:
+            ingest_config = config.get("ingest", {})
+            settings = dict(
+                capture_config,
+                queue_size=ingest_config.get("queue_size", 5000),
+                overflow=ingest_config.get("overflow", "block"),
+            )
+            self.pool.start(host, port, workers, settings)
+            return
+
         def run():
             loop = asyncio.new_event_loop()
             asyncio.set_event_loop(loop)
-
-            nonlocal broadcast_callback
+            profiling.register_loop("proxy", loop)
 
             for attempt in range(3):
                 try:
-                    opts = Options(listen_host=host, listen_port=port)
+                    opts = Options(
+                        listen_host=host,
+                        listen_port=port,
+                        ssl_insecure=bool(capture_config.get("ssl_insecure", False)),
+                    )
                     # Create DumpMaster inside the thread so it attaches to the fresh loop
                     # Pass loop explicitly to avoid "no running event loop" error
                     self.master = DumpMaster(
                         opts, with_termlog=True, with_dumper=False, loop=loop
                     )
-                    self.master.addons.add(TrafficAddon(broadcast_callback))
+                    self.master.addons.add(self.addon)
 
                     if attempt == 0:
                         startup_event.set()
@@ -135,6 +157,8 @@ class ProxyManager:
         logger.info(f"Mitmproxy started on {host}:{port}")
 
     def stop_proxy(self):
+        if self.pool.workers:
+            self.pool.stop()
         if self.master:
             try:
                 self.master.shutdown()
@@ -150,8 +174,24 @@ class ProxyManager:
         logger.info("Mitmproxy stopped")
 
     def is_running(self):
+        if self.pool.running():
+            return True
         return self.thread is not None and self.thread.is_alive()
 
+    def capture_stats(self):
+        """Capture mode and, in multi-process mode, the state of each worker."""
+        if self.pool.workers:
+            return self.pool.stats()
+        return {"mode": "thread", "workers": []}
+
+    def capture_counters(self):
+        """TrafficAddon counters per capture process: ``{"main": {...}}`` or one per worker."""
+        if self.pool.workers:
+            return {
+                str(worker.index): worker.stats.get("addon", {}) for worker in self.pool.workers
+            }
+        return {"main": dict(self.addon.counters)}
+
 
 # 全局管理器实例
 proxy_manager = ProxyManager()
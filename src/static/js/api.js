@@ -14,18 +14,31 @@ export const API = {
     return await res.json();
   },
 
-  async getHistory(limit = 50, offset = 0, query = "") {
-    let url = `/api/requests?limit=${limit}&offset=${offset}`;
+  async getHistory(limit = 50, cursor = null, query = "") {
+    let url = `/api/requests?limit=${limit}`;
+    if (cursor) url += `&cursor=${encodeURIComponent(cursor)}`;
     if (query) url += `&q=${encodeURIComponent(query)}`;
     const res = await fetch(url);
     return await res.json();
   },
 
+  async getRequest(id) {
+    const res = await fetch(`/api/requests/${id}`);
+    if (!res.ok) throw new Error(`Request ${id} not found`);
+    return await res.json();
+  },
+
   async getStats() {
     const res = await fetch("/api/stats");
     return await res.json();
   },
 
+  exportUrl(query = "", format = "har") {
+    let url = `/api/export/${format}`;
+    if (query) url += `?q=${encodeURIComponent(query)}`;
+    return url;
+  },
+
   async clearAll() {
     const res = await fetch("/api/clear", {
       method: "POST",
@@ -57,7 +70,14 @@ export const API = {
 
     socket.onmessage = (event) => {
       const data = JSON.parse(event.data);
-      data.id = Date.now() + Math.random();
+      // 流量按批次推送，每帧包含多条摘要及因客户端落后而跳过的条数
+      if (data.type === "batch") {
+        if (data.skipped) onMessage({ type: "skipped", count: data.skipped });
+        data.events.forEach((item) => onMessage(item));
+        return;
+      }
+      // 实时推送的流量带有数据库 id，通知等其他消息仍使用本地 id
+      data.id ??= Date.now() + Math.random();
       onMessage(data);
     };
 
@@ -65,6 +85,20 @@ export const API = {
       if (onError) onError(err);
     };
 
+    // 连接建立后重新发送当前的订阅过滤条件
+    socket.onopen = () => {
+      if (this.subscription) socket.send(JSON.stringify(this.subscription));
+    };
+
+    this.socket = socket;
     return socket;
   },
+
+  // 服务端过滤实时流量: { host, method, status, url_contains, url_regex, min_latency_ms }
+  subscribe(filters, detail) {
+    this.subscription = { type: "subscribe", filters, detail };
+    if (this.socket?.readyState === WebSocket.OPEN) {
+      this.socket.send(JSON.stringify(this.subscription));
+    }
+  },
 };
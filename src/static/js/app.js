@@ -35,6 +35,12 @@ class App {
                     this.handleRemoteClear();
                 } else if (data.type === 'notification') {
                     UI.addNotification(data);
+                } else if (data.type === 'skipped') {
+                    console.warn(`Live feed lagging, skipped ${data.count} events`);
+                } else if (data.type === 'subscribed') {
+                    console.info('Live feed subscription:', data.filters);
+                } else if (data.type === 'error') {
+                    UI.showToast(data.message, 'error');
                 } else {
                     this.handleNewRequest(data);
                 }
@@ -80,6 +86,7 @@ class App {
     bindEvents() {
         const proxyToggle = document.getElementById('proxy-toggle');
         const clearBtn = document.getElementById('clear-btn');
+        const exportBtn = document.getElementById('export-btn');
         const bellBtn = document.getElementById('bell-btn');
         const markReadBtn = document.getElementById('mark-read-btn');
         const notifDropdown = document.getElementById('notif-dropdown');
@@ -117,6 +124,11 @@ class App {
             }
         });
 
+        // Export (按当前搜索条件导出，浏览器直接下载流式响应)
+        exportBtn.addEventListener('click', () => {
+            window.location.href = API.exportUrl(searchInput.value.trim());
+        });
+
         // Notification Bell
         bellBtn.addEventListener('click', (e) => {
             e.stopPropagation();
@@ -33,6 +33,11 @@ export const UI = {
         return Object.entries(headers).map(([k, v]) => `${k}: ${v}`).join('\n');
     },
 
+    formatBodyPart(part) {
+        if (part?.binary) return `(Binary body, ${part.size} bytes)`;
+        return this.formatBody(part?.body);
+    },
+
     formatBody(content) {
         if (!content) return '(Empty Body)';
         try {
@@ -78,8 +78,8 @@ export const DashboardView = {
         this.stats.totalRequests = stats.total;
         this.stats.successCount = stats.success;
         this.stats.errorCount = stats.error;
-        if (stats.avg_latency) {
-            this.stats.avgLatency = Math.round(stats.avg_latency) || 0;
+        if (stats.avg_latency_ms !== undefined) {
+            this.stats.avgLatency = Math.round(stats.avg_latency_ms) || 0;
             this.stats.totalLatency = this.stats.avgLatency * this.stats.totalRequests;
         }
         this.updateUI();
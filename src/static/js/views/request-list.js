@@ -9,7 +9,7 @@ export const RequestListView = {
     detailPanel: null,
     selectedRequest: null,
     currentTab: 'Header',
-    offset: 0,
+    cursor: null,
     limit: 50,
     query: '',
     searchTimeout: null,
@@ -53,16 +53,11 @@ export const RequestListView = {
         this.loadMoreBtn.disabled = true;
         
         try {
-            const history = await API.getHistory(this.limit, this.offset, this.query);
-            if (history && history.length > 0) {
-                history.forEach(data => this.renderRequest(data, true));
-                this.offset += history.length;
-                if (history.length < this.limit) {
-                    this.loadMoreBtn.style.display = 'none';
-                }
-            } else {
-                this.loadMoreBtn.style.display = 'none';
-            }
+            const page = await API.getHistory(this.limit, this.cursor, this.query);
+            const items = page?.items || [];
+            items.forEach(data => this.renderRequest(data, true));
+            this.cursor = page?.next_cursor || null;
+            this.loadMoreBtn.style.display = this.cursor ? 'block' : 'none';
         } catch (err) {
             console.error('Failed to load more history:', err);
             UI.showToast('加载失败', 'error');
@@ -81,17 +76,27 @@ export const RequestListView = {
         item.innerHTML = `
             <div class="col method ${methodClass}">${data.method}</div>
             <div class="col status ${statusClass}">${data.status || 'Unknown'}</div>
-            <div class="col url">${data.url}</div>
+            <div class="col url">${data.url}${data.snippet ? `<div class="search-snippet">${data.snippet}</div>` : ''}</div>
             <div class="col timestamp">${data.timestamp || ''}</div>
             <div class="col time">${data.time}</div>
         `;
 
-        item.addEventListener('click', () => {
+        item.addEventListener('click', async () => {
             this.requestList.querySelectorAll('.request-item').forEach(i => i.classList.remove('selected'));
             item.classList.add('selected');
             this.selectedRequest = data;
             this.detailPanel.style.display = 'flex';
-            this.updateDetailContent();
+            // 列表只包含摘要字段，首次打开时按需加载头部、Cookie 与主体
+            if (data.request?.body === undefined) {
+                try {
+                    Object.assign(data, await API.getRequest(data.id));
+                } catch (err) {
+                    console.error('Failed to load request detail:', err);
+                    UI.showToast('加载请求详情失败', 'error');
+                    return;
+                }
+            }
+            if (this.selectedRequest === data) this.updateDetailContent();
         });
 
         if (append) {
@@ -127,11 +132,11 @@ export const RequestListView = {
                 html = `
                     <div class="detail-section">
                         <h3>请求主体 (Request Body)</h3>
-                        <pre><code>${UI.formatBody(this.selectedRequest.request.body)}</code></pre>
+                        <pre><code>${UI.formatBodyPart(this.selectedRequest.request)}</code></pre>
                     </div>
                     <div class="detail-section">
                         <h3>响应主体 (Response Body)</h3>
-                        <pre><code>${UI.formatBody(this.selectedRequest.response.body)}</code></pre>
+                        <pre><code>${UI.formatBodyPart(this.selectedRequest.response)}</code></pre>
                     </div>
                 `;
                 break;
@@ -172,7 +177,7 @@ export const RequestListView = {
                     </div>
                     <div class="detail-section">
                         <h3>响应主体 (Response Body)</h3>
-                        <pre><code>${UI.formatBody(this.selectedRequest.response.body)}</code></pre>
+                        <pre><code>${UI.formatBodyPart(this.selectedRequest.response)}</code></pre>
                     </div>
                 `;
                 break;
@@ -193,13 +198,13 @@ export const RequestListView = {
         if (this.requestList) this.requestList.innerHTML = '';
         if (this.detailPanel) this.detailPanel.style.display = 'none';
         this.selectedRequest = null;
-        this.offset = 0;
+        this.cursor = null;
         if (this.loadMoreBtn) this.loadMoreBtn.style.display = 'none';
     },
 
     async filter(query) {
         this.query = query;
-        this.offset = 0;
+        this.cursor = null;
         
         if (this.searchTimeout) clearTimeout(this.searchTimeout);
         
@@ -0,0 +1,258 @@
+import math
+
+# /api/stats/latency 返回的分位数
+PERCENTILES = (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("p999", 0.999))
+# 主机数超过上限后，新主机的延迟计入该分组
+OTHER_HOSTS = "(other)"
+
+
+class LatencySketch:
+    """Mergeable latency distribution with bounded relative error.
+
+    Values fall into logarithmic buckets (HDR histogram / DDSketch style):
+    bucket ``i`` covers ``(gamma**(i-1), gamma**i]`` with
+    ``gamma = (1 + a) / (1 - a)``, so any quantile is returned within a
+    relative error ``a`` of a real sample. The bucket count is bounded by the
+    value range (about 800 for 1ms..1h at 1%), not by the number of samples.
+    Counts may be added with a negative sign, which lets retention subtract
+    deleted rows; sketches with the same accuracy merge by adding counts.
+    """
+
+    __slots__ = ("relative_accuracy", "_log_gamma", "bins", "zeros", "count")
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self._log_gamma = math.log((1 + relative_accuracy) / (1 - relative_accuracy))
+        self.bins = {}
+        # <= 0ms 的样本 (缓存命中、导入的流量) 单独计数
+        self.zeros = 0
+        self.count = 0
+
+    def index(self, value):
+        """Bucket of ``value``; None for values that are not positive."""
+        if value <= 0:
+            return None
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def add_index(self, index, count=1):
+        self.count += count
+        if index is None:
+            self.zeros += count
+            return
+        n = self.bins.get(index, 0) + count
+        if n:
+            self.bins[index] = n
+        else:
+            del self.bins[index]
+
+    def add(self, value, count=1):
+        self.add_index(self.index(value), count)
+
+    def merge(self, other):
+        for index, n in other.bins.items():
+            self.add_index(index, n)
+        self.add_index(None, other.zeros)
+
+    def _value(self, index):
+        # 桶内的代表值，与桶两端的相对误差都不超过 relative_accuracy
+        return 2 * math.exp(index * self._log_gamma) / (1 + math.exp(self._log_gamma))
+
+    def quantiles(self, qs):
+        """Estimated quantiles for ascending ``qs`` (0..1) in one pass; None if empty."""
+        if self.count <= 0:
+            return [None] * len(qs)
+        values = []
+        seen = self.zeros
+        indexes = iter(sorted(self.bins))
+        last = None
+        for q in qs:
+            rank = q * (self.count - 1)
+            while seen <= rank:
+                index = next(indexes, None)
+                if index is None:
+                    break
+                last = index
+                seen += self.bins[index]
+            values.append(self._value(last) if last is not None else 0.0)
+        return values
+
+    def quantile(self, q):
+        return self.quantiles((q,))[0]
+
+    def percentiles(self):
+        qs = [q for _, q in PERCENTILES] + [1.0]
+        values = self.quantiles(qs)
+        summary = {"count": self.count}
+        for (name, _), value in zip(PERCENTILES + (("max", 1.0),), values):
+            summary[name] = round(value, 1) if value is not None else None
+        return summary
+
+    def state(self):
+        return {"zeros": self.zeros, "bins": list(self.bins.items())}
+
+    @classmethod
+    def from_state(cls, state, relative_accuracy=0.01):
+        sketch = cls(relative_accuracy)
+        sketch.zeros = state["zeros"]
+        sketch.bins = {int(index): n for index, n in state["bins"]}
+        sketch.count = sketch.zeros + sum(sketch.bins.values())
+        return sketch
+
+
+class StatsEngine:
+    """Running traffic aggregates maintained on every save.
+
+    The aggregates are rebuilt from the database once (at startup, after a
+    backend switch or after clear_all) and then updated incrementally, so
+    /api/stats is O(1) regardless of table size. Latency is kept as
+    LatencySketch distributions globally, per status class and per host
+    (at most ``max_hosts``; later hosts share the OTHER_HOSTS sketch).
+    """
+
+    def __init__(self, max_hosts=1000, relative_accuracy=0.01):
+        self.ready = False
+        self.max_hosts = max_hosts
+        self.relative_accuracy = relative_accuracy
+        self.reset()
+
+    def reset(self):
+        self.total = 0
+        self.latency_sum = 0
+        self.latency_count = 0
+        # 按状态码分类计数: {"2xx": n, "4xx": n, "other": n}
+        self.by_class = {}
+        self.latency = LatencySketch(self.relative_accuracy)
+        self.latency_by_class = {}
+        # 主机的分组在重建前不会移除，删除旧行时总能减到当初计入的分组
+        self.latency_by_host = {}
+
+    @staticmethod
+    def status_class(status_code):
+        if status_code is None or not 100 <= status_code < 600:
+            return "other"
+        return f"{status_code // 100}xx"
+
+    def _host_sketch(self, host):
+        sketch = self.latency_by_host.get(host or "")
+        if sketch is None:
+            if len(self.latency_by_host) >= self.max_hosts:
+                host = OTHER_HOSTS
+                sketch = self.latency_by_host.get(host)
+            if sketch is None:
+                sketch = self.latency_by_host[host or ""] = LatencySketch(self.relative_accuracy)
+        return sketch
+
+    def _add_latency(self, cls, host, latency_ms, count):
+        self.latency_sum += latency_ms * count
+        self.latency_count += count
+        # 桶号只计算一次，三个维度共用
+        index = self.latency.index(latency_ms)
+        self.latency.add_index(index, count)
+        sketch = self.latency_by_class.get(cls)
+        if sketch is None:
+            sketch = self.latency_by_class[cls] = LatencySketch(self.relative_accuracy)
+        sketch.add_index(index, count)
+        self._host_sketch(host).add_index(index, count)
+
+    def add(self, status_code, latency_ms, host=None, count=1):
+        self.total += count
+        cls = self.status_class(status_code)
+        self.by_class[cls] = self.by_class.get(cls, 0) + count
+        if latency_ms is not None:
+            self._add_latency(cls, host, latency_ms, count)
+
+    def remove(self, status_code, latency_ms, host=None):
+        """Undo ``add`` for a deleted row (retention pruning)."""
+        self.add(status_code, latency_ms, host, count=-1)
+        cls = self.status_class(status_code)
+        if self.by_class.get(cls) == 0:
+            del self.by_class[cls]
+
+    def load(self, groups):
+        """Rebuild from grouped rows of (status_class, host, latency_ms, total).
+
+        ``status_class`` is the status code divided by 100 (e.g. 2 for 2xx).
+        """
+        self.reset()
+        self.merge(groups)
+        self.ready = True
+
+    def merge(self, groups, sign=1):
+        """Add grouped rows (see ``load``); ``sign=-1`` subtracts a dropped partition."""
+        for cls, host, latency_ms, total in groups:
+            total = int(total or 0) * sign
+            self.total += total
+            key = f"{int(cls)}xx" if cls is not None and 1 <= cls <= 5 else "other"
+            self.by_class[key] = self.by_class.get(key, 0) + total
+            if not self.by_class[key]:
+                del self.by_class[key]
+            if latency_ms is not None:
+                self._add_latency(key, host, latency_ms, total)
+
+    def state(self):
+        """Raw aggregates, for handing the running totals to another process.
+
+        Only the global latency sketch is included; per-host and per-class
+        percentiles are served by the capture process.
+        """
+        return {
+            "total": self.total,
+            "latency_sum": self.latency_sum,
+            "latency_count": self.latency_count,
+            "by_class": dict(self.by_class),
+            "latency": self.latency.state(),
+        }
+
+    def restore(self, state):
+        """Replace the aggregates with a ``state()`` taken elsewhere."""
+        self.total = state["total"]
+        self.latency_sum = state["latency_sum"]
+        self.latency_count = state["latency_count"]
+        self.by_class = dict(state["by_class"])
+        self.latency = LatencySketch.from_state(state["latency"], self.relative_accuracy)
+        self.ready = True
+
+    def latency_percentiles(self, by="all", key=None, top=20):
+        """p50/p90/p99/p999 of the global, per-class or per-host distributions.
+
+        ``key`` selects one host or class; otherwise the ``top`` busiest
+        groups are returned.
+        """
+        if by == "all":
+            sketches = {"all": self.latency}
+        elif by == "status_class":
+            sketches = self.latency_by_class
+        elif by == "host":
+            sketches = self.latency_by_host
+        else:
+            raise ValueError("by must be all, host or status_class")
+        if key is not None:
+            sketches = {key: sketches[key]} if key in sketches else {}
+        groups = [
+            dict(key=name, **sketch.percentiles())
+            for name, sketch in sketches.items()
+            if sketch.count > 0
+        ]
+        groups.sort(key=lambda group: group["count"], reverse=True)
+        return {
+            "by": by,
+            "relative_accuracy": self.relative_accuracy,
+            "groups": groups[:top],
+        }
+
+    def snapshot(self):
+        success = self.by_class.get("2xx", 0) + self.by_class.get("3xx", 0)
+        error = self.by_class.get("4xx", 0) + self.by_class.get("5xx", 0)
+        avg_latency = (
+            self.latency_sum / self.latency_count if self.latency_count else 0
+        )
+        percentiles = self.latency.percentiles()
+        return {
+            "total": self.total,
+            "success": success,
+            "error": error,
+            "avg_latency": f"{int(avg_latency)}ms",
+            "avg_latency_ms": round(avg_latency, 1),
+            "latency_percentiles_ms": {name: percentiles[name] for name, _ in PERCENTILES},
+            "by_class": dict(sorted(self.by_class.items())),
+        }
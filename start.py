@@ -1,3 +1,4 @@
+import argparse
 import sys
 import os
 import uvicorn
@@ -10,8 +11,28 @@ sys.path.append(src_dir)
 from logging_config import logger, config
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Start ProxyInsight.")
+    parser.add_argument(
+        "--production",
+        action="store_true",
+        help="separate capture process plus [server] api_workers API workers",
+    )
+    args = parser.parse_args()
+
     port = config.get("app_port", 8000)
     host = config.get("app_host", "0.0.0.0")
+    server_config = config.get("server", {})
+
+    if args.production or server_config.get("mode") == "production":
+        from cluster import run_production
+
+        api_workers = int(server_config.get("api_workers", 0)) or os.cpu_count() or 1
+        logger.info(
+            f"Starting in production mode: capture process + {api_workers} API workers "
+            f"on http://{host}:{port}"
+        )
+        run_production(host, port, api_workers)
+        sys.exit(0)
 
     logger.info(f"Startup successful. Backend running on http://{host}:{port}")
 
@@ -0,0 +1,706 @@
+"""End-to-end capture throughput benchmark.
+
+Starts a local HTTP + HTTPS upstream in a child process, runs the FastAPI app
+and ProxyManager in this process on a scratch SQLite database, and drives a
+request mix through the proxy with httpx. For every concurrency level it
+reports:
+
+- proxy-added latency: percentiles of the proxied run minus the same
+  percentiles of an identical run sent straight to the upstream
+- sustained flows/s: rows committed by the DB writer per second
+- persistence lag: client response received -> row committed
+- WebSocket delivery lag: client response received -> event on /ws/traffic
+- peak RSS of the app process (plus capture workers, if any)
+
+Results are saved as JSON (tests/bench_results/) and can be compared with a
+previous run::
+
+    python tests/bench_capture.py --concurrency 1,16,64 --requests 3000
+    python tests/bench_capture.py --mix GET:0:1,POST:256k:1 --https 0.5
+    python tests/bench_capture.py --compare tests/bench_results/capture-<ts>.json
+
+The load generator shares the interpreter with the app, as a real client on
+the same host would share the CPU; compare runs made on the same machine.
+"""
+
+import argparse
+import asyncio
+import base64
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import resource
+import shutil
+import socket
+import ssl
+import sys
+import tempfile
+import threading
+import time
+from itertools import count
+
+import httpx
+from wsproto import ConnectionType, WSConnection
+from wsproto.events import (
+    AcceptConnection,
+    CloseConnection,
+    Ping,
+    Request,
+    TextMessage,
+)
+
+from bench_common import (
+    compare_results,
+    distribution,
+    format_size,
+    parse_size,
+    print_table,
+    save_results,
+    use_src,
+)
+
+DEFAULT_MIX = "GET:0:2,GET:2k:5,GET:64k:2,POST:16k:1"
+BENCH_ID = re.compile(r"[?&]bench=(\d+)")
+
+# ---------------------------------------------------------------------------
+# 上游服务器 (子进程): /bytes/<n> 返回 n 字节, POST /echo 读取请求体
+# ---------------------------------------------------------------------------
+
+
+def _self_signed_cert(directory):
+    """Write a throwaway certificate for 127.0.0.1 / localhost; returns (cert, key) paths."""
+    import ipaddress
+
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(hours=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(
+            x509.SubjectAlternativeName(
+                [x509.DNSName("localhost"), x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]
+            ),
+            critical=False,
+        )
+        .sign(key, hashes.SHA256())
+    )
+    cert_path = os.path.join(directory, "upstream.crt")
+    key_path = os.path.join(directory, "upstream.key")
+    with open(cert_path, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(
+            key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            )
+        )
+    return cert_path, key_path
+
+
+_payloads = {}
+
+
+def payload(size):
+    """Text body of ``size`` bytes (random base64: realistic to index, poor to compress)."""
+    if size not in _payloads:
+        _payloads[size] = base64.b64encode(os.urandom(size))[:size]
+    return _payloads[size]
+
+
+async def _handle_upstream(reader, writer):
+    try:
+        while True:
+            head = await reader.readuntil(b"\r\n\r\n")
+            lines = head.decode("latin-1").split("\r\n")
+            method, target, _ = lines[0].split(" ", 2)
+            length, close = 0, False
+            for line in lines[1:]:
+                name, _, value = line.partition(":")
+                name = name.strip().lower()
+                if name == "content-length":
+                    length = int(value)
+                elif name == "connection":
+                    close = value.strip().lower() == "close"
+            if length:
+                await reader.readexactly(length)
+            path = target.split("?", 1)[0]
+            status = b"200 OK"
+            if path.startswith("/bytes/") and method == "GET":
+                body = payload(int(path[7:]))
+            elif path == "/echo" and method == "POST":
+                body = b'{"received": %d}' % length
+            else:
+                status, body = b"404 Not Found", b"not found"
+            writer.write(
+                b"HTTP/1.1 %s\r\nContent-Type: text/plain\r\nContent-Length: %d\r\n\r\n"
+                % (status, len(body))
+                + body
+            )
+            await writer.drain()
+            if close:
+                break
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _serve_upstream(conn, cert_path, key_path):
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert_path, key_path)
+    context.set_alpn_protocols(["http/1.1"])
+    plain = await asyncio.start_server(_handle_upstream, "127.0.0.1", 0, backlog=1024)
+    secure = await asyncio.start_server(
+        _handle_upstream, "127.0.0.1", 0, ssl=context, backlog=1024
+    )
+    conn.send((plain.sockets[0].getsockname()[1], secure.sockets[0].getsockname()[1]))
+    # 父进程关闭管道即退出
+    await asyncio.get_running_loop().run_in_executor(None, conn.recv_bytes)
+
+
+def _run_upstream(conn, cert_path, key_path):
+    try:
+        asyncio.run(_serve_upstream(conn, cert_path, key_path))
+    except EOFError:
+        pass
+
+
+class Upstream:
+    def __init__(self, workdir):
+        self.workdir = workdir
+        self.process = None
+        self.ports = None
+        self._conn = None
+
+    def start(self):
+        cert_path, key_path = _self_signed_cert(self.workdir)
+        ctx = multiprocessing.get_context("spawn")
+        self._conn, child = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_run_upstream, args=(child, cert_path, key_path), name="upstream", daemon=True
+        )
+        self.process.start()
+        child.close()
+        if not self._conn.poll(30):
+            raise RuntimeError("Upstream server did not start")
+        self.ports = self._conn.recv()
+
+    def base_url(self, scheme):
+        port = self.ports[0] if scheme == "http" else self.ports[1]
+        return f"{scheme}://127.0.0.1:{port}"
+
+    def stop(self):
+        if self._conn is not None:
+            self._conn.close()
+        if self.process is not None:
+            self.process.join(5)
+            if self.process.is_alive():
+                self.process.kill()
+
+
+# ---------------------------------------------------------------------------
+# 应用 (本进程): uvicorn 运行在独立线程的事件循环中
+# ---------------------------------------------------------------------------
+
+
+class App:
+    """The FastAPI app and ProxyManager, running in-process on a background loop."""
+
+    def __init__(self, port, proxy_port):
+        self.port = port
+        self.proxy_port = proxy_port
+        self.loop = None
+        self.server = None
+        self.thread = None
+
+    def start(self, timeout=30.0):
+        import uvicorn
+
+        import main
+
+        self.main = main
+        self.server = uvicorn.Server(
+            uvicorn.Config(main.app, host="127.0.0.1", port=self.port, log_level="warning")
+        )
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_until_complete, args=(self.server.serve(),), name="bench-app"
+        )
+        self.thread.start()
+        deadline = time.monotonic() + timeout
+        while not self.server.started:
+            if not self.thread.is_alive() or time.monotonic() > deadline:
+                raise RuntimeError("App did not start")
+            time.sleep(0.05)
+
+    def call(self, func, *args):
+        """Run ``func`` on the app loop (as an endpoint would) and return its result."""
+
+        async def run():
+            result = func(*args)
+            return await result if asyncio.iscoroutine(result) else result
+
+        return asyncio.run_coroutine_threadsafe(run(), self.loop).result()
+
+    def start_proxy(self, timeout=30.0):
+        from proxy_mgr import proxy_manager
+
+        # 不经过 /api/proxy/toggle: 基准测试不修改系统代理设置
+        self.call(
+            proxy_manager.start_proxy, self.main.broadcast_traffic, "127.0.0.1", self.proxy_port
+        )
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", self.proxy_port), timeout=1).close()
+                return
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError("Proxy did not start listening")
+                time.sleep(0.1)
+
+    def clear(self):
+        from db import db_manager
+
+        self.call(db_manager.clear_all)
+
+    def stop(self):
+        from proxy_mgr import proxy_manager
+
+        self.call(proxy_manager.stop_proxy)
+        self.server.should_exit = True
+        self.thread.join(30)
+        self.loop.close()
+
+
+# ---------------------------------------------------------------------------
+# WebSocket 订阅端 (wsproto): 记录每个基准请求的事件到达时间
+# ---------------------------------------------------------------------------
+
+
+class TrafficWatcher:
+    """Minimal /ws/traffic client recording when each benchmark flow is delivered."""
+
+    def __init__(self):
+        self.delivered = {}
+        self.skipped = 0
+        self._ws = WSConnection(ConnectionType.CLIENT)
+        self._accepted = asyncio.Event()
+        self._task = None
+        self._writer = None
+
+    async def connect(self, port, timeout=10.0):
+        reader, self._writer = await asyncio.open_connection("127.0.0.1", port)
+        self._writer.write(self._ws.send(Request(host=f"127.0.0.1:{port}", target="/ws/traffic")))
+        self._task = asyncio.create_task(self._read(reader))
+        await asyncio.wait_for(self._accepted.wait(), timeout)
+
+    async def _read(self, reader):
+        parts = []
+        while data := await reader.read(256 * 1024):
+            self._ws.receive_data(data)
+            for event in self._ws.events():
+                if isinstance(event, AcceptConnection):
+                    self._accepted.set()
+                elif isinstance(event, TextMessage):
+                    parts.append(event.data)
+                    if event.message_finished:
+                        self._on_message("".join(parts), time.perf_counter())
+                        parts = []
+                elif isinstance(event, Ping):
+                    self._writer.write(self._ws.send(event.response()))
+                elif isinstance(event, CloseConnection):
+                    return
+
+    def _on_message(self, text, now):
+        message = json.loads(text)
+        if message.get("type") != "batch":
+            return
+        self.skipped += message.get("skipped", 0)
+        for event in message["events"]:
+            match = BENCH_ID.search(event.get("url") or "")
+            if match:
+                self.delivered.setdefault(int(match.group(1)), now)
+
+    async def close(self):
+        try:
+            self._writer.write(self._ws.send(CloseConnection(code=1000)))
+            await self._writer.drain()
+        except Exception:
+            pass
+        self._task.cancel()
+        self._writer.close()
+
+
+# ---------------------------------------------------------------------------
+# 负载
+# ---------------------------------------------------------------------------
+
+
+def parse_mix(text):
+    """``"GET:2k:5,POST:16k:1"`` -> [(method, size, weight)]."""
+    mix = []
+    for item in text.split(","):
+        parts = item.strip().split(":")
+        if len(parts) not in (2, 3):
+            raise ValueError(f"Invalid mix entry {item!r} (expected METHOD:SIZE[:WEIGHT])")
+        method = parts[0].upper()
+        if method not in ("GET", "POST"):
+            raise ValueError(f"Unsupported method in mix: {method}")
+        mix.append((method, parse_size(parts[1]), float(parts[2]) if len(parts) == 3 else 1.0))
+    return mix
+
+
+def plan_requests(mix, https_share, n, seed):
+    """Deterministic list of (scheme, method, size) drawn from the weighted mix."""
+    rng = random.Random(seed)
+    weights = [weight for _, _, weight in mix]
+    plan = []
+    for method, size, _ in rng.choices(mix, weights, k=n):
+        scheme = "https" if rng.random() < https_share else "http"
+        plan.append((scheme, method, size))
+    return plan
+
+
+class Driver:
+    """Sends the planned requests with ``concurrency`` workers and records their timing."""
+
+    def __init__(self, upstream, ids, proxy=None):
+        self.upstream = upstream
+        self.proxy = proxy
+        # 所有场景共用的请求编号，写在 URL 中以便匹配 WebSocket 事件
+        self.ids = ids
+
+    async def run(self, plan, concurrency, total=None, duration=None):
+        """Returns ``{bench_id: (start, end, ok)}`` in perf_counter seconds."""
+        client = httpx.AsyncClient(
+            proxy=self.proxy,
+            verify=False,
+            trust_env=False,
+            timeout=60.0,
+            limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+        )
+        bases = {scheme: self.upstream.base_url(scheme) for scheme in ("http", "https")}
+        results = {}
+        deadline = time.perf_counter() + duration if duration else None
+        total = total or (None if duration else len(plan))
+        sequence = count()
+
+        async def worker():
+            for n in sequence:
+                if (total is not None and n >= total) or (
+                    deadline is not None and time.perf_counter() >= deadline
+                ):
+                    return
+                scheme, method, size = plan[n % len(plan)]
+                bench_id = next(self.ids)
+                if method == "GET":
+                    url, content = f"{bases[scheme]}/bytes/{size}?bench={bench_id}", None
+                else:
+                    url, content = f"{bases[scheme]}/echo?bench={bench_id}", payload(size)
+                start = time.perf_counter()
+                try:
+                    response = await client.request(method, url, content=content)
+                    ok = response.status_code == 200
+                except httpx.HTTPError:
+                    ok = False
+                results[bench_id] = (start, time.perf_counter(), ok)
+
+        async with client:
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return results
+
+
+def latencies_ms(results):
+    return [(end - start) * 1000 for start, end, ok in results.values() if ok]
+
+
+# ---------------------------------------------------------------------------
+# 采样: 写入进度与内存
+# ---------------------------------------------------------------------------
+
+
+def _rss_mb(pid="self"):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+class Sampler:
+    """Samples committed writer rows and RSS every ``interval`` seconds."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = []
+        self.peak_rss_mb = 0.0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        from db import db_manager
+        from proxy_mgr import proxy_manager
+
+        n = 0
+        while True:
+            self.samples.append((time.perf_counter(), db_manager.writer_stats["rows"]))
+            if n % 20 == 0:
+                rss = _rss_mb() + sum(
+                    _rss_mb(w.pid) for w in proxy_manager.pool.workers if w.alive()
+                )
+                self.peak_rss_mb = max(self.peak_rss_mb, rss)
+            n += 1
+            await asyncio.sleep(self.interval)
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+def persistence_lags_ms(ends, samples, rows_before):
+    """Lag between the k-th client response and the k-th committed row."""
+    lags, j = [], 0
+    for k, end in enumerate(sorted(ends), 1):
+        while j < len(samples) and samples[j][1] - rows_before < k:
+            j += 1
+        if j == len(samples):
+            break
+        lags.append((samples[j][0] - end) * 1000)
+    return lags
+
+
+async def wait_for(predicate, timeout):
+    deadline = time.perf_counter() + timeout
+    while not predicate():
+        if time.perf_counter() > deadline:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+
+# ---------------------------------------------------------------------------
+# 场景
+# ---------------------------------------------------------------------------
+
+
+async def run_scenario(app, upstream, args, mix, concurrency):
+    from db import db_manager
+
+    name = f"c{concurrency}"
+    plan = plan_requests(mix, args.https, args.requests or 10000, args.seed)
+    direct = Driver(upstream, args.ids)
+    proxied = Driver(upstream, args.ids, proxy=f"http://127.0.0.1:{app.proxy_port}")
+
+    await asyncio.to_thread(app.clear)
+    if args.warmup:
+        await proxied.run(plan, concurrency, total=args.warmup)
+        await direct.run(plan, concurrency, total=args.warmup)
+
+    # 预热产生的流量先全部落库，直连基线不与写入竞争
+    await asyncio.to_thread(app.call, db_manager.flush)
+    metrics = {}
+    baseline = None
+    if not args.no_baseline:
+        baseline = await direct.run(plan, concurrency, args.requests, args.duration)
+        metrics.update(distribution(latencies_ms(baseline), "direct_latency_ms"))
+
+    await asyncio.to_thread(app.call, db_manager.flush)
+    rows_before = db_manager.writer_stats["rows"]
+    watcher = TrafficWatcher()
+    await watcher.connect(app.port)
+    sampler = Sampler()
+    sampler.start()
+
+    results = await proxied.run(plan, concurrency, args.requests, args.duration)
+    ok = {bench_id: r for bench_id, r in results.items() if r[2]}
+    persisted = await wait_for(
+        lambda: db_manager.writer_stats["rows"] - rows_before >= len(ok), args.drain_timeout
+    )
+    await wait_for(lambda: all(i in watcher.delivered for i in ok), 2.0)
+    await sampler.stop()
+    await watcher.close()
+
+    start = min(r[0] for r in results.values())
+    end = max(r[1] for r in results.values())
+    proxied_ms = latencies_ms(results)
+    metrics.update(
+        {
+            "requests": len(results),
+            "errors": len(results) - len(ok),
+            "requests_per_s": round(len(ok) / (end - start), 1),
+        }
+    )
+    metrics.update(distribution(proxied_ms, "proxy_latency_ms"))
+    if baseline:
+        for key in ("p50", "p90", "p99", "p999", "mean"):
+            before = metrics.get(f"direct_latency_ms.{key}")
+            after = metrics.get(f"proxy_latency_ms.{key}")
+            if before is not None and after is not None:
+                metrics[f"proxy_added_ms.{key}"] = round(after - before, 3)
+
+    committed = db_manager.writer_stats["rows"] - rows_before
+    done_at = next((t for t, rows in sampler.samples if rows - rows_before >= committed), end)
+    metrics["flows_persisted"] = committed
+    metrics["flows_per_s"] = round(committed / max(done_at - start, 1e-9), 1)
+    if not persisted:
+        print(f"[{name}] warning: only {committed}/{len(ok)} flows persisted", file=sys.stderr)
+    ends = [r[1] for r in ok.values()]
+    metrics.update(distribution(persistence_lags_ms(ends, sampler.samples, rows_before), "persist_lag_ms"))
+
+    ws_lags = [
+        (watcher.delivered[i] - r[1]) * 1000 for i, r in ok.items() if i in watcher.delivered
+    ]
+    metrics.update(distribution(ws_lags, "ws_lag_ms"))
+    metrics["ws_missing"] = len(ok) - len(ws_lags)
+    metrics["ws_skipped"] = watcher.skipped
+    metrics["peak_rss_mb"] = round(sampler.peak_rss_mb, 1)
+    return {"name": name, "concurrency": concurrency, "metrics": metrics}
+
+
+SUMMARY_ROWS = (
+    ("requests/s", "requests_per_s"),
+    ("flows/s (persisted)", "flows_per_s"),
+    ("errors", "errors"),
+    ("direct p50 / p99 ms", "direct_latency_ms.p50", "direct_latency_ms.p99"),
+    ("proxied p50 / p99 ms", "proxy_latency_ms.p50", "proxy_latency_ms.p99"),
+    ("proxy added p50 / p99 / p999 ms", "proxy_added_ms.p50", "proxy_added_ms.p99", "proxy_added_ms.p999"),
+    ("persist lag p50 / p99 / max ms", "persist_lag_ms.p50", "persist_lag_ms.p99", "persist_lag_ms.max"),
+    ("ws lag p50 / p99 / max ms", "ws_lag_ms.p50", "ws_lag_ms.p99", "ws_lag_ms.max"),
+    ("ws missing / skipped", "ws_missing", "ws_skipped"),
+    ("peak RSS MB", "peak_rss_mb"),
+)
+
+
+def print_summary(scenarios):
+    rows = []
+    for label, *keys in SUMMARY_ROWS:
+        row = [label]
+        for scenario in scenarios:
+            values = [scenario["metrics"].get(key) for key in keys]
+            row.append(" / ".join("-" if v is None else f"{v:g}" for v in values))
+        rows.append(row)
+    print()
+    print_table(["metric"] + [s["name"] for s in scenarios], rows)
+
+
+async def run(args):
+    mix = parse_mix(args.mix)
+    workdir = tempfile.mkdtemp(prefix="proxy-insight-bench-")
+    # 必须在导入应用模块之前设置: 独立的数据库与端口
+    os.environ["DB_PATH"] = os.path.join(workdir, "bench.db")
+    os.environ["PROXY_PORT"] = str(args.proxy_port)
+    use_src()
+    from logging_config import config
+
+    config["capture"] = dict(config.get("capture", {}), workers=args.capture_workers, ssl_insecure=True)
+    logging.getLogger("proxy_insight").setLevel(args.log_level.upper())
+
+    upstream = Upstream(workdir)
+    app = App(args.app_port, args.proxy_port)
+    args.ids = count()
+    scenarios = []
+    try:
+        upstream.start()
+        await asyncio.to_thread(app.start)
+        await asyncio.to_thread(app.start_proxy)
+        for concurrency in args.concurrency:
+            scenario = await run_scenario(app, upstream, args, mix, concurrency)
+            scenarios.append(scenario)
+            m = scenario["metrics"]
+            print(
+                f"[{scenario['name']}] {m['requests']} requests, {m['requests_per_s']} req/s, "
+                f"{m['flows_per_s']} flows/s",
+                flush=True,
+            )
+    finally:
+        if app.thread is not None:
+            await asyncio.to_thread(app.stop)
+        upstream.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    params = {
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        "duration": args.duration,
+        "warmup": args.warmup,
+        "mix": [f"{m}:{format_size(s)}:{w:g}" for m, s, w in mix],
+        "https": args.https,
+        "capture_workers": args.capture_workers,
+        "seed": args.seed,
+        "self_max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    print_summary(scenarios)
+    path = save_results("capture", params, scenarios, args.output)
+    print(f"\nResults saved to {path}")
+    if args.compare:
+        regressions = compare_results(scenarios, args.compare, args.threshold)
+        return 1 if regressions else 0
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="End-to-end capture throughput benchmark.")
+    parser.add_argument(
+        "--concurrency",
+        type=lambda s: [int(c) for c in s.split(",")],
+        default=[1, 16, 64],
+        help="comma-separated concurrency levels, one scenario each (default: 1,16,64)",
+    )
+    parser.add_argument("--requests", type=int, default=2000, help="requests per scenario")
+    parser.add_argument(
+        "--duration", type=float, default=None, help="run each scenario for N seconds instead"
+    )
+    parser.add_argument("--warmup", type=int, default=200, help="unmeasured requests first")
+    parser.add_argument(
+        "--mix",
+        default=DEFAULT_MIX,
+        help=f"weighted METHOD:SIZE:WEIGHT entries; GET sizes are response bodies, "
+        f"POST sizes request bodies (default: {DEFAULT_MIX})",
+    )
+    parser.add_argument("--https", type=float, default=0.0, help="share of HTTPS requests (0-1)")
+    parser.add_argument(
+        "--capture-workers", type=int, default=0, help="[capture] workers (0 = proxy thread)"
+    )
+    parser.add_argument("--no-baseline", action="store_true", help="skip the direct run")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--app-port", type=int, default=18000)
+    parser.add_argument("--proxy-port", type=int, default=18080)
+    parser.add_argument("--drain-timeout", type=float, default=60.0)
+    parser.add_argument("--log-level", default="warning")
+    parser.add_argument("--output", help="results file (default: tests/bench_results/capture-<time>.json)")
+    parser.add_argument("--compare", help="previous results file to compare with")
+    parser.add_argument("--threshold", type=float, default=10.0, help="regression threshold in %%")
+    args = parser.parse_args(argv)
+    if args.requests and args.duration:
+        args.requests = None
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
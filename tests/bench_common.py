@@ -0,0 +1,159 @@
+"""Shared helpers of the benchmark scripts (tests/bench_*.py).
+
+Results are saved as JSON under tests/bench_results/ so that two runs can be
+compared with ``--compare``; every scenario stores a flat ``metrics`` dict
+(``"proxy_latency_ms.p99": 12.3``).
+"""
+
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_DIR = os.path.join(PROJECT_ROOT, "src")
+RESULTS_DIR = os.path.join(PROJECT_ROOT, "tests", "bench_results")
+
+PERCENTILES = (("p50", 50), ("p90", 90), ("p99", 99), ("p999", 99.9))
+
+_SIZE_UNITS = {"": 1, "k": 1024, "m": 1024 * 1024, "g": 1024 * 1024 * 1024}
+
+
+def use_src():
+    """Make the application modules importable (they live flat in src/)."""
+    if SRC_DIR not in sys.path:
+        sys.path.insert(0, SRC_DIR)
+
+
+def parse_size(text):
+    """``"64k"`` -> 65536; plain integers are bytes."""
+    text = str(text).strip().lower().removesuffix("b")
+    unit = text[-1:] if text[-1:] in _SIZE_UNITS else ""
+    return int(float(text[: len(text) - len(unit)]) * _SIZE_UNITS[unit])
+
+
+def format_size(size):
+    """65536 -> ``"64k"`` (inverse of parse_size for round sizes)."""
+    for unit in ("g", "m", "k"):
+        if size >= _SIZE_UNITS[unit] and size % _SIZE_UNITS[unit] == 0:
+            return f"{size // _SIZE_UNITS[unit]}{unit}"
+    return str(size)
+
+
+def percentile(ordered, q):
+    """Nearest-rank percentile of an already sorted list (None if empty)."""
+    if not ordered:
+        return None
+    rank = math.ceil(q / 100 * len(ordered))
+    return ordered[min(max(rank, 1), len(ordered)) - 1]
+
+
+def distribution(values, prefix):
+    """Flat summary (count, mean, percentiles, max) of a list of samples."""
+    ordered = sorted(values)
+    metrics = {f"{prefix}.count": len(ordered)}
+    if not ordered:
+        return metrics
+    metrics[f"{prefix}.mean"] = round(sum(ordered) / len(ordered), 3)
+    for name, q in PERCENTILES:
+        metrics[f"{prefix}.{name}"] = round(percentile(ordered, q), 3)
+    metrics[f"{prefix}.max"] = round(ordered[-1], 3)
+    return metrics
+
+
+def machine_info():
+    info = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+    try:
+        info["commit"] = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=PROJECT_ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        info["dirty"] = bool(
+            subprocess.run(
+                ["git", "status", "--porcelain", "--untracked-files=no"],
+                cwd=PROJECT_ROOT,
+                capture_output=True,
+                text=True,
+            ).stdout.strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        info["commit"] = None
+    return info
+
+
+def save_results(kind, params, scenarios, output=None):
+    """Write a results document and return its path."""
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{kind}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    document = {
+        "benchmark": kind,
+        "machine": machine_info(),
+        "params": params,
+        "scenarios": scenarios,
+    }
+    with open(output, "w") as f:
+        json.dump(document, f, indent=2)
+    return output
+
+
+def print_table(headers, rows):
+    cells = [[str(h) for h in headers]] + [
+        ["-" if v is None else str(v) for v in row] for row in rows
+    ]
+    widths = [max(len(row[i]) for row in cells) for i in range(len(headers))]
+    for n, row in enumerate(cells):
+        print("  ".join(v.rjust(w) if i else v.ljust(w) for i, (v, w) in enumerate(zip(row, widths))))
+        if n == 0:
+            print("  ".join("-" * w for w in widths))
+
+
+def higher_is_better(metric):
+    return "per_s" in metric
+
+
+def compare_results(scenarios, baseline_path, threshold=10.0, metrics=None):
+    """Print the change of every shared metric against a saved run.
+
+    Returns the number of metrics that got worse by more than ``threshold``
+    percent.
+    """
+    with open(baseline_path) as f:
+        baseline = {s["name"]: s["metrics"] for s in json.load(f)["scenarios"]}
+    rows, regressions = [], 0
+    for scenario in scenarios:
+        before = baseline.get(scenario["name"])
+        if before is None:
+            continue
+        for metric, value in scenario["metrics"].items():
+            if metrics is not None and metric not in metrics:
+                continue
+            old = before.get(metric)
+            if not isinstance(value, (int, float)) or not isinstance(old, (int, float)):
+                continue
+            change = (value - old) / abs(old) * 100 if old else 0.0
+            worse = -change if higher_is_better(metric) else change
+            flag = ""
+            if worse > threshold:
+                flag = "REGRESSION"
+                regressions += 1
+            elif worse < -threshold:
+                flag = "improved"
+            rows.append((scenario["name"], metric, old, value, f"{change:+.1f}%", flag))
+    print(f"\nCompared with {baseline_path} (threshold {threshold:g}%):")
+    if not rows:
+        print("No scenarios in common.")
+        return 0
+    print_table(("scenario", "metric", "before", "after", "change", ""), rows)
+    return regressions
@@ -0,0 +1,531 @@
+"""Storage-layer benchmark over synthetic traffic datasets.
+
+Generates realistic flows (zipf-distributed hosts and body words, a weighted
+body-size distribution, a share of repeated bodies for the content-addressed
+store) and grows the dataset through checkpoints, e.g. 1k -> 100k -> 1m rows.
+At every checkpoint it measures, per backend:
+
+- insert throughput of ``bulk_insert`` and of the live ``save_request`` path
+- first page, deep page (keyset) and filtered page latency of ``get_requests``
+- full-text and literal search latency
+- ``get_stats`` latency (running aggregates, time window, full rebuild)
+- per-host latency percentiles from the running sketches
+- detail (``get_request``) latency and on-disk size
+
+``clear_all`` is timed once the largest dataset has been measured. SQLite
+runs on a scratch database; MySQL runs against ``[mysql]`` in config.toml
+(database ``--mysql-database``, created if missing) and is skipped when no
+server is reachable::
+
+    python tests/bench_storage.py --rows 1k,100k,1m
+    python tests/bench_storage.py --rows 10k,1m,10m --bodies 0:1,1k:2,8k:1 --partitioning day
+    python tests/bench_storage.py --rows 1k,100k --compare tests/bench_results/storage-<ts>.json
+"""
+
+import argparse
+import asyncio
+import base64
+import logging
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+from bench_common import (
+    compare_results,
+    distribution,
+    format_size,
+    parse_size,
+    print_table,
+    save_results,
+    use_src,
+)
+
+DEFAULT_BODIES = "0:35,256:25,2k:25,16k:12,128k:3"
+STATUSES = (
+    (200, "OK", 85),
+    (304, "Not Modified", 4),
+    (302, "Found", 3),
+    (404, "Not Found", 5),
+    (500, "Internal Server Error", 3),
+)
+DAY_MS = 24 * 3600 * 1000
+
+
+def parse_count(text):
+    """``"100k"`` -> 100000 (decimal units, unlike sizes)."""
+    text = str(text).strip().lower()
+    units = {"k": 1000, "m": 1000000}
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def format_count(n):
+    for unit, value in (("m", 1000000), ("k", 1000)):
+        if n >= value and n % value == 0:
+            return f"{n // value}{unit}"
+    return str(n)
+
+
+def parse_weights(text, parse=parse_size):
+    """``"0:25,4k:10"`` -> ([0, 4096], [25.0, 10.0])."""
+    values, weights = [], []
+    for item in text.split(","):
+        value, _, weight = item.strip().partition(":")
+        values.append(parse(value))
+        weights.append(float(weight or 1))
+    return values, weights
+
+
+# ---------------------------------------------------------------------------
+# 合成数据
+# ---------------------------------------------------------------------------
+
+
+class Dataset:
+    """Deterministic generator of flow dicts in the shape ``save_request`` receives."""
+
+    VARIANTS = 8
+
+    def __init__(self, args):
+        self.rng = random.Random(args.seed)
+        rng = self.rng
+        self.sizes, self.size_weights = parse_weights(args.bodies)
+        self.dedup = args.dedup
+        self.binary = args.binary
+        self.post_share = args.post_share
+        letters = "abcdefghijklmnopqrstuvwxyz"
+        self.words = [
+            "".join(rng.choices(letters, k=rng.randint(3, 9))) for _ in range(5000)
+        ]
+        self.word_weights = [1 / (rank + 1) for rank in range(len(self.words))]
+        self.hosts = [f"api{i}.svc{i % 17}.example.com" for i in range(args.hosts)]
+        self.host_weights = [1 / (rank + 1) for rank in range(len(self.hosts))]
+        self.paths = [
+            "/" + "/".join(rng.choices(self.words[:400], k=rng.randint(1, 4)))
+            for _ in range(2000)
+        ]
+        self.statuses = [s[:2] for s in STATUSES]
+        self.status_weights = [s[2] for s in STATUSES]
+        # 每种大小预先生成若干文本与二进制主体，生成数据集时只做拼接
+        self.text = {size: [self._text(size) for _ in range(self.VARIANTS)] for size in self.sizes}
+        self.blobs = {
+            size: [os.urandom(size) for _ in range(self.VARIANTS)] for size in self.sizes
+        }
+        self.end_ms = int(time.time() * 1000)
+        self.start_ms = self.end_ms - int(args.days * DAY_MS)
+        self.total = None
+        self.n = 0
+
+    def _text(self, size):
+        if not size:
+            return b""
+        words = []
+        length = 0
+        while length < size:
+            chunk = self.rng.choices(self.words, self.word_weights, k=256)
+            words.extend(chunk)
+            length += sum(len(w) + 1 for w in chunk)
+        return (b'{"text": "' + " ".join(words).encode())[: size - 2] + b'"}'
+
+    def common_word(self):
+        return self.words[0]
+
+    def rare_word(self):
+        return self.words[-1]
+
+    def _body(self, n, side):
+        size = self.rng.choices(self.sizes, self.size_weights)[0]
+        if not size:
+            return b"", ""
+        variant = self.rng.randrange(self.VARIANTS)
+        if self.rng.random() < self.binary:
+            body, content_type = self.blobs[size][variant], "application/octet-stream"
+        else:
+            body, content_type = self.text[size][variant], "application/json"
+        if self.rng.random() >= self.dedup:
+            # 唯一主体: 以行号开头，内容寻址存储无法去重
+            prefix = b'{"id": "row%d%s", ' % (n, side.encode())
+            body = prefix + body[len(prefix) :]
+        return body, content_type
+
+    def flows(self, count):
+        """Generate the next ``count`` flows, captured_at increasing across the time span."""
+        rng = self.rng
+        flows = []
+        span = self.end_ms - self.start_ms
+        for _ in range(count):
+            n = self.n
+            self.n += 1
+            captured_at = self.start_ms + span * n // max(self.total or n + 1, 1)
+            host = rng.choices(self.hosts, self.host_weights)[0]
+            path = rng.choice(self.paths)
+            post = rng.random() < self.post_share
+            request_body, request_type = self._body(n, "q") if post else (b"", "")
+            response_body, response_type = self._body(n, "s")
+            status_code, reason = rng.choices(self.statuses, self.status_weights)[0]
+            latency = int(rng.lognormvariate(4.2, 0.9))
+            request_headers = {"host": host, "user-agent": "bench/1.0", "accept": "*/*"}
+            if request_type:
+                request_headers["content-type"] = request_type
+            response_headers = {"content-type": response_type or "text/plain", "server": "bench"}
+            flows.append(
+                {
+                    "method": "POST" if post else "GET",
+                    "url": f"https://{host}{path}?page={n % 50}",
+                    "scheme": "https",
+                    "host": host,
+                    "path": path,
+                    "status": f"{status_code} {reason}",
+                    "status_code": status_code,
+                    "reason": reason,
+                    "time": f"{latency}ms",
+                    "latency_ms": latency,
+                    "captured_at": captured_at,
+                    "request": {
+                        "headers": request_headers,
+                        "body": request_body,
+                        "content_type": request_type,
+                        "content_encoding": "",
+                        "cookies": {"session": base64.b16encode(n.to_bytes(6, "big")).decode()},
+                    },
+                    "response": {
+                        "headers": response_headers,
+                        "body": response_body,
+                        "content_type": response_type,
+                        "content_encoding": "",
+                        "cookies": {},
+                    },
+                }
+            )
+        return flows
+
+
+# ---------------------------------------------------------------------------
+# 后端
+# ---------------------------------------------------------------------------
+
+
+def mysql_reachable(settings, timeout=2.0):
+    try:
+        socket.create_connection(
+            (settings.get("host", "127.0.0.1"), int(settings.get("port", 3306))), timeout
+        ).close()
+        return True
+    except OSError:
+        return False
+
+
+async def open_backend(backend, args):
+    """A fresh, empty DatabaseManager on ``backend`` (None if it is unavailable)."""
+    from db import DatabaseManager
+    from logging_config import config
+
+    config["db_type"] = backend
+    if backend == "mysql":
+        import aiomysql
+
+        settings = dict(config.get("mysql", {}), database=args.mysql_database)
+        if not mysql_reachable(settings):
+            print(f"MySQL not reachable at {settings.get('host')}:{settings.get('port')}, skipped")
+            return None
+        conn = await aiomysql.connect(
+            host=settings.get("host", "127.0.0.1"),
+            port=int(settings.get("port", 3306)),
+            user=settings.get("user", "root"),
+            password=settings.get("password", "root"),
+        )
+        async with conn.cursor() as cur:
+            await cur.execute(f"CREATE DATABASE IF NOT EXISTS `{args.mysql_database}`")
+        conn.close()
+        config["mysql"] = settings
+    db = DatabaseManager()
+    await db.init_db()
+    await db.clear_all()
+    return db
+
+
+async def storage_bytes(db):
+    if db.db_type == "mysql":
+        async with db.get_conn() as conn:
+            rows = await db._fetchall(
+                conn,
+                "SELECT COALESCE(SUM(data_length + index_length), 0) AS size "
+                "FROM information_schema.tables WHERE table_schema = DATABASE()",
+            )
+        return int(rows[0]["size"])
+    paths = [db.db_path, db.db_path + "-wal"]
+    if os.path.isdir(db.shard_dir):
+        for name in os.listdir(db.shard_dir):
+            paths.append(os.path.join(db.shard_dir, name))
+    return sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+
+
+# ---------------------------------------------------------------------------
+# 测量
+# ---------------------------------------------------------------------------
+
+
+async def timed(repeat, func, *args, **kwargs):
+    samples, result = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = await func(*args, **kwargs)
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples, result
+
+
+def body_bytes(flows):
+    return sum(len(f["request"]["body"]) + len(f["response"]["body"]) for f in flows)
+
+
+async def grow(db, dataset, count, batch_rows, live_rows):
+    """Insert ``count`` more rows: bulk batches first, the last ``live_rows`` via the writer."""
+    metrics = {}
+    # 至少一半走批量写入，小数据集也能得到两种写入速率
+    live_rows = min(live_rows, count // 2)
+    bulk_rows = count - live_rows
+    generate_s = insert_s = 0.0
+    inserted = raw = 0
+    while inserted < bulk_rows:
+        start = time.perf_counter()
+        flows = dataset.flows(min(batch_rows, bulk_rows - inserted))
+        generate_s += time.perf_counter() - start
+        raw += body_bytes(flows)
+        start = time.perf_counter()
+        inserted += await db.bulk_insert(flows)
+        insert_s += time.perf_counter() - start
+    if bulk_rows:
+        metrics["insert_rows_per_s"] = round(bulk_rows / insert_s, 1)
+        metrics["insert_mb_per_s"] = round(raw / 1048576 / insert_s, 2)
+
+    if live_rows:
+        flows = dataset.flows(live_rows)
+        await db.start_writer()
+        start = time.perf_counter()
+        for flow in flows:
+            await db.save_request(flow)
+        await db.flush()
+        live_s = time.perf_counter() - start
+        await db.stop_writer()
+        metrics["live_rows_per_s"] = round(live_rows / live_s, 1)
+    metrics["generate_s"] = round(generate_s, 2)
+    return metrics
+
+
+async def measure_queries(db, dataset, rows, args):
+    metrics = {}
+    repeat = args.repeat
+
+    async def record(name, samples_result):
+        samples, result = samples_result
+        metrics.update(distribution(samples, name))
+        return result
+
+    first = await record("first_page_ms", await timed(repeat, db.get_requests, limit=50))
+    newest = first["items"][0]["id"] if first["items"] else rows
+    # 深分页: 翻到最旧的 10% 数据 (keyset，与逐页翻动的代价相同)
+    await record(
+        "deep_page_ms", await timed(repeat, db.get_requests, limit=50, before_id=max(newest // 10, 2))
+    )
+    await record(
+        "host_page_ms", await timed(repeat, db.get_requests, limit=50, host=dataset.hosts[-1])
+    )
+    await record("status_page_ms", await timed(repeat, db.get_requests, limit=50, status="5xx"))
+    await record(
+        "search_common_ms",
+        await timed(repeat, db.get_requests, limit=50, query=dataset.common_word()),
+    )
+    await record(
+        "search_rare_ms", await timed(repeat, db.get_requests, limit=50, query=dataset.rare_word())
+    )
+    # 子串扫描随数据量线性增长，只测少数几次
+    await record(
+        "search_literal_ms",
+        await timed(
+            args.literal_repeat,
+            db.get_requests,
+            limit=50,
+            query=dataset.rare_word(),
+            mode="literal",
+        ),
+    )
+    await record("stats_ms", await timed(repeat, db.get_stats))
+    await record(
+        "stats_window_ms",
+        await timed(repeat, db.get_stats, since=dataset.end_ms - DAY_MS, until=dataset.end_ms),
+    )
+    await record("stats_rebuild_ms", await timed(1, db.rebuild_stats))
+    await record(
+        "latency_hosts_ms", await timed(repeat, db.get_latency_percentiles, by="host")
+    )
+    ids = [random.Random(i).randint(1, newest) for i in range(repeat)]
+    samples = []
+    for request_id in ids:
+        start = time.perf_counter()
+        await db.get_request(request_id)
+        samples.append((time.perf_counter() - start) * 1000)
+    metrics.update(distribution(samples, "detail_ms"))
+    return metrics
+
+
+async def run_backend(backend, sizes, args):
+    db = await open_backend(backend, args)
+    if db is None:
+        return []
+    dataset = Dataset(args)
+    dataset.total = sizes[-1]
+    scenarios = []
+    rows = 0
+    try:
+        for target in sizes:
+            metrics = await grow(db, dataset, target - rows, args.batch_rows, args.live_rows)
+            rows = target
+            if db.db_type == "sqlite":
+                # 计算文件大小前合并 WAL
+                await db._pool.checkpoint("TRUNCATE")
+            size = await storage_bytes(db)
+            metrics["db_size_mb"] = round(size / 1048576, 2)
+            metrics["bytes_per_row"] = round(size / rows, 1)
+            metrics.update(await measure_queries(db, dataset, rows, args))
+            name = f"{backend}-{format_count(target)}"
+            scenarios.append({"name": name, "backend": backend, "rows": target, "metrics": metrics})
+            print(
+                f"[{name}] {metrics.get('insert_rows_per_s', '-')} rows/s bulk, "
+                f"{metrics['db_size_mb']} MB, first page {metrics['first_page_ms.p50']} ms",
+                flush=True,
+            )
+        samples, _ = await timed(1, db.clear_all)
+        scenarios[-1]["metrics"]["clear_all_ms"] = round(samples[0], 3)
+    finally:
+        await db.stop_writer()
+        await db.close_pool()
+    return scenarios
+
+
+SUMMARY_ROWS = (
+    ("bulk insert rows/s", "insert_rows_per_s"),
+    ("bulk insert body MB/s", "insert_mb_per_s"),
+    ("live writer rows/s", "live_rows_per_s"),
+    ("db size MB", "db_size_mb"),
+    ("bytes/row", "bytes_per_row"),
+    ("first page p50/p99 ms", "first_page_ms.p50", "first_page_ms.p99"),
+    ("deep page p50/p99 ms", "deep_page_ms.p50", "deep_page_ms.p99"),
+    ("host filter p50 ms", "host_page_ms.p50"),
+    ("status filter p50 ms", "status_page_ms.p50"),
+    ("search common p50 ms", "search_common_ms.p50"),
+    ("search rare p50 ms", "search_rare_ms.p50"),
+    ("search literal p50 ms", "search_literal_ms.p50"),
+    ("stats p50 ms", "stats_ms.p50"),
+    ("stats window p50 ms", "stats_window_ms.p50"),
+    ("stats rebuild ms", "stats_rebuild_ms.p50"),
+    ("latency by host p50 ms", "latency_hosts_ms.p50"),
+    ("detail p50 ms", "detail_ms.p50"),
+    ("clear_all ms", "clear_all_ms"),
+)
+
+
+def print_summary(scenarios):
+    rows = []
+    for label, *keys in SUMMARY_ROWS:
+        row = [label]
+        for scenario in scenarios:
+            values = [scenario["metrics"].get(key) for key in keys]
+            row.append(" / ".join("-" if v is None else f"{v:g}" for v in values))
+        rows.append(row)
+    print()
+    print_table(["metric"] + [s["name"] for s in scenarios], rows)
+
+
+async def run(args):
+    sizes = sorted(set(args.rows))
+    workdir = tempfile.mkdtemp(prefix="proxy-insight-bench-")
+    # 必须在导入 db 之前设置: SQLite 使用独立的临时数据库
+    os.environ["DB_PATH"] = os.path.join(workdir, "bench.db")
+    use_src()
+    from logging_config import config
+
+    logging.getLogger("proxy_insight").setLevel(args.log_level.upper())
+    config["retention"] = {}
+    config["partitioning"] = dict(
+        config.get("partitioning", {}),
+        enabled=args.partitioning != "off",
+        granularity=args.partitioning if args.partitioning != "off" else "day",
+    )
+    scenarios = []
+    try:
+        for backend in args.backends:
+            scenarios.extend(await run_backend(backend, sizes, args))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if not scenarios:
+        print("No backend available")
+        return 1
+
+    params = {
+        "rows": sizes,
+        "backends": args.backends,
+        "bodies": args.bodies,
+        "dedup": args.dedup,
+        "binary": args.binary,
+        "post_share": args.post_share,
+        "hosts": args.hosts,
+        "days": args.days,
+        "partitioning": args.partitioning,
+        "batch_rows": args.batch_rows,
+        "live_rows": args.live_rows,
+        "seed": args.seed,
+        "body_sizes": [format_size(s) for s in parse_weights(args.bodies)[0]],
+    }
+    print_summary(scenarios)
+    path = save_results("storage", params, scenarios, args.output)
+    print(f"\nResults saved to {path}")
+    if args.compare:
+        return 1 if compare_results(scenarios, args.compare, args.threshold) else 0
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Storage-layer benchmark over synthetic datasets.")
+    parser.add_argument(
+        "--rows",
+        type=lambda s: [parse_count(c) for c in s.split(",")],
+        default=[1000, 100000],
+        help="comma-separated dataset sizes, measured as the dataset grows (default: 1k,100k)",
+    )
+    parser.add_argument(
+        "--backends",
+        type=lambda s: [b.strip().lower() for b in s.split(",")],
+        default=["sqlite", "mysql"],
+        help="sqlite and/or mysql; unreachable backends are skipped",
+    )
+    parser.add_argument(
+        "--bodies",
+        default=DEFAULT_BODIES,
+        help=f"weighted SIZE:WEIGHT body-size distribution (default: {DEFAULT_BODIES})",
+    )
+    parser.add_argument("--dedup", type=float, default=0.5, help="share of repeated bodies (0-1)")
+    parser.add_argument("--binary", type=float, default=0.1, help="share of binary bodies (0-1)")
+    parser.add_argument("--post-share", type=float, default=0.2, help="share of POSTs with a body")
+    parser.add_argument("--hosts", type=int, default=500)
+    parser.add_argument("--days", type=float, default=7, help="capture time span of the dataset")
+    parser.add_argument("--partitioning", choices=("off", "hour", "day"), default="off")
+    parser.add_argument("--batch-rows", type=int, default=5000)
+    parser.add_argument("--live-rows", type=int, default=2000, help="rows per checkpoint via save_request")
+    parser.add_argument("--repeat", type=int, default=20, help="runs per query")
+    parser.add_argument("--literal-repeat", type=int, default=3)
+    parser.add_argument("--mysql-database", default="proxy_insight_bench")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log-level", default="warning")
+    parser.add_argument("--output", help="results file (default: tests/bench_results/storage-<time>.json)")
+    parser.add_argument("--compare", help="previous results file to compare with")
+    parser.add_argument("--threshold", type=float, default=10.0, help="regression threshold in %%")
+    return asyncio.run(run(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
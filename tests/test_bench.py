@@ -0,0 +1,96 @@
+"""Unit tests of the benchmark helpers (tests/bench_*.py), without running a benchmark."""
+
+import argparse
+import json
+
+import pytest
+
+from bench_capture import parse_mix, persistence_lags_ms, plan_requests
+from bench_common import compare_results, distribution, format_size, parse_size, percentile
+from bench_storage import Dataset, format_count, parse_count, parse_weights
+
+
+@pytest.mark.parametrize("text, size", [("0", 0), ("512", 512), ("2k", 2048), ("64kb", 65536), ("1.5m", 1572864)])
+def test_sizes_parse_and_format(text, size):
+    assert parse_size(text) == size
+    assert parse_size(format_size(size)) == size
+
+
+def test_percentiles_use_the_nearest_rank():
+    ordered = list(range(1, 101))
+    assert [percentile(ordered, q) for q in (50, 90, 99, 99.9)] == [50, 90, 99, 100]
+    assert percentile([], 50) is None
+    metrics = distribution([3, 1, 2], "lat")
+    assert metrics["lat.count"] == 3 and metrics["lat.mean"] == 2 and metrics["lat.max"] == 3
+
+
+def test_mix_plans_are_weighted_and_reproducible():
+    mix = parse_mix("GET:0:3,POST:16k:1")
+    assert mix == [("GET", 0, 3.0), ("POST", 16384, 1.0)]
+    plan = plan_requests(mix, https_share=0.5, n=2000, seed=7)
+    # 同一个种子得到相同的请求序列，两次运行可以直接比较
+    assert plan == plan_requests(mix, https_share=0.5, n=2000, seed=7)
+    posts = sum(1 for _, method, _ in plan if method == "POST")
+    assert 400 < posts < 600
+    with pytest.raises(ValueError):
+        parse_mix("PUT:1k")
+
+
+def test_persistence_lag_pairs_responses_with_committed_rows():
+    ends = [1.0, 1.1, 1.2]
+    # (采样时间, 已提交的行数)
+    samples = [(1.05, 10), (1.3, 12), (1.4, 13)]
+    lags = persistence_lags_ms(ends, samples, rows_before=10)
+    assert [round(lag) for lag in lags] == [300, 200, 200]
+
+
+def test_compare_flags_regressions_in_the_right_direction(tmp_path):
+    baseline = tmp_path / "before.json"
+    baseline.write_text(
+        json.dumps(
+            {"scenarios": [{"name": "c16", "metrics": {"lat.p99": 10.0, "flows_per_s": 1000}}]}
+        )
+    )
+    better = [{"name": "c16", "metrics": {"lat.p99": 8.0, "flows_per_s": 1200}}]
+    worse = [{"name": "c16", "metrics": {"lat.p99": 12.0, "flows_per_s": 800}}]
+    assert compare_results(better, baseline) == 0
+    assert compare_results(worse, baseline) == 2
+    assert compare_results(worse, baseline, threshold=25) == 0
+
+
+def dataset_args(**overrides):
+    args = dict(
+        seed=3, bodies="0:1,256:2,2k:1", dedup=0.5, binary=0.0, post_share=0.2, hosts=20, days=2
+    )
+    return argparse.Namespace(**dict(args, **overrides))
+
+
+def test_counts_and_weights_parse():
+    assert [parse_count(t) for t in ("500", "10k", "1.5m")] == [500, 10000, 1500000]
+    assert format_count(100000) == "100k" and format_count(1234) == "1234"
+    assert parse_weights("0:25,4k:10,64k") == ([0, 4096, 65536], [25.0, 10.0, 1.0])
+
+
+def test_synthetic_datasets_are_deterministic():
+    first, second = Dataset(dataset_args()), Dataset(dataset_args())
+    second.end_ms, second.start_ms = first.end_ms, first.start_ms
+    for dataset in (first, second):
+        dataset.total = 500
+    flows = first.flows(500)
+    # 相同的种子生成相同的数据集，不同机器上的结果可以直接比较
+    assert flows == second.flows(500)
+    captured = [flow["captured_at"] for flow in flows]
+    assert captured == sorted(captured)
+    assert first.start_ms <= captured[0] and captured[-1] <= first.end_ms
+    assert {len(flow["response"]["body"]) for flow in flows} <= {0, 256, 2048}
+
+
+def test_dedup_share_controls_repeated_bodies():
+    def distinct(dedup):
+        dataset = Dataset(dataset_args(bodies="2k", dedup=dedup, post_share=0))
+        bodies = [flow["response"]["body"] for flow in dataset.flows(200)]
+        return len(set(bodies))
+
+    # 全部重复时只剩预生成的几种主体，完全不重复时每行各不相同
+    assert distinct(1.0) <= Dataset.VARIANTS
+    assert distinct(0.0) == 200
@@ -0,0 +1,79 @@
+"""Unit tests of the bounded body decoding used for indexing and literal search."""
+
+import gzip
+import os
+import sys
+import zlib
+
+import brotli
+import pytest
+import zstandard
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from body_store import CODEC_RAW, iter_decoded, pack_body, read_prefix  # noqa: E402
+from db import BodyMatcher, index_text  # noqa: E402
+
+TEXT = ("héllo wörld " * 20000).encode()
+
+
+def deflate_raw(data):
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+@pytest.mark.parametrize(
+    "content_encoding, encode",
+    [
+        ("", lambda data: data),
+        ("gzip", gzip.compress),
+        ("deflate", zlib.compress),
+        ("deflate", deflate_raw),
+        ("br", brotli.compress),
+        ("zstd", lambda data: zstandard.ZstdCompressor().compress(data)),
+    ],
+)
+def test_prefix_matches_the_start_of_the_decoded_body(content_encoding, encode):
+    codec, payload = pack_body(encode(TEXT))
+    assert read_prefix(codec, payload, content_encoding, 1000) == (TEXT[:1000], True)
+    assert read_prefix(codec, payload, content_encoding, len(TEXT) + 1) == (TEXT, False)
+
+
+def test_decoding_stops_at_the_limit():
+    # 约 100KB 的 gzip 解压后是 100MB
+    bomb = gzip.compress(b"\0" * (100 * 1024 * 1024))
+    chunks = []
+
+    def feed():
+        for start in range(0, len(bomb), 4096):
+            chunks.append(start)
+            yield bomb[start : start + 4096]
+
+    pieces = iter_decoded(feed(), "gzip", chunk_size=1024)
+    assert len(next(pieces)) == 1024
+    # 只消费了产生第一块输出所需的输入
+    assert len(chunks) == 1
+    data, truncated = read_prefix(CODEC_RAW, bomb, "gzip", 4096)
+    assert (len(data), truncated) == (4096, True)
+
+
+def test_broken_encoding_falls_back_to_the_raw_bytes():
+    assert read_prefix(CODEC_RAW, b"not gzip at all", "gzip", 100) == (b"not gzip at all", False)
+    assert read_prefix(CODEC_RAW, b"plain", "x-unknown", 3) == (b"pla", True)
+
+
+def test_index_text_drops_a_character_cut_by_the_limit():
+    body = gzip.compress("ü".encode() * 10)
+    # 5 个字符的前缀取 20 字节，正好是 10 个完整的 ü
+    assert index_text(body, 5, "gzip", "text/plain; charset=utf-8") == "üüüüü"
+    assert index_text("x" * 10, 3) == "xxx"
+    assert index_text(b"\x89PNG", 10, "", "image/png") == ""
+
+
+def test_body_match_only_searches_the_indexed_prefix():
+    matcher = BodyMatcher()
+    codec, payload = pack_body(gzip.compress(b"a" * 5000 + b"needle"))
+    args = ("digest", codec, payload, "gzip", "text/plain")
+    assert matcher(*args, "AAA", 100) == 1
+    assert matcher(*args, "needle", 100) == 0
+    assert matcher("other", codec, payload, "gzip", "text/plain", "needle", 10000) == 1
@@ -0,0 +1,194 @@
+"""Unit tests of the live traffic fan-out (src/broadcast.py) with fake WebSockets."""
+
+import asyncio
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from broadcast import DETAIL_FULL, Broadcaster, ClientSession, Subscription  # noqa: E402
+from logging_config import config  # noqa: E402
+
+
+class FakeWebSocket:
+    """Records sent frames; ``stall`` makes send_text hang like a stuck client."""
+
+    def __init__(self, stall=False):
+        self.stall = stall
+        self.frames = []
+        self.closed = False
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text):
+        if self.stall:
+            await asyncio.sleep(3600)
+        self.frames.append(json.loads(text))
+
+    async def close(self):
+        self.closed = True
+
+    def events(self):
+        return [e for f in self.frames if f.get("type") == "batch" for e in f["events"]]
+
+
+def make_event(n):
+    return {
+        "id": n,
+        "method": "GET",
+        "url": f"https://api.example.com/items/{n}",
+        "host": "api.example.com",
+        "status": "200 OK",
+        "status_code": 200,
+        "latency_ms": 40,
+        "request": {"headers": {"accept": "*/*"}},
+    }
+
+
+def make_broadcaster(**websocket):
+    config["websocket"] = dict(
+        {"queue_size": 1000, "batch_interval_ms": 20, "max_batch": 200, "send_timeout_s": 5},
+        **websocket,
+    )
+    return Broadcaster()
+
+
+def test_full_queue_drops_oldest_and_reports_skipped():
+    session = ClientSession(FakeWebSocket(), queue_size=3, detail=DETAIL_FULL)
+    for n in range(5):
+        session.enqueue(json.dumps({"id": n}), now=float(n))
+    # 客户端滞后按队列中最早事件的入队时间计算
+    assert session.lag(now=10.0) == 8.0
+    frame = json.loads(session.take_frame(max_batch=10))
+    assert [e["id"] for e in frame["events"]] == [2, 3, 4]
+    assert frame["skipped"] == 2
+    # 跟不上的客户端降级为只接收摘要
+    assert session.detail != DETAIL_FULL and session.downgraded
+    assert session.take_frame(max_batch=10) is None
+    assert session.lag(now=10.0) == 0.0
+
+
+def test_events_are_coalesced_into_batched_frames():
+    async def run():
+        broadcaster = make_broadcaster(max_batch=50)
+        websocket = FakeWebSocket()
+        await broadcaster.connect(websocket)
+        for n in range(120):
+            broadcaster.publish(make_event(n))
+        await asyncio.sleep(0.3)
+        await broadcaster.close()
+        assert [e["id"] for e in websocket.events()] == list(range(120))
+        # 同一批次间隔内的事件合并成少量帧，单帧不超过 max_batch
+        assert len(websocket.frames) == 3
+        assert all(len(f["events"]) <= 50 for f in websocket.frames)
+        # 摘要模式不带请求头与主体
+        assert "request" not in websocket.events()[0]
+
+    asyncio.run(run())
+
+
+def test_stuck_client_is_dropped_without_delaying_others():
+    async def run():
+        broadcaster = make_broadcaster(send_timeout_s=0.1)
+        stuck, healthy = FakeWebSocket(stall=True), FakeWebSocket()
+        await broadcaster.connect(stuck)
+        await broadcaster.connect(healthy, detail=DETAIL_FULL)
+        for n in range(10):
+            broadcaster.publish(make_event(n))
+        await asyncio.sleep(0.4)
+        assert stuck.closed and broadcaster.stats()["dropped_clients"] == 1
+        assert [e["id"] for e in healthy.events()] == list(range(10))
+        assert healthy.events()[0]["request"] == {"headers": {"accept": "*/*"}}
+        await broadcaster.close()
+        assert broadcaster.stats()["clients"] == 0
+
+    asyncio.run(run())
+
+
+def test_control_messages_are_never_dropped():
+    async def run():
+        broadcaster = make_broadcaster(queue_size=2)
+        websocket = FakeWebSocket()
+        await broadcaster.connect(websocket)
+        broadcaster.send_control({"type": "clear"})
+        for n in range(5):
+            broadcaster.publish(make_event(n))
+        await asyncio.sleep(0.2)
+        await broadcaster.close()
+        assert websocket.frames[0] == {"type": "clear"}
+        assert [e["id"] for e in websocket.events()] == [3, 4]
+        assert websocket.frames[1]["skipped"] == 3
+
+    asyncio.run(run())
+
+
+def test_subscription_filters_combine_keys_and_alternatives():
+    subscription = Subscription(
+        {"host": "example.com", "method": ["get", "post"], "status": ["4xx", "500"]}
+    )
+    event = dict(make_event(1), host="api.example.com", status_code=404)
+    assert subscription.matches(event)
+    # 不同键之间是 AND，同一键的多个取值之间是 OR
+    assert subscription.matches(dict(event, method="POST", status_code=500))
+    assert not subscription.matches(dict(event, status_code=200))
+    assert not subscription.matches(dict(event, method="DELETE"))
+    assert not subscription.matches(dict(event, host="notexample.com"))
+    slow = Subscription({"min_latency_ms": 100, "url_regex": r"/items/\d+$"})
+    assert slow.matches(dict(event, latency_ms=150))
+    assert not slow.matches(dict(event, latency_ms=50))
+    assert not slow.matches(dict(event, latency_ms=150, url="https://api.example.com/other"))
+
+
+@pytest.mark.parametrize(
+    "pattern",
+    [
+        r"(a+)+$",
+        r"(a|ab)*c",
+        r"(\w+)\1",
+        r"(?P<x>a)(?P=x)",
+        r"(?:[a-z]+\.){2,}",
+        r"(?x) a+ # verbose",
+        "x" * 201,
+        r"(unclosed",
+    ],
+)
+def test_unsafe_or_invalid_url_regex_is_rejected(pattern):
+    with pytest.raises(ValueError):
+        Subscription({"url_regex": pattern})
+
+
+@pytest.mark.parametrize(
+    "pattern", [r"/v\d+/items/\d+$", r"(a|b|\d)+", r"[(|]+", r"\(a+\)+", r"(?i:api)+", r"(a{1})+"]
+)
+def test_safe_url_regex_is_accepted(pattern):
+    assert Subscription({"url_regex": pattern}).url_regex is not None
+
+
+def test_subscribe_messages_filter_events_before_encoding():
+    async def run():
+        broadcaster = make_broadcaster()
+        websocket = FakeWebSocket()
+        session = await broadcaster.connect(websocket)
+        broadcaster.handle_message(
+            session, json.dumps({"type": "subscribe", "filters": {"url_contains": "items/1"}})
+        )
+        broadcaster.handle_message(session, json.dumps({"type": "subscribe", "filters": {"colour": 1}}))
+        for n in range(12):
+            broadcaster.publish(make_event(n))
+        await asyncio.sleep(0.2)
+        broadcaster.handle_message(session, json.dumps({"type": "unsubscribe"}))
+        broadcaster.publish(make_event(99))
+        await asyncio.sleep(0.2)
+        await broadcaster.close()
+        replies = [f for f in websocket.frames if f.get("type") != "batch"]
+        assert replies[0] == {"type": "subscribed", "filters": {"url_contains": "items/1"}, "detail": "summary"}
+        # 无效的订阅返回错误，并保留原有过滤条件
+        assert replies[1]["type"] == "error" and "colour" in replies[1]["message"]
+        assert [e["id"] for e in websocket.events()] == [1, 10, 11, 99]
+        assert session.filtered == 9
+
+    asyncio.run(run())
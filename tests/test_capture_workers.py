@@ -0,0 +1,122 @@
+"""Unit tests of the multi-process capture plumbing (src/capture_workers.py)."""
+
+import asyncio
+import os
+import pickle
+import socket
+import sys
+from multiprocessing import Pipe
+
+import pytest
+from mitmproxy.test import tflow
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from capture_workers import PortDispatcher, RecordShipper, check_listen_patch  # noqa: E402
+from mitmproxy.proxy import mode_servers  # noqa: E402
+from ingest import FlowRecord, TrafficAddon  # noqa: E402
+
+
+def make_record(n):
+    flow = tflow.tflow(resp=True)
+    flow.request.path = f"/items/{n}"
+    return FlowRecord.from_flow(flow)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def received(conn):
+    messages = []
+    while conn.poll(1):
+        messages.append(pickle.loads(conn.recv_bytes()))
+    return messages
+
+
+def test_shipper_sends_batches_with_counters():
+    ours, theirs = Pipe()
+    shipper = RecordShipper(theirs, batch_size=4, interval=0.5)
+    for n in range(10):
+        shipper.put(make_record(n))
+    shipper.start()
+    shipper.close()
+    messages = received(ours)
+    flows = [record.path for message in messages for record in message["flows"]]
+    assert flows == [f"/items/{n}" for n in range(10)]
+    assert max(len(message["flows"]) for message in messages) == 4
+    last = messages[-1]["stats"]
+    assert (last["captured"], last["dropped"], last["depth"]) == (10, 0, 0)
+
+
+def test_shipper_drops_instead_of_blocking_when_told_to():
+    _, theirs = Pipe()
+    shipper = RecordShipper(theirs, maxsize=2, block=False)
+    results = [shipper.put(make_record(n)) for n in range(5)]
+    assert results == [True, True, False, False, False]
+    assert shipper.counters["dropped"] == 3
+
+
+def test_addon_hands_records_to_the_channel():
+    class Channel(list):
+        def put(self, record):
+            self.append(record)
+            return True
+
+    channel = Channel()
+    TrafficAddon(channel).response(tflow.tflow(resp=True))
+    (record,) = channel
+    assert record.status_code == 200 and record.response_body == b"message"
+
+
+def test_dispatcher_spreads_connections_round_robin():
+    async def run():
+        seen = []
+
+        def backend(name):
+            async def handle(reader, writer):
+                seen.append(name)
+                writer.write(name.encode() + await reader.read(100))
+                await writer.drain()
+                writer.close()
+
+            return handle
+
+        ports = [free_port(), free_port()]
+        servers = [
+            await asyncio.start_server(backend(f"w{i}:"), "127.0.0.1", port)
+            for i, port in enumerate(ports)
+        ]
+        dispatcher = PortDispatcher("127.0.0.1", free_port(), ports)
+        dispatcher.start()
+        try:
+            replies = []
+            for n in range(4):
+                reader, writer = await asyncio.open_connection("127.0.0.1", dispatcher.port)
+                writer.write(f"ping{n}".encode())
+                writer.write_eof()
+                replies.append((await reader.read()).decode())
+                writer.close()
+        finally:
+            dispatcher.stop()
+            for server in servers:
+                server.close()
+        # 字节原样转发，连接依次分给各个工作进程
+        assert replies == ["w0:ping0", "w1:ping1", "w0:ping2", "w1:ping3"]
+        assert dispatcher.connections == 4
+
+    asyncio.run(run())
+
+
+def test_reuse_port_patch_refuses_an_incompatible_mitmproxy(monkeypatch):
+    # 当前安装的 mitmproxy 与替换的 listen 兼容
+    check_listen_patch()
+
+    async def listen(self, host, port, *, reuse=False):
+        return []
+
+    monkeypatch.setattr(mode_servers.RegularInstance, "listen", listen)
+    with pytest.raises(RuntimeError, match="takes other arguments"):
+        check_listen_patch()
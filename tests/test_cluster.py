@@ -0,0 +1,68 @@
+"""Unit tests of the production-mode process plumbing (src/cluster.py)."""
+
+import asyncio
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from cluster import CaptureForwarder, EventHub, EventSubscriber  # noqa: E402
+
+
+@pytest.mark.parametrize(
+    "method, path, forwarded",
+    [
+        ("GET", "/", False),
+        ("GET", "/static/js/app.js", False),
+        ("GET", "/api/requests", False),
+        ("GET", "/api/requests/42", False),
+        ("GET", "/api/stats", False),
+        ("GET", "/api/export/har", False),
+        ("GET", "/api/cert/download", False),
+        # 写操作、抓包控制与配置由采集进程处理
+        ("POST", "/api/requests", True),
+        ("DELETE", "/api/requests", True),
+        ("POST", "/api/proxy/start", True),
+        ("GET", "/api/config", True),
+        ("POST", "/api/import", True),
+    ],
+)
+def test_only_read_endpoints_are_served_by_api_workers(method, path, forwarded):
+    assert CaptureForwarder.should_forward(method, path) is forwarded
+
+
+def test_events_reach_every_subscriber_in_order():
+    async def run():
+        path = os.path.join(tempfile.mkdtemp(prefix="proxy-insight-run-"), "events.sock")
+        hub = EventHub()
+        await hub.start(path)
+        inboxes = [[], []]
+        subscribers = []
+        for inbox in inboxes:
+
+            async def handler(message, inbox=inbox):
+                inbox.append(message)
+
+            subscriber = EventSubscriber()
+            subscriber.start(path, handler)
+            subscribers.append(subscriber)
+        while len(hub.subscribers) < 2:
+            await asyncio.sleep(0.01)
+
+        for n in range(5):
+            hub.publish({"type": "traffic", "event": {"id": n}})
+        while any(len(inbox) < 5 for inbox in inboxes):
+            await asyncio.sleep(0.01)
+
+        for subscriber in subscribers:
+            assert subscriber.stats()["connected"]
+            await subscriber.close()
+        await hub.close()
+        for inbox in inboxes:
+            assert [m["event"]["id"] for m in inbox] == list(range(5))
+        assert hub.stats()["dropped"] == 0
+
+    asyncio.run(asyncio.wait_for(run(), 10))
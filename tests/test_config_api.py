@@ -0,0 +1,57 @@
+"""Unit tests of the targeted config.toml rewrite behind /api/config/update."""
+
+import os
+import sys
+import tomllib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from config_api import _write_config  # noqa: E402
+
+CONFIG = """# top comment
+app_port = 8000  # the web UI
+db_type = "sqlite"
+
+[mysql]
+# connection
+host = "127.0.0.1"
+password = "a#b"
+# pool_min_size = 1
+
+[writer]
+# batch_size = 500
+"""
+
+
+def test_only_changed_keys_are_rewritten(tmp_path):
+    path = tmp_path / "config.toml"
+    path.write_text(CONFIG)
+    _write_config(
+        str(path),
+        {
+            "db_type": "mysql",
+            "app_port": 8000,
+            "proxy_port": 9090,
+            "mysql": {"host": "db.internal", "password": "a#b", "pool_min_size": 2},
+            "import": {"workers": 4},
+        },
+    )
+    text = path.read_text()
+    # 注释、未修改的键和值中的 # 原样保留
+    assert text.startswith("# top comment\napp_port = 8000  # the web UI\ndb_type = \"mysql\"\nproxy_port = 9090\n")
+    assert '# connection\nhost = "db.internal"\npassword = "a#b"\npool_min_size = 2\n# pool_min_size = 1\n' in text
+    assert "[writer]\n# batch_size = 500\n" in text
+    assert tomllib.loads(text) == {
+        "app_port": 8000,
+        "db_type": "mysql",
+        "proxy_port": 9090,
+        "mysql": {"host": "db.internal", "password": "a#b", "pool_min_size": 2},
+        "writer": {},
+        "import": {"workers": 4},
+    }
+
+
+def test_missing_file_is_created(tmp_path):
+    path = tmp_path / "config.toml"
+    _write_config(str(path), {"db_type": "sqlite", "mysql": {"user": 'x"y'}})
+    assert tomllib.loads(path.read_text()) == {"db_type": "sqlite", "mysql": {"user": 'x"y'}}
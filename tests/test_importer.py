@@ -0,0 +1,149 @@
+"""Unit tests of the bulk import readers and converters (src/importer.py)."""
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+
+import pytest
+from mitmproxy import io
+from mitmproxy.test import tflow
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from importer import (  # noqa: E402
+    FORMAT_FLOWS,
+    FORMAT_HAR,
+    FORMAT_NDJSON,
+    ImportJob,
+    convert_chunk,
+    detect_format,
+    run_import,
+    spool_upload,
+)
+
+
+class MemoryDB:
+    """Collects the flows run_import hands to bulk_insert."""
+
+    def __init__(self):
+        self.flows = []
+
+    async def bulk_insert(self, flows):
+        self.flows.extend(flows)
+        return len(flows)
+
+
+def har_entry(n, text="hello"):
+    return {
+        "startedDateTime": "2024-05-01T10:00:00.000Z",
+        "time": 12,
+        "request": {
+            "method": "GET",
+            "url": f"https://api.example.com/items/{n}",
+            "httpVersion": "HTTP/1.1",
+            "headers": [{"name": "Accept", "value": "*/*"}],
+            "cookies": [],
+            "queryString": [],
+        },
+        "response": {
+            "status": 200,
+            "statusText": "OK",
+            "httpVersion": "HTTP/1.1",
+            "headers": [{"name": "Content-Type", "value": "text/plain"}],
+            "cookies": [],
+            "content": {"size": len(text), "mimeType": "text/plain", "text": text},
+        },
+    }
+
+
+def write_file(suffix, data):
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    return path
+
+
+def test_formats_are_detected_by_extension_or_content():
+    har = write_file(".json", json.dumps({"log": {"entries": []}}).encode())
+    ndjson = write_file(".txt", json.dumps(har_entry(1)).encode() + b"\n")
+    unknown = write_file(".bin", b"\x00\x01")
+    try:
+        assert detect_format(har) == FORMAT_HAR
+        assert detect_format(ndjson) == FORMAT_NDJSON
+        assert detect_format(unknown, name="capture.flows") == FORMAT_FLOWS
+        with pytest.raises(ValueError):
+            detect_format(unknown)
+    finally:
+        for path in (har, ndjson, unknown):
+            os.remove(path)
+
+
+def test_broken_entries_are_counted_not_fatal():
+    items = [json.dumps(har_entry(1)), "{not json", json.dumps(har_entry(2))]
+    flows, skipped, failed, last_error = convert_chunk(FORMAT_NDJSON, items)
+    assert [flow["url"] for flow in flows] == [
+        "https://api.example.com/items/1",
+        "https://api.example.com/items/2",
+    ]
+    assert (skipped, failed) == (0, 1) and last_error.startswith("JSONDecodeError")
+
+
+def test_har_file_is_streamed_in_batches(monkeypatch):
+    monkeypatch.setattr("importer._settings", lambda: {"batch_rows": 3, "chunk_entries": 2})
+    entries = [har_entry(n, text=f"body {n}") for n in range(7)]
+    path = write_file(".har", json.dumps({"log": {"version": "1.2", "entries": entries}}).encode())
+    db = MemoryDB()
+    job = ImportJob(path, cleanup=True)
+    asyncio.run(run_import(job, db, workers=0))
+    assert job.status == "done", job.error
+    assert (job.imported, job.read_bytes) == (7, job.total_bytes)
+    assert [flow["response"]["body"] for flow in db.flows] == [b"body %d" % n for n in range(7)]
+    # 上传的临时文件在导入结束后删除
+    assert not os.path.exists(path)
+
+
+def test_mitmproxy_flow_dumps_are_imported():
+    path = write_file(".flows", b"")
+    with open(path, "wb") as f:
+        writer = io.FlowWriter(f)
+        for n in range(3):
+            flow = tflow.tflow(resp=True)
+            flow.request.path = f"/items/{n}"
+            writer.add(flow)
+        # 没有响应的流量被跳过
+        writer.add(tflow.tflow())
+    db = MemoryDB()
+    job = ImportJob(path, cleanup=True)
+    asyncio.run(run_import(job, db, workers=0))
+    assert job.status == "done", job.error
+    assert (job.imported, job.skipped, job.failed) == (3, 1, 0)
+    assert [flow["path"] for flow in db.flows] == ["/items/0", "/items/1", "/items/2"]
+    assert db.flows[0]["response"]["body"] == b"message"
+
+
+def test_uploads_are_spooled_to_a_temporary_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+
+    async def chunks(fail=False):
+        for n in range(300):
+            yield b"%05d\n" % n * 1000
+        if fail:
+            raise ConnectionError("client went away")
+
+    async def run():
+        path = await spool_upload(chunks(), suffix=".ndjson")
+        try:
+            assert path.endswith(".ndjson")
+            with open(path, "rb") as f:
+                assert f.read() == b"".join(b"%05d\n" % n * 1000 for n in range(300))
+        finally:
+            os.remove(path)
+
+        with pytest.raises(ConnectionError):
+            await spool_upload(chunks(fail=True))
+        # 上传中断时删除已写入的临时文件
+        assert os.listdir(tmp_path) == []
+
+    asyncio.run(run())
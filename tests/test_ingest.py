@@ -0,0 +1,125 @@
+"""Unit tests of the proxy-thread to app-loop ingest channel (src/ingest.py)."""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+
+from mitmproxy.test import tflow
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from ingest import (  # noqa: E402
+    OVERFLOW_BLOCK,
+    OVERFLOW_DROP_BODIES,
+    OVERFLOW_DROP_OLDEST,
+    FlowRecord,
+    IngestChannel,
+)
+
+
+def make_record(n, body=b"payload"):
+    flow = tflow.tflow(resp=True)
+    flow.request.path = f"/items/{n}"
+    flow.response.content = body
+    return FlowRecord.from_flow(flow)
+
+
+def record_numbers(records):
+    return [int(record.path.rsplit("/", 1)[1]) for record in records]
+
+
+def test_record_expands_into_the_save_request_shape():
+    flow = tflow.tflow(resp=True)
+    flow.request.headers["cookie"] = "session=abc"
+    flow.response.headers["content-type"] = "text/plain; charset=utf-8"
+    data = FlowRecord.from_flow(flow).to_dict()
+    assert data["status"] == "200 OK" and data["latency_ms"] == 3000
+    assert data["captured_at"] == int(flow.request.timestamp_start * 1000)
+    assert data["request"]["cookies"] == {"session": "abc"}
+    # 主体保持原始字节，由存储层按需解码
+    assert data["response"]["body"] == b"message"
+    assert data["response"]["content_type"] == "text/plain; charset=utf-8"
+
+
+def test_drop_oldest_keeps_the_newest_records():
+    channel = IngestChannel(maxsize=3, policy=OVERFLOW_DROP_OLDEST)
+    for n in range(5):
+        assert channel.put(make_record(n))
+    assert record_numbers(channel._take_all()) == [2, 3, 4]
+    assert channel.stats()["dropped"] == 2
+
+
+def test_drop_oldest_also_bounds_buffered_bytes():
+    channel = IngestChannel(maxsize=100, max_bytes=100, policy=OVERFLOW_DROP_OLDEST)
+    for n in range(4):
+        channel.put(make_record(n, body=b"x" * 40))
+    stats = channel.stats()
+    assert stats["buffered_bytes"] <= 100
+    assert record_numbers(channel._take_all()) == [2, 3]
+
+
+def test_drop_bodies_keeps_metadata_of_every_flow():
+    channel = IngestChannel(maxsize=10, max_bytes=100, policy=OVERFLOW_DROP_BODIES)
+    for n in range(4):
+        channel.put(make_record(n, body=b"x" * 40))
+    records = channel._take_all()
+    # 超出字节上限的流量只丢弃主体，元数据照常入库
+    assert record_numbers(records) == [0, 1, 2, 3]
+    assert [len(record.response_body) for record in records] == [40, 40, 0, 0]
+    assert channel.stats()["bodies_dropped"] == 2
+
+
+def test_block_waits_for_the_consumer():
+    channel = IngestChannel(maxsize=2, policy=OVERFLOW_BLOCK)
+    channel.put(make_record(0))
+    channel.put(make_record(1))
+    done = threading.Event()
+
+    def producer():
+        channel.put(make_record(2))
+        done.set()
+
+    thread = threading.Thread(target=producer)
+    thread.start()
+    # 缓冲区满时代理线程等待，而不是丢弃流量
+    assert not done.wait(0.2)
+    assert record_numbers(channel._take_all()) == [0, 1]
+    assert done.wait(2)
+    thread.join()
+    assert record_numbers(channel._take_all()) == [2]
+    assert channel.stats()["blocked"] == 1
+
+
+def test_unknown_policy_falls_back_to_block():
+    assert IngestChannel(policy="drop-everything").policy == OVERFLOW_BLOCK
+
+
+def test_consumer_processes_records_from_another_thread():
+    async def run():
+        seen = []
+
+        async def handler(data):
+            seen.append(data["path"])
+
+        channel = IngestChannel(maxsize=100)
+        channel.start(handler)
+        threads = [
+            threading.Thread(target=lambda n=n: channel.put(make_record(n))) for n in range(20)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        deadline = time.monotonic() + 2
+        while len(seen) < 20 and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        await channel.stop()
+        assert sorted(seen) == sorted(f"/items/{n}" for n in range(20))
+        stats = channel.stats()
+        assert (stats["accepted"], stats["processed"], stats["depth"]) == (20, 20, 0)
+        # 关闭后不再接收记录
+        assert not channel.put(make_record(99))
+
+    asyncio.run(run())
@@ -0,0 +1,103 @@
+"""Unit tests of the non-blocking logging setup and the sampled access log."""
+
+import json
+import logging
+import os
+import queue
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import logging_config  # noqa: E402
+from logging_config import AccessLog, DroppingQueueHandler  # noqa: E402
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def make_flow(n):
+    return {
+        "method": "GET",
+        "url": f"https://api.example.com/items/{n}",
+        "host": "api.example.com",
+        "status": "200 OK",
+        "status_code": 200,
+        "latency_ms": 12,
+        "captured_at": 1700000000000 + n,
+        "request": {"body": b""},
+        "response": {"body": b"hello"},
+    }
+
+
+def test_rate_limit_caps_lines_per_second(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(logging_config.time, "monotonic", lambda: clock[0])
+    access = AccessLog(sample_rate=1.0, rate_limit=5)
+    for n in range(20):
+        access.log(make_flow(n))
+    assert (access.logged, access.suppressed) == (5, 15)
+    # 进入下一秒后配额重新计算
+    clock[0] += 1
+    access.log(make_flow(20))
+    assert access.logged == 6
+
+
+def test_sampling_logs_a_fraction_of_flows(monkeypatch):
+    access = AccessLog(sample_rate=0.0, rate_limit=0)
+    for n in range(50):
+        access.log(make_flow(n))
+    assert (access.logged, access.suppressed) == (0, 50)
+
+    values = iter([0.1, 0.9] * 50)
+    monkeypatch.setattr(logging_config.random, "random", lambda: next(values))
+    sampled = AccessLog(sample_rate=0.5, rate_limit=0)
+    for n in range(100):
+        sampled.log(make_flow(n))
+    assert (sampled.logged, sampled.suppressed) == (50, 50)
+
+
+def test_json_access_lines_carry_sizes_not_bodies():
+    json_logger = logging.getLogger("proxy_insight.test_access")
+    json_logger.propagate = False
+    handler = ListHandler()
+    json_logger.addHandler(handler)
+    try:
+        AccessLog(rate_limit=0, json_logger=json_logger).log(make_flow(1), request_id=7)
+    finally:
+        json_logger.removeHandler(handler)
+    (line,) = handler.messages
+    record = json.loads(line)
+    assert record["id"] == 7 and record["url"] == "https://api.example.com/items/1"
+    assert (record["request_size"], record["response_size"]) == (0, 5)
+
+
+def test_full_log_queue_drops_instead_of_blocking():
+    handler = DroppingQueueHandler(queue.Queue(maxsize=3))
+    log = logging.getLogger("proxy_insight.test_queue")
+    log.propagate = False
+    log.addHandler(handler)
+    try:
+        for n in range(10):
+            log.warning(f"line {n}")
+    finally:
+        log.removeHandler(handler)
+    assert handler.queue.qsize() == 3
+    assert handler.dropped == 7
+
+
+def test_partial_config_sections_keep_their_defaults(tmp_path, monkeypatch):
+    (tmp_path / "config.toml").write_text('db_type = "mysql"\n\n[writer]\nbatch_size = 50\n')
+    monkeypatch.setattr(logging_config, "SRC_DIR", str(tmp_path))
+    monkeypatch.delenv("DB_TYPE", raising=False)
+    loaded = logging_config.load_config()
+    assert loaded["db_type"] == "mysql"
+    # 只写了部分键的配置段按键合并，其余键仍取默认值
+    assert loaded["writer"] == dict(logging_config.DEFAULT_CONFIG["writer"], batch_size=50)
+    assert loaded["retention"] == logging_config.DEFAULT_CONFIG["retention"]
+    assert logging_config.DEFAULT_CONFIG["writer"]["batch_size"] == 500
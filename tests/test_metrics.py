@@ -0,0 +1,91 @@
+"""Unit tests of the OpenMetrics exposition (src/metrics.py)."""
+
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import db  # noqa: E402,F401  (注册存储层的指标)
+import metrics  # noqa: E402
+from metrics import Counter, CounterFamily, Gauge, Histogram, Registry  # noqa: E402
+
+SAMPLE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*(\{[a-z_]+="(?:[^"\\]|\\.)*"(,[a-z_]+="(?:[^"\\]|\\.)*")*\})? \S+$')
+
+
+def test_families_render_in_openmetrics_text_format():
+    registry = Registry()
+    requests = Counter("app_requests", "Requests served", ("path",), registry)
+    requests.labels(path="/a").inc()
+    requests.labels(path='/b"\n').inc(2)
+    depth = Gauge("app_queue_depth", "Queued items", registry=registry)
+    depth.set(7)
+    text = registry.render()
+    assert text.endswith("# EOF\n")
+    assert text.splitlines() == [
+        "# TYPE app_requests counter",
+        "# HELP app_requests Requests served",
+        'app_requests_total{path="/a"} 1',
+        'app_requests_total{path="/b\\"\\n"} 2',
+        "# TYPE app_queue_depth gauge",
+        "# HELP app_queue_depth Queued items",
+        "app_queue_depth 7",
+        "# EOF",
+    ]
+
+
+def test_histogram_buckets_are_cumulative_and_end_at_inf():
+    registry = Registry()
+    latency = Histogram("app_latency_seconds", "Latency", registry=registry, buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        latency.observe(value)
+    lines = registry.render().splitlines()
+    assert lines[2:7] == [
+        'app_latency_seconds_bucket{le="0.1"} 2',
+        'app_latency_seconds_bucket{le="1.0"} 3',
+        'app_latency_seconds_bucket{le="+Inf"} 4',
+        "app_latency_seconds_count 4",
+        "app_latency_seconds_sum 3.65",
+    ]
+
+
+def test_scrape_time_collectors_are_rendered_after_registered_families():
+    registry = Registry()
+    Counter("app_static", "Registered", registry=registry).inc()
+    registry.add_collector(lambda: [Gauge("app_dynamic", "Collected")])
+    names = [line.split()[2] for line in registry.render().splitlines() if line.startswith("# TYPE")]
+    assert names == ["app_static", "app_dynamic"]
+
+
+def test_counter_families_copy_totals_and_counters_only_increase():
+    registry = Registry()
+
+    def collect():
+        # 每次抓取新建指标族，填入其他组件累计的总数
+        captured = CounterFamily("app_captured", "Captured", ("worker",))
+        for worker, total in totals.items():
+            captured.add(total, worker=worker)
+        return [captured]
+
+    totals = {0: 5, 1: 2}
+    registry.add_collector(collect)
+    assert registry.render().splitlines()[2:4] == [
+        'app_captured_total{worker="0"} 5',
+        'app_captured_total{worker="1"} 2',
+    ]
+    totals[0] = 9
+    assert 'app_captured_total{worker="0"} 9' in registry.render().splitlines()
+    child = Counter("app_requests", "Requests", ("path",)).labels(path="/")
+    assert not hasattr(child, "set") and not hasattr(child, "dec")
+    assert hasattr(Gauge("app_depth", "Depth", ("queue",)).labels(queue="a"), "set")
+
+
+def test_application_registry_is_well_formed():
+    text = metrics.REGISTRY.render()
+    families = [line.split()[2] for line in text.splitlines() if line.startswith("# TYPE")]
+    # 每个指标族只出现一次，样本行都符合文本格式
+    assert len(families) == len(set(families))
+    assert "proxy_insight_proxy_up" in families and "proxy_insight_db_save_seconds" in families
+    for line in text.splitlines():
+        if not line.startswith("#"):
+            assert SAMPLE.match(line), line
@@ -27,7 +27,7 @@ async def test_mysql():
         await db.save_request(test_data)
         print("Request saved successfully!")
 
-        requests = await db.get_requests(limit=1)
+        requests = (await db.get_requests(limit=1))["items"]
         print(f"Retrieved {len(requests)} requests.")
         if requests:
             print(f"Last request URL: {requests[0]['url']}")
@@ -0,0 +1,112 @@
+"""Unit tests of the sampling profiler, stage timers and slow-callback detector (src/profiling.py)."""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from profiling import (  # noqa: E402
+    SlowCallbackDetector,
+    collapsed,
+    register_loop,
+    sample_thread,
+    stage,
+    stage_summary,
+)
+
+
+def busy_leaf(stop):
+    while not stop.is_set():
+        sum(range(100))
+
+
+def busy_root(stop):
+    busy_leaf(stop)
+
+
+def test_sampled_stacks_are_collapsed_root_first():
+    stop = threading.Event()
+    worker = threading.Thread(target=busy_root, args=(stop,))
+    worker.start()
+    try:
+        stacks = sample_thread(worker.ident, duration=0.2, interval=0.005)
+    finally:
+        stop.set()
+        worker.join()
+    assert sum(stacks.values()) > 5
+    stack, _ = stacks.most_common(1)[0]
+    frames = stack.split(";")
+    # 根帧在前，被采样的函数在最后
+    assert frames[0].endswith("Thread._bootstrap")
+    assert frames[-2:] == ["test_profiling.py:busy_root", "test_profiling.py:busy_leaf"]
+    for line in collapsed(stacks).splitlines():
+        folded, count = line.rsplit(" ", 1)
+        assert " " not in folded and int(count) > 0
+
+
+def test_sampling_stops_when_the_thread_exits():
+    worker = threading.Thread(target=lambda: None)
+    worker.start()
+    worker.join()
+    started = time.perf_counter()
+    assert not sample_thread(worker.ident, duration=5, interval=0.01)
+    assert time.perf_counter() - started < 1
+
+
+def test_stage_timers_accumulate_into_the_summary():
+    timer = stage("test.stage")
+    for seconds in (0.0001, 0.0003, 0.002):
+        timer.observe(seconds)
+    summary = stage_summary()["test.stage"]
+    assert summary["count"] == 3
+    assert summary["total_ms"] == 2.4
+    assert summary["mean_us"] == 800.0
+    # 只记录最大值所在桶的上界
+    assert summary["max_bucket_ms"] == 2.5
+
+
+def test_slow_callbacks_are_reported_by_loop_and_callback():
+    detector = SlowCallbackDetector()
+
+    def blocking():
+        time.sleep(0.06)
+
+    async def run():
+        register_loop("test")
+        loop = asyncio.get_running_loop()
+        for _ in range(2):
+            loop.call_soon(blocking)
+            loop.call_soon(lambda: None)
+        await asyncio.sleep(0.2)
+
+    original = asyncio.events.Handle._run
+    detector.enable(threshold_ms=30)
+    try:
+        asyncio.run(run())
+    finally:
+        detector.disable()
+    assert asyncio.events.Handle._run is original
+
+    report = detector.report()
+    assert not report["enabled"] and report["threshold_ms"] == 30
+    (entry,) = report["callbacks"]
+    assert entry["loop"] == "test" and entry["count"] == 2
+    assert entry["callback"].startswith("test_slow_callbacks_are_reported_by_loop_and_callback.<locals>.blocking")
+    assert entry["max_ms"] >= 60 and len(report["recent"]) == 2
+    detector.reset()
+    assert detector.report()["callbacks"] == []
+
+
+def test_detection_switches_itself_off_after_the_duration():
+    detector = SlowCallbackDetector()
+    original = asyncio.events.Handle._run
+    detector.enable(threshold_ms=100, duration=0.05)
+    assert detector.enabled() and detector.report()["expires_at"] is not None
+    deadline = time.monotonic() + 2
+    while detector.enabled() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not detector.enabled()
+    assert asyncio.events.Handle._run is original
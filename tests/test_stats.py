@@ -0,0 +1,113 @@
+"""Unit tests of the running traffic aggregates (src/stats.py)."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from stats import OTHER_HOSTS, LatencySketch, StatsEngine  # noqa: E402
+
+
+def test_snapshot_counts_classes_and_average_latency():
+    stats = StatsEngine()
+    stats.add(200, 10)
+    stats.add(302, 30)
+    stats.add(404, 50, count=2)
+    stats.add(None, None)
+    snapshot = stats.snapshot()
+    assert snapshot["total"] == 5
+    assert snapshot["success"] == 2
+    assert snapshot["error"] == 2
+    assert snapshot["avg_latency_ms"] == 35.0
+    assert snapshot["avg_latency"] == "35ms"
+    assert snapshot["by_class"] == {"2xx": 1, "3xx": 1, "4xx": 2, "other": 1}
+
+
+def test_load_matches_incremental_updates():
+    incremental = StatsEngine()
+    for code, latency in [(200, 5), (201, 7), (500, 100), (503, None), (99, 1)]:
+        incremental.add(code, latency)
+    rebuilt = StatsEngine()
+    # (status_code // 100, host, latency_ms, total)，与 _stat_groups 的结果一致
+    rebuilt.load([(2, None, 5, 1), (2, None, 7, 1), (5, None, 100, 1), (5, None, None, 1), (0, None, 1, 1)])
+    assert rebuilt.ready
+    assert rebuilt.snapshot() == incremental.snapshot()
+
+
+def test_merge_with_negative_sign_undoes_a_partition():
+    groups = [(2, "a.example.com", 15, 4), (5, "b.example.com", 900, 2), (None, "c", None, 3)]
+    stats = StatsEngine()
+    stats.load(groups)
+    assert stats.total == 9
+    assert stats.latency.count == 6
+    stats.merge(groups, sign=-1)
+    assert (stats.total, stats.latency_sum, stats.latency_count) == (0, 0, 0)
+    assert stats.by_class == {}
+    assert stats.latency.count == 0 and stats.latency.bins == {}
+
+
+def test_remove_undoes_add_in_every_sketch():
+    stats = StatsEngine(max_hosts=3)
+    rows = [
+        (200, 12, "a.example.com"),
+        (404, 250, "b.example.com"),
+        (500, 0, "c.example.com"),
+        (None, None, "d.example.com"),
+        (302, 3_600_000, "e.example.com"),
+        (200, 12, "a.example.com"),
+    ]
+    for row in rows:
+        stats.add(*row)
+    assert stats.total == 6
+    # 超出 max_hosts 的主机共用一个分组
+    assert OTHER_HOSTS in stats.latency_by_host
+    for row in reversed(rows):
+        stats.remove(*row)
+    assert (stats.total, stats.latency_sum, stats.latency_count) == (0, 0, 0)
+    assert stats.by_class == {}
+    assert (stats.latency.count, stats.latency.bins, stats.latency.zeros) == (0, {}, 0)
+    for sketch in list(stats.latency_by_host.values()) + list(stats.latency_by_class.values()):
+        assert sketch.count == 0 and sketch.bins == {}
+
+
+def test_sketch_quantiles_stay_within_the_relative_accuracy():
+    sketch = LatencySketch(relative_accuracy=0.01)
+    # 跨越多个数量级的延迟: 1ms .. 约 20s
+    samples = sorted(round(1.0009 ** n, 3) for n in range(11000))
+    for value in samples:
+        sketch.add(value)
+    for q in (0.5, 0.9, 0.99, 0.999, 1.0):
+        exact = samples[int(q * (len(samples) - 1))]
+        assert abs(sketch.quantile(q) - exact) <= 0.01 * exact
+    assert len(sketch.bins) < 500
+    # 相同精度的分布按计数合并
+    other = LatencySketch.from_state(sketch.state())
+    other.merge(sketch)
+    assert other.count == 2 * len(samples)
+    assert other.quantiles((0.5, 0.99)) == sketch.quantiles((0.5, 0.99))
+    assert LatencySketch().quantile(0.5) is None
+
+
+def test_percentiles_by_host_and_class():
+    stats = StatsEngine()
+    for n in range(100):
+        stats.add(200, 10 + n, host="fast.example.com")
+        stats.add(503, 1000 + 10 * n, host="slow.example.com")
+    stats.add(200, 5, host="rare.example.com")
+    by_host = stats.latency_percentiles(by="host", top=2)
+    assert [group["key"] for group in by_host["groups"]] == ["fast.example.com", "slow.example.com"]
+    (slow,) = stats.latency_percentiles(by="status_class", key="5xx")["groups"]
+    assert slow["count"] == 100 and 1450 <= slow["p50"] <= 1520
+    assert stats.latency_percentiles(by="host", key="missing")["groups"] == []
+    assert set(stats.snapshot()["latency_percentiles_ms"]) == {"p50", "p90", "p99", "p999"}
+
+
+def test_state_round_trips_to_another_engine():
+    stats = StatsEngine()
+    for code, latency in [(200, 5), (404, 70), (None, None)]:
+        stats.add(code, latency)
+    follower = StatsEngine()
+    follower.restore(stats.state())
+    assert follower.ready
+    assert follower.snapshot() == stats.snapshot()
+    assert follower.latency.bins == stats.latency.bins
@@ -0,0 +1,927 @@
+"""Behaviour tests of the storage layer on a temporary SQLite database.
+
+Run with ``python -m pytest tests/test_storage.py``. Every test opens a fresh,
+empty DatabaseManager (see ``database``) and drives it through asyncio.run.
+"""
+
+import asyncio
+import atexit
+import base64
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from contextlib import asynccontextmanager
+
+# 测试使用独立的临时数据库，不能碰到 proxy_traffic.db
+WORKDIR = tempfile.mkdtemp(prefix="proxy-insight-test-")
+atexit.register(shutil.rmtree, WORKDIR, ignore_errors=True)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+import db as db_module  # noqa: E402
+from db import DatabaseManager  # noqa: E402
+from db import build_snippet, parse_latency, parse_status, split_url  # noqa: E402
+from har import stream_har, stream_ndjson  # noqa: E402
+from importer import ImportJob, run_import  # noqa: E402
+from logging_config import config  # noqa: E402
+
+HOUR_MS = 3600 * 1000
+
+# 实例创建时读取这两个值
+db_module.DB_PATH = os.path.join(WORKDIR, "test.db")
+db_module.SHARD_DIR = os.path.join(WORKDIR, "proxy_traffic_shards")
+
+
+def make_flow(
+    n,
+    captured_at,
+    host="api.example.com",
+    status=200,
+    latency=40,
+    body=None,
+    content_type="application/json",
+    content_encoding="",
+):
+    """A flow dict in the shape ``save_request`` receives (bodies as wire bytes)."""
+    if body is None:
+        body = '{"row": %d, "text": "needle haystack"}' % n
+    if isinstance(body, str):
+        body = body.encode()
+    return {
+        "method": "POST" if n % 3 == 0 else "GET",
+        "url": f"https://{host}/items/{n}?q=1",
+        "scheme": "https",
+        "host": host,
+        "path": f"/items/{n}",
+        "status": f"{status} OK",
+        "status_code": status,
+        "reason": "OK",
+        "time": f"{latency}ms",
+        "latency_ms": latency,
+        "captured_at": captured_at,
+        "request": {
+            "headers": {"host": host, "content-type": "application/json"},
+            "body": b'{"query": %d}' % n if n % 3 == 0 else b"",
+            "content_type": "application/json",
+            "content_encoding": "",
+            "cookies": {"session": f"s{n}"},
+        },
+        "response": {
+            "headers": {"content-type": content_type},
+            "body": body,
+            "content_type": content_type,
+            "content_encoding": content_encoding,
+            "cookies": {},
+        },
+    }
+
+
+def flow_numbers(items):
+    """The ``n`` that make_flow put in the url of each listed row."""
+    return [int(item["url"].split("?")[0].rsplit("/", 1)[1]) for item in items]
+
+
+async def all_ids(db, **kwargs):
+    """Ids of every page of get_requests, following next_cursor."""
+    ids = []
+    page = await db.get_requests(**kwargs)
+    while True:
+        ids.extend(item["id"] for item in page["items"])
+        if not page["next_cursor"]:
+            return ids
+        page = await db.get_requests(cursor=page["next_cursor"], **kwargs)
+
+
+async def count_rows(db):
+    total = 0
+    async with db.get_conn() as conn:
+        for part in db._sources():
+            schema = await db._attach_source(conn, part)
+            rows = await db._fetchall(
+                conn, f"SELECT COUNT(*) AS n FROM {db._table(schema, 'requests')}"
+            )
+            total += rows[0]["n"]
+    return total
+
+
+async def body_refcounts_consistent(db):
+    """True when every body's refcount equals the rows (and index texts) pointing at it."""
+    async with db.get_conn() as conn:
+        refs = {}
+        tables = [("requests", "{side}_body_hash")]
+        if db.fts_text_refs:
+            tables.append(("requests_fts_text", "{side}_hash"))
+        for part in db._sources():
+            schema = await db._attach_source(conn, part)
+            for table, column in tables:
+                for side in ("request", "response"):
+                    rows = await db._fetchall(
+                        conn,
+                        f"SELECT {column.format(side=side)} AS hash, COUNT(*) AS n "
+                        f"FROM {db._table(schema, table)} "
+                        f"WHERE {column.format(side=side)} IS NOT NULL GROUP BY hash",
+                    )
+                    for row in rows:
+                        refs[row["hash"]] = refs.get(row["hash"], 0) + row["n"]
+        stored = {
+            row["hash"]: row["refcount"]
+            for row in await db._fetchall(conn, "SELECT hash, refcount FROM bodies")
+        }
+    return stored == refs
+
+
+@asynccontextmanager
+async def database(pool_size=4, retention=None, partitioning=False, **writer):
+    """A fresh, empty DatabaseManager.
+
+    ``retention`` overrides the [retention] keys (the background loop is kept
+    idle, tests call enforce_retention), ``writer`` the [writer] keys.
+    ``partitioning`` splits storage into hourly shards.
+    """
+    config["db_type"] = "sqlite"
+    config["sqlite"] = {"pool_size": pool_size}
+    config["retention"] = dict(retention or {}, interval_s=3600)
+    config["partitioning"] = {"enabled": partitioning, "granularity": "hour"}
+    config["writer"] = dict({"batch_size": 500, "batch_interval_ms": 50}, **writer)
+    db = DatabaseManager()
+    try:
+        await db.init_db()
+        await db.clear_all()
+        yield db
+    finally:
+        await db.stop_writer()
+        # 未关闭的连接池会留下 aiosqlite 线程，使测试进程无法退出
+        await db.close_pool()
+
+
+def test_writer_batches_queued_flows():
+    async def run():
+        now = int(time.time() * 1000)
+        async with database(batch_size=16, batch_interval_ms=20) as db:
+            await db.start_writer()
+            await asyncio.gather(*(db.save_request(make_flow(n, now)) for n in range(100)))
+            await db.flush()
+            stats = db.get_writer_stats()
+            assert stats["rows"] == 100
+            assert stats["failed_rows"] == 0
+            assert stats["queue_depth"] == 0
+            # 批量写入：事务数远少于行数，且单批不超过 batch_size
+            assert stats["batches"] <= 100 // 16 + 2
+            assert stats["max_batch_size"] <= 16
+            rows = (await db.get_requests(limit=200))["items"]
+            assert len(rows) == 100
+            assert rows[0]["url"] == "https://api.example.com/items/99?q=1"
+
+    asyncio.run(run())
+
+
+def test_save_without_writer_persists_immediately():
+    async def run():
+        now = int(time.time() * 1000)
+        async with database() as db:
+            await db.save_request(make_flow(1, now, status=404))
+            rows = (await db.get_requests())["items"]
+            assert [row["status"] for row in rows] == ["404 OK"]
+            detail = await db.get_request(rows[0]["id"])
+            assert detail["response"]["body"] == '{"row": 1, "text": "needle haystack"}'
+
+    asyncio.run(run())
+
+
+def test_clear_all_drains_the_queue_first():
+    async def run():
+        now = int(time.time() * 1000)
+        async with database(batch_interval_ms=200) as db:
+            await db.start_writer()
+            for n in range(10):
+                await db.save_request(make_flow(n, now))
+            await db.clear_all()
+            # 清空之前已排队的行先落库再删除，不会在清空后被写回
+            await db.flush()
+            assert (await db.get_requests())["items"] == []
+
+    asyncio.run(run())
+
+
+def test_ids_are_not_reused_after_clear_all():
+    async def run():
+        now = int(time.time() * 1000)
+        async with database() as db:
+            for n in range(3):
+                await db.save_request(make_flow(n, now))
+            used = max(await all_ids(db))
+            await db.clear_all()
+            # 重启后的实例从数据库恢复下一个 id
+            restarted = DatabaseManager()
+            await restarted.init_db()
+            try:
+                await restarted.save_request(make_flow(3, now))
+                assert min(await all_ids(restarted)) > used
+            finally:
+                await restarted.close_pool()
+
+    asyncio.run(run())
+
+
+def test_connections_are_pooled_and_reused():
+    async def run():
+        async with database(pool_size=2) as db:
+            seen = set()
+
+            async def borrow():
+                async with db.get_conn() as conn:
+                    seen.add(id(conn))
+                    await asyncio.sleep(0.01)
+
+            for _ in range(5):
+                await borrow()
+            await asyncio.gather(*(borrow() for _ in range(8)))
+            # 并发借用也只会用到池中的两个连接
+            assert len(seen) == 2
+
+    asyncio.run(run())
+
+
+def test_refresh_config_retires_the_pool_until_init_db():
+    async def run():
+        async with database() as db:
+            old = db._pool
+            db.refresh_config()
+            assert db._pool is None
+            assert db._retired_pools == [("sqlite", old)]
+            await db.init_db()
+            assert db._retired_pools == []
+            assert old._conns == []
+            assert db._pool is not None and db._pool is not old
+
+    asyncio.run(run())
+
+
+def test_wal_readers_are_read_only_and_never_blocked_by_the_writer():
+    async def run():
+        now = int(time.time() * 1000)
+        async with database() as db:
+            await db.save_request(make_flow(1, now))
+            async with db.get_conn() as conn:
+                rows = await (await conn.execute("PRAGMA journal_mode")).fetchall()
+                assert rows[0][0] == "wal"
+                try:
+                    await conn.execute("DELETE FROM requests")
+                except sqlite3.OperationalError as e:
+                    assert "readonly" in str(e)
+                else:
+                    raise AssertionError("reader connection accepted a write")
+            async with db.get_write_conn() as writer:
+                await writer.execute("DELETE FROM requests")
+                # 写事务未提交时，读连接照常读取提交前的快照
+                async with db.get_conn() as conn:
+                    rows = await (await conn.execute("SELECT COUNT(*) FROM requests")).fetchall()
+                    assert rows[0][0] == 1
+
+    asyncio.run(run())
+
+
+def test_checkpoint_copies_the_wal_back():
+    async def run():
+        now = int(time.time() * 1000)
+        async with database() as db:
+            for n in range(20):
+                await db.save_request(make_flow(n, now))
+            result = await db._pool.checkpoint()
+            assert result["busy"] == 0
+            assert result["wal_frames"] > 0
+            assert result["checkpointed_frames"] == result["wal_frames"]
+            assert db._pool.last_checkpoint is result
+
+    asyncio.run(run())
+
+
+def test_legacy_values_parse_into_typed_columns():
+    assert parse_status("404 Not Found") == (404, "Not Found")
+    assert parse_status(200) == (200, "")
+    assert parse_status("oops") == (None, "oops")
+    assert parse_latency("123ms") == 123
+    assert parse_latency(None) is None
+    assert split_url("https://a.example.com:8443/x/y?q=1") == ("https", "a.example.com", "/x/y?q=1")
+    assert split_url("http://b.example.com") == ("http", "b.example.com", "/")
+
+
+def test_host_and_status_filters_use_typed_columns():
+    async def run():
+        now = int(time.time() * 1000)
+        async with database() as db:
+            for n in range(12):
+                host = "a.example.com" if n % 2 else "b.example.com"
+                await db.save_request(make_flow(n, now + n, host=host, status=200 + n * 25))
+            rows = (await db.get_requests(host="a.example.com"))["items"]
+            assert {row["host"] for row in rows} == {"a.example.com"}
+            assert len(rows) == 6
+            rows = (await db.get_requests(status="4xx"))["items"]
+            assert sorted(row["status_code"] for row in rows) == [400, 425, 450, 475]
+            rows = (await db.get_requests(status="450"))["items"]
+            assert [row["status_code"] for row in rows] == [450]
+
+    asyncio.run(run())
+
+
+def test_legacy_rows_are_migrated_on_init():
+    async def run():
+        path = os.path.join(WORKDIR, "legacy.db")
+        conn = sqlite3.connect(path)
+        conn.execute(
+            """
+            CREATE TABLE requests (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                method TEXT, url TEXT, status INTEGER, time TEXT,
+                request_headers TEXT, request_body TEXT, request_cookies TEXT,
+                response_headers TEXT, response_body TEXT, response_cookies TEXT,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        conn.execute(
+            "INSERT INTO requests (method, url, status, time, request_headers, request_body, "
+            "request_cookies, response_headers, response_body, response_cookies, timestamp) "
+            "VALUES ('GET', 'http://old.example.com/a?b=1', '502 Bad Gateway', '87ms', "
+            "'{}', '', '{}', '{}', 'legacy body', '{}', '2024-05-01 10:00:00')"
+        )
+        conn.commit()
+        conn.close()
+
+        config["db_type"] = "sqlite"
+        db_module.DB_PATH, default_path = path, db_module.DB_PATH
+        try:
+            db = DatabaseManager()
+        finally:
+            db_module.DB_PATH = default_path
+        try:
+            await db.init_db()
+            [row] = (await db.get_requests())["items"]
+            assert (row["host"], row["status_code"], row["latency_ms"]) == ("old.example.com", 502, 87)
+            assert row["status"] == "502 Bad Gateway"
+            # SQLite 的 CURRENT_TIMESTAMP 是 UTC
+            assert row["captured_at"] == 1714557600000
+            # 旧的内联正文迁移进主体存储
+            assert (await db.get_request(row["id"]))["response"]["body"] == "legacy body"
+        finally:
+            await db.close_pool()
+
+    asyncio.run(run())
+
+
+def test_running_stats_match_a_rebuild():
+    async def run():
+        now = int(time.time() * 1000)
+        async with database() as db:
+            await db.start_writer()
+            for n in range(40):
+                await db.save_request(make_flow(n, now, status=(200, 302, 404, 500)[n % 4], latency=n))
+            await db.flush()
+            running = await db.get_stats()
+            assert running["total"] == 40
+            assert running["by_class"] == {"2xx": 10, "3xx": 10, "4xx": 10, "5xx": 10}
+            await db.rebuild_stats()
+            assert await db.get_stats() == running
+            await db.clear_all()
+            assert (await db.get_stats())["total"] == 0
+
+    asyncio.run(run())
+
+
+def test_full_text_search_ranks_and_highlights_matches():
+    async def run():
+        now = int(time.time() * 1000)
+        async with database() as db:
+            assert db.fts_enabled
+            for n in range(10):
+                body = '{"text": "plain row %d"}' % n
+                if n in (3, 7):
+                    body = '{"text": "the <b>kangaroo</b> jumped %d"}' % n
+                await db.save_request(make_flow(n, now + n, body=body))
+            hits = (await db.get_requests(query="kangar"))["items"]
+            assert sorted(flow_numbers(hits)) == [3, 7]
+            for hit in hits:
+                assert "<mark>kangar" in hit["snippet"]
+                # 主体中的 HTML 被转义，只保留高亮标记
+                assert "&lt;b&gt;" in hit["snippet"]
+                assert hit["score"] > 0
+            assert (await db.get_requests(query="wombat"))["items"] == []
+
+    asyncio.run(run())
+
+
+def test_literal_mode_matches_substrings_inside_tokens():
+    async def run():
+        now = int(time.time() * 1000)
+        async with database() as db:
+            for n in range(5):
+                await db.save_request(make_flow(n, now + n))
+            # "eedl" 不是完整的词，全文索引找不到，字面量模式按子串匹配
+            assert (await db.get_requests(query="eedl"))["items"] == []
+            assert len((await db.get_requests(query="eedl", mode="literal"))["items"]) == 5
+
+    asyncio.run(run())
+
+
+def test_build_snippet_windows_the_first_hit():
+    text = "x" * 200 + " Needle " + "y" * 200
+    snippet = build_snippet(("https://example.com/", text), ["needle"], width=10)
+    assert snippet == "…" + "x" * 9 + " <mark>Needle</mark> " + "y" * 9 + "…"
+    assert build_snippet(("nothing here",), ["needle"]) == ""
+
+
+def test_cursor_pages_stay_stable_while_rows_arrive():
+    async def run():
+        now = int(time.time() * 1000)
+        async with database() as db:
+            for n in range(25):
+                await db.save_request(make_flow(n, now + n))
+            first = await db.get_requests(limit=10)
+            assert flow_numbers(first["items"]) == list(range(24, 14, -1))
+            # 翻页期间新抓到的行不会让后续页重复或跳过
+            for n in range(25, 30):
+                await db.save_request(make_flow(n, now + n))
+            second = await db.get_requests(limit=10, cursor=first["next_cursor"])
+            assert flow_numbers(second["items"]) == list(range(14, 4, -1))
+            newer = await db.get_requests(limit=10, cursor=first["prev_cursor"])
+            assert sorted(flow_numbers(newer["items"])) == list(range(25, 30))
+            ids = await all_ids(db, limit=7)
+            assert len(ids) == len(set(ids)) == 30
+            assert ids == sorted(ids, reverse=True)
+
+    asyncio.run(run())
+
+
+def test_ranked_search_pages_from_a_snapshot():
+    async def run():
+        now = int(time.time() * 1000)
+        async with database() as db:
+            for n in range(12):
+                await db.save_request(make_flow(n, now + n))
+            first = await db.get_requests(limit=5, query="needle")
+            await db.save_request(make_flow(12, now + 12))
+            # 游标固定了首屏时的最大 id，新行不会插入到后续页中
+            ids = [item["id"] for item in first["items"]]
+            page = first
+            while page["next_cursor"]:
+                page = await db.get_requests(limit=5, query="needle", cursor=page["next_cursor"])
+                ids.extend(item["id"] for item in page["items"])
+            assert len(ids) == len(set(ids)) == 12
+            assert first["prev_cursor"] is None
+
+    asyncio.run(run())
+
+
+def test_list_rows_are_summaries_and_detail_loads_the_flow():
+    async def run():
+        now = int(time.time() * 1000)
+        async with database() as db:
+            await db.save_request(make_flow(1, now, body="kangaroo"))
+            (row,) = (await db.get_requests())["items"]
+            # 列表只返回摘要列，请求头和正文按需从详情接口加载
+            assert "request" not in row and "response" not in row
+            assert row["host"] == "api.example.com" and row["status"] == "200 OK"
+            detail = await db.get_request(row["id"])
+            assert detail["response"]["body"] == "kangaroo"
+            assert detail["url"] == row["url"]
+            assert await db.get_request(row["id"] + 1000) is None
+
+    asyncio.run(run())
+
+
+def test_bodies_are_stored_once_and_compressed():
+    async def run():
+        now = int(time.time() * 1000)
+        big = '{"items": [%s]}' % ", ".join(['"repeated entry"'] * 200)
+        async with database() as db:
+            for n in range(3):
+                await db.save_request(make_flow(n, now + n, body=big))
+            await db.save_request(make_flow(3, now + 3, body="tiny"))
+            conn = sqlite3.connect(db_module.DB_PATH)
+            try:
+                rows = conn.execute("SELECT size, codec, length(data), refcount FROM bodies").fetchall()
+            finally:
+                conn.close()
+            # 相同正文只存一份，小正文不压缩，可压缩的大正文以 zlib 存储
+            by_size = {size: (codec, stored, refs) for size, codec, stored, refs in rows}
+            # 旧版 SQLite 上索引文本也存入 bodies，UTF-8 正文与其索引文本共用一份
+            per_row = 2 if db.fts_text_refs else 1
+            codec, stored, refs = by_size[len(big)]
+            assert (codec, refs) == ("zlib", 3 * per_row) and stored < len(big) // 4
+            assert by_size[4] == ("raw", 4, per_row)
+            for item in (await db.get_requests())["items"]:
+                detail = await db.get_request(item["id"])
+                assert detail["response"]["body"] == ("tiny" if flow_numbers([item]) == [3] else big)
+
+    asyncio.run(run())
+
+
+def test_raw_bodies_are_decoded_when_viewed():
+    async def run():
+        now = int(time.time() * 1000)
+        text = '{"greeting": "grüße aus dem känguru-gehege", "pad": "%s"}' % ("x" * 200)
+        async with database() as db:
+            await db.save_request(
+                make_flow(1, now, body=gzip.compress(text.encode()), content_encoding="gzip")
+            )
+            await db.save_request(
+                make_flow(2, now + 1, body=b"\x89PNG\r\n\x1a\n\x00\xff", content_type="image/png")
+            )
+            ids = {flow_numbers([item])[0]: item["id"] for item in (await db.get_requests())["items"]}
+            # 保存的是线上的原始字节，查看详情时才解压并按字符集解码
+            response = (await db.get_request(ids[1]))["response"]
+            assert response["body"] == text and not response["binary"]
+            assert response["raw_size"] < response["size"] == len(text.encode())
+            binary = (await db.get_request(ids[2]))["response"]
+            assert binary["binary"] and binary["body"] == ""
+            # 全文索引与字面量搜索都能看到压缩正文中的文本
+            assert flow_numbers((await db.get_requests(query="gehege"))["items"]) == [1]
+            assert flow_numbers((await db.get_requests(query="guru-ge", mode="literal"))["items"]) == [1]
+
+    asyncio.run(run())
+
+
+def test_retention_age_uses_captured_at():
+    async def run():
+        now = int(time.time() * 1000)
+        async with database(retention={"max_age_hours": 1}) as db:
+            # 后写入的旧流量 id 更大，但 captured_at 早于截止时间
+            for n in range(5):
+                await db.save_request(make_flow(n, now - 60_000))
+            for n in range(5, 10):
+                await db.save_request(make_flow(n, now - 3 * HOUR_MS))
+            for n in range(10, 12):
+                await db.save_request(make_flow(n, now))
+
+            result = await db.enforce_retention()
+
+            assert result["deleted_rows"] == 5
+            items = (await db.get_requests(limit=50))["items"]
+            assert sorted(flow_numbers(items)) == [0, 1, 2, 3, 4, 10, 11]
+            assert db.stats.total == 7
+            assert await body_refcounts_consistent(db)
+            # 被剪除的行也从全文索引中移除
+            hits = (await db.get_requests(query="needle"))["items"]
+            assert sorted(flow_numbers(hits)) == [0, 1, 2, 3, 4, 10, 11]
+
+    asyncio.run(run())
+
+
+def test_retention_row_limit_keeps_the_newest_rows():
+    async def run():
+        now = int(time.time() * 1000)
+        async with database(retention={"max_rows": 25, "chunk_size": 7}) as db:
+            for n in range(80):
+                await db.save_request(make_flow(n, now + n, status=(200, 404)[n % 2]))
+
+            await db.enforce_retention()
+
+            ids = await all_ids(db, limit=50)
+            assert len(ids) == 25
+            items = (await db.get_requests(limit=50))["items"]
+            assert sorted(flow_numbers(items)) == list(range(55, 80))
+            assert await body_refcounts_consistent(db)
+            # 剪除时同步扣减的统计与重建结果一致
+            running = await db.get_stats()
+            await db.rebuild_stats()
+            assert await db.get_stats() == running
+
+    asyncio.run(run())
+
+
+def test_retention_body_limit_frees_stored_bytes():
+    async def run():
+        now = int(time.time() * 1000)
+        async with database(retention={"max_body_mb": 0.02, "chunk_size": 5}) as db:
+            for n in range(40):
+                await db.save_request(
+                    make_flow(n, now + n, body=os.urandom(2048), content_type="application/octet-stream")
+                )
+
+            result = await db.enforce_retention()
+
+            body_bytes, index_bytes = await db._body_bytes()
+            assert body_bytes + index_bytes <= 0.02 * 1024 * 1024
+            assert result["freed_body_bytes"] >= 2048 * result["deleted_rows"]
+            items = (await db.get_requests(limit=50))["items"]
+            # 剪除的总是最旧的行
+            assert sorted(flow_numbers(items)) == list(range(40 - len(items), 40))
+            assert await body_refcounts_consistent(db)
+
+    asyncio.run(run())
+
+
+def test_free_pages_are_kept_without_incremental_auto_vacuum():
+    async def run():
+        async with database(retention={"vacuum_pages": 16}) as db:
+            async with db.get_write_conn() as conn:
+                # 旧库: 未启用 auto_vacuum
+                await conn.execute("PRAGMA auto_vacuum = NONE")
+                await conn.execute("VACUUM")
+                await conn.execute("CREATE TABLE filler (data BLOB)")
+                await conn.executemany("INSERT INTO filler VALUES (?)", [(os.urandom(4096),)] * 50)
+                await conn.commit()
+                await conn.execute("DROP TABLE filler")
+                await conn.commit()
+            statements = []
+            fetchall = db._fetchall
+
+            async def recording(conn, sql, *args):
+                statements.append(sql)
+                return await fetchall(conn, sql, *args)
+
+            db._fetchall = recording
+            await db._reclaim_free_pages()
+            assert not any("incremental_vacuum" in sql for sql in statements)
+
+            # 转换为增量 auto_vacuum 后空闲页逐步归还
+            async with db.get_write_conn() as conn:
+                await conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                await conn.execute("VACUUM")
+                await conn.execute("CREATE TABLE filler (data BLOB)")
+                await conn.executemany("INSERT INTO filler VALUES (?)", [(os.urandom(4096),)] * 50)
+                await conn.commit()
+                await conn.execute("DROP TABLE filler")
+                await conn.commit()
+            await db._reclaim_free_pages()
+            assert any("incremental_vacuum" in sql for sql in statements)
+            async with db.get_write_conn() as conn:
+                rows = await fetchall(conn, "PRAGMA freelist_count")
+            assert rows[0]["freelist_count"] == 0
+
+    asyncio.run(run())
+
+
+def test_retention_drops_expired_partitions():
+    async def run():
+        now = int(time.time() * 1000)
+        async with database(retention={"max_age_hours": 2}, partitioning=True) as db:
+            flows = [make_flow(n, now - (5 - n // 10) * HOUR_MS) for n in range(60)]
+            for flow in flows:
+                await db.save_request(flow)
+            shards_before = set(db.partitions.partitions)
+
+            await db.enforce_retention()
+
+            kept = [f for f in flows if f["captured_at"] >= now - 2 * HOUR_MS]
+            assert await count_rows(db) == len(kept)
+            assert db.stats.total == len(kept)
+            # 整个过期的分片直接删除文件，而不是逐行删除
+            dropped = shards_before - set(db.partitions.partitions)
+            assert len(dropped) >= 3
+            for name in dropped:
+                assert not os.path.exists(db._shard_path(name))
+            assert await body_refcounts_consistent(db)
+            running = await db.get_stats()
+            await db.rebuild_stats()
+            assert await db.get_stats() == running
+
+    asyncio.run(run())
+
+
+def test_running_stats_match_a_rebuild_after_pruning():
+    async def run():
+        now = int(time.time() * 1000)
+        retention = {"max_age_hours": 2, "max_rows": 20}
+        async with database(retention=retention, partitioning=True) as db:
+            flows = [
+                make_flow(
+                    n,
+                    now - (4 - n // 10) * HOUR_MS + n,
+                    host=f"h{n % 4}.example.com",
+                    status=(200, 404, 503)[n % 3],
+                    latency=n * 7 % 300,
+                )
+                for n in range(50)
+            ]
+            assert await db.bulk_insert(flows) == 50
+            await db.rebuild_stats()
+
+            await db.enforce_retention()
+            running = db.stats.state()
+            by_host = db.stats.latency_percentiles(by="host")
+            await db.rebuild_stats()
+
+            # 删除分片与逐行删除都从延迟分布中减去对应的样本
+            assert running == db.stats.state()
+            assert by_host == db.stats.latency_percentiles(by="host")
+
+    asyncio.run(run())
+
+
+def test_retention_row_limit_across_partitions():
+    async def run():
+        now = int(time.time() * 1000)
+        async with database(retention={"max_rows": 25, "chunk_size": 7}, partitioning=True) as db:
+            flows = [make_flow(n, now - (3 - n // 20) * HOUR_MS + n) for n in range(80)]
+            for flow in flows:
+                await db.save_request(flow)
+
+            await db.enforce_retention()
+
+            items = (await db.get_requests(limit=50))["items"]
+            # 保留的是最新的 25 行
+            assert sorted(flow_numbers(items)) == list(range(55, 80))
+            assert await body_refcounts_consistent(db)
+
+    asyncio.run(run())
+
+
+def test_cursor_paging_across_shards():
+    async def run():
+        now = int(time.time() * 1000)
+        async with database(partitioning=True) as db:
+            for n in range(30):
+                await db.save_request(make_flow(n, now - (n % 3) * HOUR_MS + n))
+            assert len(db._sources()) >= 3
+
+            ids = await all_ids(db, limit=7)
+            assert len(ids) == 30
+            assert ids == sorted(ids, reverse=True)
+
+            # 反向翻页回到第一页
+            first = await db.get_requests(limit=7)
+            second = await db.get_requests(limit=7, cursor=first["next_cursor"])
+            back = await db.get_requests(limit=7, cursor=second["prev_cursor"])
+            assert [i["id"] for i in back["items"]] == [i["id"] for i in first["items"]]
+
+            # 全文检索的结果同样可以跨分片完整翻页
+            found = await all_ids(db, limit=4, query="needle")
+            assert sorted(found) == sorted(ids)
+            literal = await all_ids(db, limit=4, query="needle", mode="literal")
+            assert sorted(literal) == sorted(ids)
+            for request_id in ids[:3]:
+                assert (await db.get_request(request_id))["id"] == request_id
+
+    asyncio.run(run())
+
+
+async def collect(chunks):
+    return "".join([chunk async for chunk in chunks])
+
+
+def test_har_export_streams_decoded_entries_oldest_first():
+    async def run():
+        now = int(time.time() * 1000)
+        png = b"\x89PNG\r\n\x1a\n\x00\xff"
+        async with database(partitioning=True) as db:
+            db.export_batch_rows = 2
+            await db.save_request(make_flow(0, now - 2 * HOUR_MS))
+            await db.save_request(
+                make_flow(1, now - HOUR_MS, body=gzip.compress(b"hello gzip"), content_encoding="gzip")
+            )
+            await db.save_request(make_flow(2, now, body=png, content_type="image/png"))
+            await db.save_request(make_flow(3, now + 1, host="other.example.com"))
+
+            har = json.loads(await collect(stream_har(db.export_rows())))
+            entries = har["log"]["entries"]
+            assert har["log"]["version"] == "1.2"
+            assert [e["request"]["url"] for e in entries] == [
+                f"https://{host}/items/{n}?q=1"
+                for n, host in enumerate(["api.example.com"] * 3 + ["other.example.com"])
+            ]
+            first = entries[0]
+            assert first["request"]["postData"]["text"] == '{"query": 0}'
+            assert {"name": "q", "value": "1"} in first["request"]["queryString"]
+            # 导出的是解除 Content-Encoding 后的内容，二进制内容按 base64 输出
+            assert entries[1]["response"]["content"]["text"] == "hello gzip"
+            binary = entries[2]["response"]["content"]
+            assert binary["encoding"] == "base64" and base64.b64decode(binary["text"]) == png
+
+            lines = (await collect(stream_ndjson(db.export_rows(host="other.example.com")))).splitlines()
+            assert [json.loads(line)["request"]["url"] for line in lines] == [
+                "https://other.example.com/items/3?q=1"
+            ]
+            since = (await collect(stream_ndjson(db.export_rows(since=now - 1000)))).splitlines()
+            assert len(since) == 2
+
+    asyncio.run(run())
+
+
+def test_export_releases_the_reader_between_pages():
+    async def run():
+        now = int(time.time() * 1000)
+        async with database(pool_size=1) as db:
+            db.export_batch_rows = 3
+            for n in range(7):
+                await db.save_request(make_flow(n, now + n))
+            pages = db.export_rows()
+            first = await anext(pages)
+            # 唯一的读连接已归还，导出进行中其他查询不会被阻塞
+            listed = await asyncio.wait_for(db.get_requests(limit=50), 2)
+            assert len(listed["items"]) == 7
+            # 导出开始之后提交的行不在本次导出中
+            await db.save_request(make_flow(7, now + 7))
+            rest = [row async for page in pages for row in page]
+            assert [row["id"] for row in first + rest] == sorted(await all_ids(db))[:7]
+
+    asyncio.run(run())
+
+
+def test_har_export_import_round_trip():
+    async def run():
+        now = int(time.time() * 1000)
+        bodies = [None, "unicode ✓ 中文".encode(), bytes(range(256)) * 4, b""]
+        flows = [
+            make_flow(n, now - n * 1000, body=bodies[n % len(bodies)], status=(200, 404)[n % 2])
+            for n in range(12)
+        ]
+        path = os.path.join(WORKDIR, "round-trip.har")
+        async with database() as db:
+            assert await db.bulk_insert(flows) == 12
+            originals = [await db.get_request(i) for i in await all_ids(db, limit=50)]
+            stats = await db.get_stats()
+
+            with open(path, "w", encoding="utf-8") as f:
+                async for chunk in stream_har(db.export_rows()):
+                    f.write(chunk)
+            await db.clear_all()
+
+            job = ImportJob(path)
+            assert job.format == "har"
+            await run_import(job, db, workers=0)
+            assert job.status == "done", job.error
+            assert job.imported == 12 and job.failed == 0
+
+            imported = [await db.get_request(i) for i in await all_ids(db, limit=50)]
+            # 导入的行同样计入运行中的统计
+            assert await db.get_stats() == stats
+
+        key = lambda d: d["url"]  # noqa: E731
+        assert len(imported) == len(originals)
+        for before, after in zip(sorted(originals, key=key), sorted(imported, key=key)):
+            for field in ("method", "url", "host", "status_code", "latency_ms", "captured_at"):
+                assert after[field] == before[field], field
+            for side in ("request", "response"):
+                assert after[side]["body"] == before[side]["body"], side
+
+    asyncio.run(run())
+
+
+def test_follower_sees_shards_created_and_dropped_by_the_writer():
+    async def run():
+        now = int(time.time() * 1000)
+        async with database(retention={"max_age_hours": 2}, partitioning=True) as db:
+            await db.save_request(make_flow(0, now))
+            follower = DatabaseManager()
+            await follower.open_follower()
+            try:
+                # 写入进程新建了更早时段的分片
+                for n in range(1, 4):
+                    await db.save_request(make_flow(n, now - 5 * HOUR_MS))
+                assert len(await all_ids(follower)) == 1
+                await follower.refresh_partitions()
+                assert sorted(await all_ids(follower)) == sorted(await all_ids(db))
+
+                await db.enforce_retention()
+                await follower.refresh_partitions()
+                assert set(follower.partitions.partitions) == set(db.partitions.partitions)
+                assert flow_numbers((await follower.get_requests())["items"]) == [0]
+            finally:
+                await follower.close_pool()
+
+    asyncio.run(run())
+
+
+def test_follower_opens_readers_only_and_applies_the_writer_state():
+    async def run():
+        now = int(time.time() * 1000)
+        async with database(batch_interval_ms=200) as db:
+            await db.save_request(make_flow(0, now))
+            follower = DatabaseManager()
+            await follower.open_follower()
+            try:
+                assert follower._pool.writer is None and follower.fts_enabled
+                try:
+                    async with follower.get_write_conn():
+                        raise AssertionError("a follower must not borrow a writer")
+                except RuntimeError:
+                    pass
+
+                await db.save_request(make_flow(1, now))
+                await db.start_writer()
+                pending = await db.save_request(make_flow(2, now))
+                # 排队中的行在写入进程之外查不到，工作进程应转发详情请求
+                state = json.loads(json.dumps(db.writer_state()))
+                assert state["uncommitted_from"] == pending
+                follower.follow_writer(state)
+                assert await follower.get_request(pending) is None
+                assert follower.may_be_uncommitted(pending)
+                assert not follower.may_be_uncommitted(pending - 1)
+                # 主库的 id 范围与统计随写入状态更新，无需重新扫描
+                assert follower.partitions.get("main").max_id == pending - 1
+                assert follower.stats.ready and follower.stats.total == 2
+
+                await db.flush()
+                follower.follow_writer(db.writer_state())
+                assert follower.partitions.get("main").to_dict() == db.partitions.get("main").to_dict()
+                assert follower.uncommitted_from == pending + 1
+                assert (await follower.get_request(pending))["url"].endswith("/items/2?q=1")
+            finally:
+                await follower.close_pool()
+
+    asyncio.run(run())